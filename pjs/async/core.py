@@ -50,6 +50,9 @@ import select
 import socket
 import sys
 import time
+import heapq
+import itertools
+import logging
 
 import pjs.utils
 import pjs.queues
@@ -112,6 +115,9 @@ def poll(timeout=0.0, map=None):
     # pick up results from Messages and process queued
     pjs.queues.pickupResults()
 
+    # don't sleep past the next timer
+    timeout = timerTimeout(timeout)
+
     if map is None:
         map = socket_map
     if map:
@@ -157,10 +163,15 @@ def poll(timeout=0.0, map=None):
     if func_map:
         funcCheck()
 
+    if _timers:
+        runTimers()
+
 def poll2(timeout=0.0, map=None):
     # Use the poll() support added to the select module in Python 2.0
     if map is None:
         map = socket_map
+    # don't sleep past the next timer
+    timeout = timerTimeout(timeout)
     if timeout is not None:
         # timeout is in milliseconds
         timeout = int(timeout*1000)
@@ -196,6 +207,9 @@ def poll2(timeout=0.0, map=None):
     if func_map:
         funcCheck()
 
+    if _timers:
+        runTimers()
+
 poll3 = poll2                           # Alias for backward compatibility
 
 def funcCheck():
@@ -209,7 +223,10 @@ def funcCheck():
         try:
             ret = f.func(**f.funcArgs)
         except Exception, e:
+            # the function isn't watched any more
+            del func_map[f]
             cb(e)
+            continue
 
         if ret:
             cb()
@@ -259,6 +276,64 @@ def wf(self, checkFunc, cb, initFunc=None):
 
     func_map[checkFunc] = cb
 
+### ====== ###
+### Timers ###
+### ====== ###
+
+# Scheduled Timers. This is a heap of (time due, sequence number, Timer).
+# The sequence number keeps timers due at the same time in the order they
+# were scheduled.
+_timers = []
+_timerSeq = itertools.count()
+
+class Timer:
+    """A function scheduled to run from the main loop. See callLater()."""
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevents the function from running if it hasn't already"""
+        self.cancelled = True
+
+def callLater(delay, func, *args):
+    """Runs func(*args) from the main loop after delay seconds. Returns a
+    Timer that can be cancelled. This is for timeouts and other delayed work
+    that shouldn't tie up a thread in the pools.
+    """
+    timer = Timer(time.time() + delay, func, args)
+    heapq.heappush(_timers, (timer.when, _timerSeq.next(), timer))
+    return timer
+
+def timerTimeout(timeout):
+    """Returns the timeout for select/poll, shortened so that we wake up in
+    time for the next timer.
+    """
+    while _timers and _timers[0][2].cancelled:
+        heapq.heappop(_timers)
+    if _timers:
+        wait = max(0.0, _timers[0][0] - time.time())
+        if timeout is None or wait < timeout:
+            return wait
+    return timeout
+
+def runTimers():
+    """Runs all timers that are due"""
+    now = time.time()
+    while _timers and _timers[0][0] <= now:
+        when, seq, timer = heapq.heappop(_timers)
+        if timer.cancelled:
+            continue
+        timer.cancelled = True
+        try:
+            timer.func(*timer.args)
+        except Exception, e:
+            nil, t, v, tbinfo = compact_traceback()
+            logging.warning("[runTimers] Exception in timer %s: %s: %s -- %s",
+                            timer.func, t, v, tbinfo)
+
 class dispatcher:
 
     debug = False
@@ -513,13 +588,17 @@ class dispatcher_with_send(dispatcher):
 
     watch_function = wf
 
+    # the most we try to write into the socket at once. batched output
+    # (eg. S2S queues) needs this to be large.
+    send_size = 65536
+
     def __init__(self, sock=None, map=None):
         dispatcher.__init__(self, sock, map)
         self.out_buffer = ''
 
     def initiate_send(self):
         num_sent = 0
-        num_sent = dispatcher.send(self, self.out_buffer[:512])
+        num_sent = dispatcher.send(self, self.out_buffer[:self.send_size])
         self.out_buffer = self.out_buffer[num_sent:]
 
     def handle_write(self):
@@ -5,9 +5,14 @@
 
 import binascii
 import base64
+import hmac
+import os
 import re
 
-from pjs.db import DBautocommit
+import pjs.scram
+
+from pjs.procpool import runInline
+from pjs.storage.base import getStorage
 from pjs.utils import generateId
 from pjs.elementtree.ElementTree import Element
 from pjs.jid import JID
@@ -72,13 +77,50 @@ def KD(k, s):
     """
     return H('%s:%s' % (k, s))
 
+def digestResponse(username, realm, password, nonce, cnonce, nc, digestUri):
+    """Returns the response the client should send in DIGEST-MD5 and our
+    rspauth as per RFC 2831. Only uses its arguments, so that it can run in
+    the process pool (see pjs.procpool).
+    """
+    a1 = "%s:%s:%s" % (H("%s:%s:%s" % (username, realm, password)),
+                       nonce, cnonce)
+    a2 = ":%s" % digestUri
+    a2client = "AUTHENTICATE:%s" % digestUri
+
+    digest = HEX(KD(HEX(H(a1)),
+                    "%s:%s:%s:%s:%s" % (nonce, nc,
+                                          cnonce, "auth",
+                                          HEX(H(a2client)))))
+    rspauth = HEX(KD(HEX(H(a1)),
+                     "%s:%s:%s:%s:%s" % (nonce, nc,
+                                           cnonce, "auth",
+                                           HEX(H(a2)))))
+    return digest, rspauth
+
+def scramVerify(mechanism, storedKey, serverKey, authMessage, proof):
+    """Returns the ServerSignature of a SCRAM exchange or None if the
+    client's proof is wrong (RFC 5802). Like digestResponse(), it only uses
+    its arguments.
+    """
+    hash = pjs.scram.HASHES[mechanism]
+    clientSignature = hmac.new(storedKey, authMessage, hash).digest()
+    if len(proof) != len(clientSignature):
+        return None
+    clientKey = ''.join([chr(ord(x) ^ ord(y))
+                         for x, y in zip(proof, clientSignature)])
+    if hash(clientKey).digest() != storedKey:
+        return None
+    return hmac.new(serverKey, authMessage, hash).digest()
+
 class SASLPlain:
     """Implements the SASL PLAIN authentication mechanism"""
     def __init__(self, msg):
         self.msg = msg
 
-    def handle(self, b64text):
-        """Verify the username/password in response"""
+    def handle(self, b64text, execute=runInline):
+        """Verify the username/password in response. execute isn't used,
+        since there's nothing to hash.
+        """
         authtext = ''
         if b64text:
             try:
@@ -91,18 +133,10 @@ class SASLPlain:
             if len(auth) != 3:
                 raise SASLIncorrectEncodingError
 
-            con = DBautocommit()
-            c = con.cursor()
-            c.execute("SELECT * FROM jids WHERE \
-                jid = ? AND password = ?", (auth[1] + \
-                                            '@' + self.msg.conn.server.hostname, auth[2]))
-            res = c.fetchall()
-            if len(res) == 0:
-                c.close()
-                con.close()
+            password = getStorage().getPassword(auth[1] + '@' + \
+                                                self.msg.conn.server.hostname)
+            if password is None or password != auth[2]:
                 raise SASLAuthError
-            c.close()
-            con.close()
 
         self.msg.conn.data['sasl']['complete'] = True
         self.msg.conn.data['sasl']['in-progress'] = False
@@ -111,6 +145,8 @@ class SASLPlain:
         # record the JID for local delivery
         self.msg.conn.server.conns[self.msg.conn.id] = (JID(self.msg.conn.data['user']['jid']),
                                                         self.msg.conn)
+        self.msg.conn.server.sessions.authenticate(self.msg.conn,
+                                                   self.msg.conn.data['user']['jid'])
 
         self.msg.conn.parser.resetParser()
 
@@ -145,12 +181,14 @@ class SASLDigestMD5:
         self.failures = 0
         self.state = SASLDigestMD5.INIT
 
-    def handle(self, data=None):
+    def handle(self, data=None, execute=runInline):
         """Performs DIGEST-MD5 auth based on current state.
 
         data -- either None for initial challenge, base64-encoded text when
                 the client responds to challenge 1, or the tree when the client
                 responds to challenge 2.
+        execute -- called as execute(func, *args) to compute the digests. See
+                   pjs.procpool.getExecutor().
         """
 
         # TODO: authz
@@ -203,38 +241,17 @@ class SASLDigestMD5:
                 raise SASLAuthError
 
             # fetch the password now
-            con = DBautocommit()
-            c = con.cursor()
-            c.execute("SELECT password FROM jids WHERE \
-                jid = ?", (username + '@%s' % self.msg.conn.server.hostname,))
-            for row in c:
-                password = row['password']
-                break
-            else:
+            password = getStorage().getPassword(username + '@%s' % \
+                                                self.msg.conn.server.hostname)
+            if password is None:
                 self._handleFailure()
-                c.close()
-                con.close()
                 raise SASLAuthError
-            c.close()
-            con.close()
 
             # compute the digest as per RFC 2831
-            a1 = "%s:%s:%s" % (H("%s:%s:%s" % (username, realm, password)),
-                               nonce, cnonce)
-            a2 = ":%s" % digest_uri
-            a2client = "AUTHENTICATE:%s" % digest_uri
-
-            digest = HEX(KD(HEX(H(a1)),
-                            "%s:%s:%s:%s:%s" % (nonce, nc,
-                                                  cnonce, "auth",
-                                                  HEX(H(a2client)))))
+            digest, rspauth = execute(digestResponse, username, realm,
+                                      password, nonce, cnonce, nc, digest_uri)
 
             if digest == response:
-                rspauth = HEX(KD(HEX(H(a1)),
-                                 "%s:%s:%s:%s:%s" % (nonce, nc,
-                                                       cnonce, "auth",
-                                                       HEX(H(a2)))))
-
                 self.state = SASLDigestMD5.SENT_CHALLENGE2
 
                 res = Element('challenge',
@@ -260,6 +277,8 @@ class SASLDigestMD5:
                 # record the JID for local delivery
                 self.msg.conn.server.conns[self.msg.conn.id] = (JID(d['user']['jid']),
                                                                 self.msg.conn)
+                self.msg.conn.server.sessions.authenticate(self.msg.conn,
+                                                           d['user']['jid'])
 
                 self.msg.conn.parser.resetParser()
 
@@ -324,31 +343,185 @@ class SASLDigestMD5:
             self.failures = 0
             self.state = SASLDigestMD5.INIT
 
+class SASLScram:
+    """Implements the SASL SCRAM-SHA-1 and SCRAM-SHA-256 authentication
+    mechanisms (RFC 5802, RFC 7677) with the keys of pjs.scram. Channel
+    binding isn't supported. Stores state of the authentication, so should
+    be saved between requests.
+    """
+
+    # states
+    INIT = 0
+    SENT_CHALLENGE = 1
+
+    def __init__(self, msg, mechanism):
+        """msg -- the Message object.
+        mechanism -- 'SCRAM-SHA-1' or 'SCRAM-SHA-256'.
+        """
+        self.msg = msg
+        self.mechanism = mechanism
+        self.hash = pjs.scram.HASHES[mechanism]
+        self.state = SASLScram.INIT
+        self.username = None
+        self.nonce = None
+        self.keys = None
+        # True if the user doesn't exist and self.keys are made up
+        self.unknown = False
+        self.gs2Header = None
+        self.clientFirstBare = None
+        self.serverFirst = None
+
+    def handle(self, data=None, execute=runInline):
+        """Performs SCRAM auth based on current state.
+
+        data -- base64-encoded client-first-message, which may come with
+                the <auth>, or the client-final-message.
+        execute -- called as execute(func, *args) to verify the client's
+                   proof. See pjs.procpool.getExecutor().
+        """
+        try:
+            text = ''
+            if data and data != '=':
+                text = fromBase64(data)
+        except:
+            self.state = SASLScram.INIT
+            raise SASLIncorrectEncodingError
+
+        if self.state == SASLScram.INIT:
+            if not text:
+                # the client sends its first message in a response
+                res = Element('challenge',
+                              {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-sasl'})
+                res.text = ''
+                return res
+            return self._handleClientFirst(text)
+        elif self.state == SASLScram.SENT_CHALLENGE:
+            self.state = SASLScram.INIT
+            return self._handleClientFinal(text, execute)
+        else:
+            self.state = SASLScram.INIT
+            raise SASLAuthError
+
+    def _handleClientFirst(self, text):
+        """Checks the client-first-message and returns the challenge with
+        the server-first-message
+        """
+        # gs2-cbind-flag, authzid, client-first-message-bare
+        parts = text.split(',', 2)
+        if len(parts) != 3:
+            raise SASLIncorrectEncodingError
+        cbind, authzid, bare = parts
+        if cbind not in ('n', 'y'):
+            # channel binding isn't supported
+            raise SASLAuthError
+
+        attrs = self._parseAttributes(bare)
+        if 'm' in attrs or 'n' not in attrs or not attrs.get('r'):
+            raise SASLIncorrectEncodingError
+
+        username = attrs['n'].replace('=2C', ',').replace('=3D', '=')
+        hostname = self.msg.conn.server.hostname
+        jid = '%s@%s' % (username, hostname)
+        if authzid and authzid != 'a=' + jid:
+            raise SASLInvalidAuthzError
+
+        # unknown users get a challenge as well and fail with the proof, so
+        # as not to tell which accounts exist (RFC 5802 #9)
+        self.keys = pjs.scram.getKeys(jid, self.mechanism)
+        self.unknown = self.keys is None
+        if self.unknown:
+            self.keys = pjs.scram.getMockKeys(jid, self.mechanism)
+
+        salt, iterations = self.keys[:2]
+        self.username = username
+        self.nonce = attrs['r'] + self._makeNonce()
+        self.gs2Header = '%s,%s,' % (cbind, authzid)
+        self.clientFirstBare = bare
+        self.serverFirst = 'r=%s,s=%s,i=%d' % (self.nonce, b64encode(salt),
+                                               iterations)
+        self.state = SASLScram.SENT_CHALLENGE
+
+        res = Element('challenge',
+                      {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-sasl'})
+        res.text = b64encode(self.serverFirst)
+        return res
+
+    def _handleClientFinal(self, text, execute):
+        """Verifies the client's proof and returns the <success> with the
+        server's signature
+        """
+        # the proof is the last attribute and isn't part of AuthMessage
+        index = text.rfind(',p=')
+        if index == -1:
+            raise SASLIncorrectEncodingError
+        withoutProof = text[:index]
+        attrs = self._parseAttributes(withoutProof)
+        try:
+            proof = fromBase64(text[index + 3:])
+        except:
+            raise SASLIncorrectEncodingError
+
+        if attrs.get('r') != self.nonce or \
+           attrs.get('c') != b64encode(self.gs2Header):
+            raise SASLAuthError
+
+        salt, iterations, storedKey, serverKey = self.keys
+        authMessage = ','.join([self.clientFirstBare, self.serverFirst,
+                                withoutProof])
+        serverSignature = execute(scramVerify, self.mechanism, storedKey,
+                                  serverKey, authMessage, proof)
+        if serverSignature is None or self.unknown:
+            raise SASLAuthError
+
+        d = self.msg.conn.data
+        d['sasl']['complete'] = True
+        d['sasl']['in-progress'] = False
+        d['user']['jid'] = '%s@%s' % (self.username,
+                                      self.msg.conn.server.hostname)
+
+        # record the JID for local delivery
+        self.msg.conn.server.conns[self.msg.conn.id] = (JID(d['user']['jid']),
+                                                        self.msg.conn)
+        self.msg.conn.server.sessions.authenticate(self.msg.conn,
+                                                   d['user']['jid'])
+
+        self.msg.conn.parser.resetParser()
+
+        res = Element('success',
+                      {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-sasl'})
+        res.text = b64encode('v=' + b64encode(serverSignature))
+        return res
+
+    def _makeNonce(self):
+        """Returns the server's part of the nonce"""
+        return b64encode(os.urandom(18))
+
+    def _parseAttributes(self, text):
+        """Parses the comma-separated attr=value pairs of a SCRAM message"""
+        attrs = {}
+        for part in text.split(','):
+            if len(part) < 2 or part[1] != '=':
+                raise SASLIncorrectEncodingError
+            attrs[part[0]] = part[2:]
+        return attrs
+
 class IQAuthPlain:
     """Handles the old-style jabber:iq:auth plaintext auth"""
     def __init__(self, msg):
         self.msg = msg
 
     def handle(self, username, password):
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT password FROM jids WHERE \
-            jid = ?", (username + '@%s' % self.msg.conn.server.hostname,))
-        res = c.fetchone()
-        if res:
-            password = res[0]
-        else:
-            c.close()
-            con.close()
+        stored = getStorage().getPassword(username + '@%s' % \
+                                          self.msg.conn.server.hostname)
+        if stored is None or stored != password:
             raise IQAuthError
-        c.close()
-        con.close()
 
         d = self.msg.conn.data
         d['user']['jid'] = '%s@%s' % (username, self.msg.conn.server.hostname)
         # record the JID for local delivery
         self.msg.conn.server.conns[self.msg.conn.id] = (JID(d['user']['jid']),
                                                         self.msg.conn)
+        self.msg.conn.server.sessions.authenticate(self.msg.conn, d['user']['jid'])
 
         self.msg.conn.parser.resetParser()
 
@@ -358,19 +531,10 @@ class IQAuthDigest:
         self.msg = msg
         self.streamid = msg.conn.data['stream']['id']
     def handle(self, username, digest):
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT password FROM jids WHERE \
-            jid = ?", (username + '@%s' % self.msg.conn.server.hostname,))
-        res = c.fetchone()
-        if res:
-            password = res[0]
-        else:
-            c.close()
-            con.close()
+        password = getStorage().getPassword(username + '@%s' % \
+                                            self.msg.conn.server.hostname)
+        if password is None:
             raise IQAuthError
-        c.close()
-        con.close()
 
         s = sha1()
         s.update(self.streamid + password)
@@ -384,6 +548,7 @@ class IQAuthDigest:
             # record the JID for local delivery
             self.msg.conn.server.conns[self.msg.conn.id] = (JID(d['user']['jid']),
                                                             self.msg.conn)
+            self.msg.conn.server.sessions.authenticate(self.msg.conn, d['user']['jid'])
 
             self.msg.conn.parser.resetParser()
             return
@@ -0,0 +1,160 @@
+"""Coalescing of presence changes from flapping clients.
+
+Some clients (mostly mobile ones) send several presence changes in quick
+succession, eg. available, away, unavailable, available. Each of these is
+broadcast to every subscriber of the user. With a coalescing window set for
+the user (pjs.conf.conf.presenceCoalesceWindow and presenceCoalesceWindows),
+the changes that follow the initial presence are held for the window and
+only the latest one is broadcast. If the latest one is the same as what the
+subscribers already have, as after a transient unavailable/available pair,
+nothing is broadcast at all.
+
+The initial presence, directed presence and the unavailable presence sent
+when the stream closes are never held.
+"""
+
+import logging
+
+import pjs.async.core as asyncore
+import pjs.conf.conf
+
+from pjs.elementtree.ElementTree import Element
+from pjs.events import C2SStanzaDispatcher
+from pjs.serializer import tostring
+
+def getWindow(jid):
+    """Returns the coalescing window of the user jid in seconds"""
+    return pjs.conf.conf.presenceCoalesceWindows.get(jid,
+                                    pjs.conf.conf.presenceCoalesceWindow)
+
+class PresenceCoalescer:
+    """Holds the clients' presence changes for their coalescing window.
+    Held presences are dispatched again through the C2S stanza phases when
+    the window ends.
+    """
+    def __init__(self, fanoutFunc=None):
+        """fanoutFunc -- optional function that returns the number of
+                         stanzas a broadcast from a connection results in.
+                         Used for the fanoutSaved counter.
+        """
+        self.fanoutFunc = fanoutFunc
+
+        # connection id => [latest held presence, Timer]
+        self.pending = {}
+
+        # connection id => serialized presence last broadcast
+        self.lastSent = {}
+
+        # connection id => presence that's being dispatched after its window
+        self.released = {}
+
+        # presences that were held
+        self.held = 0
+        # held presences that were replaced by a later one
+        self.coalesced = 0
+        # presences not sent because the subscribers already had them
+        self.suppressed = 0
+        # held presences that were broadcast when the window ended
+        self.flushed = 0
+        # stanzas that would've been sent for the presences that weren't
+        self.fanoutSaved = 0
+
+    def hold(self, conn, tree):
+        """Decides whether the client's presence in tree is broadcast now.
+        Returns True if it was held, in which case the caller should drop
+        it.
+        """
+        if self.released.get(conn.id) is tree:
+            del self.released[conn.id]
+            self._passed(conn, tree)
+            return False
+
+        if tree.get('to') is not None:
+            return False
+
+        user = conn.data['user']
+        window = getWindow(user['jid'])
+        if not window:
+            return False
+
+        entry = self.pending.get(conn.id)
+
+        if conn.data['stream']['closing']:
+            # the stream's closing, so the unavailable goes out now and
+            # replaces anything held
+            if entry is not None:
+                entry[1].cancel()
+                del self.pending[conn.id]
+                self._saved(conn)
+            return False
+
+        if not user['active'] and entry is None:
+            # initial presence
+            self._passed(conn, tree)
+            return False
+
+        if entry is not None:
+            entry[0] = tree
+            self.coalesced += 1
+            self._saved(conn)
+        else:
+            timer = asyncore.callLater(window, self._flush, conn)
+            self.pending[conn.id] = [tree, timer]
+            self.held += 1
+
+        return True
+
+    def remove(self, conn):
+        """Forgets everything about conn. Call when it's closed."""
+        entry = self.pending.pop(conn.id, None)
+        if entry is not None:
+            entry[1].cancel()
+        self.lastSent.pop(conn.id, None)
+        self.released.pop(conn.id, None)
+
+    def _flush(self, conn):
+        """Broadcasts the latest presence held for conn"""
+        entry = self.pending.pop(conn.id, None)
+        if entry is None:
+            return
+        tree = entry[0]
+
+        if tostring(tree) == self.lastSent.get(conn.id):
+            self.suppressed += 1
+            self._saved(conn)
+            return
+
+        self.flushed += 1
+        self.released[conn.id] = tree
+        try:
+            self.dispatch(conn, tree)
+        except Exception, e:
+            logging.warning("[%s] Couldn't dispatch the held presence of %s: %s",
+                            self.__class__, conn.data['user']['jid'], e)
+            self.released.pop(conn.id, None)
+
+    def dispatch(self, conn, tree):
+        """Runs the presence in tree through the C2S stanza phases again"""
+        wrapper = Element('wrapper')
+        wrapper.append(tree)
+        C2SStanzaDispatcher().dispatch(wrapper, conn)
+
+    def _passed(self, conn, tree):
+        """Records that tree is broadcast"""
+        self.lastSent[conn.id] = tostring(tree)
+
+    def _saved(self, conn):
+        """Counts the stanzas saved by not broadcasting a presence"""
+        if self.fanoutFunc is not None:
+            self.fanoutSaved += self.fanoutFunc(conn)
+
+    def getStats(self):
+        """Returns a dict with the counters"""
+        return {
+                'pending' : len(self.pending),
+                'held' : self.held,
+                'coalesced' : self.coalesced,
+                'suppressed' : self.suppressed,
+                'flushed' : self.flushed,
+                'fanoutSaved' : self.fanoutSaved,
+                }
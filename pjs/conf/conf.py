@@ -4,3 +4,173 @@
 # launcher.run() needs to be executed in order to actually
 # bind to sockets.
 launcher = None
+
+# seconds to wait for an outgoing S2S connection to be established before
+# trying the next address of the remote server
+s2sConnectTimeout = 15
+
+# per-domain overrides of s2sConnectTimeout. domain => seconds
+s2sConnectTimeouts = {}
+
+# limits of the outbound stanza queues for remote domains. see pjs.outqueue.
+# the oldest stanzas are dropped when there are more than s2sQueueMaxSize
+# waiting or they take up more than s2sQueueMaxBytes bytes, and stanzas older
+# than s2sQueueMaxAge seconds are dropped. dropped stanzas are bounced to
+# their senders.
+s2sQueueMaxSize = 5000
+s2sQueueMaxBytes = 1048576
+s2sQueueMaxAge = 120
+
+# seconds between the checks for stale stanzas in the queues of domains that
+# we have no connection to. queues left empty are removed.
+s2sQueuePruneInterval = 60
+
+# secret for generating dialback keys. a random one is generated on startup
+# if this is not set, but then keys don't survive restarts.
+dialbackSecret = None
+
+# seconds that a dialback key verified on one of our incoming streams is
+# trusted on that stream without asking the authoritative server again. new
+# streams are always verified (see pjs.dialback).
+dialbackCacheTTL = 600
+
+# seconds during which a client's presence changes are coalesced, so that
+# only the latest one is broadcast. 0 disables coalescing. see pjs.coalesce.
+presenceCoalesceWindow = 0
+
+# per-user overrides of presenceCoalesceWindow. bare JID => seconds
+presenceCoalesceWindows = {}
+
+# limits of the roster cache (see pjs.rostercache): the most users whose
+# rosters are cached and the most contacts in all of them together
+rosterCacheMaxUsers = 10000
+rosterCacheMaxContacts = 1000000
+
+# number of roster changes logged per user for roster versioning. clients
+# whose cached roster is older than that get the full roster.
+rosterVersionLogSize = 200
+
+# rosters with at least this many contacts are streamed to the client in
+# chunks instead of being sent as one stanza (see pjs.rosterstream). 0
+# disables streaming.
+rosterStreamThreshold = 1000
+
+# number of roster items serialized into one chunk when streaming
+rosterStreamChunkSize = 200
+
+# streamed chunks are written only while the connection has less than this
+# many bytes waiting to be sent
+rosterStreamBufferSize = 65536
+
+# number of serialized chunks the thread reading a streamed roster can get
+# ahead of the client. it waits for the client to read when there are more.
+rosterStreamQueueSize = 4
+
+# seconds a client can go without reading its streamed roster before it's
+# disconnected
+rosterStreamTimeout = 60
+
+# the most connections open to one DB at once (see pjs.db.ConnectionPool)
+dbPoolSize = 20
+
+# seconds to wait for a DB connection when all of them are in use
+dbPoolTimeout = 10
+
+# number of prepared statements each DB connection keeps
+dbStatementCacheSize = 100
+
+# DB connections idle for longer than this many seconds are checked before
+# they're reused
+dbPoolCheckInterval = 60
+
+# journal mode of the DB, set by pjs.schema.migrate(). In WAL mode readers
+# don't block the writer and the writer doesn't block readers. None leaves
+# the mode alone.
+dbJournalMode = 'WAL'
+
+# pragmas set on each DB connection. None leaves SQLite's default.
+# NORMAL doesn't sync on every commit in WAL mode. A power loss can lose the
+# last commits, but doesn't corrupt the DB.
+dbSynchronous = 'NORMAL'
+# page cache size of each connection. negative values are in KiB.
+dbCacheSize = -16384
+# bytes of the DB file read through memory mapping
+dbMmapSize = 268435456
+
+# storage of the users and rosters: 'sqlite', 'memory', 'sharded' or the
+# dotted path of a pjs.storage.base.Storage subclass. see pjs.storage.
+storageBackend = 'sqlite'
+
+# file the memory backend keeps its data in between runs. None keeps it only
+# in memory.
+storageSnapshotFile = 'db.snapshot'
+
+# seconds between snapshots of the memory backend, if anything changed. 0
+# only takes one at shutdown.
+storageSnapshotInterval = 60
+
+# number of SQLite files the sharded backend spreads the users over. the
+# users have to be moved when it's changed (see pjs.storage.shardedstore).
+storageShards = 4
+
+# file names of the shards of the sharded backend. %d is the shard number.
+storageShardName = 'db-shard%d'
+
+# file of the sharded backend with the ids and shards of all JIDs
+storageDirectoryName = 'db-directory'
+
+# keep the data of the storage backend in memory and write the changes to
+# the backend in the background, in batches (see pjs.storage.writebehind).
+# only for backends that keep the data on disk.
+storageWriteBehind = False
+
+# the most changes written in one transaction
+storageWriteBehindBatchSize = 500
+
+# seconds a change can wait for more changes to join its batch
+storageWriteBehindDelay = 0.05
+
+# changes can't be made while this many are waiting to be written
+storageWriteBehindMaxQueue = 100000
+
+# file the changes are appended to until they're written, so that they
+# survive a crash of the server. None loses the changes that weren't written
+# yet.
+storageWriteBehindJournal = None
+
+# sync the journal to disk after every change, so that the changes also
+# survive a crash of the machine
+storageWriteBehindFsync = False
+
+# keep the set of local users and the recently used passwords in memory, so
+# that logins and messages to unknown users don't go to the storage backend
+# (see pjs.storage.usercache). not used with write-behind, which keeps
+# everything in memory anyway.
+userCache = True
+
+# seconds a user's password is cached after it's read
+userCacheCredentialTTL = 300
+
+# the most passwords cached
+userCacheMaxCredentials = 10000
+
+# seconds between reloads of the set of users, for users added to the
+# storage by other programs. 0 never reloads it.
+userCacheRefreshInterval = 0
+
+# SCRAM mechanisms offered to clients, most preferred first (see pjs.scram)
+scramMechanisms = ['SCRAM-SHA-256', 'SCRAM-SHA-1']
+
+# PBKDF2 iterations of new SCRAM keys. the keys made with another count keep
+# working; pjs/scram.py --all makes them again.
+scramIterations = 4096
+
+# secret for the salts that SCRAM logins of unknown users are answered with.
+# a random one is generated on startup if this is not set, but then the
+# salts change on restarts.
+scramMockSecret = None
+
+# processes that make the SCRAM keys and run the CPU-bound work of the
+# handlers in processPoolHandlers of pjs.conf.handlers (see pjs.procpool).
+# 0 does all of it in the calling thread.
+processPoolSize = 2
@@ -0,0 +1,77 @@
+"""Stream features that we offer during stream negotiation. These are
+modifiable at run-time through the functions below.
+
+The features handlers in pjs.handlers.stream don't build the
+<stream:features> element for every connection. Instead, they keep it
+pre-encoded and rebuild it only when 'generation' changes, so any change to
+the feature set must go through these functions (or bump 'generation').
+"""
+
+import pjs.scram
+
+from pjs.elementtree.ElementTree import Element, SubElement
+
+# Incremented every time a feature set changes. Used to invalidate the
+# pre-encoded <stream:features> templates.
+generation = 0
+
+def _makeAuthFeatures():
+    mechs = Element('mechanisms', {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-sasl'})
+    for mech in pjs.scram.getMechanisms():
+        SubElement(mechs, 'mechanism').text = mech
+    SubElement(mechs, 'mechanism').text = 'DIGEST-MD5'
+    SubElement(mechs, 'mechanism').text = 'PLAIN'
+
+    # we also support the old style jabber:iq:auth
+    iqauth = Element('auth', {'xmlns' : 'http://jabber.org/features/iq-auth'})
+
+    return [mechs, iqauth]
+
+def _makePostAuthFeatures():
+    return [
+            Element('bind', {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-bind'}),
+            Element('session', {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-session'}),
+            # roster versioning (RFC 6121 2.6, XEP-0237)
+            Element('ver', {'xmlns' : 'urn:xmpp:features:rosterver'}),
+            ]
+
+# stage name => list of feature Elements
+# 'init' -- sent after the initial stream header. we don't have TLS for now,
+#           so it's the same as 'auth'.
+# 'auth' -- sent after channel encryption.
+# 'postauth' -- sent after authentication.
+_features = {
+             'init' : _makeAuthFeatures(),
+             'auth' : _makeAuthFeatures(),
+             'postauth' : _makePostAuthFeatures(),
+             }
+
+def getFeatures(stage):
+    """Returns the list of feature Elements for the stage. The list must not
+    be modified directly; use setFeatures() or addFeature() instead.
+    """
+    return _features.get(stage, [])
+
+def setFeatures(stage, features):
+    """Replaces all features offered in the stage with the features list of
+    Elements.
+    """
+    global generation
+    _features[stage] = list(features)
+    generation += 1
+
+def addFeature(stage, feature):
+    """Adds the feature Element to the ones offered in the stage"""
+    global generation
+    _features.setdefault(stage, []).append(feature)
+    generation += 1
+
+def removeFeature(stage, tag):
+    """Removes all features with the tag from the stage. tag is matched
+    against the element's tag without the namespace.
+    """
+    global generation
+    def localName(el):
+        return el.tag.split('}')[-1]
+    _features[stage] = [f for f in _features.get(stage, []) if localName(f) != tag]
+    generation += 1
@@ -15,6 +15,7 @@ import pjs.handlers.auth
 import pjs.handlers.presence
 import pjs.handlers.message
 import pjs.handlers.route
+import pjs.handlers.dialback
 
 # TODO: add functions to fetch handlers from the config file
 
@@ -117,6 +118,11 @@ handlers = {
                               'handler' : pjs.handlers.presence.C2SPresenceHandler,
                               'description' : 'handles plain presence from clients'
                               },
+            'c2s-presence-load' : {
+                                   'handler' : pjs.handlers.presence.C2SPresenceLoadHandler,
+                                   'description' : 'loads the subscriptions and ' +\
+                                                   'handles plain presence from clients'
+                                   },
             's2s-presence' : {
                               'handler' : pjs.handlers.presence.S2SPresenceHandler,
                               'description' : 'handles plain presence from servers'
@@ -144,5 +150,27 @@ handlers = {
             'route-client': {
                              'handler' : pjs.handlers.route.ClientRouteHandler,
                              'description' : 'routes data to a client on this server'
-                             }
-            }
\ No newline at end of file
+                             },
+            'route-batch' : {
+                             'handler' : pjs.handlers.route.BatchRouteHandler,
+                             'description' : 'routes a batch of stanzas to clients ' +\
+                                             'and servers with one write per connection'
+                             },
+            'db-result' : {
+                           'handler' : pjs.handlers.dialback.DialbackResultHandler,
+                           'description' : 'handles dialback keys and their results'
+                           },
+            'db-verify' : {
+                           'handler' : pjs.handlers.dialback.DialbackVerifyHandler,
+                           'description' : 'verifies dialback keys and handles ' +\
+                                           'the answers to our verify requests'
+                           }
+            }
+
+# ThreadedHandler classes whose CPU-bound work runs in the process pool
+# instead of their thread when processPoolSize is set (see pjs.procpool).
+# They have to set cpuBound, like pjs.handlers.auth.SASLResponseHandler. A
+# call costs a pickled round trip to another process, which is more than the
+# hashing of a DIGEST-MD5 or SCRAM login
+# (prototypes/load-tests/cpu-offload.py), so none are by default.
+processPoolHandlers = []
\ No newline at end of file
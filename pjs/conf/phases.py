@@ -59,10 +59,12 @@ _corePhases = {
           'db-result' : {
                          'description' : 'result of dialback coming from the other server',
                          'xpath' : '{jabber:server:dialback}result',
+                         'handlers' : [h['db-result']]
                          },
           'db-verify' : {
                          'description' : 'verification of the dialback key',
                          'xpath' : '{jabber:server:dialback}verify',
+                         'handlers' : [h['db-verify']]
                          },
           'test' : {
                     'description' : 'test phase for simple tests',
@@ -7,11 +7,17 @@ See the design doc for more information on asynchronous connections.
 
 import pjs.async.core as asyncore
 import pjs.parsers
+import pjs.resolver
+import pjs.conf.conf
 import logging
 import socket
+import errno
 
 from pjs.elementtree.ElementTree import Element
-from pjs.events import Dispatcher
+from pjs.events import Dispatcher, S2SStanzaDispatcher
+from pjs.serializer import BoundStanza
+from pjs.handlers.stream import XML_DECL, outStreamHeader
+from pjs.outqueue import OutboundQueue
 
 # TODO: add TLS here through tlslite's asyncore integration.
 #from tlslite.integration.TLSAsyncDispatcherMixIn import TLSAsyncDispatcherMixIn
@@ -51,6 +57,9 @@ class Connection(asyncore.dispatcher_with_send):
                             'complete' : False,
                             }
 
+        # data sent while the output is held. see hold().
+        self.held = None
+
     def handle_expt(self):
         logging.warning("[%s] Socket exception occurred for %s",
                         self.__class__, self.addr)
@@ -70,6 +79,39 @@ class Connection(asyncore.dispatcher_with_send):
         data = self.recv(4096)
         self.parser.feed(data)
 
+    def send(self, data):
+        """Queues data for sending. Unicode is encoded into UTF-8 first,
+        since that's the only encoding we speak on the wire.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        held = self.held
+        if held is not None:
+            held.append(data)
+            return
+        asyncore.dispatcher_with_send.send(self, data)
+
+    def hold(self):
+        """Holds back the data passed to send() until release() is called.
+        This is used while a big result is written in pieces with
+        sendThrough(), so that no other stanza ends up in the middle of it.
+        """
+        if self.held is None:
+            self.held = []
+
+    def release(self):
+        """Sends the data that was held back since hold()"""
+        held = self.held
+        self.held = None
+        if held:
+            asyncore.dispatcher_with_send.send(self, ''.join(held))
+
+    def sendThrough(self, data):
+        """Sends data even if the output is held"""
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        asyncore.dispatcher_with_send.send(self, data)
+
 class ClientConnection(Connection):
     """A connection between a client and a server (us) initiated by
     the client.
@@ -91,7 +133,6 @@ class ClientConnection(Connection):
                                                         # updates
                              'active' : False, # active resource is an available resource
                                                # that send an initial presence
-                             'lastPresence' : None # last <presence> stanza sent by client
                              }
 
         logging.info("[%s] New c2s connection accepted from %s",
@@ -131,6 +172,9 @@ class ServerInConnection(ServerConnection):
         self.id = 'sin%s' % id(self)
 
         self.data['server']['direction'] = 'from'
+        # domains that passed dialback on this stream. stanzas from other
+        # domains are dropped by the S2SStanzaDispatcher.
+        self.data['server']['verified'] = []
 
         logging.info("New ServerInConnection created with %s", addr)
 
@@ -151,7 +195,13 @@ class ServerInConnection(ServerConnection):
         self.parser.feed(data)
 
 class ServerOutConnection(ServerConnection):
-    """An s2s connection from us to a remote server"""
+    """An s2s connection from us to a remote server.
+
+    These are created without a socket. connectTo() finds the remote
+    server's addresses with pjs.resolver and connects to them one by one
+    without blocking until one accepts. The connection attempts are timed out
+    with timers on the main loop.
+    """
     def __init__(self, sock, addr, server):
         ServerConnection.__init__(self, sock, addr, server)
 
@@ -160,22 +210,184 @@ class ServerOutConnection(ServerConnection):
         self.data['server']['direction'] = 'to'
 
         # queue of messages to send to the remote server as soon as we are
-        # ready (ie. completed auth, tls, db, etc.)
-        self.outQueue = []
+        # ready (ie. completed auth, tls, db, etc.). S2SServer replaces this
+        # with the domain's queue, which outlives the connection.
+        self.outQueue = OutboundQueue(None)
+
+        # (IP, port) pairs left to try when connecting
+        self.targets = []
+        # True once the remote server's addresses were found
+        self.resolved = False
+        self.connectTimer = None
+
+        # True once the other side replied with its <stream>
+        self.streamOpen = False
+
+        # dialback elements waiting for the stream to open. these go out
+        # before any stanzas and aren't subject to dialback themselves.
+        self.controlQueue = []
+        self._controlTimer = None
 
         logging.info("New ServerOutConnection created with %s", addr)
 
+    def connectTo(self, hostname, addrs=None):
+        """Starts connecting to the server of hostname. addrs is an optional
+        list of (IP, port) pairs to use instead of looking the domain up.
+        """
+        self.data['server']['hostname'] = hostname
+        if addrs:
+            self._gotAddresses(addrs)
+        else:
+            pjs.resolver.getResolver().resolveServer(hostname, self._gotAddresses)
+
+    def _gotAddresses(self, addrs):
+        if not addrs:
+            logging.warning("[%s] Can't resolve %s",
+                            self.__class__, self.data['server']['hostname'])
+        self.resolved = bool(addrs)
+        self.targets = list(addrs)
+        self._connectNext()
+
+    def _connectNext(self):
+        """Tries the next address in self.targets"""
+        if self.socket is not None:
+            self.del_channel()
+            self.socket.close()
+            self.socket = None
+
+        hostname = self.data['server']['hostname']
+        if not self.targets:
+            # the senders are told that the stanzas can't be delivered
+            # (RFC 6120 8.3.3)
+            if self.resolved:
+                condition = 'remote-server-timeout'
+            else:
+                condition = 'remote-server-not-found'
+            logging.warning("[%s] Couldn't connect to %s. Bouncing %d queued stanzas",
+                            self.__class__, hostname,
+                            self.outQueue.clear(condition))
+            self.handle_close()
+            return
+
+        addr = self.targets.pop(0)
+        logging.debug("[%s] Connecting to %s at %s", self.__class__, hostname, addr)
+
+        self.connectTimer = asyncore.callLater(getConnectTimeout(hostname),
+                                               self._connectTimedOut, addr)
+        try:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.addr = addr
+            self.connect(addr)
+        except socket.error, e:
+            self._connectFailed(addr, e)
+
+    def _connectTimedOut(self, addr):
+        self.connectTimer = None
+        self._connectFailed(addr, 'timed out')
+
+    def _connectFailed(self, addr, reason):
+        logging.info("[%s] Connection to %s at %s failed: %s", self.__class__,
+                     self.data['server']['hostname'], addr, reason)
+        if self.connectTimer:
+            self.connectTimer.cancel()
+            self.connectTimer = None
+        self.connected = False
+        self._connectNext()
+
+    def _checkConnected(self):
+        """Called when the socket becomes readable or writable while
+        connecting. Returns True if the connection was established.
+        """
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._connectFailed(self.addr, errno.errorcode.get(err, err))
+            return False
+        self.connected = True
+        self.handle_connect()
+        return True
+
+    def handle_read_event(self):
+        if self.connected or self._checkConnected():
+            ServerConnection.handle_read_event(self)
+
+    def handle_write_event(self):
+        if self.connected or self._checkConnected():
+            ServerConnection.handle_write_event(self)
+
+    def handle_connect(self):
+        if self.connectTimer:
+            self.connectTimer.cancel()
+            self.connectTimer = None
+
+        hostname = self.data['server']['hostname']
+        logging.info("[%s] Connected to %s at %s", self.__class__, hostname, self.addr)
+
+        # the stanzas wait in outQueue until the stream's negotiated
+        self.send(XML_DECL + outStreamHeader(hostname))
+
+    def initiate_send(self):
+        # data sent before we're connected waits in the buffer
+        if self.connected:
+            ServerConnection.initiate_send(self)
+
+    def sendControl(self, data):
+        """Sends stream-level data, such as dialback elements, as soon as
+        the stream is open. Everything queued in one pass of the main loop
+        goes out in one write.
+        """
+        self.controlQueue.append(data)
+        if self.streamOpen and self._controlTimer is None:
+            self._controlTimer = asyncore.callLater(0, self.flushControl)
+
+    def openStream(self):
+        """Called when the other side opened its stream. Sends the queued
+        control data.
+        """
+        self.streamOpen = True
+        self.flushControl()
+
+    def flushControl(self):
+        self._controlTimer = None
+        if self.controlQueue:
+            data = u''.join(self.controlQueue)
+            self.controlQueue = []
+            self.send(data)
+
     def handle_close(self):
         hostname = self.data['server']['hostname']
 
         logging.debug("[%s] Closing ServerOutConnection with %s",
                       self.__class__, hostname)
 
+        if self.connectTimer:
+            self.connectTimer.cancel()
+            self.connectTimer = None
+        self.targets = []
+        self.outQueue.detach(self)
+        if self._controlTimer:
+            self._controlTimer.cancel()
+            self._controlTimer = None
         if hostname:
-            self.server.s2sConns[hostname][1] = None
+            self.server.dialbackLinkClosed(hostname)
+
+        conns = self.server.s2sConns.get(hostname)
+        if conns is not None and conns[1] is self:
+            conns[1] = None
+
+        if self.socket is None:
+            # never got connected
+            self.server.conns.pop(self.id, None)
+            return
 
         ServerConnection.handle_close(self)
 
+def getConnectTimeout(hostname):
+    """Returns the number of seconds to wait for a connection to the server
+    of hostname to be established
+    """
+    return pjs.conf.conf.s2sConnectTimeouts.get(hostname,
+                                                pjs.conf.conf.s2sConnectTimeout)
+
 class LocalServerInConnection(ServerConnection):
     """Connection like ServerOutConnection, but for local S2S"""
     def __init__(self, sock, addr, server):
@@ -186,20 +398,7 @@ class LocalServerInConnection(ServerConnection):
         self.data['server']['direction'] = 'from'
         self.data['server']['hostname'] = 'localhost'
 
-        # send the <stream> to prime the parser for the ns it'll deal with,
-        # but tell it not to process the xml during priming, since we don't
-        # care for auth/encr on a loopback connection
-        self.parser.disable()
-        data = "<?xml version='1.0' ?>" +\
-                "<stream:stream xmlns='jabber:server' " +\
-                "xmlns:stream='http://etherx.jabber.org/streams' " +\
-                "version='1.0'>"
-        self.parser.feed(data)
-        self.parser.depth = 1
-        self.parser.stream = Element('{http://etherx.jabber.org/streams}stream',
-                                     {'version' : '1.0'})
-        self.parser.ns = 'jabber:server'
-        self.parser.enable()
+        primeLocalParser(self.parser)
 
         logging.info("New LocalServerInConnection created with %s", addr)
 
@@ -219,6 +418,106 @@ class LocalServerInConnection(ServerConnection):
         data = self.recv(4096)
         self.parser.feed(data)
 
+class LocalDeliveryConnection:
+    """Delivers stanzas for the domains that this process serves without
+    going through a loopback S2S socket. It stands in for the incoming S2S
+    connection from our own domain: stanzas handed to deliver() are
+    dispatched to the S2S stanza phases with this object as the connection,
+    just as if they were read from a LocalServerInConnection.
+
+    Stanzas are dispatched from the main loop after the current Message
+    finishes its handler, instead of recursively from within it. Elements
+    are dispatched as they are (after moving them into the jabber:server
+    namespace), so they aren't serialized and parsed again. Text is fed to a
+    parser that's primed for a jabber:server stream.
+
+    What the S2S handlers send back on this connection is meant for the
+    sending server, which is us, so it's delivered as well, like the
+    loopback S2S connection echoed it back.
+    """
+
+    # ThreadedHandlers in the S2S phases watch their functions through the
+    # connection
+    watch_function = asyncore.wf
+
+    def __init__(self, server):
+        self.server = server
+        self.addr = ('local', 0)
+        self.id = 'locdeliv%s' % id(self)
+
+        self.data = {}
+        self.data['stream'] = {
+                               'in-stream' : True,
+                               'id' : '',
+                               'closing' : False,
+                               }
+        self.data['server'] = {
+                               'hostname' : server.hostname,
+                               'direction' : 'from',
+                               }
+
+        self.parser = pjs.parsers.borrow_parser(self)
+        primeLocalParser(self.parser)
+
+        # stanzas (Elements or text) waiting to be dispatched
+        self.pending = []
+
+        # number of stanzas delivered. for stats.
+        self.delivered = 0
+
+    def deliver(self, data):
+        """Queues data for dispatching. data can be whatever
+        pjs.handlers.write.prepareDataForSending() handles.
+        """
+        if data is None:
+            return
+        if not isinstance(data, list):
+            data = [data]
+
+        schedule = not self.pending
+        for item in data:
+            if isinstance(item, Element):
+                self.pending.append(toServerNS(item))
+            elif isinstance(item, BoundStanza):
+                self.pending.append(toServerNS(item.element()))
+            elif isinstance(item, basestring):
+                if item:
+                    self.pending.append(item)
+            else:
+                logging.debug("[%s] Can't deliver an object of type %s",
+                              self.__class__, type(item))
+
+        if schedule and self.pending:
+            # a timer, so that it runs on the next pass of the main loop even
+            # if we're called from a timer or a watched function
+            asyncore.callLater(0, self._flush)
+
+    def _flush(self):
+        """Dispatches all pending stanzas. Called from the main loop."""
+        pending = self.pending
+        self.pending = []
+        for item in pending:
+            try:
+                if isinstance(item, basestring):
+                    self.parser.feed(item)
+                else:
+                    wrapper = Element('wrapper')
+                    wrapper.append(item)
+                    S2SStanzaDispatcher().dispatch(wrapper, self)
+                self.delivered += 1
+            except Exception, e:
+                logging.warning("[%s] Failed to deliver a local stanza: %s",
+                                self.__class__, e)
+
+    def send(self, data):
+        """Output of the S2S handlers is meant for the sending server, which
+        is us, so it's delivered.
+        """
+        self.deliver(data)
+
+    def handle_close(self):
+        pass
+
 class LocalServerOutConnection(asyncore.dispatcher_with_send):
     """Simple server out connection for local S2S. All it does is
     forward all data sent to it to the LocalServerInConnection.
@@ -238,6 +537,57 @@ class LocalServerOutConnection(asyncore.dispatcher_with_send):
         del self.server.conns[self.id]
         self.close()
 
+def primeLocalParser(parser):
+    """Feeds the parser the <stream> to prime it for the jabber:server ns
+    it'll deal with, but tells it not to process the xml during priming,
+    since we don't care for auth/encr on a loopback connection.
+    """
+    parser.disable()
+    data = "<?xml version='1.0' ?>" +\
+            "<stream:stream xmlns='jabber:server' " +\
+            "xmlns:stream='http://etherx.jabber.org/streams' " +\
+            "version='1.0'>"
+    parser.feed(data)
+    parser.depth = 1
+    parser.stream = Element('{http://etherx.jabber.org/streams}stream',
+                            {'version' : '1.0'})
+    parser.ns = 'jabber:server'
+    parser.enable()
+
+_CLIENT_NS = '{jabber:client}'
+_SERVER_NS = '{jabber:server}'
+
+def toServerNS(tree, inDefault=True):
+    """Returns a copy of tree with the elements in the jabber:client
+    namespace moved into jabber:server, so that it looks like it was parsed
+    off an S2S stream. Unqualified elements in the default namespace are
+    moved as well. The top element is always new, but subtrees that don't
+    need changes are shared with tree, so they shouldn't be modified.
+
+    inDefault -- whether tree's parent is in the stream's default namespace
+    """
+    tag = tree.tag
+    if tag[:1] != '{':
+        if inDefault:
+            tag = _SERVER_NS + tag
+    elif tag.startswith(_CLIENT_NS):
+        tag = _SERVER_NS + tag[len(_CLIENT_NS):]
+
+    childInDefault = tag.startswith(_SERVER_NS) and tree.get('xmlns') is None
+
+    new = tree.makeelement(tag, dict(tree.items()))
+    new.text = tree.text
+    new.tail = tree.tail
+    for child in tree:
+        newChild = toServerNS(child, childInDefault)
+        if newChild.tag == child.tag and len(newChild) == len(child) and \
+           all([a is b for a, b in zip(newChild, child)]):
+            # nothing changed in this subtree
+            newChild = child
+        new.append(newChild)
+
+    return new
+
 class LocalTriggerConnection(asyncore.dispatcher_with_send):
     """This creates a local connection back to our server.
 
@@ -1,15 +1,357 @@
-"""SQLite in-memory storage. Mostly for testing purposes now.
-This can be replaced by rewriting the relevant classes and using them
-in your own custom handlers.
+"""SQLite connections for the SQLite storage backend
+(pjs.storage.sqlitestore). Other backends can be plugged in through
+pjs.storage.base.
+
+Connections are pooled (see ConnectionPool). DB() checks a connection out of
+the pool of the DB and closing it puts it back, as does dropping the last
+reference to it.
 """
 
+import thread
+import threading
+import time
+import logging
+
 from pysqlite2 import dbapi2 as sqlite
 
+import pjs.conf.conf
+
 dbname = 'db'
 
+class PoolTimeout(Exception):
+    """Raised when no connection became available in time"""
+
+class PooledCursor(sqlite.Cursor):
+    """A cursor that keeps its PooledConnection checked out while it's
+    being used
+    """
+
+class PooledConnection(object):
+    """A connection checked out of a ConnectionPool. It's used like the
+    sqlite connection it wraps. close() returns the connection to the pool,
+    which also happens when neither it nor any of its cursors are referenced
+    any more.
+    """
+    def __init__(self, pool, con):
+        self.__dict__['_pool'] = pool
+        self.__dict__['_con'] = con
+
+    def __getattr__(self, name):
+        return getattr(self._getCon(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._getCon(), name, value)
+
+    def cursor(self):
+        c = self._getCon().cursor(PooledCursor)
+        c.pooled = self
+        return c
+
+    def execute(self, *args):
+        c = self.cursor()
+        c.execute(*args)
+        return c
+
+    def executemany(self, *args):
+        c = self.cursor()
+        c.executemany(*args)
+        return c
+
+    def _getCon(self):
+        con = self.__dict__['_con']
+        if con is None:
+            raise sqlite.ProgrammingError, 'Cannot operate on a closed connection.'
+        return con
+
+    def close(self):
+        """Returns the connection to the pool. Any transaction left open is
+        rolled back.
+        """
+        con = self.__dict__['_con']
+        if con is not None:
+            self.__dict__['_con'] = None
+            self._pool.checkin(con)
+
+    def __del__(self):
+        self.close()
+
+class ConnectionPool:
+    """A bounded pool of connections to one DB.
+
+    The threadpool threads each tend to get back the connection they used
+    last, so its statement cache stays warm for the queries that thread
+    runs. A thread takes another thread's idle connection only when it has
+    none of its own, and opens a new one only when there are no idle ones.
+    When all maxSize connections are in use, checkout() waits for one.
+    """
+    def __init__(self, name, maxSize=None, timeout=None,
+                 statementCacheSize=None, checkInterval=None):
+        """name -- DB name.
+        maxSize -- the most connections open at once.
+        timeout -- seconds to wait for a connection when all are in use.
+        statementCacheSize -- number of prepared statements each connection
+                              keeps.
+        checkInterval -- connections that have been idle for longer than
+                         this many seconds are tested before they're handed
+                         out.
+        """
+        if maxSize is None:
+            maxSize = pjs.conf.conf.dbPoolSize
+        if timeout is None:
+            timeout = pjs.conf.conf.dbPoolTimeout
+        if statementCacheSize is None:
+            statementCacheSize = pjs.conf.conf.dbStatementCacheSize
+        if checkInterval is None:
+            checkInterval = pjs.conf.conf.dbPoolCheckInterval
+        self.name = name
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self.statementCacheSize = statementCacheSize
+        self.checkInterval = checkInterval
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+        # thread id => list of (connection, time it was returned) of the idle
+        # connections last used by that thread. The most recently returned
+        # is at the end.
+        self.idle = {}
+        self.idleCount = 0
+        # number of open connections, idle or in use
+        self.size = 0
+        self.closed = False
+
+        self.opened = 0
+        self.reused = 0
+        # reused connections that were last used by another thread
+        self.stolen = 0
+        self.discarded = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.waitTime = 0.0
+        self.maxWait = 0.0
+
+    def checkout(self, isolationLevel="DEFERRED"):
+        """Returns a PooledConnection with the given isolation level"""
+        while True:
+            con, idleSince = self._take()
+            if con is None:
+                try:
+                    con = self._connect()
+                except:
+                    self._release()
+                    raise
+            elif time.time() - idleSince > self.checkInterval and \
+                 not self._isHealthy(con):
+                self._discard(con)
+                continue
+
+            con.isolation_level = isolationLevel
+            return PooledConnection(self, con)
+
+    def checkin(self, con):
+        """Puts con back into the pool"""
+        try:
+            con.rollback()
+        except Exception, e:
+            logging.warning("[%s] Discarding a connection to %s: %s",
+                            self.__class__, self.name, e)
+            self._discard(con)
+            return
+
+        self.lock.acquire()
+        try:
+            if self.closed:
+                self.size -= 1
+                con.close()
+                return
+            self.idle.setdefault(thread.get_ident(), []).append((con, time.time()))
+            self.idleCount += 1
+            self.available.notify()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Closes the idle connections. The ones in use are closed when
+        they're returned.
+        """
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for conns in self.idle.values():
+                for con, idleSince in conns:
+                    con.close()
+                    self.size -= 1
+            self.idle = {}
+            self.idleCount = 0
+            self.available.notifyAll()
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        """Returns a dict with the pool's size and usage"""
+        self.lock.acquire()
+        try:
+            if self.waits:
+                avgWait = self.waitTime / self.waits
+            else:
+                avgWait = 0.0
+            return {
+                    'size' : self.size,
+                    'maxSize' : self.maxSize,
+                    'idle' : self.idleCount,
+                    'inUse' : self.size - self.idleCount,
+                    'opened' : self.opened,
+                    'reused' : self.reused,
+                    'stolen' : self.stolen,
+                    'discarded' : self.discarded,
+                    'waits' : self.waits,
+                    'timeouts' : self.timeouts,
+                    'avgWait' : avgWait,
+                    'maxWait' : self.maxWait,
+                    }
+        finally:
+            self.lock.release()
+
+    def _take(self):
+        """Takes an idle connection or reserves a place for a new one,
+        waiting if needed. Returns (connection, time it became idle) or
+        (None, None) if a new connection should be opened.
+        """
+        tid = thread.get_ident()
+        start = None
+        self.lock.acquire()
+        try:
+            while True:
+                if self.closed:
+                    raise sqlite.ProgrammingError, \
+                          'The connection pool of %s is closed.' % self.name
+                if self.idleCount:
+                    conns = self.idle.get(tid)
+                    if not conns:
+                        for otherTid, conns in self.idle.items():
+                            if conns:
+                                break
+                        self.stolen += 1
+                    con, idleSince = conns.pop()
+                    self.idleCount -= 1
+                    self.reused += 1
+                    break
+                if self.size < self.maxSize:
+                    self.size += 1
+                    self.opened += 1
+                    con = idleSince = None
+                    break
+
+                now = time.time()
+                if start is None:
+                    start = now
+                    self.waits += 1
+                remaining = start + self.timeout - now
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self._recordWait(now - start)
+                    raise PoolTimeout, \
+                          'No connection to %s available after %s seconds' % \
+                          (self.name, self.timeout)
+                self.available.wait(remaining)
+
+            if start is not None:
+                self._recordWait(time.time() - start)
+            for otherTid in [t for t, conns in self.idle.items() if not conns]:
+                del self.idle[otherTid]
+            return con, idleSince
+        finally:
+            self.lock.release()
+
+    def _recordWait(self, waited):
+        self.waitTime += waited
+        if waited > self.maxWait:
+            self.maxWait = waited
+
+    def _connect(self):
+        # connections are handed from thread to thread, but only one
+        # thread uses a connection at a time
+        con = sqlite.connect(self.name, timeout=10.0,
+                             check_same_thread=False,
+                             cached_statements=self.statementCacheSize)
+        # allows us to select by column name instead of just by index
+        con.row_factory = sqlite.Row
+        conf = pjs.conf.conf
+        for pragma, value in (('synchronous', conf.dbSynchronous),
+                              ('cache_size', conf.dbCacheSize),
+                              ('mmap_size', conf.dbMmapSize)):
+            if value is not None:
+                con.execute("PRAGMA %s = %s" % (pragma, value))
+        return con
+
+    def _isHealthy(self, con):
+        try:
+            con.execute("SELECT 1").fetchone()
+            return True
+        except Exception, e:
+            logging.warning("[%s] Connection to %s failed the check: %s",
+                            self.__class__, self.name, e)
+            return False
+
+    def _discard(self, con):
+        """Closes con and frees its place in the pool"""
+        try:
+            con.close()
+        except: pass
+        self.lock.acquire()
+        try:
+            self.discarded += 1
+        finally:
+            self.lock.release()
+        self._release()
+
+    def _release(self):
+        """Frees the place of a connection that's gone"""
+        self.lock.acquire()
+        try:
+            self.size -= 1
+            self.available.notify()
+        finally:
+            self.lock.release()
+
+# DB name => ConnectionPool
+pools = {}
+_poolsLock = threading.Lock()
+
+def getPool(name=None):
+    """Returns the ConnectionPool of the DB name or of the current DB"""
+    if not name:
+        name = dbname
+    pool = pools.get(name)
+    if pool is None:
+        _poolsLock.acquire()
+        try:
+            pool = pools.get(name)
+            if pool is None:
+                pool = pools[name] = ConnectionPool(name)
+        finally:
+            _poolsLock.release()
+    return pool
+
+def closePool(name=None):
+    """Closes the pool of the DB name or of the current DB. This needs to be
+    done before the DB file is removed or replaced.
+    """
+    if not name:
+        name = dbname
+    _poolsLock.acquire()
+    try:
+        pool = pools.pop(name, None)
+    finally:
+        _poolsLock.release()
+    if pool is not None:
+        pool.close()
+
 def DB(name=None, isolationLevel="DEFERRED"):
-    """Connects to the database and returns the connection. Uses the default
-    isolation level (DEFERRED).
+    """Checks a connection out of the pool and returns it. Uses the default
+    isolation level (DEFERRED). Close the connection to return it to the
+    pool.
     name -- DB name. This is cached until it's changed, so if the same DB is
             being accessed, just call DB()
     isolationLevel -- None for autocommit. Otherwise, either "DEFERRED",
@@ -20,16 +362,15 @@ def DB(name=None, isolationLevel="DEFERRED"):
         n = dbname
     else:
         n = dbname = name
-    db = sqlite.connect(n, timeout=10.0, isolation_level=isolationLevel)
-    # allows us to select by column name instead of just by index
-    db.row_factory = sqlite.Row
-    return db
+    return getPool(n).checkout(isolationLevel)
 
-def DBautocommit():
+def DBautocommit(name=None):
     """Connects to the database and returns the connection. Uses the autocommit
     isolation level.
+    name -- DB name. The current DB if not given. Unlike DB(), this doesn't
+            make name the current DB.
     """
-    return DB(isolationLevel=None)
+    return getPool(name).checkout(None)
 
 def commitSQLiteTransaction(con, cursor):
     """Tries to commit the transaction opened in connection 'con' and close
@@ -47,4 +388,37 @@ def commitSQLiteTransaction(con, cursor):
         raise e
 
     cursor.close()
-    return True
\ No newline at end of file
+    return True
+
+def beginImmediate(con):
+    """Starts a transaction on the autocommit connection con that takes the
+    write lock right away, so that what's read in it can't be changed by
+    another writer before it's written back. Returns the cursor to use.
+    Finish the transaction with commitImmediate().
+    """
+    c = con.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    return c
+
+def commitImmediate(con, cursor):
+    """Commits the transaction started with beginImmediate() and closes the
+    cursor. If commit fails, attempts to rollback and raises the DB
+    exception.
+    """
+    try:
+        cursor.execute("COMMIT")
+    except Exception, e:
+        rollbackImmediate(con, cursor)
+        raise e
+
+    cursor.close()
+    return True
+
+def rollbackImmediate(con, cursor):
+    """Rolls back the transaction started with beginImmediate() and closes
+    the cursor. Does nothing if rollback fails.
+    """
+    try:
+        cursor.execute("ROLLBACK")
+    except: pass
+    cursor.close()
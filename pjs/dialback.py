@@ -0,0 +1,140 @@
+"""Server dialback (XEP-0220) support: key generation and the cache of
+verified domains.
+
+The keys are bound to the stream they were issued on (XEP-0185), and a key
+that's verified is only trusted on that stream. A new stream from a domain
+always costs a verification round trip to the domain's authoritative server,
+even if the domain was verified on another stream a moment ago. Trusting the
+domain on new streams would let anyone who can open a stream claim a domain
+that was verified recently, so this is deliberate. What saves the round
+trips is that all verification requests to a domain are sent together over
+our one outgoing connection to it (see pjs.server.S2SServer.requestVerify()),
+and that the VerifiedDomainCache answers a <db:result/> that a remote server
+repeats on a stream it already authorized without asking again.
+
+The handlers that use these are in pjs.handlers.dialback.
+"""
+
+import hmac
+import hashlib
+import os
+import time
+
+import pjs.conf.conf
+
+from pjs.serializer import escapeAttr, escapeText
+
+NS_DIALBACK = 'jabber:server:dialback'
+
+_secret = None
+
+def getSecret():
+    """Returns the secret used for generating dialback keys. It's taken
+    from pjs.conf.conf.dialbackSecret or generated once per process.
+    """
+    global _secret
+    if _secret is None:
+        secret = pjs.conf.conf.dialbackSecret
+        if not secret:
+            secret = os.urandom(32).encode('hex')
+        _secret = hashlib.sha256(secret).hexdigest()
+    return _secret
+
+def makeKey(receiving, originating, streamId):
+    """Generates the dialback key for the stream with streamId that we
+    opened as originating to the receiving server (XEP-0185).
+    """
+    text = '%s %s %s' % (receiving, originating, streamId)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hmac.new(getSecret(), text, hashlib.sha256).hexdigest()
+
+def checkKey(key, receiving, originating, streamId):
+    """Returns True if key is the one we generated for the stream"""
+    if not key:
+        return False
+    expected = makeKey(receiving, originating, streamId)
+    if len(key) != len(expected):
+        return False
+    # compare in constant time
+    res = 0
+    for a, b in zip(key, expected):
+        res |= ord(a) ^ ord(b)
+    return res == 0
+
+def resultElement(frm, to, key=None, type=None):
+    """Returns the text of a <db:result/>"""
+    return _dbElement('result', frm, to, None, key, type)
+
+def verifyElement(frm, to, id, key=None, type=None):
+    """Returns the text of a <db:verify/>"""
+    return _dbElement('verify', frm, to, id, key, type)
+
+def _dbElement(name, frm, to, id, key, type):
+    out = u"<db:%s from='%s' to='%s'" % (name, escapeAttr(frm), escapeAttr(to))
+    if id is not None:
+        out += u" id='%s'" % escapeAttr(id)
+    if type is not None:
+        out += u" type='%s'" % type
+    if key:
+        return out + u">%s</db:%s>" % (escapeText(key), name)
+    return out + u"/>"
+
+class VerifiedDomainCache:
+    """Remembers the keys that the authoritative servers confirmed recently
+    for the streams we issued, so that a remote server repeating its
+    <db:result/> on the same stream doesn't need another verification round
+    trip. The keys are bound to the stream id (see makeKey()), so a key is
+    never trusted on another stream and new streams aren't sped up by this.
+    """
+    def __init__(self, ttl=None, maxSize=10000):
+        if ttl is None:
+            ttl = pjs.conf.conf.dialbackCacheTTL
+        self.ttl = ttl
+        self.maxSize = maxSize
+
+        # (domain, stream id) => (key, expiry time)
+        self.entries = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, domain, streamId, key):
+        """Records that the key was verified for domain on the stream with
+        streamId
+        """
+        if len(self.entries) >= self.maxSize:
+            self.purge()
+            if len(self.entries) >= self.maxSize:
+                self.entries.clear()
+        self.entries[(domain, streamId)] = (key, time.time() + self.ttl)
+
+    def isVerified(self, domain, streamId, key):
+        """Returns True if the key was verified for domain on the stream
+        with streamId within the TTL
+        """
+        entry = self.entries.get((domain, streamId))
+        if entry is not None:
+            if entry[1] <= time.time():
+                del self.entries[(domain, streamId)]
+            elif entry[0] == key:
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def invalidate(self, domain):
+        """Forgets all verified keys of domain"""
+        for k in self.entries.keys():
+            if k[0] == domain:
+                del self.entries[k]
+
+    def purge(self):
+        """Removes the expired entries"""
+        now = time.time()
+        for k, (key, expires) in self.entries.items():
+            if expires <= now:
+                del self.entries[k]
+
+    def __len__(self):
+        return len(self.entries)
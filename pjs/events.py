@@ -6,6 +6,7 @@ import logging
 
 from pjs.conf.phases import corePhases, c2sStanzaPhases, s2sStanzaPhases
 from pjs.conf.handlers import handlers as h
+from pjs.jid import JID
 from pjs.utils import compact_traceback
 
 from pjs.queues import _runningMessages, _processingQ, resultQ
@@ -104,11 +105,15 @@ class Message:
         # connection can now be processed
         resultQ.put((self.conn.id, self.outputBuffer or None))
 
-    def resume(self):
+    def resume(self, e=None):
         """Resumes the execution of handlers. This is the callback for when
-        the thread is done executing. It gets called by the Connection.
+        the thread is done executing. It gets called by the Connection. e is
+        the exception raised by the handler's initiating or checking
+        function, if any.
         """
-        if callable(self._handlerResumeFunc):
+        if e is not None:
+            self._lastRetVal = e
+        elif callable(self._handlerResumeFunc):
             self._lastRetVal = self._handlerResumeFunc()
         if isinstance(self._lastRetVal, Exception):
             self._gotException = True
@@ -139,10 +144,21 @@ class Message:
             self._lastRetVal = e
 
     def _execThreadedHandler(self, handler):
-        """Run a handler out of process with a callback to resume"""
-        checkFunc, initFunc = handler.handle(self.tree, self, self._lastRetVal)
-        self._handlerResumeFunc = handler.resume
-        self.conn.watch_function(checkFunc, self.resume, initFunc)
+        """Run a handler out of process with a callback to resume. Returns
+        False if the handler couldn't be started, in which case the exception
+        is recorded like an in-process handler's.
+        """
+        try:
+            checkFunc, initFunc = handler.handle(self.tree, self, self._lastRetVal)
+            self._handlerResumeFunc = handler.resume
+            self.conn.watch_function(checkFunc, self.resume, initFunc)
+        except Exception, e:
+            nil, t, v, tbinfo = compact_traceback()
+            logging.debug("Exception in threaded handler: %s: %s -- %s", t,v,tbinfo)
+            self._gotException = True
+            self._lastRetVal = e
+            return False
+        return True
 
     def _execLink(self):
         """Execute a single link in the chain of handlers"""
@@ -156,8 +172,8 @@ class Message:
                 if isinstance(errorHandler, pjs.handlers.base.Handler):
                     self._execHandler(errorHandler)
                 elif isinstance(errorHandler, pjs.handlers.base.ThreadedHandler):
-                    self._execThreadedHandler(errorHandler)
-                    return True
+                    if self._execThreadedHandler(errorHandler):
+                        return True
                 else:
                     logging.warning("[%s] Unknown error handler type (%s) for %s",
                                     self.__class__, type(errorHandler),
@@ -177,8 +193,8 @@ class Message:
                     self.lastInPair = True
                     self._updateRunningHandlers()
             elif isinstance(handler, pjs.handlers.base.ThreadedHandler):
-                self._execThreadedHandler(handler)
-                return True
+                if self._execThreadedHandler(handler):
+                    return True
             else:
                 logging.warning("[%s] Unknown handler type (%s) for %s",
                                 self.__class__, type(handler), handler)
@@ -295,5 +311,23 @@ class _S2SStanzaDispatcher(_Dispatcher):
     def __init__(self):
         self.phasesList = s2sStanzaPhases
 
+    def dispatch(self, tree, conn, knownPhase=None):
+        """Dispatches the stanza if it comes from a domain that was verified
+        on the connection. Only remote servers' connections keep the list of
+        verified domains. See _Dispatcher.dispatch()
+        """
+        verified = conn and conn.data.get('server', {}).get('verified')
+        if verified is not None:
+            frm = tree[0].get('from')
+            try:
+                domain = frm and JID(frm).domain
+            except Exception:
+                domain = None
+            if domain not in verified:
+                logging.warning("[%s] Dropping stanza from unverified " +\
+                                "domain %s", self.__class__, domain)
+                return
+        _Dispatcher.dispatch(self, tree, conn, knownPhase)
+
 _s2sStanzaDispatcher = _S2SStanzaDispatcher()
 def S2SStanzaDispatcher(): return _s2sStanzaDispatcher
\ No newline at end of file
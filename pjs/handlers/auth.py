@@ -4,6 +4,8 @@
 
 import pjs.auth_mechanisms as mechs
 import pjs.threadpool as threadpool
+import pjs.scram
+import pjs.procpool
 import logging
 
 from pjs.handlers.base import Handler, ThreadedHandler, poll, chainOutput
@@ -116,6 +118,12 @@ class SASLAuthHandler(ThreadedHandler):
                 digest = mechs.SASLDigestMD5(msg)
                 data['sasl']['mechObj'] = digest
                 return chainOutput(lastRetVal, digest.handle())
+            elif mech in pjs.scram.getMechanisms():
+                data['sasl']['mech'] = mech
+                scram = mechs.SASLScram(msg, mech)
+                data['sasl']['mechObj'] = scram
+                text = tree.text and tree.text.strip()
+                return chainOutput(lastRetVal, scram.handle(text))
             else:
                 logging.warning("[%s] Mechanism %s not implemented",
                                 self.__class__, mech)
@@ -146,6 +154,10 @@ class SASLAuthHandler(ThreadedHandler):
         
 class SASLResponseHandler(ThreadedHandler):
     """Handles SASL's <response> element sent from the other side"""
+
+    # the responses are checked by hashing
+    cpuBound = True
+
     def __init__(self):
         # this is true when the threaded handler returns
         self.done = False
@@ -156,6 +168,7 @@ class SASLResponseHandler(ThreadedHandler):
         self.done = False
         
         tpool = msg.conn.server.threadpool
+        execute = pjs.procpool.getExecutor(self)
         
         # the actual function executing in the thread
         def act():
@@ -169,9 +182,10 @@ class SASLResponseHandler(ThreadedHandler):
     
             text = tree.text
             if text:
-                return chainOutput(lastRetVal, mech.handle(text.strip()))
+                return chainOutput(lastRetVal, mech.handle(text.strip(),
+                                                           execute))
             else:
-                return chainOutput(lastRetVal, mech.handle(tree))
+                return chainOutput(lastRetVal, mech.handle(tree, execute))
                 
         def cb(workReq, retVal):
             self.done = True
@@ -27,6 +27,12 @@ class ThreadedHandler:
     run in the thread can block if needed, but the handler must be able to
     continue running after the thread's done.
     """
+
+    # True if the work is mostly computation, which the handler runs with
+    # the executor of pjs.procpool.getExecutor() so that it can be moved out
+    # of the server process. See processPoolHandlers in pjs.conf.handlers.
+    cpuBound = False
+
     def __init__(self):
         """Will be called at server start"""
         pass
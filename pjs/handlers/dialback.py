@@ -0,0 +1,88 @@
+"""Server dialback (XEP-0220) handlers.
+
+We are the originating server on our outgoing connections: we send a
+<db:result/> with our key when the remote stream opens, and start sending
+stanzas when it comes back as valid. On incoming connections we are the
+receiving server and ask the authoritative server of the remote domain to
+verify the key over our outgoing connection to it, unless the same key was
+already verified on this stream. Stanzas are only accepted from the domains
+that were verified on the stream. When a remote server asks us to verify a key we generated,
+we check it with pjs.dialback.checkKey().
+"""
+
+import logging
+
+from pjs.handlers.base import Handler
+from pjs.dialback import checkKey, resultElement, verifyElement
+
+class DialbackResultHandler(Handler):
+    """Handles <db:result/> on both incoming and outgoing connections"""
+    def handle(self, tree, msg, lastRetVal=None):
+        conn = msg.conn
+        s2s = conn.server
+        frm = tree.get('from')
+        to = tree.get('to')
+        type = tree.get('type')
+
+        if not frm or not to:
+            logging.debug("[%s] Malformed db:result", self.__class__)
+            return lastRetVal
+
+        if type is not None:
+            # the answer to the key we sent on our outgoing connection
+            if conn.data['server'].get('direction') != 'to':
+                return lastRetVal
+            if type == 'valid':
+                logging.info("[%s] %s accepted our dialback key",
+                             self.__class__, frm)
+                conn.outQueue.attach(conn)
+            else:
+                logging.warning("[%s] %s rejected our dialback key",
+                                self.__class__, frm)
+                conn.outQueue.clear()
+            return lastRetVal
+
+        # a remote server wants to send to us over this incoming connection
+        if not s2s.isLocalDomain(to):
+            msg.addTextOutput(resultElement(to, frm, type='invalid'))
+            return lastRetVal
+
+        key = tree.text
+        streamId = conn.data['stream']['id']
+        if streamId and s2s.dialbackCache.isVerified(frm, streamId, key):
+            s2s.inboundVerified(conn, frm)
+            msg.addTextOutput(resultElement(to, frm, type='valid'))
+        else:
+            s2s.requestVerify(frm, to, conn, key)
+
+        return lastRetVal
+
+class DialbackVerifyHandler(Handler):
+    """Handles <db:verify/> requests to us as the authoritative server and
+    the answers to our own requests.
+    """
+    def handle(self, tree, msg, lastRetVal=None):
+        conn = msg.conn
+        frm = tree.get('from')
+        to = tree.get('to')
+        id = tree.get('id')
+        type = tree.get('type')
+
+        if not frm or not to or not id:
+            logging.debug("[%s] Malformed db:verify", self.__class__)
+            return lastRetVal
+
+        if type is not None:
+            # answer to a request sent by S2SServer.requestVerify()
+            conn.server.verifyAnswered(frm, id, type == 'valid')
+            return lastRetVal
+
+        # we're the authoritative server. frm is the receiving server that
+        # got our key on the stream with this id.
+        if checkKey(tree.text, frm, to, id):
+            type = 'valid'
+        else:
+            type = 'invalid'
+        msg.addTextOutput(verifyElement(to, frm, id, type=type))
+
+        return lastRetVal
@@ -4,9 +4,13 @@ import logging
 import pjs.threadpool as threadpool
 
 from pjs.handlers.base import ThreadedHandler, Handler, chainOutput, poll
+import pjs.conf.conf
+
 from pjs.roster import Roster
+from pjs.rosterstream import RosterStream
 from pjs.elementtree.ElementTree import Element, SubElement
 from pjs.utils import tostring, generateId, FunctionCall
+from pjs.serializer import StanzaTemplate
 from copy import deepcopy
 
 def bindResource(msg, resource):
@@ -25,13 +29,32 @@ def bindResource(msg, resource):
     data['user']['resource'] = resource
 
     # record the resource in the JID object of the (JID, Connection) pair
-    # this is for local delivery lookups
     server.conns[msg.conn.id][0].resource = resource
 
-    # save the jid/resource in the server's global storage
-    if not server.data['resources'].has_key(jid):
-        server.data['resources'][jid] = {}
-    server.data['resources'][jid][resource] = msg.conn
+    # save the jid/resource in the server's session index. this also
+    # updates server.data['resources']. it's used for local delivery lookups.
+    server.sessions.bind(msg.conn, jid, resource)
+
+def makeRosterPush(to, version, cjid, item):
+    """Creates a roster push <iq> for the JID to with the change to the
+    contact cjid in the roster version. item is the contact's RosterItem or
+    None if the contact was removed.
+    """
+    iq = Element('iq', {
+                        'to' : to,
+                        'type' : 'set',
+                        'id' : generateId()[:10]
+                        })
+    query = SubElement(iq, 'query', {
+                                     'xmlns' : 'jabber:iq:roster',
+                                     'ver' : str(version)
+                                     })
+    if item is not None:
+        query.append(item.getAsTree())
+    else:
+        SubElement(query, 'item', {'jid' : cjid, 'subscription' : 'remove'})
+
+    return iq
 
 class IQBindHandler(Handler):
     """Handles resource binding"""
@@ -76,6 +99,19 @@ class IQSessionHandler(Handler):
 
         return chainOutput(lastRetVal, res)
 
+def makeInternalError(tree, to):
+    """Creates the internal-server-error reply to the <iq> tree"""
+    iq = Element('iq', {
+                        'to' : to,
+                        'type' : 'error',
+                        'id' : tree.get('id')
+                        })
+    error = SubElement(iq, 'error', {'type' : 'cancel'})
+    SubElement(error, 'internal-server-error', {
+                               'xmlns' : 'urn:ietf:params:xml:ns:xmpp-stanzas'
+                               })
+    return iq
+
 class IQRosterGetHandler(ThreadedHandler):
     """Responds to a roster iq get request"""
     def __init__(self):
@@ -83,9 +119,12 @@ class IQRosterGetHandler(ThreadedHandler):
         self.done = False
         # used to pass the output to the next handler
         self.retVal = None
+        # RosterStream for big rosters
+        self.stream = None
 
     def handle(self, tree, msg, lastRetVal=None):
         self.done = False
+        self.stream = None
 
         tpool = msg.conn.server.threadpool
 
@@ -104,16 +143,60 @@ class IQRosterGetHandler(ThreadedHandler):
                 return
 
             roster = Roster(jid)
-
-            roster.loadRoster()
+            to = '/'.join([jid, resource])
 
             res = Element('iq', {
-                                 'to' : '/'.join([jid, resource]),
+                                 'to' : to,
                                  'type' : 'result',
                                  'id' : id
                                  })
 
-            res.append(roster.getAsTree())
+            # clients that support roster versioning send the version of the
+            # roster they have (RFC 6121 2.6). this is read before the roster
+            # so that it's never newer than what we send.
+            ver = tree[0].get('ver')
+            if ver is not None:
+                current = roster.getVersion()
+                if ver == str(current):
+                    # the client's roster is up to date
+                    return chainOutput(lastRetVal, res)
+
+            # counted without loading the roster, so that big rosters can be
+            # streamed
+            count = roster.countItems()
+
+            if ver is not None:
+                # send the full roster if it's smaller than the changes
+                changes = roster.getChanges(ver, count)
+                if changes is not None:
+                    retVal = chainOutput(lastRetVal, res)
+                    for version, cjid, item in changes:
+                        retVal = chainOutput(retVal,
+                                             makeRosterPush(to, version, cjid, item))
+                    return retVal
+
+            # big rosters are written to the connection in chunks by
+            # checkFunc as they're read
+            threshold = pjs.conf.conf.rosterStreamThreshold
+            if threshold and count >= threshold:
+                query = SubElement(res, 'query', {'xmlns' : 'jabber:iq:roster'})
+                if ver is not None:
+                    query.set('ver', str(current))
+                stream = RosterStream(msg.conn, res)
+                # checkFunc writes the chunks while they're produced
+                self.stream = stream
+                if not stream.produce(roster.iterItems()):
+                    # nothing was written. never send a part of the roster
+                    # as if it were all of it.
+                    return chainOutput(lastRetVal, makeInternalError(tree, to))
+                return
+
+            roster.loadRoster()
+
+            query = roster.getAsTree()
+            if ver is not None:
+                query.set('ver', str(current))
+            res.append(query)
             return chainOutput(lastRetVal, res)
 
         def cb(workReq, retVal):
@@ -129,6 +212,9 @@ class IQRosterGetHandler(ThreadedHandler):
         def checkFunc():
             # need to poll manually or the callback's never called from the pool
             poll(tpool)
+            if self.stream is not None:
+                # the chunks are written as the client reads them
+                return self.stream.pump() and self.done
             return self.done
 
         def initFunc():
@@ -201,9 +287,15 @@ class IQRosterUpdateHandler(ThreadedHandler):
                      }
 
                 query = deepcopy(tree[0])
+                if 'ver' in query.attrib:
+                    del query.attrib['ver']
 
                 retVal = chainOutput(lastRetVal, query)
 
+                # the user won't get the contact's presence anymore
+                msg.conn.server.contactPresences.setSubscription(jid, cjid,
+                                                                 False)
+
                 if roster.removeContact(cjid) is False:
                     # We don't even have this contact in the roster anymore.
                     # The contact is probably local (like ourselves).
@@ -220,6 +312,8 @@ class IQRosterUpdateHandler(ThreadedHandler):
                     # problem should go away, as it will allow the roster-push
                     # to arrive after presences every time.
                     pass
+                else:
+                    query.set('ver', str(roster.version))
 
                 # route the presence first, then do a roster push
                 msg.setNextHandler('roster-push')
@@ -237,7 +331,8 @@ class IQRosterUpdateHandler(ThreadedHandler):
             sub = roster.getSubPrimaryName(cid)
 
             # prepare the result for roster push
-            query = Roster.createRosterQuery(cjid, sub, name, groups)
+            query = Roster.createRosterQuery(cjid, sub, name, groups,
+                                             version=roster.version)
 
             msg.setNextHandler('roster-push')
 
@@ -332,19 +427,25 @@ class RosterPushHandler(ThreadedHandler):
                 resource = msg.conn.data['user']['resource']
                 resources = msg.conn.server.data['resources'][jid]
 
+            # pushes carry the version of the change they're for, set by the
+            # handler that made it, so that the clients that cache the roster
+            # can ask only for later changes. pushes without a change don't
+            # carry one, since the current version could include changes
+            # whose pushes the client didn't get yet.
+
+            # the push is the same for all resources except for the 'to'
+            # and 'id', so serialize it only once
+            iq = Element('iq', {'type' : 'set'})
+            iq.append(query)
+            template = StanzaTemplate(iq, ('to', 'id'))
+
             for res, con in resources.items():
                 # don't send the roster to clients that didn't request it
                 if con.data['user']['requestedRoster']:
-                    iq = Element('iq', {
-                                        'to' : '%s/%s' % (jid, res),
-                                        'type' : 'set',
-                                        'id' : generateId()[:10]
-                                        })
-                    iq.append(query)
-
-                    # TODO: remove this. debug.
-                    logging.debug("Sending " + tostring(iq))
-                    con.send(tostring(iq))
+                    out = template.render(to='%s/%s' % (jid, res),
+                                          id=generateId()[:10])
+                    logging.debug("[%s] Sending %s", self.__class__, out)
+                    con.send(out)
 
             if tree.tag == '{jabber:client}iq' and tree.get('id'):
                 # send an ack to client if this is in reply to a roster get/set
@@ -6,113 +6,94 @@ import pjs.threadpool as threadpool
 from pjs.handlers.base import ThreadedHandler, Handler, chainOutput, poll
 from pjs.elementtree.ElementTree import Element
 from pjs.utils import FunctionCall, tostring
+from pjs.serializer import StanzaTemplate
+from pjs.handlers.route import RouteBatch
 from pjs.roster import Roster, Subscription
+from pjs.subscriptions import getSubscriptionGraph
 from pjs.jid import JID
 from copy import deepcopy
 
-# TODO: this class can be made into a regular Handler by introducing a
-# subscribers/subscriptions cache and updating it in a separate
-# ThreadedHandler (maybe for privacy lists)
-class C2SPresenceHandler(ThreadedHandler):
+# types of subscription <presence/> stanzas
+SUBSCRIPTION_TYPES = ('subscribe', 'subscribed', 'unsubscribe', 'unsubscribed')
+
+class C2SPresenceHandler(Handler):
     """Handles plain <presence> (without type) and
     <presence type="unavailable"> sent by the clients.
+
+    The subscribers and subscriptions come from the subscription graph cache
+    (see pjs.subscriptions), so this runs in the main loop. If the user's
+    subscriptions aren't cached yet, it hands the stanza over to
+    C2SPresenceLoadHandler, which loads them in the threadpool.
+    """
+    def handle(self, tree, msg, lastRetVal=None):
+        if msg.conn.server.presenceCoalescer.hold(msg.conn, tree):
+            # sent later if it's still the latest one. see pjs.coalesce.
+            return lastRetVal
+
+        jid = msg.conn.data['user']['jid']
+        graph = getSubscriptionGraph()
+
+        # the contacts are only probed by the first resource
+        initial = isInitialPresence(tree, msg) and \
+                  not msg.conn.server.contactPresences.has(jid)
+
+        subscribers = graph.getContacts(jid, Subscription.PRESENCE_FROM)
+        subscriptions = None
+        if initial:
+            subscriptions = graph.getContacts(jid, Subscription.PRESENCE_TO)
+
+        if subscribers is None or (initial and subscriptions is None):
+            msg.setNextHandler('c2s-presence-load')
+            return lastRetVal
+
+        return broadcastPresence(tree, msg, lastRetVal,
+                                 subscribers, subscriptions)
+
+class C2SPresenceLoadHandler(ThreadedHandler):
+    """Loads the user's subscriptions into the subscription graph and then
+    does the same as C2SPresenceHandler. This only runs for the user's
+    first presence after the cache was emptied.
+
+    Only the loading runs in the threadpool. The presence is broadcast by
+    resume(), in the main loop like C2SPresenceHandler, so that the
+    connection's state and the user's snapshot are only ever changed from
+    the main loop. A presence from another resource that was broadcast while
+    the subscriptions were loading is seen there, and the contacts aren't
+    probed twice. Later presences from the same connection wait for this one
+    in the connection's Message queue (see pjs.queues).
     """
     def __init__(self):
         # this is true when the threaded handler returns
         self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
+        # (subscribers, subscriptions) read by the thread
+        self.contacts = None
+        self.tree = None
+        self.msg = None
+        self.lastRetVal = None
 
     def handle(self, tree, msg, lastRetVal=None):
         self.done = False
-        self.retVal = lastRetVal
+        self.contacts = None
+        self.tree = tree
+        self.msg = msg
+        self.lastRetVal = lastRetVal
         tpool = msg.conn.server.threadpool
 
         def act():
-            d = msg.conn.data
-
-            retVal = lastRetVal
-
-            jid = d['user']['jid']
-            resource = d['user']['resource']
-
+            jid = msg.conn.data['user']['jid']
             roster = Roster(jid)
 
-            presTree = deepcopy(tree)
-            presTree.set('from', '%s/%s' % (jid, resource))
-
-            probes = []
-            if tree.get('to') is None and not d['user']['active']:
-                # initial presence
-                # TODO: we don't need to do it every time. we can cache the
-                # data after the first resource is active and just resend
-                # that to all new resources
-                d['user']['active'] = True
-
-                # get jids of the contacts whose status we're interested in
-                cjids = roster.getPresenceSubscriptions()
-
-                probeTree = Element('presence', {
-                                                 'type': 'probe',
-                                                 'from' : '%s/%s' \
-                                                    % (jid, resource)
-                                                 })
-
-                # TODO: replace this with a more efficient router handler
-                for cjid in cjids:
-                    probeTree.set('to', cjid)
-                    probeRouteData = {
-                                      'to' : cjid,
-                                      'data' : deepcopy(probeTree)
-                                      }
-                    probes.append(probeRouteData)
-                    # they're sent first. see below
-
-                # broadcast to other resources of this user
-                retVal = self.broadcastToOtherResources(presTree, msg, retVal, jid, resource)
-
-            elif tree.get('to') is not None:
-                # TODO: directed presence
-                return
-            elif tree.get('type') == 'unavailable':
-                # broadcast to other resources of this user
-                d['user']['active'] = False
-                retVal = self.broadcastToOtherResources(presTree, msg, retVal, jid, resource)
-
-            # record this stanza as the last presence sent from this client
-            lastPresence = deepcopy(tree)
-            lastPresence.set('from', '%s/%s' % (jid, resource))
-            d['user']['lastPresence'] = lastPresence
-
-            # lookup contacts interested in presence
-            cjids = roster.getPresenceSubscribers()
-
-            # TODO: replace this with another router handler that would send
-            # it out to all cjids in a batch instead of queuing a handler
-            # for each
-            for cjid in cjids:
-                presTree.set('to', cjid)
-                presRouteData = {
-                     'to' : cjid,
-                     'data' : deepcopy(presTree)
-                     }
-                retVal = chainOutput(retVal, presRouteData)
-                msg.setNextHandler('route-server')
-
-            # send the probes first
-            for probe in probes:
-                msg.setNextHandler('route-server')
-                retVal = chainOutput(retVal, probe)
+            # the first call loads the cache
+            subscribers = roster.getPresenceSubscribers()
+            subscriptions = None
+            if isInitialPresence(tree, msg):
+                subscriptions = roster.getPresenceSubscriptions()
 
-            return retVal
+            return subscribers, subscriptions
 
         def cb(workReq, retVal):
+            self.contacts = retVal
             self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
 
         req = threadpool.makeRequests(act, None, cb)
 
@@ -127,34 +108,131 @@ class C2SPresenceHandler(ThreadedHandler):
         return FunctionCall(checkFunc), FunctionCall(initFunc)
 
     def resume(self):
-        return self.retVal
+        subscribers, subscriptions = self.contacts
+        return broadcastPresence(self.tree, self.msg, self.lastRetVal,
+                                 subscribers, subscriptions)
 
-    def broadcastToOtherResources(self, tree, msg, lastRetVal,
-                                  jid=None, resource=None):
-        """Takes in the stanza to broadcast to other resources of this
-        user and sets the next handler to route-server. Returns the
-        lastRetVal with chained route-server handlers.
-
-        tree -- tree to modify with the 'to' address and send out
-        """
-        jid = jid or msg.conn.data['user']['jid']
-        resource = resource or msg.conn.data['user']['resource']
-
-        retVal = lastRetVal
-
-        resources = msg.conn.server.data['resources'][jid]
-        for r in resources:
-            if r != resource:
-                otherRes = jid + '/' + r
-                tree.set('to', otherRes)
-                presRouteData = {
-                     'to' : otherRes,
-                     'data' : tree
-                     }
-                retVal = chainOutput(lastRetVal, presRouteData)
-                msg.setNextHandler('route-server')
+def isInitialPresence(tree, msg):
+    """Returns True if tree is the first available presence of the
+    connection's resource.
+    """
+    return tree.get('to') is None and not msg.conn.data['user']['active']
+
+def broadcastPresence(tree, msg, lastRetVal, subscribers, subscriptions=None):
+    """Sends the client's presence to the contacts in subscribers and the
+    user's other resources. For the initial presence of the user's first
+    resource, the contacts in subscriptions are probed as well. Additional
+    resources get the contacts' presence from the user's snapshot instead.
+    Returns the new lastRetVal.
+    """
+    d = msg.conn.data
+
+    retVal = lastRetVal
+
+    jid = d['user']['jid']
+    resource = d['user']['resource']
+
+    presTree = deepcopy(tree)
+    presTree.set('from', '%s/%s' % (jid, resource))
+
+    # everything is routed in one batch. probes go first.
+    batch = RouteBatch()
+    fullJID = '%s/%s' % (jid, resource)
+    snapshots = msg.conn.server.contactPresences
+    if isInitialPresence(tree, msg) and snapshots.has(jid):
+        # another resource is already online and has probed the contacts,
+        # so we know their presence
+        d['user']['active'] = True
+
+        for pres in snapshots.get(jid, fullJID):
+            batch.addClient(fullJID, pres)
+
+        # broadcast to other resources of this user
+        broadcastToOtherResources(presTree, msg, batch, jid, resource)
+
+    elif isInitialPresence(tree, msg):
+        # initial presence of the first resource
+        d['user']['active'] = True
+        snapshots.create(jid, subscriptions or [])
+
+        probeTree = Element('presence', {
+                                         'type': 'probe',
+                                         'from' : '%s/%s' \
+                                            % (jid, resource)
+                                         })
+        # serialize once and only splice in the 'to' for each contact
+        probeTemplate = StanzaTemplate(probeTree, ('to',))
+
+        # probes to local contacts are answered right here from the
+        # last-presence store. only remote contacts are really probed.
+        s2s = msg.conn.server.launcher.getS2SServer()
+        store = msg.conn.server.lastPresences
+        for cjid in subscriptions or []:
+            if s2s.isLocalDomain(getDomain(cjid)):
+                for pres in store.get(cjid, fullJID):
+                    snapshots.set(jid, pres.get('from'), pres.template)
+                    batch.addClient(fullJID, pres)
+            else:
+                batch.addServer(cjid, probeTemplate.bind(to=cjid))
+
+        # broadcast to other resources of this user
+        broadcastToOtherResources(presTree, msg, batch, jid, resource)
+
+    elif tree.get('to') is not None:
+        # TODO: directed presence
+        return
+    elif tree.get('type') == 'unavailable':
+        # broadcast to other resources of this user
+        d['user']['active'] = False
+        broadcastToOtherResources(presTree, msg, batch, jid, resource)
+
+        if not hasActiveResources(msg.conn.server, jid):
+            snapshots.drop(jid)
 
-        return retVal
+    # record this stanza as the last presence sent from this client
+    msg.conn.server.lastPresences.update(jid, resource, presTree)
+
+    # the stanza is the same for every contact except for the 'to'
+    presTemplate = StanzaTemplate(presTree, ('to',))
+
+    for cjid in subscribers:
+        batch.addServer(cjid, presTemplate.bind(to=cjid))
+
+    if batch:
+        msg.setNextHandler('route-batch')
+        retVal = chainOutput(retVal, batch)
+
+    return retVal
+
+def hasActiveResources(server, jid):
+    """Returns True if any resource of jid has sent available presence"""
+    for conn in server.data['resources'].get(jid, {}).values():
+        if conn.data['user']['active']:
+            return True
+    return False
+
+def getDomain(jid):
+    """Returns the domain part of the textual JID jid"""
+    return jid.split('@', 1)[-1].split('/', 1)[0]
+
+def broadcastToOtherResources(tree, msg, batch, jid=None, resource=None):
+    """Adds the presence in tree to the RouteBatch batch for delivery to
+    all other bound resources of the user. They're delivered directly,
+    since they're on this server.
+
+    tree -- tree to send out. Its 'to' address is filled in for each
+            resource.
+    """
+    jid = jid or msg.conn.data['user']['jid']
+    resource = resource or msg.conn.data['user']['resource']
+
+    template = StanzaTemplate(tree, ('to',))
+
+    resources = msg.conn.server.data['resources'].get(jid, {})
+    for r in resources:
+        if r != resource:
+            otherRes = jid + '/' + r
+            batch.addClient(otherRes, template.bind(to=otherRes))
 
 class S2SPresenceHandler(Handler):
     """Handles plain <presence> (without type) sent by the servers"""
@@ -168,8 +246,15 @@ class S2SPresenceHandler(Handler):
             return data
 
         logging.debug("[%s] Routing %s", self.__class__, tostring(tree))
+
+        # keep the user's snapshot of the contacts' presence current
+        to = tree.get('to')
+        if to:
+            c2s = msg.conn.server.launcher.getC2SServer()
+            c2s.contactPresences.update(to.split('/', 1)[0], tree)
+
         d = {
-             'to' : tree.get('to'),
+             'to' : to,
              'data' : tree,
              'preprocessFunc' : rewriteTo
              }
@@ -186,19 +271,10 @@ class S2SProbeHandler(Handler):
             logging.debug("[%s] Couldn't create a JID from %s",
                           self.__class__, tree.get('to'))
             return
-        jids = msg.conn.server.launcher.getC2SServer().data['resources']
-        resources = jids.get(jid.getBare())
-        if not resources:
-            return
-
-        lastPresences = []
-        for res, con in resources.items():
-            lp = con.data['user']['lastPresence']
-            if lp is not None:
-                lpcopy = deepcopy(lp) # keep the last presence intact
-                # modify the copy to include the 'to' attr for s2s routing
-                lpcopy.set('to', tree.get('from'))
-                lastPresences.append(lpcopy)
+        # the presences are stored serialized, so this only splices in the
+        # 'to' for each resource
+        store = msg.conn.server.launcher.getC2SServer().lastPresences
+        lastPresences = store.get(jid.getBare(), tree.get('from'))
 
         if lastPresences:
             d = {
@@ -247,35 +323,34 @@ class S2SSubscriptionHandler(ThreadedHandler):
 
             doRoute = False
 
-            cinfo = roster.getContactInfo(cjid.getBare())
             subType = tree.get('type')
+            if subType not in SUBSCRIPTION_TYPES:
+                return
+
+            # the state change is made in one transaction. a contact that
+            # isn't in the roster is added when it asks to subscribe.
+            cinfo, oldSub = roster.applyTransition(cjid.getBare(), 'in', subType,
+                                                   subType == 'subscribe')
+            if cinfo:
+                # the user's snapshot follows the contacts it's subscribed to
+                c2s = msg.conn.server.launcher.getC2SServer()
+                c2s.contactPresences.setSubscription(jid.getBare(),
+                        cjid.getBare(),
+                        cinfo.subscription in Subscription.PRESENCE_TO)
 
             retVal = lastRetVal
 
             # S2S SUBSCRIBE
             if subType == 'subscribe':
 
-                if not cinfo:
-                    # contact doesn't exist, so it's a first-time add
-                    # need to add the contact with subscription None + Pending In
-                    roster.updateContact(cjid.getBare(), None, None, Subscription.NONE_PENDING_IN)
-                    cinfo = roster.getContactInfo(cjid.getBare())
-                    doRoute = True
-                if cinfo.subscription in (Subscription.NONE,
-                                          Subscription.NONE_PENDING_OUT,
-                                          Subscription.TO):
-                    # change state
-                    if cinfo.subscription == Subscription.NONE:
-                        roster.setSubscription(cinfo.id, Subscription.NONE_PENDING_IN)
-                    elif cinfo.subscription == Subscription.NONE_PENDING_OUT:
-                        roster.setSubscription(cinfo.id, Subscription.NONE_PENDING_IN_OUT)
-                    elif cinfo.subscription == Subscription.TO:
-                        roster.setSubscription(cinfo.id, Subscription.TO_PENDING_IN)
-
+                if oldSub in (Subscription.NONE,
+                              Subscription.NONE_PENDING_OUT,
+                              Subscription.TO):
+                    # the state changed (this includes first-time adds)
                     doRoute = True
-                elif cinfo.subscription in (Subscription.FROM,
-                                            Subscription.FROM_PENDING_OUT,
-                                            Subscription.BOTH):
+                elif oldSub in (Subscription.FROM,
+                                Subscription.FROM_PENDING_OUT,
+                                Subscription.BOTH):
                     # auto-reply with "subscribed" stanza
                     doRoute = False
                     out = "<presence to='%s' from='%s' type='subscribed'/>" % (cjid.getBare(), jid.getBare())
@@ -305,20 +380,8 @@ class S2SSubscriptionHandler(ThreadedHandler):
 
                 if cinfo:
                     subscription = cinfo.subscription
-                    if cinfo.subscription in (Subscription.NONE_PENDING_OUT,
-                                              Subscription.NONE_PENDING_IN_OUT,
-                                              Subscription.FROM_PENDING_OUT):
-                        # change state
-                        if cinfo.subscription == Subscription.NONE_PENDING_OUT:
-                            roster.setSubscription(cinfo.id, Subscription.TO)
-                            subscription = Subscription.TO
-                        elif cinfo.subscription == Subscription.NONE_PENDING_IN_OUT:
-                            roster.setSubscription(cinfo.id, Subscription.TO_PENDING_IN)
-                            subscription = Subscription.TO_PENDING_IN
-                        elif cinfo.subscription == Subscription.FROM_PENDING_OUT:
-                            roster.setSubscription(cinfo.id, Subscription.BOTH)
-                            subscription = Subscription.BOTH
-
+                    # only act if we were waiting for the approval
+                    if subscription != oldSub:
                         # forward the subscribed presence
                         # prepare the presence data for routing
                         d = {
@@ -330,7 +393,8 @@ class S2SSubscriptionHandler(ThreadedHandler):
                         # create an updated roster item for roster push
                         query = Roster.createRosterQuery(cinfo.jid,
                                     Subscription.getPrimaryNameFromState(subscription),
-                                    cinfo.name, cinfo.groups)
+                                    cinfo.name, cinfo.groups,
+                                    version=roster.version)
 
                         routeData = {}
                         conns = msg.conn.server.launcher.getC2SServer().data['resources']
@@ -350,22 +414,8 @@ class S2SSubscriptionHandler(ThreadedHandler):
 
                 if cinfo:
                     subscription = cinfo.subscription
-                    if subscription not in (Subscription.NONE,
-                                            Subscription.NONE_PENDING_OUT,
-                                            Subscription.TO):
-                        if subscription == Subscription.NONE_PENDING_IN \
-                          or subscription == Subscription.FROM:
-                            roster.setSubscription(cinfo.id, Subscription.NONE)
-                            subscription = Subscription.NONE
-                        elif subscription == Subscription.NONE_PENDING_IN_OUT \
-                          or subscription == Subscription.FROM_PENDING_OUT:
-                            roster.setSubscription(cinfo.id, Subscription.NONE_PENDING_OUT)
-                            subscription = Subscription.NONE_PENDING_OUT
-                        elif subscription == Subscription.TO_PENDING_IN \
-                          or subscription == Subscription.BOTH:
-                            roster.setSubscription(cinfo.id, Subscription.TO)
-                            subscription = Subscription.TO
-
+                    # only act if the contact was subscribed or asked to be
+                    if subscription != oldSub:
                         # these steps are really in reverse order due to handler queuing
 
                         # send unavailable presence from all resources
@@ -407,7 +457,8 @@ class S2SSubscriptionHandler(ThreadedHandler):
                         # say anything about this, so leave it out for now.
                         query = Roster.createRosterQuery(cinfo.jid,
                                     Subscription.getPrimaryNameFromState(subscription),
-                                    cinfo.name, cinfo.groups)
+                                    cinfo.name, cinfo.groups,
+                                    version=roster.version)
 
                         # needed for S2S roster push
                         routeData = {}
@@ -434,23 +485,8 @@ class S2SSubscriptionHandler(ThreadedHandler):
 
                 if cinfo:
                     subscription = cinfo.subscription
-                    if subscription not in (Subscription.NONE,
-                                            Subscription.NONE_PENDING_IN,
-                                            Subscription.FROM):
-                        # change state
-                        if subscription == Subscription.NONE_PENDING_OUT \
-                          or subscription == Subscription.TO:
-                            roster.setSubscription(cinfo.id, Subscription.NONE)
-                            subscription = Subscription.NONE
-                        elif subscription == Subscription.NONE_PENDING_IN_OUT \
-                          or subscription == Subscription.TO_PENDING_IN:
-                            roster.setSubscription(cinfo.id, Subscription.NONE_PENDING_IN)
-                            subscription = Subscription.NONE_PENDING_IN
-                        elif subscription == Subscription.FROM_PENDING_OUT \
-                          or subscription == Subscription.BOTH:
-                            roster.setSubscription(cinfo.id, Subscription.FROM)
-                            subscription = Subscription.FROM
-
+                    # only act if we were subscribed or asked to be
+                    if subscription != oldSub:
                         # prepare the unsubscribed presence data for routing
                         d = {
                              'to' : jid,
@@ -461,7 +497,8 @@ class S2SSubscriptionHandler(ThreadedHandler):
                         # create an updated roster item for roster push
                         query = Roster.createRosterQuery(cinfo.jid,
                                     Subscription.getPrimaryNameFromState(subscription),
-                                    cinfo.name, cinfo.groups)
+                                    cinfo.name, cinfo.groups,
+                                    version=roster.version)
 
                         # needed for S2S roster push
                         routeData = {}
@@ -529,9 +566,21 @@ class C2SSubscriptionHandler(ThreadedHandler):
                 # TODO: throw exception here
                 return
 
+            if type not in SUBSCRIPTION_TYPES:
+                return
+
             roster = Roster(jid)
-            # get the RosterItem
-            cinfo = roster.getContactInfo(cjid.getBare())
+            # change the state in one transaction and get the RosterItem.
+            # RFC 3921 section 8.2 bullet 4 says we MUST create a new roster
+            # entry with empty name and groups for subscribe requests to
+            # contacts that aren't in the roster.
+            cinfo, oldSub = roster.applyTransition(cjid.getBare(), 'out', type,
+                                                   type == 'subscribe')
+            if cinfo:
+                # the user's snapshot follows the contacts it's subscribed to
+                msg.conn.server.contactPresences.setSubscription(jid,
+                        cjid.getBare(),
+                        cinfo.subscription in Subscription.PRESENCE_TO)
 
             retVal = lastRetVal
 
@@ -541,35 +590,15 @@ class C2SSubscriptionHandler(ThreadedHandler):
                 # we must always route the subscribe presence so as to allow
                 # the other servers to resynchronize their sub lists.
                 # RFC 3921 9.2
-                if not cinfo:
-                    # contact doesn't exist, but according to RFC 3921
-                    # section 8.2 bullet 4 we MUST create a new roster entry
-                    # for it with empty name and groups.
-                    roster.updateContact(cjid.getBare())
-
-                    # now refetch the contact info
-                    cinfo = roster.getContactInfo(cjid.getBare())
-
-                cid = cinfo.id
                 name = cinfo.name
                 subscription = cinfo.subscription
                 groups = cinfo.groups
 
-                # update the subscription state
-                if subscription == Subscription.NONE:
-                    roster.setSubscription(cid, Subscription.NONE_PENDING_OUT)
-                    subscription = Subscription.NONE_PENDING_OUT
-                elif subscription == Subscription.NONE_PENDING_IN:
-                    roster.setSubscription(cid, Subscription.NONE_PENDING_IN_OUT)
-                    subscription = Subscription.NONE_PENDING_IN_OUT
-                elif subscription == Subscription.FROM:
-                    roster.setSubscription(cid, Subscription.FROM_PENDING_OUT)
-                    subscription = Subscription.FROM_PENDING_OUT
-
                 # send a roster push with ask
                 query = Roster.createRosterQuery(cjid.getBare(),
                             Subscription.getPrimaryNameFromState(subscription),
-                            name, groups, {'ask' : 'subscribe'})
+                            name, groups, {'ask' : 'subscribe'},
+                            version=roster.version)
 
                 # stamp presence with 'from' JID
                 treeCopy = deepcopy(tree)
@@ -598,24 +627,13 @@ class C2SSubscriptionHandler(ThreadedHandler):
                                     "non-existent contact %s", self.__class__, cjid)
                 else:
                     subscription = cinfo.subscription
-                    if cinfo.subscription in (Subscription.NONE_PENDING_IN,
-                                              Subscription.NONE_PENDING_IN_OUT,
-                                              Subscription.TO_PENDING_IN):
-                        # update state and deliver
-                        if cinfo.subscription == Subscription.NONE_PENDING_IN:
-                            roster.setSubscription(cinfo.id, Subscription.FROM)
-                            subscription = Subscription.FROM
-                        elif cinfo.subscription == Subscription.NONE_PENDING_IN_OUT:
-                            roster.setSubscription(cinfo.id, Subscription.FROM_PENDING_OUT)
-                            subscription = Subscription.FROM_PENDING_OUT
-                        elif cinfo.subscription == Subscription.TO_PENDING_IN:
-                            roster.setSubscription(cinfo.id, Subscription.BOTH)
-                            subscription = Subscription.BOTH
-
+                    # deliver only if the contact asked to subscribe
+                    if subscription != oldSub:
                         # roster stanza
                         query = Roster.createRosterQuery(cjid.getBare(),
                                     Subscription.getPrimaryNameFromState(subscription),
-                                    cinfo.name, cinfo.groups)
+                                    cinfo.name, cinfo.groups,
+                                    version=roster.version)
 
                         # stamp presence with 'from'
                         treeCopy = deepcopy(tree)
@@ -670,26 +688,12 @@ class C2SSubscriptionHandler(ThreadedHandler):
                     return chainOutput(retVal, d)
                 else:
                     subscription = cinfo.subscription
-                    if subscription == Subscription.BOTH: # mutual
-                        roster.setSubscription(cinfo.id, Subscription.FROM)
-                        subscription = Subscription.FROM
-                    elif subscription in (Subscription.NONE_PENDING_OUT, # one way
-                                          Subscription.NONE_PENDING_IN_OUT,
-                                          Subscription.TO,
-                                          Subscription.TO_PENDING_IN):
-                        if subscription == Subscription.NONE_PENDING_OUT \
-                          or subscription == Subscription.TO:
-                            roster.setSubscription(cinfo.id, Subscription.NONE)
-                            subscription = Subscription.NONE
-                        elif subscription == Subscription.NONE_PENDING_IN_OUT \
-                          or subscription == Subscription.TO_PENDING_IN:
-                            roster.setSubscription(cinfo.id, Subscription.NONE_PENDING_IN)
-                            subscription = Subscription.NONE_PENDING_IN
 
                     # roster stanza
                     query = Roster.createRosterQuery(cjid.getBare(),
                                 Subscription.getPrimaryNameFromState(subscription),
-                                cinfo.name, cinfo.groups)
+                                cinfo.name, cinfo.groups,
+                                version=roster.version)
 
                     # stamp presence with 'from'
                     treeCopy = deepcopy(tree)
@@ -716,22 +720,8 @@ class C2SSubscriptionHandler(ThreadedHandler):
                                     "non-existent contact %s", self.__class__, cjid)
                 else:
                     subscription = cinfo.subscription
-                    if subscription not in (Subscription.NONE,
-                                            Subscription.NONE_PENDING_OUT,
-                                            Subscription.TO):
-                        if subscription == Subscription.NONE_PENDING_IN \
-                          or subscription == Subscription.FROM:
-                            roster.setSubscription(cinfo.id, Subscription.NONE)
-                            subscription = Subscription.NONE
-                        elif subscription == Subscription.NONE_PENDING_IN_OUT \
-                          or subscription == Subscription.FROM_PENDING_OUT:
-                            roster.setSubscription(cinfo.id, Subscription.NONE_PENDING_OUT)
-                            subscription = Subscription.NONE
-                        elif subscription == Subscription.TO_PENDING_IN \
-                          or subscription == Subscription.BOTH:
-                            roster.setSubscription(cinfo.id, Subscription.TO)
-                            subscription = Subscription.TO
-
+                    # only act if the contact was subscribed or asked to be
+                    if subscription != oldSub:
                         # roster query
                         if subscription == Subscription.NONE_PENDING_OUT:
                             itemArgs = {'ask' : 'subscribe'}
@@ -739,7 +729,8 @@ class C2SSubscriptionHandler(ThreadedHandler):
                             itemArgs = {}
                         query = roster.createRosterQuery(cjid.getBare(),
                                         Subscription.getPrimaryNameFromState(subscription),
-                                        cinfo.name, cinfo.groups, itemArgs)
+                                        cinfo.name, cinfo.groups, itemArgs,
+                                        version=roster.version)
 
                         # stamp presence with 'from'
                         treeCopy = deepcopy(tree)
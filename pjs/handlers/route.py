@@ -7,6 +7,7 @@ import logging
 from pjs.handlers.base import Handler, chainOutput
 from pjs.handlers.write import prepareDataForSending
 from pjs.elementtree.ElementTree import Element
+from pjs.serializer import BoundStanza
 from pjs.jid import JID
 
 class ClientRouteHandler(Handler):
@@ -38,7 +39,7 @@ class ClientRouteHandler(Handler):
             logging.warning("[%s] No data to send", self.__class__)
             return
 
-        conns = msg.conn.server.launcher.getC2SServer().conns
+        sessions = msg.conn.server.launcher.getC2SServer().sessions
 
         try:
             to = getRoute(data, to)
@@ -52,24 +53,17 @@ class ClientRouteHandler(Handler):
             logging.warning("[%s] %s" + e, self.__class__, e)
             return
 
-        if jid.resource:
-            # locate the resource of this JID
-            def f(i):
-                if not conns[i][0]: return False
-                return conns[i][0] == jid
+        # locate the resource of this JID or all bound resources if it's
+        # a bare JID
+        if callable(preprocessFunc):
+            for con in sessions.lookup(jid):
+                con.send(prepareDataForSending(preprocessFunc(data, con)))
         else:
-            # locate all active resources of this JID
-            def f(i):
-                jidConn = conns[i]
-                if not jidConn[0]: return False
-                return jidConn[0].node == jid.node and jidConn[0].domain == jid.domain
-
-        activeJids = filter(f, conns)
-        for con in activeJids:
-            if callable(preprocessFunc):
-                conns[con][1].send(prepareDataForSending(preprocessFunc(data, conns[con][1])))
-            else:
-                conns[con][1].send(prepareDataForSending(data))
+            targets = sessions.lookup(jid)
+            if targets:
+                out = prepareDataForSending(data)
+                for con in targets:
+                    con.send(out)
 
 class ServerRouteHandler(Handler):
     """Handles routing of data to a client on this server.
@@ -91,7 +85,8 @@ class ServerRouteHandler(Handler):
             logging.warning("[%s] No data to send", self.__class__)
             return
 
-        s2sConns = msg.conn.server.launcher.getS2SServer().s2sConns
+        s2s = msg.conn.server.launcher.getS2SServer()
+        s2sConns = s2s.s2sConns
         if s2sConns is None:
             return False
 
@@ -107,37 +102,152 @@ class ServerRouteHandler(Handler):
             logging.warning("[%s] " + e, self.__class__)
             return
 
+        if s2s.isLocalDomain(jid.domain):
+            # one of our domains. hand it over in-process.
+            local = s2s.localDelivery
+            if callable(preprocessFunc):
+                local.deliver(preprocessFunc(data, local))
+            else:
+                local.deliver(data)
         # do we have an existing connection to the domain?
-        if jid.domain in s2sConns:
-            # reuse that connection
+        elif s2sConns.get(jid.domain, (None, None))[1] is not None:
+            # reuse that connection. the stanza waits in the domain's queue
+            # until the connection's ready and goes out with the rest of
+            # what's queued.
+            conn = s2sConns[jid.domain][1]
             if callable(preprocessFunc):
-                s2sConns[jid.domain][1].send(prepareDataForSending(preprocessFunc(data, s2sConns[jid.domain][1])))
+                conn.outQueue.put(prepareDataForSending(preprocessFunc(data, conn)))
             else:
-                s2sConns[jid.domain][1].send(prepareDataForSending(data))
+                conn.outQueue.put(prepareDataForSending(data))
         else:
-            # create a new S2S connection
+            # create a new S2S connection. the domain is looked up and
+            # connected to in the background.
             # populate the dictionary for the new s2s connection creator
             d = msg.conn.data
             newconn = d.setdefault('new-s2s-conn', {})
             newconn['connected'] = False
             newconn['hostname'] = jid.domain
-            if jid.domain == msg.conn.server.launcher.hostname:
-                newconn['local'] = True
-            if jid.domain == msg.conn.server.hostname:
-                newconn['ip'] = jid.domain
-            else:
-                # TODO: Domain lookup here for S2S via another handler
-                pass
             newconn['queue'] = [prepareDataForSending(data)]
 
             msg.setNextHandler('new-s2s-conn')
 
+class RouteBatch:
+    """A list of stanzas to route in a single pass of BatchRouteHandler.
+    Handlers that fan out to many recipients (eg. presence broadcasts) add
+    all of their stanzas to one of these instead of queuing a route handler
+    per recipient.
+    """
+    def __init__(self):
+        # list of (isClient, to, data, preprocessFunc) tuples
+        self.entries = []
+
+    def addClient(self, to, data, preprocessFunc=None):
+        """Queues data for delivery to the local client(s) of 'to'. This
+        works like ClientRouteHandler. See ClientRouteHandler.__doc__ for
+        the parameters.
+        """
+        self.entries.append((True, to, data, preprocessFunc))
+
+    def addServer(self, to, data):
+        """Queues data for delivery to the server of 'to'. This works like
+        ServerRouteHandler.
+        """
+        self.entries.append((False, to, data, None))
+
+    def __len__(self):
+        return len(self.entries)
+
+class BatchRouteHandler(Handler):
+    """Routes all stanzas in a RouteBatch. This handler requires
+    lastRetVal[-1] to be a RouteBatch.
+
+    The stanzas are grouped by the connection or remote domain they go out
+    to, so that each client connection gets a single write and each remote
+    domain's outbound queue gets a single batch.
+    """
+    def handle(self, tree, msg, lastRetVal=None):
+        if not isinstance(lastRetVal[-1], RouteBatch):
+            logging.warning("[%s] Passed in incorrect routing structure",
+                            self.__class__)
+            return
+
+        batch = lastRetVal.pop()
+        deliverBatch(batch, msg.conn.server.launcher)
+
+        return lastRetVal
+
+def deliverBatch(batch, launcher):
+    """Sends out all stanzas in the RouteBatch batch. Stanzas for remote
+    domains are queued in the domains' outbound queues, which creates the
+    connections if necessary.
+    """
+    sessions = launcher.getC2SServer().sessions
+    s2s = launcher.getS2SServer()
+
+    # conn.id => [conn, list of unicode chunks]. the order of the
+    # connections is kept in connOrder.
+    outputs = {}
+    connOrder = []
+
+    # remote domain => list of unicode chunks
+    remote = {}
+    domainOrder = []
+
+    def add(conn, out):
+        try:
+            outputs[conn.id][1].append(out)
+        except KeyError:
+            outputs[conn.id] = [conn, [out]]
+            connOrder.append(conn.id)
+
+    for isClient, to, data, preprocessFunc in batch.entries:
+        if data is None:
+            continue
+        try:
+            jid = getJID(getRoute(data, to))
+        except Exception, e:
+            logging.warning("[BatchRoute] %s", e)
+            continue
+
+        if isClient:
+            targets = sessions.lookup(jid)
+            if callable(preprocessFunc):
+                for con in targets:
+                    add(con, prepareDataForSending(preprocessFunc(data, con)))
+            elif targets:
+                out = prepareDataForSending(data)
+                for con in targets:
+                    add(con, out)
+        elif s2s.isLocalDomain(jid.domain):
+            # our own domain. these are dispatched in-process, but the
+            # stanzas still go in one batch.
+            if isinstance(data, list):
+                for item in data:
+                    add(s2s.localDelivery, item)
+            else:
+                add(s2s.localDelivery, data)
+        else:
+            if jid.domain not in remote:
+                remote[jid.domain] = []
+                domainOrder.append(jid.domain)
+            remote[jid.domain].append(prepareDataForSending(data))
+
+    for id in connOrder:
+        conn, chunks = outputs[id]
+        if conn is s2s.localDelivery:
+            # parsed stanzas are passed along as they are
+            conn.deliver(chunks)
+        else:
+            conn.send(u''.join(chunks))
+
+    for domain in domainOrder:
+        s2s.sendTo(domain, u''.join(remote[domain]))
 
 def getRoute(data, to):
     """Figure out the route from the data"""
     if to: return to
     else:
-        if isinstance(data, Element):
+        if isinstance(data, Element) or isinstance(data, BoundStanza):
             to = data.get('to')
             if not to:
                 raise Exception, "Can't extract routing information from %s" \
@@ -3,14 +3,64 @@ negotiation etc. Auth is handled separately in auth.py.
 """
 
 import logging
-import socket
-import pjs.threadpool as threadpool
 
-from pjs.handlers.base import Handler, ThreadedHandler, chainOutput, poll
-from pjs.handlers.write import prepareDataForSending
-from pjs.utils import generateId, FunctionCall
+import pjs.conf.features as features
+
+from pjs.handlers.base import Handler, chainOutput
+from pjs.utils import generateId
+from pjs.serializer import tobytes, escapeAttr
+from pjs.dialback import makeKey, resultElement
+from pjs.subscriptions import getSubscriptionGraph
+from pjs.rostercache import getRosterCache
 from pjs.elementtree.ElementTree import Element, SubElement
 
+# Pre-encoded pieces of the stream negotiation. Only the host and the stream
+# id differ between connections, so everything else is built once.
+XML_DECL = "<?xml version='1.0'?>"
+STREAM_NS_DECL = "xmlns:stream='http://etherx.jabber.org/streams' "
+DB_NS_DECL = "xmlns:db='jabber:server:dialback' "
+
+def streamHeader(host, id, ns):
+    """Returns the <stream:stream> opening tag that we send in reply to the
+    other side's stream. host is our hostname. host and id are escaped.
+    """
+    if ns == 'jabber:server':
+        # s2s streams need the dialback namespace
+        nsDecl = STREAM_NS_DECL + DB_NS_DECL
+    else:
+        nsDecl = STREAM_NS_DECL
+    return "<stream:stream from='" + escapeAttr(host) + \
+            "' id='" + escapeAttr(id) + \
+            "' xmlns='" + ns + "' " + nsDecl + "version='1.0'>"
+
+def outStreamHeader(host):
+    """Returns the <stream:stream> opening tag that initiates an s2s stream
+    to the remote server with the hostname host, which is escaped.
+    """
+    return "<stream:stream xmlns='jabber:server' " + STREAM_NS_DECL + \
+            DB_NS_DECL + "to='" + escapeAttr(host) + "' version='1.0'>"
+
+# stage => (features generation, encoded <stream:features>)
+_featuresCache = {}
+
+def getFeaturesData(stage):
+    """Returns the encoded <stream:features> element for the stage. See
+    pjs.conf.features. The encoded element is cached until the feature set
+    changes.
+    """
+    gen = features.generation
+    cached = _featuresCache.get(stage)
+    if cached is not None and cached[0] == gen:
+        return cached[1]
+
+    res = Element('stream:features')
+    for feature in features.getFeatures(stage):
+        res.append(feature)
+    data = tobytes(res)
+
+    _featuresCache[stage] = (gen, data)
+    return data
+
 class InStreamInitHandler(Handler):
     """Handler for initializing the stream when it was initiated by the
     remote side.
@@ -40,13 +90,7 @@ class InStreamInitHandler(Handler):
 
         # no one should need to modify this, so we don't pass it along
         # to the next handler, but just add it to the socket write queue
-        # commenting this out for now as it causes expat problems
-        msg.addTextOutput(u"<?xml version='1.0'?>" + \
-        #msg.addTextOutput(
-                "<stream:stream from='%s' id='%s' xmlns='%s' "  \
-                    % (msg.conn.server.hostname, id, ns) + \
-                "xmlns:stream='http://etherx.jabber.org/streams' " + \
-                "version='1.0'>")
+        msg.addTextOutput(XML_DECL + streamHeader(msg.conn.server.hostname, id, ns))
 
 class InStreamReInitHandler(Handler):
     """Handler for a remotely reinitialized stream, such as after TLS/SASL.
@@ -67,10 +111,7 @@ class InStreamReInitHandler(Handler):
 
         msg.conn.data['stream']['id'] = id
 
-        msg.addTextOutput(u"<stream:stream from='%s' id='%s' xmlns='%s' "  \
-                              % (msg.conn.server.hostname, id, ns) + \
-                        "xmlns:stream='http://etherx.jabber.org/streams' " + \
-                        "version='1.0'>")
+        msg.addTextOutput(streamHeader(msg.conn.server.hostname, id, ns))
 
         if msg.conn.data['tls']['complete']:
             # TODO: go to features-auth
@@ -86,128 +127,72 @@ class InStreamReInitHandler(Handler):
 class OutStreamInitHandler(Handler):
     """Handles the reply to our initiating s2s stream"""
     def handle(self, tree, msg, lastRetVal=None):
-        # TODO: continue with features, auth, etc.
-        # for now, just assume it's localhost
+        # TODO: continue with features, TLS, etc.
+        conn = msg.conn
+        hostname = conn.data['server']['hostname']
+        streamId = tree.get('id')
+        conn.data['stream']['id'] = streamId
 
-        # forward any queued messages for this connection
-        out = prepareDataForSending(msg.conn.outQueue)
-        return chainOutput(lastRetVal, out)
+        # authenticate with dialback. the queued stanzas are sent once the
+        # other side says our key is valid. see pjs.handlers.dialback.
+        key = makeKey(hostname, conn.server.hostname, streamId)
+        conn.sendControl(resultElement(conn.server.hostname, hostname, key))
+
+        # also send any dialback verification requests that were waiting
+        # for the stream
+        conn.openStream()
+
+class FeaturesInitHandler(Handler):
+    """Handler for outgoing features after the initial stream header"""
+    def handle(self, tree, msg, lastRetVal=None):
+        return chainOutput(lastRetVal, getFeaturesData('init'))
 
 class FeaturesAuthHandler(Handler):
     """Handler for outgoing features after channel encryption."""
     def handle(self, tree, msg, lastRetVal=None):
-        res = Element('stream:features')
-        mechs = SubElement(res, 'mechanisms',
-                           {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-sasl'})
-        SubElement(mechs, 'mechanism').text = 'DIGEST-MD5'
-        SubElement(mechs, 'mechanism').text = 'PLAIN'
-
-        # we also support the old style jabber:iq:auth
-        SubElement(res, 'auth', {
-                    'xmlns' : 'http://jabber.org/features/iq-auth'
-                    })
-
-        return chainOutput(lastRetVal, res)
-
-# we don't have TLS for now
-FeaturesInitHandler = FeaturesAuthHandler
+        return chainOutput(lastRetVal, getFeaturesData('auth'))
 
 class FeaturesPostAuthHandler(Handler):
     """Handler for outgoing features after authentication."""
     def handle(self, tree, msg, lastRetVal=None):
-        res = Element('stream:features')
-        SubElement(res, 'bind',
-                   {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-bind'})
-        SubElement(res, 'session',
-                   {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-session'})
-
-        return chainOutput(lastRetVal, res)
+        return chainOutput(lastRetVal, getFeaturesData('postauth'))
 
-class NewS2SConnHandler(ThreadedHandler):
+class NewS2SConnHandler(Handler):
     """Creates a new outgoing s2s connection. Gets its data from
     the conn.data dict with key 'new-s2s-conn'.
 
-    This is threaded because socket.connect will block.
+    This doesn't block. The domain is resolved and connected to from the
+    main loop (see pjs.connection.ServerOutConnection), and the queued data
+    waits in the connection's outQueue until the stream is up.
     """
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-        self.retVal = lastRetVal
-        tpool = msg.conn.server.threadpool
-
-        def act():
-            d = msg.conn.data
-            if 'new-s2s-conn' not in d or \
-                'hostname' not in d['new-s2s-conn'] or \
-                'ip' not in d['new-s2s-conn']:
-                logging.warning("[%s] Invoked without necessary data in connection",
-                                self.__class__)
-                return
-
-            local = False
-            if d['new-s2s-conn'].get('local'):
-                local = True
-
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((d['new-s2s-conn']['ip'],
-                          d['new-s2s-conn'].setdefault('port', 5269)))
-
-            serv = msg.conn.server.launcher.getS2SServer()
-            if not serv:
-                logging.warning("[%s] Can't find an S2SServer in launcher",
-                                self.__class__)
-                return
-
-            if local:
-                conn = serv.createLocalOutConnection(sock)
-                # if we're connecting to ourselves, we don't need the <stream>.
-                # instead just send out the outQueue
-                data = d['new-s2s-conn'].get('queue')
-                if data is not None:
-                    conn.send(prepareDataForSending(data))
-            else:
-                sOutConn = serv.createRemoteOutConnection(sock)
-
-                # copy over any queued messages to send once fully connected
-                sOutConn.outQueue.extend(d['new-s2s-conn'].setdefault('queue', []))
-
-                # register the connection with the S2S server
-                serverConns = serv.s2sConns.setdefault(d['new-s2s-conn']['hostname'], [None, None])
-                serverConns[1] = sOutConn
-
-                # send the initial stream
-                # commenting this out for now as it causes expat problems
-                sOutConn.send("<?xml version='1.0' ?>")
-                sOutConn.send("<stream:stream xmlns='jabber:server' " +\
-                              "xmlns:stream='http://etherx.jabber.org/streams' " +\
-                              "to='%s' " % d['new-s2s-conn']['hostname'] + \
-                              "version='1.0'>")
-
-        def cb(workReq, retVal):
-            self.done = True
-            # we don't return anything, but make sure we pass the
-            # lastRetVal along
-            self.retVal = lastRetVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-
-        def initFunc():
-            tpool.putRequest(req[0])
-
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-
-    def resume(self):
-        return self.retVal
+        d = msg.conn.data
+        if 'new-s2s-conn' not in d or \
+            'hostname' not in d['new-s2s-conn']:
+            logging.warning("[%s] Invoked without necessary data in connection",
+                            self.__class__)
+            return
+
+        newconn = d.pop('new-s2s-conn')
+        hostname = newconn['hostname']
+
+        serv = msg.conn.server.launcher.getS2SServer()
+        if not serv:
+            logging.warning("[%s] Can't find an S2SServer in launcher",
+                            self.__class__)
+            return
+
+        if newconn.get('local') or serv.isLocalDomain(hostname):
+            # we're the server for this domain, so there's nothing to
+            # connect to
+            serv.localDelivery.deliver(newconn.get('queue'))
+            return
+
+        addrs = None
+        if 'ip' in newconn:
+            addrs = [(newconn['ip'], newconn.get('port', 5269))]
+
+        serv.connectTo(hostname, newconn.get('queue'), addrs)
 
 class StreamEndHandler(Handler):
     """Handles the other side closing the stream. For clients, this sends out
@@ -253,13 +238,22 @@ class CleanUpConnHandler(Handler):
         conn = msg.conn
         data = msg.conn.data
 
+        jid = None
         if data.has_key('user'):
             jid = data['user']['jid']
-            resource = data['user']['resource']
 
-            # the connection could've been closed before binding
-            if jid and resource:
-                del msg.conn.server.data['resources'][jid][resource]
+            # the connection could've been closed before binding. the
+            # index handles that.
+            conn.server.sessions.remove(conn)
+            conn.server.lastPresences.remove(jid, data['user']['resource'])
+            conn.server.presenceCoalescer.remove(conn)
+
+            # the subscriptions and roster are loaded again when the user
+            # comes back
+            if not conn.server.sessions.isOnline(jid):
+                getSubscriptionGraph().invalidate(jid)
+                getRosterCache().evict(jid)
+                conn.server.contactPresences.drop(jid)
 
         del conn.server.conns[conn.id]
 
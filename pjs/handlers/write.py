@@ -5,6 +5,7 @@ import logging
 
 from pjs.handlers.base import Handler
 from pjs.utils import tostring
+from pjs.serializer import BoundStanza
 
 #TODO: do we need a handler for arbitrary binary data?
 
@@ -17,19 +18,19 @@ class WriteHandler(Handler):
         all items that are either strings or Elements. Doesn't
         modify lastRetVal.
         """
-        out = msg.outputBuffer
+        out = msg.outputBuffer.encode('utf-8')
 
         # clear msg's buffer since we don't want it to be sent twice
         # (Dispatcher sends it after Message processing is done)
         msg.outputBuffer = u''
 
-        out += prepareDataForSending(lastRetVal)
+        out += encodeDataForSending(lastRetVal)
         msg.conn.send(out)
 
 def prepareDataForSending(lastRetVal):
     """Converts lastRetVal into unicode data that's ready to be sent over
-    the wire. lastRetVal can be either a single unit or a list of: text, Element
-    values.
+    the wire. lastRetVal can be either a single unit or a list of: text, Element,
+    BoundStanza values.
     """
     out = u''
 
@@ -41,8 +42,10 @@ def prepareDataForSending(lastRetVal):
         for item in lastRetVal:
             if isinstance(item, et.Element):
                 out += tostring(item)
+            elif isinstance(item, BoundStanza):
+                out += item.render()
             elif isinstance(item, str):
-                out += unicode(item)
+                out += item.decode('utf-8')
             elif isinstance(item, unicode):
                 out += item
             else:
@@ -51,4 +54,22 @@ def prepareDataForSending(lastRetVal):
                                 " type %s to socket",
                                 type(item))
 
-    return out
\ No newline at end of file
+    return out
+
+def encodeDataForSending(lastRetVal):
+    """Like prepareDataForSending(), but returns the data encoded into UTF-8
+    for Connection.send(). Text that's already encoded, such as the cached
+    <stream:features>, is passed through as it is.
+    """
+    if lastRetVal is None or isinstance(lastRetVal, Exception):
+        return ''
+    if not isinstance(lastRetVal, list):
+        lastRetVal = [lastRetVal]
+
+    out = []
+    for item in lastRetVal:
+        if isinstance(item, str):
+            out.append(item)
+        else:
+            out.append(prepareDataForSending(item).encode('utf-8'))
+    return ''.join(out)
\ No newline at end of file
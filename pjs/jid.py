@@ -1,5 +1,5 @@
 import re
-from pjs.db import DBautocommit
+from pjs.storage.base import getStorage
 
 class JID:
     """Models a JID"""
@@ -25,14 +25,7 @@ class JID:
     
     def exists(self):
         """Returns True if this JID exists in the DB"""
-        c = DBautocommit().cursor()
-        c.execute("SELECT jid FROM jids WHERE jid = ? AND password != ''",
-                  (self.getBare(),))
-        res = c.fetchone()
-        if res:
-            return True
-        else:
-            return False
+        return getStorage().userExists(self.getBare())
         
     def __cmp__(self, other):
         assert isinstance(other, JID)
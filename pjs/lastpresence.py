@@ -0,0 +1,206 @@
+"""Stores of presence information kept in memory.
+
+LastPresenceStore has the last presence of every available resource of the
+local users and is used to answer probes. PresenceSnapshots has the current
+presence of the contacts of the online local users and is sent to a user's
+additional resources instead of probing the contacts again.
+
+The presences are kept serialized (see pjs.serializer.StanzaTemplate) with
+only the 'to' left to fill in, so they're sent with a dict lookup and no
+copying or serialization.
+"""
+
+from threading import RLock
+
+from pjs.serializer import StanzaTemplate
+
+class LastPresenceStore:
+    """Maps bare JIDs of local users to the last available presence of
+    each of their resources.
+    """
+    def __init__(self):
+        # Updates can come from the threadpool (C2SPresenceLoadHandler), so
+        # they're synchronized.
+        self.lock = RLock()
+
+        # bare JID => {resource => StanzaTemplate}
+        self.presences = {}
+
+        self.probes = 0
+        self.answered = 0
+
+    def update(self, jid, resource, tree):
+        """Records tree as the last presence of jid/resource. Unavailable
+        presences remove the resource. tree should have its 'from' set and
+        is not modified.
+        """
+        if tree.get('type') == 'unavailable':
+            self.remove(jid, resource)
+            return
+        template = StanzaTemplate(tree, ('to',))
+        self.lock.acquire()
+        try:
+            self.presences.setdefault(jid, {})[resource] = template
+        finally:
+            self.lock.release()
+
+    def remove(self, jid, resource):
+        """Forgets the presence of jid/resource"""
+        self.lock.acquire()
+        try:
+            resources = self.presences.get(jid)
+            if resources is not None:
+                resources.pop(resource, None)
+                if not resources:
+                    del self.presences[jid]
+        finally:
+            self.lock.release()
+
+    def get(self, jid, to):
+        """Returns the list of the last presences of all available resources
+        of jid addressed to the JID to, as BoundStanzas. The list is empty
+        if jid isn't available.
+        """
+        self.probes += 1
+        self.lock.acquire()
+        try:
+            resources = self.presences.get(jid)
+            if not resources:
+                return []
+            self.answered += 1
+            return [template.bind(to=to) for template in resources.values()]
+        finally:
+            self.lock.release()
+
+    def getResources(self, jid):
+        """Returns the list of available resources of jid"""
+        return self.presences.get(jid, {}).keys()
+
+    def isAvailable(self, jid):
+        """Returns True if jid has at least one available resource"""
+        return bool(self.presences.get(jid))
+
+    def __len__(self):
+        return len(self.presences)
+
+class PresenceSnapshots:
+    """Maps bare JIDs of local users to the current presence of their
+    contacts. A user's snapshot is started when the first resource sends its
+    initial presence and probes the contacts. It's filled in by the answers
+    and the contacts' later broadcasts, follows the subscriptions that change
+    while the user is online (see setSubscription()), and is dropped when the
+    user's last resource goes unavailable.
+    """
+    def __init__(self):
+        self.lock = RLock()
+
+        # bare JID => (set of probed bare JIDs, {contact's full JID =>
+        # StanzaTemplate})
+        self.snapshots = {}
+
+        self.hits = 0
+
+    def create(self, jid, contacts):
+        """Starts the snapshot of jid, whose contacts with bare JIDs in the
+        list contacts were just probed.
+        """
+        self.lock.acquire()
+        try:
+            self.snapshots[jid] = (set(contacts), {})
+        finally:
+            self.lock.release()
+
+    def setSubscription(self, jid, cjid, subscribed):
+        """Records whether the user jid is now subscribed to the presence of
+        the contact with the bare JID cjid. The contact's presences are
+        dropped when the user isn't subscribed anymore.
+        """
+        self.lock.acquire()
+        try:
+            snapshot = self.snapshots.get(jid)
+            if snapshot is None:
+                return
+            contacts, presences = snapshot
+            if subscribed:
+                contacts.add(cjid)
+                return
+            contacts.discard(cjid)
+            for frm in presences.keys():
+                if frm.split('/', 1)[0] == cjid:
+                    del presences[frm]
+        finally:
+            self.lock.release()
+
+    def has(self, jid):
+        """Returns True if jid has a snapshot"""
+        return jid in self.snapshots
+
+    def update(self, jid, tree):
+        """Records the presence in tree sent to the user jid. Only presences
+        that were broadcast to jid's bare JID or that came from probed
+        contacts are recorded, so directed presence is left out.
+        """
+        snapshot = self.snapshots.get(jid)
+        if snapshot is None:
+            return
+        frm = tree.get('from')
+        if not frm:
+            return
+
+        type = tree.get('type')
+        if type == 'unavailable':
+            self.remove(jid, frm)
+            return
+        elif type is not None:
+            return
+
+        to = tree.get('to') or ''
+        if '/' in to and frm.split('/', 1)[0] not in snapshot[0]:
+            return
+
+        self.set(jid, frm, StanzaTemplate(tree, ('to',)))
+
+    def set(self, jid, frm, template):
+        """Records template as the presence of the contact's full JID frm"""
+        self.lock.acquire()
+        try:
+            snapshot = self.snapshots.get(jid)
+            if snapshot is not None:
+                snapshot[1][frm] = template
+        finally:
+            self.lock.release()
+
+    def remove(self, jid, frm):
+        """Forgets the presence of the contact's full JID frm"""
+        self.lock.acquire()
+        try:
+            snapshot = self.snapshots.get(jid)
+            if snapshot is not None:
+                snapshot[1].pop(frm, None)
+        finally:
+            self.lock.release()
+
+    def get(self, jid, to):
+        """Returns the list of the contacts' presences in jid's snapshot
+        addressed to the JID to, as BoundStanzas.
+        """
+        self.lock.acquire()
+        try:
+            snapshot = self.snapshots.get(jid)
+            if snapshot is None:
+                return []
+            self.hits += 1
+            return [template.bind(to=to) for template in snapshot[1].values()]
+        finally:
+            self.lock.release()
+
+    def drop(self, jid):
+        """Drops the snapshot of jid"""
+        self.lock.acquire()
+        try:
+            self.snapshots.pop(jid, None)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.snapshots)
@@ -0,0 +1,267 @@
+"""Outbound stanza queues for remote domains.
+
+Every remote domain that we send to gets one OutboundQueue, which outlives
+the S2S connections to that domain. Stanzas are buffered in it while the
+connection is being set up (DNS, connect, stream and dialback negotiation)
+and are written out in large batches once it's ready. This way a burst of
+stanzas for one domain (eg. a presence broadcast) turns into a few big
+writes instead of one write per stanza.
+
+Stanzas that can't be delivered, because the domain can't be reached or
+they waited too long, are handed to the queue's bounce function, which
+returns errors to their senders (see makeBounce()).
+"""
+
+import time
+import logging
+
+import pjs.async.core as asyncore
+import pjs.conf.conf
+
+from collections import deque
+from copy import copy
+from pjs.elementtree.ElementTree import Element, SubElement, XML
+
+# the most bytes that are joined into a single write
+MAX_WRITE_SIZE = 65536
+
+# error types of the conditions that stanzas are bounced with
+ERROR_TYPES = {
+               'remote-server-not-found' : 'cancel',
+               'remote-server-timeout' : 'wait',
+               'resource-constraint' : 'wait',
+               }
+
+def makeBounce(data, condition):
+    """Creates the error reply to the serialized stanza data, to be sent
+    back to its sender. Returns None for stanzas that mustn't be answered
+    with an error (errors, iq results and presence) or that can't be parsed.
+    See RFC 6120 section 8.3.
+    """
+    try:
+        tree = XML(data)
+    except Exception, e:
+        logging.debug("[outqueue] Can't parse a stanza to bounce: %s", e)
+        return None
+
+    name = tree.tag.split('}')[-1]
+    type = tree.get('type')
+    if name not in ('message', 'iq') or type in ('error', 'result') or \
+            not tree.get('from'):
+        return None
+
+    reply = Element(tree.tag, {'type' : 'error', 'to' : tree.get('from')})
+    if tree.get('to'):
+        reply.set('from', tree.get('to'))
+    if tree.get('id'):
+        reply.set('id', tree.get('id'))
+    for child in tree:
+        reply.append(copy(child))
+    error = SubElement(reply, 'error', {'type' : ERROR_TYPES[condition]})
+    # qualified, so that it keeps its namespace when the reply is moved into
+    # jabber:server for local delivery
+    SubElement(error, '{urn:ietf:params:xml:ns:xmpp-stanzas}' + condition)
+    return reply
+
+class OutboundQueue:
+    """Buffers stanzas for a remote domain until a connection is ready for
+    them, and drains them into the connection in batches.
+
+    Stanzas that wait longer than maxAge seconds are dropped, as are the
+    oldest stanzas once more than maxSize are queued or they take up more
+    than maxBytes bytes. Dropped stanzas are passed to bounce.
+    """
+    def __init__(self, domain, maxSize=None, maxAge=None, maxBytes=None,
+                 bounce=None):
+        """bounce -- optional function called with the list of dropped
+                     stanzas and the stanza error condition (eg.
+                     'remote-server-timeout') to bounce them with.
+        """
+        self.domain = domain
+        if maxSize is None:
+            maxSize = pjs.conf.conf.s2sQueueMaxSize
+        if maxAge is None:
+            maxAge = pjs.conf.conf.s2sQueueMaxAge
+        if maxBytes is None:
+            maxBytes = pjs.conf.conf.s2sQueueMaxBytes
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.maxBytes = maxBytes
+        self.bounce = bounce
+
+        # (time queued, UTF-8 encoded data)
+        self.items = deque()
+        # bytes queued
+        self.size = 0
+
+        # connection that we drain into. None while it's not ready.
+        self.conn = None
+        self._drainTimer = None
+
+        # stats
+        self.queued = 0
+        self.sent = 0
+        self.writes = 0
+        self.dropped = 0
+        self.expired = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def put(self, data):
+        """Queues data for sending. Unicode is encoded into UTF-8, so that
+        the size limit counts what goes on the wire. The data is sent from
+        the main loop, so that everything queued in one pass goes out in one
+        write.
+        """
+        if not data:
+            return
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        now = time.time()
+        self.items.append((now, data))
+        self.size += len(data)
+        self.queued += 1
+
+        self._expire(now)
+        dropped = []
+        while self.items and (len(self.items) > self.maxSize or
+                              self.size > self.maxBytes):
+            dropped.append(self._drop())
+            self.dropped += 1
+        self._bounce(dropped, 'resource-constraint')
+
+        if self.conn is not None and self._drainTimer is None:
+            self._drainTimer = asyncore.callLater(0, self.drain)
+
+    def extend(self, items):
+        """Queues all data in the items list"""
+        for data in items:
+            self.put(data)
+
+    def attach(self, conn):
+        """Marks the queue as ready and starts draining into conn. This
+        should be called once the stream to the domain is fully negotiated.
+        """
+        self.conn = conn
+        self.drain()
+
+    def detach(self, conn):
+        """Stops draining into conn. The stanzas stay queued for the next
+        connection.
+        """
+        if self.conn is conn:
+            self.conn = None
+        if self._drainTimer is not None:
+            self._drainTimer.cancel()
+            self._drainTimer = None
+
+    def isReady(self):
+        """Returns True if there's a connection to drain into"""
+        return self.conn is not None
+
+    def drain(self):
+        """Writes all queued stanzas into the connection"""
+        self._drainTimer = None
+        if self.conn is None:
+            return
+
+        now = time.time()
+        self._expire(now)
+
+        batch = []
+        batchSize = 0
+        while self.items:
+            queuedAt, data = self.items.popleft()
+            self.size -= len(data)
+
+            latency = now - queuedAt
+            self.totalLatency += latency
+            if latency > self.maxLatency:
+                self.maxLatency = latency
+            self.sent += 1
+
+            batch.append(data)
+            batchSize += len(data)
+            if batchSize >= MAX_WRITE_SIZE:
+                self._write(batch)
+                batch = []
+                batchSize = 0
+
+        if batch:
+            self._write(batch)
+
+    def clear(self, condition='remote-server-not-found'):
+        """Drops everything in the queue and bounces it with the stanza
+        error condition. Returns the number of stanzas dropped.
+        """
+        num = len(self.items)
+        self.dropped += num
+        dropped = [data for queuedAt, data in self.items]
+        self.items.clear()
+        self.size = 0
+        self._bounce(dropped, condition)
+        return num
+
+    def expire(self):
+        """Drops and bounces the stanzas that have been waiting longer than
+        maxAge. This is done when stanzas are queued or sent, so it only
+        needs to be called for queues that are idle.
+        """
+        self._expire(time.time())
+
+    def _write(self, batch):
+        self.writes += 1
+        self.conn.send(''.join(batch))
+
+    def _drop(self):
+        queuedAt, data = self.items.popleft()
+        self.size -= len(data)
+        return data
+
+    def _expire(self, now):
+        """Drops the stanzas that have been waiting longer than maxAge"""
+        cutoff = now - self.maxAge
+        dropped = []
+        while self.items and self.items[0][0] < cutoff:
+            dropped.append(self._drop())
+            self.expired += 1
+        self._bounce(dropped, 'remote-server-timeout')
+
+    def _bounce(self, dropped, condition):
+        if not dropped:
+            return
+        logging.info("[%s] Dropping %d stanzas for %s: %s", self.__class__,
+                     len(dropped), self.domain, condition)
+        if self.bounce is not None:
+            try:
+                self.bounce(dropped, condition)
+            except Exception, e:
+                logging.warning("[%s] Failed to bounce the stanzas for %s: %s",
+                                self.__class__, self.domain, e)
+
+    def __len__(self):
+        return len(self.items)
+
+    def getStats(self):
+        """Returns a dict with the depth and latency of the queue"""
+        if self.items:
+            oldest = time.time() - self.items[0][0]
+        else:
+            oldest = 0.0
+        if self.sent:
+            avgLatency = self.totalLatency / self.sent
+        else:
+            avgLatency = 0.0
+        return {
+                'depth' : len(self.items),
+                'size' : self.size,
+                'oldest' : oldest,
+                'ready' : self.conn is not None,
+                'queued' : self.queued,
+                'sent' : self.sent,
+                'writes' : self.writes,
+                'dropped' : self.dropped,
+                'expired' : self.expired,
+                'avgLatency' : avgLatency,
+                'maxLatency' : self.maxLatency,
+                }
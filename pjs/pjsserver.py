@@ -1,10 +1,12 @@
 """Main module for starting the server"""
 
 import pjs.conf.conf
+import pjs.scram
+import pjs.procpool
 import logging
 import os, os.path, sys
 
-from pjs.db import DB, sqlite
+from pjs.storage.base import getStorage
 
 class PJSLauncher:
     """The one and only instance of the server. This controls all other
@@ -61,43 +63,13 @@ class PJSLauncher:
         return self._s2s
 
 def populateDB():
-    """Creates a sample database"""
-    con = DB()
-    c = con.cursor()
-    try:
-        c.execute("CREATE TABLE jids (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
-                                        jid TEXT NOT NULL,\
-                                        password TEXT NOT NULL,\
-                                        UNIQUE(jid))")
-        c.execute("CREATE TABLE roster (userid INTEGER REFERENCES jids NOT NULL,\
-                                        contactid INTEGER REFERENCES jids NOT NULL,\
-                                        name TEXT,\
-                                        subscription INTEGER DEFAULT 0,\
-                                        PRIMARY KEY (userid, contactid)\
-                                        )")
-        c.execute("CREATE TABLE rostergroups (groupid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
-                                              userid INTEGER REFERENCES jids NOT NULL,\
-                                              name TEXT NOT NULL,\
-                                              UNIQUE(userid, name)\
-                                              )")
-        c.execute("CREATE TABLE rostergroupitems\
-                    (groupid INTEGER REFERENCES rostergroup NOT NULL,\
-                     contactid INTEGER REFERENCES jids NOT NULL,\
-                     PRIMARY KEY (groupid, contactid))")
-        c.execute("INSERT INTO jids (jid, password) VALUES ('tro@localhost', 'test')")
-        c.execute("INSERT INTO jids (jid, password) VALUES ('dv@localhost', 'test')")
-        c.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
-        c.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
-        con.commit()
-#        c.execute("INSERT INTO roster (userid, contactid, subscription) VALUES (1, 2, 8)")
-#        c.execute("INSERT INTO roster (userid, contactid, subscription) VALUES (2, 1, 8)")
-#        c.execute("INSERT INTO rostergroups (userid, name) VALUES (1, 'friends')")
-#        c.execute("INSERT INTO rostergroups (userid, name) VALUES (1, 'weirdos')")
-#        c.execute("INSERT INTO rostergroupitems (groupid, contactid) VALUES (1, 2)")
-    except sqlite.OperationalError, e:
-        if e.message.find('already exists') >= 0: pass
-        else: raise
-    c.close()
+    """Creates a sample database or brings an existing one up to date"""
+    storage = getStorage()
+    storage.setup()
+    if not storage.getUsers():
+        for jid in ('tro@localhost', 'dv@localhost',
+                    'bob@localhost', 'alice@localhost'):
+            pjs.scram.addUser(jid, 'test')
 
 if __name__ == '__main__':
     launcher = PJSLauncher()
@@ -132,6 +104,8 @@ if __name__ == '__main__':
             print >> sys.stderr, 'Could not create logging directory'
             configLogging()
 
+    # the processes are forked before the server's threads are started
+    pjs.procpool.startPool()
     populateDB()
 
     launcher.run()
@@ -144,4 +118,6 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         # clean up
         logging.info("KeyboardInterrupt sent. Shutting down...")
+        getStorage().close()
+        pjs.procpool.stopPool()
         logging.shutdown()
\ No newline at end of file
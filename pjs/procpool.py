@@ -0,0 +1,158 @@
+"""Process pool for the CPU-bound work of ThreadedHandlers.
+
+The threadpool's threads hold the GIL while they compute, so hashing in a
+handler slows down the main loop as much as if it ran there. A
+ThreadedHandler that sets cpuBound (see pjs.handlers.base) runs the
+computation with the executor that getExecutor() returns. For the handler
+classes in processPoolHandlers of pjs.conf.handlers, the executor sends the
+call to one of processPoolSize worker processes as a ProcessRequest and
+waits for the ProcessResponse, without holding the GIL. Other handlers, and
+all of them when the pool isn't started, run the call in their own thread.
+Other CPU-bound work, like making the SCRAM keys in pjs.scram, uses the
+ProcessPool from getPool() directly.
+
+The connection and the storage stay in the server process. Only the
+computation is sent, so the function has to be defined at module level and
+only use its arguments, and the arguments and the result have to be
+picklable.
+"""
+
+import cPickle
+import logging
+import threading
+
+import pjs.conf.conf
+
+from pjs.utils import compact_traceback
+
+class ProcessError(Exception):
+    """Raised in place of an exception that couldn't be sent back from a
+    worker process
+    """
+    pass
+
+class ProcessRequest:
+    """A call to run in a worker process"""
+    def __init__(self, func, args=None, kwds=None):
+        """func -- function defined at module level.
+        args, kwds -- its picklable arguments.
+        """
+        self.func = func
+        self.args = args or ()
+        self.kwds = kwds or {}
+
+class ProcessResponse:
+    """The outcome of a ProcessRequest"""
+    def __init__(self, result=None, error=None):
+        """result -- what the function returned.
+        error -- the exception it raised, if any.
+        """
+        self.result = result
+        self.error = error
+
+    def get(self):
+        """Returns the result or raises the error"""
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+def execute(request):
+    """Runs the ProcessRequest in a worker process and returns its
+    ProcessResponse
+    """
+    try:
+        return ProcessResponse(request.func(*request.args, **request.kwds))
+    except Exception, e:
+        nil, t, v, tbinfo = compact_traceback()
+        logging.debug("Exception in process: %s: %s -- %s", t, v, tbinfo)
+        try:
+            cPickle.dumps(e, 2)
+        except Exception:
+            e = ProcessError('%s: %s' % (t, v))
+        return ProcessResponse(error=e)
+
+def runInline(func, *args):
+    """Executor that calls func in this thread"""
+    return func(*args)
+
+class ProcessPool:
+    """Worker processes that run ProcessRequests for the threads"""
+    def __init__(self, processes):
+        """Forks the processes now, so it's best done before any threads
+        are started
+        """
+        import multiprocessing
+        self.pool = multiprocessing.Pool(processes)
+        self.processes = processes
+
+    def apply(self, func, *args):
+        """Runs func(*args) in a worker process and returns what it returns.
+        Blocks the calling thread until then.
+        """
+        response = self.pool.apply(execute, (ProcessRequest(func, args),))
+        return response.get()
+
+    def map(self, func, argsList):
+        """Runs func(*args) for every args tuple in argsList in the worker
+        processes and returns the list of what the calls return. Raises the
+        first exception of the calls. Blocks the calling thread until all
+        of them are done.
+        """
+        requests = [ProcessRequest(func, args) for args in argsList]
+        return [response.get() for response in self.pool.map(execute, requests)]
+
+    def close(self):
+        """Waits for the running calls and stops the processes"""
+        self.pool.close()
+        self.pool.join()
+
+_pool = None
+_poolLock = threading.Lock()
+
+def startPool(processes=None):
+    """Starts the process pool with processPoolSize processes if processes
+    isn't given. With 0 processes, no pool is started.
+    """
+    global _pool
+    if processes is None:
+        processes = pjs.conf.conf.processPoolSize
+    _poolLock.acquire()
+    try:
+        if _pool is None and processes > 0:
+            _pool = ProcessPool(processes)
+    finally:
+        _poolLock.release()
+
+def stopPool():
+    """Stops the process pool"""
+    global _pool
+    _poolLock.acquire()
+    try:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    finally:
+        _poolLock.release()
+
+def getPool():
+    """Returns the ProcessPool or None if it isn't started"""
+    return _pool
+
+def getExecutor(handler):
+    """Returns the function that runs the CPU-bound work of the handler,
+    called as execute(func, *args). It runs func in the process pool if the
+    handler's class is in processPoolHandlers and is cpuBound, and in the
+    calling thread otherwise.
+    """
+    # imported here, because pjs.conf.handlers imports the handlers
+    import pjs.conf.handlers
+
+    pool = _pool
+    if pool is None or \
+       handler.__class__ not in pjs.conf.handlers.processPoolHandlers:
+        return runInline
+    if not getattr(handler, 'cpuBound', False):
+        logging.warning("[procpool] %s isn't CPU-bound. Running its work " +\
+                        "in its thread.", handler.__class__)
+        return runInline
+    return pool.apply
@@ -10,7 +10,7 @@ import pjs.conf.conf
 import socket
 import logging
 from Queue import Queue, Empty
-from pjs.handlers.write import prepareDataForSending
+from pjs.handlers.write import encodeDataForSending
 
 # Variables that the dispatchers share
 
@@ -70,7 +70,7 @@ def pickupResults():
                     conn = server.conns[connId][1]
                     # FIXME: this should be prevented. test socket for writability
                     try:
-                        conn.send(prepareDataForSending(out))
+                        conn.send(encodeDataForSending(out))
                     except socket.error, e:
                         logging.warning("[pickupResults] Socket error: %s", e)
                     break
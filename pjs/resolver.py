@@ -0,0 +1,460 @@
+"""Asynchronous DNS resolution for outgoing S2S connections.
+
+Remote servers are found with the _xmpp-server._tcp SRV record of their
+domain (RFC 3920 #14.4), falling back to the domain's A record on port 5269.
+Queries are sent over UDP from the main loop, so a slow nameserver doesn't
+tie up a thread in the pools.
+
+This speaks just enough of the DNS wire format (RFC 1035) to ask for SRV and
+A records and read the answers. Answers are cached for as long as their TTL
+says. Names that don't exist or have no records of the type are cached as
+well, for as long as the SOA record in the answer allows (RFC 2308).
+"""
+
+import socket
+import struct
+import random
+import time
+import logging
+
+import pjs.async.core as asyncore
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_SRV = 33
+CLASS_IN = 1
+
+RCODE_OK = 0
+RCODE_NXDOMAIN = 3
+
+DNS_PORT = 53
+XMPP_SERVER_PORT = 5269
+
+# seconds before a query is resent and the number of times it's resent
+QUERY_TIMEOUT = 3
+QUERY_RETRIES = 2
+
+# bounds on how long positive answers are cached for, in seconds
+MIN_TTL = 30
+MAX_TTL = 86400
+
+# how long to remember that a name doesn't exist or has no records when
+# the answer has no SOA record to say so
+NEGATIVE_TTL = 300
+
+# bounds on the negative caching time from the SOA record, in seconds
+MIN_NEGATIVE_TTL = 30
+MAX_NEGATIVE_TTL = 3600
+
+def encodeName(name):
+    """Encodes a domain name into the DNS label format"""
+    out = []
+    for label in name.strip('.').split('.'):
+        if not label:
+            continue
+        if len(label) > 63:
+            raise ValueError, 'DNS label too long in %s' % name
+        out.append(chr(len(label)) + label)
+    out.append('\0')
+    return ''.join(out)
+
+def makeQuery(qid, name, qtype):
+    """Returns a recursive query for the records of qtype for name"""
+    if isinstance(name, unicode):
+        name = name.encode('idna')
+    # id, flags (RD), 1 question, 0 answers, 0 authority, 0 additional
+    header = struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0)
+    return header + encodeName(name) + struct.pack('!HH', qtype, CLASS_IN)
+
+def readName(data, offset):
+    """Reads a possibly compressed name at offset in data. Returns the
+    (name, offset after the name) tuple.
+    """
+    labels = []
+    end = None
+    jumps = 0
+    while 1:
+        length = ord(data[offset])
+        if length & 0xC0 == 0xC0:
+            # pointer to a name elsewhere in the message
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 20:
+                raise ValueError, 'DNS name compression loop'
+            offset = struct.unpack('!H', data[offset:offset+2])[0] & 0x3FFF
+        elif length == 0:
+            offset += 1
+            break
+        else:
+            labels.append(data[offset+1:offset+1+length])
+            offset += 1 + length
+    if end is None:
+        end = offset
+    return '.'.join(labels).lower(), end
+
+def parseResponse(data):
+    """Parses a DNS response. Returns the (id, rcode, records) tuple, where
+    records is a list of (name, type, ttl, value) tuples from the answer
+    section. value is the IP for A records, the target for CNAMEs and
+    (priority, weight, port, target) for SRV records. SOA records from the
+    authority section are included with the SOA minimum as the value, for
+    negative caching. Other types are skipped.
+    """
+    qid, flags, qdcount, ancount, nscount, arcount = \
+                                    struct.unpack('!HHHHHH', data[:12])
+    rcode = flags & 0xF
+    offset = 12
+
+    for i in range(qdcount):
+        name, offset = readName(data, offset)
+        offset += 4
+
+    records = []
+    for i in range(ancount + nscount):
+        name, offset = readName(data, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack('!HHIH',
+                                                     data[offset:offset+10])
+        offset += 10
+        rdata = offset
+        offset += rdlength
+
+        if rclass != CLASS_IN:
+            continue
+        if i >= ancount:
+            if rtype != TYPE_SOA:
+                continue
+            # skip the mname and rname to the minimum, the last field
+            soa = readName(data, readName(data, rdata)[1])[1]
+            value = struct.unpack('!I', data[soa+16:soa+20])[0]
+        elif rtype == TYPE_A and rdlength == 4:
+            value = socket.inet_ntoa(data[rdata:rdata+4])
+        elif rtype == TYPE_CNAME:
+            value = readName(data, rdata)[0]
+        elif rtype == TYPE_SRV:
+            priority, weight, port = struct.unpack('!HHH', data[rdata:rdata+6])
+            value = (priority, weight, port, readName(data, rdata + 6)[0])
+        else:
+            continue
+        records.append((name, rtype, ttl, value))
+
+    return qid, rcode, records
+
+def readNameservers(path='/etc/resolv.conf'):
+    """Returns the list of nameserver IPs in resolv.conf"""
+    servers = []
+    try:
+        f = open(path)
+        try:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver':
+                    servers.append(parts[1])
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return servers or ['127.0.0.1']
+
+def readHosts(path='/etc/hosts'):
+    """Returns the hostname => IP dict of the IPv4 entries in the hosts
+    file. Names in it are never looked up in DNS.
+    """
+    hosts = {}
+    try:
+        f = open(path)
+        try:
+            for line in f:
+                parts = line.split('#', 1)[0].split()
+                if len(parts) < 2 or ':' in parts[0]:
+                    continue
+                for name in parts[1:]:
+                    hosts.setdefault(name.lower(), parts[0])
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return hosts
+
+def orderSRV(records):
+    """Orders SRV (priority, weight, port, target) tuples in the order in
+    which they should be tried (RFC 2782): by priority, and randomly by
+    weight within the same priority. Records with weight 0 go first in the
+    selection so that they're only picked when the random number is 0.
+    """
+    byPriority = {}
+    for rec in records:
+        byPriority.setdefault(rec[0], []).append(rec)
+
+    ordered = []
+    for priority in sorted(byPriority):
+        group = byPriority[priority]
+        group.sort(key=lambda rec: rec[1] != 0)
+        while group:
+            total = sum([rec[1] for rec in group])
+            pick = random.randint(0, total)
+            running = 0
+            for rec in group:
+                running += rec[1]
+                if running >= pick:
+                    break
+            group.remove(rec)
+            ordered.append(rec)
+    return ordered
+
+class DNSQuery(asyncore.dispatcher):
+    """A single UDP query to a nameserver. The callback is called with
+    (rcode, records) when the answer arrives, or with (None, []) if it
+    doesn't after all retries.
+    """
+    def __init__(self, nameservers, name, qtype, callback):
+        asyncore.dispatcher.__init__(self)
+
+        self.nameservers = nameservers
+        self.name = name
+        self.qtype = qtype
+        self.callback = callback
+
+        self.qid = random.randint(0, 0xFFFF)
+        self.query = makeQuery(self.qid, name, qtype)
+        self.tries = 0
+        self.timer = None
+        self.done = False
+
+        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._send()
+
+    def _send(self):
+        server = self.nameservers[self.tries % len(self.nameservers)]
+        self.tries += 1
+        self.out = self.query
+        self.target = (server, DNS_PORT)
+        self.timer = asyncore.callLater(QUERY_TIMEOUT, self.handle_timeout)
+
+    def handle_timeout(self):
+        if self.done:
+            return
+        if self.tries <= QUERY_RETRIES:
+            logging.debug("[%s] Resending query for %s", self.__class__, self.name)
+            self._send()
+        else:
+            logging.info("[%s] No answer for %s", self.__class__, self.name)
+            self.finish(None, [])
+
+    def writable(self):
+        return bool(self.out)
+
+    def readable(self):
+        return not self.done
+
+    def handle_write(self):
+        try:
+            self.socket.sendto(self.out, self.target)
+        except socket.error, e:
+            logging.debug("[%s] Failed to send query for %s: %s",
+                          self.__class__, self.name, e)
+        self.out = ''
+
+    def handle_read(self):
+        try:
+            data, addr = self.socket.recvfrom(4096)
+        except socket.error:
+            return
+        try:
+            qid, rcode, records = parseResponse(data)
+        except Exception, e:
+            logging.debug("[%s] Malformed answer for %s: %s",
+                          self.__class__, self.name, e)
+            return
+        if qid != self.qid:
+            # stray or spoofed answer
+            return
+        self.finish(rcode, records)
+
+    def finish(self, rcode, records):
+        self.done = True
+        if self.timer:
+            self.timer.cancel()
+        self.close()
+        self.callback(rcode, records)
+
+    def handle_connect(self): pass
+    def handle_close(self): self.close()
+
+class Resolver:
+    """Resolves names from the main loop with caching. Concurrent lookups
+    of the same name share one query.
+    """
+    def __init__(self, nameservers=None, hosts=None):
+        self.nameservers = nameservers or readNameservers()
+        if hosts is None:
+            hosts = readHosts()
+        self.hosts = hosts
+
+        # (name, qtype) => (expiry time, records or None for negative)
+        self.cache = {}
+
+        # (name, qtype) => list of callbacks waiting for the query
+        self.waiting = {}
+
+        # counters for the curious
+        self.stats = {
+                      'queries' : 0,
+                      'hits' : 0,
+                      'negativeHits' : 0,
+                      'failures' : 0,
+                      }
+
+    def lookup(self, name, qtype, callback):
+        """Calls callback with the list of values of the records of qtype for
+        name. The list is empty when there are none or the lookup failed.
+        The callback may be called before this returns if the answer is
+        cached.
+        """
+        name = name.lower().rstrip('.')
+        key = (name, qtype)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            expires, values = cached
+            if expires > time.time():
+                if values is None:
+                    self.stats['negativeHits'] += 1
+                    callback([])
+                else:
+                    self.stats['hits'] += 1
+                    callback(values)
+                return
+            del self.cache[key]
+
+        if key in self.waiting:
+            self.waiting[key].append(callback)
+            return
+
+        self.waiting[key] = [callback]
+        self.stats['queries'] += 1
+
+        def done(rcode, records):
+            values = self._store(key, rcode, records)
+            for cb in self.waiting.pop(key, []):
+                try:
+                    cb(values)
+                except Exception, e:
+                    logging.warning("[%s] Exception in lookup callback for %s: %s",
+                                    self.__class__, name, e)
+
+        try:
+            DNSQuery(self.nameservers, name, qtype, done)
+        except socket.error, e:
+            logging.warning("[%s] Can't query for %s: %s", self.__class__, name, e)
+            done(None, [])
+
+    def _store(self, key, rcode, records):
+        """Caches the answer for key and returns the list of values"""
+        name, qtype = key
+        if rcode is None:
+            # no answer. don't cache, so that we try again next time.
+            self.stats['failures'] += 1
+            return []
+
+        # follow CNAMEs within the answer
+        names = [name]
+        for rname, rtype, ttl, value in records:
+            if rtype == TYPE_CNAME and rname in names:
+                names.append(value)
+
+        values = []
+        ttls = []
+        for rname, rtype, ttl, value in records:
+            if rtype == qtype and rname in names:
+                values.append(value)
+                ttls.append(ttl)
+
+        if values:
+            ttl = min(max(min(ttls), MIN_TTL), MAX_TTL)
+            self.cache[key] = (time.time() + ttl, values)
+        elif rcode in (RCODE_OK, RCODE_NXDOMAIN):
+            # the SOA minimum, but no longer than the SOA itself may be
+            # cached (RFC 2308 #5)
+            soas = [min(ttl, value) for rname, rtype, ttl, value in records
+                    if rtype == TYPE_SOA]
+            if soas:
+                ttl = min(max(min(soas), MIN_NEGATIVE_TTL), MAX_NEGATIVE_TTL)
+            else:
+                ttl = NEGATIVE_TTL
+            self.cache[key] = (time.time() + ttl, None)
+        else:
+            self.stats['failures'] += 1
+
+        return values
+
+    def resolveHost(self, host, callback):
+        """Calls callback with the list of IPs of host"""
+        try:
+            socket.inet_aton(host)
+            if host.count('.') == 3:
+                callback([host])
+                return
+        except socket.error:
+            pass
+
+        ip = self.hosts.get(host.lower())
+        if ip is not None:
+            callback([ip])
+            return
+
+        self.lookup(host, TYPE_A, callback)
+
+    def resolveServer(self, domain, callback):
+        """Finds the XMPP server of domain. Calls callback with the list of
+        (IP, port) pairs to try in order. The list is empty if the domain
+        can't be resolved.
+        """
+        ip = self.hosts.get(domain.lower())
+        if ip is not None:
+            callback([(ip, XMPP_SERVER_PORT)])
+            return
+
+        def gotSRV(records):
+            if not records:
+                # no SRV. fall back to the domain itself.
+                self.resolveHost(domain, gotFallback)
+                return
+
+            targets = [(rec[3], rec[2]) for rec in orderSRV(list(records))
+                       if rec[3] != '']
+            if not targets:
+                # "." as the target means the service isn't offered
+                callback([])
+                return
+
+            # resolve all targets in parallel but keep the SRV order
+            results = [None] * len(targets)
+            remaining = [len(targets)]
+            def makeCB(i, port):
+                def gotHost(ips):
+                    results[i] = [(ip, port) for ip in ips]
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        addrs = []
+                        for r in results:
+                            addrs.extend(r)
+                        callback(addrs)
+                return gotHost
+            for i, (host, port) in enumerate(targets):
+                self.resolveHost(host, makeCB(i, port))
+
+        def gotFallback(ips):
+            callback([(ip, XMPP_SERVER_PORT) for ip in ips])
+
+        self.lookup('_xmpp-server._tcp.' + domain, TYPE_SRV, gotSRV)
+
+_resolver = None
+
+def getResolver():
+    """Returns the process-wide Resolver"""
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver()
+    return _resolver
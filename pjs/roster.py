@@ -3,28 +3,39 @@
 import logging
 
 from pjs.elementtree.ElementTree import Element, SubElement
-from pjs.db import DB, DBautocommit, commitSQLiteTransaction
+from pjs.storage.base import getStorage
+from pjs.subscriptions import getSubscriptionGraph
+from pjs.rostercache import getRosterCache
 
 class Roster:
     def __init__(self, jid):
         """Initializes the roster object, but does not fetch any
         roster-specific data from the DB. It checks if the jid
         exists in the roster and raises an exception if it doesn't.
+        The id of the jid comes from the roster cache if it's there.
+        The roster is kept in the storage backend (see pjs.storage).
+
 
         jid -- textual representation of a bare JID.
         """
         self.items = {}
         self.jid = jid
+        # version of the roster after the last change made through this
+        # object. see getVersion().
+        self.version = None
+        self.storage = getStorage()
+
+        cache = getRosterCache()
+        self.uid = cache.getUid(jid)
+        if self.uid is not None:
+            return
 
-        con = DBautocommit()
-        c = con.cursor()
         # get our own id
-        c.execute("SELECT id FROM jids WHERE jid = ?", (self.jid,))
-        res = c.fetchone()
-        if res is None:
+        self.uid = self.storage.getUserId(self.jid)
+        if self.uid is None:
             raise Exception, "No record of this JID in the DB"
 
-        self.uid = res[0]
+        cache.setUid(jid, self.uid)
 
     def addItem(self, contactId, rosterItem):
         """Adds a RosterItem for the contactId in this roster.
@@ -53,34 +64,22 @@ class Roster:
         False otherwise.
         If includeGroups is True, groups are added to the RosterItem as well.
         """
-        con = DBautocommit()
-        c = con.cursor()
-
-        c.execute("SELECT roster.contactid, roster.name, roster.subscription\
-                   FROM roster\
-                       JOIN jids ON jids.id = roster.contactid\
-                   WHERE userid = ? AND jids.jid = ?", (self.uid, cjid))
-        res = c.fetchone()
-        if res:
-            cid = res[0]
-            name = res[1]
-            sub = res[2]
-        else:
-            c.close()
-            return False
-
-        if includeGroups:
-            # get the groups
-            c.execute("SELECT rgs.name\
-                       FROM rostergroups AS rgs\
-                           JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
-                       WHERE rgs.userid = ? AND rgi.contactid = ?", (self.uid, cid))
-            groups = [group['name'] for group in c]
+        item = getRosterCache().getItem(self.jid, cjid)
+        if item is not None:
+            if not item:
+                return False
+            if includeGroups:
+                groups = list(item.groups)
+            else:
+                groups = None
+            return RosterItem(item.jid, item.name, item.subscription,
+                              groups, item.id)
 
-            return RosterItem(cjid, name, sub, groups, cid)
-        else:
+        contact = self.storage.getContact(self.uid, cjid, includeGroups)
+        if contact is None:
+            return False
 
-            return RosterItem(cjid, name, sub, id=cid)
+        return RosterItem.fromContact(contact)
 
     def updateContact(self, cjid, groups=None, name=None, subscriptionId=None):
         """Adds or updates a contact in this user's roster. Returns the
@@ -92,84 +91,59 @@ class Roster:
         name = name or ''
         groups = groups or []
 
-        con = DB()
-        c = con.cursor()
-
-        # check if this is an update to an existing roster entry
-        c.execute("SELECT cjids.id cid \
-                   FROM roster\
-                   JOIN jids AS cjids ON cjids.id = roster.contactid\
-                   JOIN jids AS ujids ON ujids.id = roster.userid\
-                   WHERE ujids.jid = ? AND cjids.jid = ?", (self.jid, cjid))
-        res = c.fetchone()
-        if res:
-            # this is an update
-            # we update the subscription if it's given to us; o/w
-            # just update the name
-            cid = res[0]
-            if subscriptionId:
-                c.execute("UPDATE roster SET name = ?, subscription = ?\
-                           WHERE contactid = ?",
-                          (name, cid, subscriptionId))
-            else:
-                c.execute("UPDATE roster SET name = ?\
-                           WHERE contactid = ?",
-                          (name, cid))
-        else:
-            # this is a new roster entry
+        contact, self.version = self.storage.updateContact(self.uid, cjid,
+                                                           name, groups,
+                                                           subscriptionId)
+        item = RosterItem.fromContact(contact)
+        cid = item.id
 
-            # check if the contact JID already exists in our DB
-            c.execute("SELECT id FROM jids WHERE jid = ?", (cjid,))
-            res = c.fetchone()
-            if res:
-                cid = res[0]
-            else:
-                # create new JID entry
-                res = c.execute("INSERT INTO jids\
-                                 (jid, password)\
-                                 VALUES\
-                                 (?, '')", (cjid,))
-                cid = res.lastrowid
-
-            c.execute("INSERT INTO roster\
-                       (userid, contactid, name, subscription)\
-                       VALUES\
-                       (?, ?, ?, ?)",
-                       (self.uid, cid, name,
-                        subscriptionId or Subscription.NONE))
-
-
-        # UPDATE GROUPS
-        # remove all group mappings for this contact and recreate
-        # them, since it's easier than figuring out what changed
-        c.execute("DELETE FROM rostergroupitems\
-                   WHERE contactid = ? AND groupid IN\
-                   (SELECT groupid FROM rostergroups WHERE\
-                       userid = ?)", (cid, self.uid))
-        for groupName in groups:
-            # get the group id
-            c.execute("SELECT groupid\
-                       FROM rostergroups\
-                       WHERE userid = ? AND name = ?", (self.uid, groupName))
-            res = c.fetchone()
-            if res:
-                gid = res[0]
-            else:
-                # need to create the group
-                res = c.execute("INSERT INTO rostergroups\
-                                 (userid, name)\
-                                 VALUES\
-                                 (?, ?)", (self.uid, groupName))
-                gid = res.lastrowid
+        getSubscriptionGraph().setSubscription(self.jid, cid,
+                                               item.subscription, cjid)
+        cache = getRosterCache()
+        cache.updateItem(self.jid, cid, item)
+        cache.setVersion(self.jid, self.version)
 
-            c.execute("INSERT INTO rostergroupitems\
-                       (groupid, contactid)\
-                       VALUES\
-                       (?, ?)", (gid, cid))
+        return cid
+
+    def applyTransition(self, cjid, direction, type, create=False):
+        """Applies the change of the subscription state to the contact cjid
+        caused by a subscription presence of type (subscribe, subscribed,
+        unsubscribe or unsubscribed). direction is 'in' for presences that
+        the contact sent to this user and 'out' for the ones this user sent.
+        See Subscription.transitions.
+
+        The lookup, the change and the version bump are done atomically by
+        the storage backend. If create is True, a contact that's not in the
+        roster is added with no name and groups first. Returns (RosterItem
+        with the new state, old state), or (None, None) if there's no such
+        contact.
+        """
+        transition = Subscription.transitions[(direction, type)]
 
-        commitSQLiteTransaction(con, c)
+        # the groups are only needed for the roster push, so they're taken
+        # from the cache if it has them
+        groups = None
+        cached = getRosterCache().getItem(self.jid, cjid)
+        if cached:
+            groups = list(cached.groups)
 
-        return cid
+        contact, old, version = self.storage.applyTransition(self.uid, cjid,
+                                                             transition,
+                                                             create, groups)
+        if contact is None:
+            return None, None
+
+        item = RosterItem.fromContact(contact)
+
+        if version is not None:
+            self.version = version
+            getSubscriptionGraph().setSubscription(self.jid, item.id,
+                                                   item.subscription, cjid)
+            cache = getRosterCache()
+            cache.updateItem(self.jid, item.id, RosterItem.fromContact(contact))
+            cache.setVersion(self.jid, self.version)
+
+        return item, old
 
     def removeContact(self, cjid):
         """Removes the contact from this user's roster. Returns the contact's
@@ -177,155 +151,237 @@ class Roster:
 
         cjid -- bare JID or the contact as a string.
         """
-        con = DB()
-        c = con.cursor()
-
-        # get the contact's id
-        c.execute("SELECT jids.id\
-                   FROM roster\
-                   JOIN jids ON roster.contactid = jids.id\
-                   WHERE roster.userid = ? AND jids.jid = ?", (self.uid, cjid))
-        res = c.fetchone()
-        if res:
-            cid = res[0]
-        else:
+        cid, version = self.storage.removeContact(self.uid, cjid)
+        if cid is None:
             logging.info("[%s] Contact %s does not exist in roster of %s",
                          self.__class__, cjid, self.jid)
-            commitSQLiteTransaction(con, c)
-            con.close()
             return False
 
-        # delete the contact from all groups it's in for this user
-        c.execute("DELETE FROM rostergroupitems\
-                   WHERE rostergroupitems.groupid IN (\
-                       SELECT rgs.groupid FROM rostergroups AS rgs\
-                       JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
-                       WHERE rgs.userid = ?\
-                    ) AND rostergroupitems.contactid = ?", (self.uid, cid))
-
-        # now delete the roster entry
-        c.execute("DELETE FROM roster\
-                   WHERE userid = ? AND contactid = ?", (self.uid, cid))
+        self.version = version
 
-        commitSQLiteTransaction(con, c)
+        getSubscriptionGraph().removeContact(self.jid, cid)
+        cache = getRosterCache()
+        cache.removeItem(self.jid, cid)
+        cache.setVersion(self.jid, self.version)
 
         return cid
 
     def getSubscription(self, cid):
         """Returns the subscription id of this user's contact with id cid"""
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT subscription FROM roster\
-                   WHERE userid = ? AND contactid = ?", (self.uid, cid))
-        res = c.fetchone()
-        if res:
-            sub = res[0]
-
-            return sub
-        else:
+        item = getRosterCache().getItemById(self.jid, cid)
+        if item:
+            return item.subscription
+        elif item is False:
             raise Exception, "No such contact in roster"
 
+        sub = self.storage.getSubscription(self.uid, cid)
+        if sub is None:
+            raise Exception, "No such contact in roster"
+        return sub
+
     def setSubscription(self, cid, sub):
         """Sets the subscription from the perspective of this user to a
         contact with ID cid to sub, which is an id retrieved via the
         Subscription class.
         """
-        con = DB()
-        c = con.cursor()
-        c.execute("UPDATE roster SET subscription = ?\
-                   WHERE userid = ? AND contactid = ?", (sub, self.uid, cid))
-        commitSQLiteTransaction(con, c)
+        self.version = self.storage.setSubscription(self.uid, cid, sub)
+
+        getSubscriptionGraph().setSubscription(self.jid, cid, sub)
+
+        cache = getRosterCache()
+        item = cache.getItemById(self.jid, cid)
+        if item:
+            cache.updateItem(self.jid, cid, RosterItem(item.jid, item.name, sub,
+                                                       item.groups, cid))
+        elif item is False:
+            cache.invalidate(self.jid)
+
+        cache.setVersion(self.jid, self.version)
+
+    def getVersion(self):
+        """Returns the current version of this user's roster. The version is
+        an int that's incremented on every change to the roster and is 0 for
+        rosters that were never changed.
+        """
+        cache = getRosterCache()
+        version = cache.getVersion(self.jid)
+        if version is not None:
+            return version
+
+        version = self.storage.getRosterVersion(self.uid)
+        cache.setVersion(self.jid, version)
+
+        return version
+
+    def getChanges(self, ver, limit=None):
+        """Returns the changes to this user's roster since the version ver,
+        which is the textual version the client has. Returns None if the
+        changes are not known or there are limit or more of them, in which
+        case the full roster has to be sent. Otherwise, returns a list of
+        (version, contact JID, RosterItem) tuples, one for every contact that
+        changed, ordered by the version of its last change. RosterItem is
+        None if the contact was removed from the roster. The changed contacts
+        come from the roster cache if it's there and are read one by one
+        otherwise, so that the roster isn't loaded.
+        """
+        try:
+            ver = int(ver)
+        except ValueError:
+            return None
+        current = self.getVersion()
+        if ver < 0 or ver > current:
+            return None
+        if ver == current:
+            return []
+
+        changes = self.storage.getRosterChanges(self.uid, ver)
+        if changes is None:
+            return None
+        if limit is not None and len(changes) >= limit:
+            return None
+
+        # read the current state of the contacts only after the log, so
+        # that it's at least as new as the versions
+        items = getRosterCache().getItems(self.jid)
+        out = []
+        for version, cid, cjid in changes:
+            if items is not None:
+                item = items.get(cid)
+            else:
+                item = None
+                contact = self.storage.getContact(self.uid, cjid)
+                if contact is not None:
+                    item = RosterItem.fromContact(contact)
+            # contacts that only asked to subscribe aren't shown
+            if item is not None and \
+                    item.subscription == Subscription.NONE_PENDING_IN:
+                item = None
+            out.append((version, cjid, item))
+
+        return out
 
     def getSubPrimaryName(self, cid):
         """Gets the primary name of a subscription for this user and this
         contact suitable for including in the subscription attribute of a
         roster's item element.
         """
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT subscription FROM roster\
-                       WHERE roster.userid = ? AND roster.contactid = ?", (self.uid, cid))
-        res = c.fetchone()
-        if res is None:
-            sub = 'none'
-        else:
-            sub = Subscription.getPrimaryNameFromState(res[0])
+        item = getRosterCache().getItemById(self.jid, cid)
+        if item is not None:
+            if not item:
+                return 'none'
+            return Subscription.getPrimaryNameFromState(item.subscription)
 
-        return sub
+        sub = self.storage.getSubscription(self.uid, cid)
+        if sub is None:
+            return 'none'
+        return Subscription.getPrimaryNameFromState(sub)
 
     def getPresenceSubscribers(self):
         """Returns a list of JIDs of contacts of this user who are interested
         in the user's presence info (from/both).
         """
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT jids.jid\
-                   FROM roster\
-                   JOIN jids ON jids.id = roster.contactid\
-                   WHERE roster.userid = ? AND\
-                       roster.subscription IN (?, ?, ?)",
-                       (self.uid, Subscription.FROM,
-                        Subscription.FROM_PENDING_OUT, Subscription.BOTH))
-        jids = []
-        res = c.fetchall()
-        for row in res:
-            jids.append(row[0])
-
-        return jids
+        return self._getPresenceContacts(Subscription.PRESENCE_FROM)
 
     def getPresenceSubscriptions(self):
         """Returns a list of JIDs of contacts of this user to whom the user
         is subscribed (to/both).
         """
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT jids.jid\
-                   FROM roster\
-                   JOIN jids ON jids.id = roster.contactid\
-                   WHERE roster.userid = ? AND\
-                       roster.subscription IN (?, ?, ?)",
-                       (self.uid, Subscription.TO,
-                        Subscription.TO_PENDING_IN, Subscription.BOTH))
-        jids = []
-        res = c.fetchall()
-        for row in res:
-            jids.append(row[0])
+        return self._getPresenceContacts(Subscription.PRESENCE_TO)
 
+    def _getPresenceContacts(self, states):
+        """Returns the JIDs of contacts with subscriptions in states. These
+        come from the subscription graph cache, which is loaded first if
+        needed.
+        """
+        jids = getSubscriptionGraph().getContacts(self.jid, states)
+        if jids is None:
+            jids = [cjid for cid, cjid, sub in self.loadSubscriptions()
+                    if sub in states]
         return jids
 
+    def loadSubscriptions(self):
+        """Reads the subscription states to all contacts of this user and
+        caches them in the subscription graph. Returns the list of
+        (contact id, contact JID, subscription) tuples.
+        """
+        graph = getSubscriptionGraph()
+        stamp = graph.beginLoad(self.jid)
+
+        items = getRosterCache().getItems(self.jid)
+        if items is not None:
+            contacts = [(cid, item.jid, item.subscription)
+                        for cid, item in items.items()]
+        else:
+            contacts = self.storage.getSubscriptions(self.uid)
+
+        graph.load(self.jid, contacts, stamp)
+
+        return contacts
+
     def loadRoster(self):
         """Loads the roster for this JID. Must be used before calling
-        getAsTree().
+        getAsTree(). The roster comes from the roster cache if it's there.
         """
-        con = DB()
-        c = con.cursor()
-        # get the contactid, name and subscriptions
-        c.execute("SELECT roster.contactid, roster.name,\
-                          roster.subscription,\
-                          contactjids.jid cjid\
-                   FROM roster\
-                       JOIN jids AS userjids ON roster.userid = userjids.id\
-                       JOIN jids AS contactjids ON roster.contactid = contactjids.id\
-                   WHERE userjids.jid = ? AND\
-                       roster.subscription != ?",
-                       (self.jid, Subscription.NONE_PENDING_IN))
+        cache = getRosterCache()
+        items = cache.getItems(self.jid)
+        if items is None:
+            items = self._readRoster()
 
+        # contacts that only asked to subscribe aren't shown
         self.items = {}
-        for row in c:
-            self.addItem(row['contactid'],
-                         RosterItem(row['cjid'], row['name'], row['subscription']))
+        for cid, item in items.items():
+            if item.subscription != Subscription.NONE_PENDING_IN:
+                self.addItem(cid, item)
 
-        # get the groups now for each cid
-        c.execute("SELECT rgi.contactid, rgs.name\
-                   FROM rostergroups AS rgs\
-                       JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
-                       JOIN jids ON rgs.userid = jids.id\
-                   WHERE jids.jid = ?", (self.jid,))
-
-        for row in c:
-            self.addGroup(row['contactid'], row['name'])
+    def _readRoster(self):
+        """Reads all contacts of this user from the storage and caches them.
+        Returns the {contact id => RosterItem} dict.
+        """
+        graph = getSubscriptionGraph()
+        graphStamp = graph.beginLoad(self.jid)
+        cache = getRosterCache()
+        cacheStamp = cache.beginLoad(self.jid)
+
+        items = {}
+        contacts = []
+        for contact in self.storage.getRoster(self.uid):
+            item = RosterItem.fromContact(contact)
+            items[item.id] = item
+            contacts.append((item.id, item.jid, item.subscription))
+
+        cache.setItems(self.jid, self.uid, items, cacheStamp)
+
+        # warm the subscription graph, since presence usually follows the
+        # roster request
+        graph.load(self.jid, contacts, graphStamp)
+
+        return items
+
+    def countItems(self):
+        """Returns the number of contacts shown in this user's roster"""
+        items = getRosterCache().getItems(self.jid)
+        if items is not None:
+            return len([1 for item in items.itervalues()
+                        if item.subscription != Subscription.NONE_PENDING_IN])
+
+        return self.storage.countRoster(self.uid, Subscription.NONE_PENDING_IN)
+
+    def iterItems(self):
+        """Yields the RosterItems of the contacts shown in this user's roster
+        one by one. If the roster isn't cached, the items are read from the
+        storage one by one and not cached, so that big rosters don't have to
+        be held in memory. See pjs.rosterstream.
+        """
+        items = getRosterCache().getItems(self.jid)
+        if items is not None:
+            for item in items.itervalues():
+                if item.subscription != Subscription.NONE_PENDING_IN:
+                    yield item
+            return
 
-        commitSQLiteTransaction(con, c)
+        for contact in self.storage.iterRoster(self.uid,
+                                               Subscription.NONE_PENDING_IN):
+            yield RosterItem.fromContact(contact)
 
     def getAsTree(self):
         """Returns the roster Element tree starting from <query>. Call
@@ -337,16 +393,21 @@ class Roster:
 
         return query
 
-    def createRosterQuery(cjid, subName, name=None, groups=None, itemArgs=None):
+    def createRosterQuery(cjid, subName, name=None, groups=None, itemArgs=None,
+                          version=None):
         """Creates and returns a <query> item for sending in an <iq> in a
         roster push.
         cjid -- jid as a str for the contact in a roster item.
         subName -- name of the subscription as a str.
         name -- name for the contact. Can be None.
         groups -- list of group names as strings.
+        version -- roster version that the change being pushed produced
+                   (Roster.version after the change). Can be None.
         """
         itemArgs = itemArgs or {}
         query = Element('query', {'xmlns' : 'jabber:iq:roster'})
+        if version is not None:
+            query.set('ver', str(version))
 
         d = {
              'jid' : cjid,
@@ -382,6 +443,14 @@ class RosterItem:
         self.subscription = subscription # id, not name
         self.groups = groups or []
 
+    def fromContact(contact):
+        """Creates a RosterItem from a contact tuple of the storage backend
+        (see pjs.storage.base.Storage)
+        """
+        cid, cjid, name, subscription, groups = contact
+        return RosterItem(cjid, name, subscription, groups, cid)
+    fromContact = staticmethod(fromContact)
+
     def getAsTree(self):
         """Return the roster item as an Element tree starting from <item>"""
         item = Element('item', {
@@ -410,6 +479,70 @@ class Subscription(object):
     FROM_PENDING_OUT = 7
     BOTH = 8
 
+    # states in which the contact receives the user's presence
+    PRESENCE_FROM = frozenset([FROM, FROM_PENDING_OUT, BOTH])
+    # states in which the user receives the contact's presence
+    PRESENCE_TO = frozenset([TO, TO_PENDING_IN, BOTH])
+
+    # changes of the user's state caused by subscription presences (RFC 3921
+    # section 9). (direction, presence type) => {old state => new state}.
+    # 'in' is for presences the contact sent to the user and 'out' for the
+    # ones the user sent. states that aren't listed don't change.
+    transitions = {
+        ('in', 'subscribe') : {
+            NONE : NONE_PENDING_IN,
+            NONE_PENDING_OUT : NONE_PENDING_IN_OUT,
+            TO : TO_PENDING_IN,
+            },
+        ('in', 'subscribed') : {
+            NONE_PENDING_OUT : TO,
+            NONE_PENDING_IN_OUT : TO_PENDING_IN,
+            FROM_PENDING_OUT : BOTH,
+            },
+        ('in', 'unsubscribe') : {
+            NONE_PENDING_IN : NONE,
+            FROM : NONE,
+            NONE_PENDING_IN_OUT : NONE_PENDING_OUT,
+            FROM_PENDING_OUT : NONE_PENDING_OUT,
+            TO_PENDING_IN : TO,
+            BOTH : TO,
+            },
+        ('in', 'unsubscribed') : {
+            NONE_PENDING_OUT : NONE,
+            TO : NONE,
+            NONE_PENDING_IN_OUT : NONE_PENDING_IN,
+            TO_PENDING_IN : NONE_PENDING_IN,
+            FROM_PENDING_OUT : FROM,
+            BOTH : FROM,
+            },
+        ('out', 'subscribe') : {
+            NONE : NONE_PENDING_OUT,
+            NONE_PENDING_IN : NONE_PENDING_IN_OUT,
+            FROM : FROM_PENDING_OUT,
+            },
+        ('out', 'subscribed') : {
+            NONE_PENDING_IN : FROM,
+            NONE_PENDING_IN_OUT : FROM_PENDING_OUT,
+            TO_PENDING_IN : BOTH,
+            },
+        ('out', 'unsubscribe') : {
+            NONE_PENDING_OUT : NONE,
+            TO : NONE,
+            NONE_PENDING_IN_OUT : NONE_PENDING_IN,
+            TO_PENDING_IN : NONE_PENDING_IN,
+            FROM_PENDING_OUT : FROM,
+            BOTH : FROM,
+            },
+        ('out', 'unsubscribed') : {
+            NONE_PENDING_IN : NONE,
+            FROM : NONE,
+            NONE_PENDING_IN_OUT : NONE_PENDING_OUT,
+            FROM_PENDING_OUT : NONE_PENDING_OUT,
+            TO_PENDING_IN : TO,
+            BOTH : TO,
+            },
+        }
+
     state2primaryName = {
                          NONE : 'none',
                          NONE_PENDING_OUT : 'none',
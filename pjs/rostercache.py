@@ -0,0 +1,357 @@
+"""Write-through cache of the users' rosters.
+
+pjs.roster.Roster reads the user's DB id and roster items from here and
+only goes to the DB when they're not cached. The Roster methods that change
+the roster update the cache after committing to the DB, so the cached
+rosters never need to be reread. The cache holds the most recently used
+rosters within the limits in pjs.conf.conf, and a user's roster is dropped
+when their last resource goes offline.
+
+The cache is shared between the main loop and the threadpool threads, so
+all access goes through a lock.
+"""
+
+import threading
+
+import pjs.conf.conf
+
+class CachedRoster:
+    """The cached data of one user's roster"""
+    def __init__(self, jid, uid):
+        self.jid = jid
+        self.uid = uid
+
+        # contact id => RosterItem for all contacts in the roster, including
+        # the ones that aren't shown to the user. None until the roster's
+        # loaded. The RosterItems are replaced, never modified, when the
+        # contacts change, so they can be handed out without copying.
+        self.items = None
+
+        # contact's bare JID => contact id
+        self.byJid = None
+
+        # the roster version (see pjs.roster.Roster.getVersion()) or None if
+        # it's not known
+        self.version = None
+
+        # the LRU list links
+        self.prev = None
+        self.next = None
+
+    def size(self):
+        """Returns the number of contacts cached"""
+        if self.items is None:
+            return 0
+        return len(self.items)
+
+class RosterCache:
+    """LRU cache of CachedRosters keyed by bare JID"""
+    def __init__(self, maxUsers=None, maxContacts=None):
+        """maxUsers -- the most users whose rosters are cached.
+        maxContacts -- the most contacts in all cached rosters together.
+        """
+        if maxUsers is None:
+            maxUsers = pjs.conf.conf.rosterCacheMaxUsers
+        if maxContacts is None:
+            maxContacts = pjs.conf.conf.rosterCacheMaxContacts
+        self.maxUsers = maxUsers
+        self.maxContacts = maxContacts
+
+        self.lock = threading.RLock()
+
+        # bare JID => CachedRoster
+        self.users = {}
+        self.contacts = 0
+
+        # bare JID => number of changes to the roster since a load from the
+        # DB started. loads that raced with a change are thrown away.
+        self.loading = {}
+
+        # least recently used at the head, most recently at the tail
+        self.head = None
+        self.tail = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getUid(self, jid):
+        """Returns the DB id of jid or None if it's not cached"""
+        self.lock.acquire()
+        try:
+            entry = self.users.get(jid)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(entry)
+            return entry.uid
+        finally:
+            self.lock.release()
+
+    def setUid(self, jid, uid):
+        """Caches the DB id of jid"""
+        self.lock.acquire()
+        try:
+            if jid not in self.users:
+                entry = CachedRoster(jid, uid)
+                self.users[jid] = entry
+                self._append(entry)
+                self._trim()
+        finally:
+            self.lock.release()
+
+    def getItems(self, jid):
+        """Returns the {contact id => RosterItem} dict of all contacts of jid
+        or None if the roster's not cached. The dict is a copy, but the
+        RosterItems must not be modified.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.users.get(jid)
+            if entry is None or entry.items is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(entry)
+            return dict(entry.items)
+        finally:
+            self.lock.release()
+
+    def getItem(self, jid, cjid):
+        """Returns the RosterItem of the contact cjid in jid's roster, False
+        if there's no such contact or None if the roster's not cached.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.users.get(jid)
+            if entry is None or entry.items is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(entry)
+            cid = entry.byJid.get(cjid)
+            if cid is None:
+                return False
+            return entry.items[cid]
+        finally:
+            self.lock.release()
+
+    def getItemById(self, jid, cid):
+        """Like getItem(), but looks the contact up by its DB id"""
+        self.lock.acquire()
+        try:
+            entry = self.users.get(jid)
+            if entry is None or entry.items is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(entry)
+            return entry.items.get(cid, False)
+        finally:
+            self.lock.release()
+
+    def getVersion(self, jid):
+        """Returns the cached roster version of jid or None"""
+        self.lock.acquire()
+        try:
+            entry = self.users.get(jid)
+            if entry is None:
+                return None
+            return entry.version
+        finally:
+            self.lock.release()
+
+    def setVersion(self, jid, version):
+        """Caches the roster version of jid if the user's cached. Versions
+        only go up, so an older version read by a slower thread is ignored.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.users.get(jid)
+            if entry is not None and \
+               (entry.version is None or version > entry.version):
+                entry.version = version
+        finally:
+            self.lock.release()
+
+    def beginLoad(self, jid):
+        """Must be called before reading jid's roster from the DB. Returns
+        the value to pass to setItems().
+        """
+        self.lock.acquire()
+        try:
+            return self.loading.setdefault(jid, 0)
+        finally:
+            self.lock.release()
+
+    def setItems(self, jid, uid, items, stamp):
+        """Caches the complete roster of jid. Returns False if the roster
+        changed while it was being read and wasn't cached.
+
+        items -- {contact id => RosterItem} of all contacts in the roster
+        stamp -- return value of beginLoad()
+        """
+        self.lock.acquire()
+        try:
+            if self.loading.pop(jid, None) != stamp:
+                return False
+            entry = self.users.get(jid)
+            if entry is None:
+                entry = CachedRoster(jid, uid)
+                self.users[jid] = entry
+                self._append(entry)
+            else:
+                self._touch(entry)
+            self.contacts -= entry.size()
+            entry.items = dict(items)
+            entry.byJid = {}
+            for cid, item in items.items():
+                entry.byJid[item.jid] = cid
+            self.contacts += entry.size()
+            self._trim()
+            return True
+        finally:
+            self.lock.release()
+
+    def updateItem(self, jid, cid, item):
+        """Replaces the RosterItem of the contact with id cid in jid's
+        roster, if it's cached
+        """
+        self.lock.acquire()
+        try:
+            self._changed(jid)
+            entry = self.users.get(jid)
+            if entry is None or entry.items is None:
+                return
+            old = entry.items.get(cid)
+            if old is None:
+                self.contacts += 1
+            else:
+                del entry.byJid[old.jid]
+            entry.items[cid] = item
+            entry.byJid[item.jid] = cid
+            if old is None:
+                self._trim()
+        finally:
+            self.lock.release()
+
+    def removeItem(self, jid, cid):
+        """Removes the contact with id cid from jid's cached roster"""
+        self.lock.acquire()
+        try:
+            self._changed(jid)
+            entry = self.users.get(jid)
+            if entry is None or entry.items is None:
+                return
+            old = entry.items.pop(cid, None)
+            if old is not None:
+                del entry.byJid[old.jid]
+                self.contacts -= 1
+        finally:
+            self.lock.release()
+
+    def invalidate(self, jid):
+        """Drops the roster of jid from the cache"""
+        self.lock.acquire()
+        try:
+            self._changed(jid)
+            entry = self.users.pop(jid, None)
+            if entry is not None:
+                self._unlink(entry)
+                self.contacts -= entry.size()
+        finally:
+            self.lock.release()
+
+    def evict(self, jid):
+        """Drops the roster of jid because it's no longer needed"""
+        self.lock.acquire()
+        try:
+            if jid in self.users:
+                self.evictions += 1
+                self.invalidate(jid)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for jid in self.loading:
+                self.loading[jid] += 1
+            self.users = {}
+            self.contacts = 0
+            self.head = self.tail = None
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.users)
+
+    def getStats(self):
+        """Returns a dict with the size and hit rate of the cache"""
+        total = self.hits + self.misses
+        if total:
+            hitRate = float(self.hits) / total
+        else:
+            hitRate = 0.0
+        return {
+                'users' : len(self.users),
+                'contacts' : self.contacts,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'hitRate' : hitRate,
+                'evictions' : self.evictions,
+                }
+
+    def _trim(self):
+        """Drops the least recently used rosters until we're within the
+        limits. The most recently used one is always kept.
+        """
+        while self.head is not self.tail and \
+              (len(self.users) > self.maxUsers or
+               self.contacts > self.maxContacts):
+            entry = self.head
+            self.evictions += 1
+            del self.users[entry.jid]
+            self._unlink(entry)
+            self.contacts -= entry.size()
+
+    def _changed(self, jid):
+        """Marks the loads of jid in progress as stale"""
+        if jid in self.loading:
+            self.loading[jid] += 1
+
+    def _append(self, entry):
+        entry.prev = self.tail
+        entry.next = None
+        if self.tail is not None:
+            self.tail.next = entry
+        else:
+            self.head = entry
+        self.tail = entry
+
+    def _unlink(self, entry):
+        if entry.prev is not None:
+            entry.prev.next = entry.next
+        else:
+            self.head = entry.next
+        if entry.next is not None:
+            entry.next.prev = entry.prev
+        else:
+            self.tail = entry.prev
+        entry.prev = entry.next = None
+
+    def _touch(self, entry):
+        """Marks entry as the most recently used"""
+        if entry is not self.tail:
+            self._unlink(entry)
+            self._append(entry)
+
+_cache = None
+
+def getRosterCache():
+    """Returns the process-wide RosterCache"""
+    global _cache
+    if _cache is None:
+        _cache = RosterCache()
+    return _cache
@@ -0,0 +1,219 @@
+"""Streaming of big roster results.
+
+The result of a roster get for a big roster is written to the connection in
+chunks, without building the <query> tree or the whole serialized stanza.
+A threadpool thread reads the RosterItems one by one (see
+pjs.roster.Roster.iterItems()) and serializes them into chunks, which it
+puts in a queue of at most rosterStreamQueueSize chunks. The main loop takes
+the chunks off the queue and writes one only while the connection's output
+buffer is below rosterStreamBufferSize, so at most a few chunks of the roster
+are in memory at any time. When the queue is full, the thread waits for the
+client to read. A client that doesn't read for rosterStreamTimeout seconds
+is disconnected, which also stops the thread.
+
+If reading the roster fails before anything was written, produce() returns
+False and the handler answers with an error. If it fails after the client
+got a part of the roster, the stream is closed with an internal-server-error
+stream error. Either way, the client never gets a roster that looks complete
+but isn't.
+
+While the result is being written, everything else sent to the connection is
+held back (see pjs.connection.Connection.hold()), so that no stanza ends up
+in the middle of it.
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+import pjs.conf.conf
+
+from pjs.serializer import startTag, endTag, serialize
+
+# sent when the roster can't be read after a part of it was written
+STREAM_ERROR = "<stream:error><internal-server-error " + \
+               "xmlns='urn:ietf:params:xml:ns:xmpp-streams'/></stream:error>"
+
+class RosterStream:
+    """Writes one roster result to a connection in chunks"""
+    def __init__(self, conn, iq):
+        """conn -- connection to write to.
+        iq -- the result <iq> Element with the <query> as its only child.
+              The query shouldn't have any items; they're passed to
+              produce().
+        """
+        self.conn = conn
+        self.chunkSize = pjs.conf.conf.rosterStreamChunkSize
+        self.maxBuffered = pjs.conf.conf.rosterStreamBufferSize
+        self.timeout = pjs.conf.conf.rosterStreamTimeout
+
+        query = iq[0]
+        head, ns = startTag(iq)
+        qhead, self.ns = startTag(query, ns)
+        self.head = head + qhead
+        self.tail = endTag(query) + endTag(iq)
+
+        self.maxQueued = pjs.conf.conf.rosterStreamQueueSize
+
+        # serialized chunks waiting to be written. filled by produce() and
+        # emptied by pump(), both under the condition's lock.
+        self.pending = deque()
+        self.cond = threading.Condition()
+        # set when all chunks were put in pending
+        self.ready = False
+        # set when the roster couldn't be read
+        self.failed = False
+
+        self.started = False
+        self.finished = False
+        # set when the stream is abandoned
+        self.cancelled = False
+        # set when the client didn't read for longer than the timeout
+        self.stalled = False
+
+        # time the client last read some of its roster, and how much was
+        # waiting to be sent then
+        self.lastProgress = None
+        self.lastBuffered = 0
+
+        self.items = 0
+        self.chunks = 0
+        self.written = 0
+
+    def produce(self, items):
+        """Serializes the RosterItems from the iterable items into chunks and
+        queues them for pump(). Runs in a threadpool thread. Waits while the
+        queue is full and returns when all chunks were queued or the stream
+        was abandoned. Returns False if the items couldn't be read before
+        anything was written, in which case nothing will be written. If they
+        can't be read later on, pump() closes the stream instead.
+        """
+        out = [self.head]
+        count = 0
+        try:
+            for item in items:
+                serialize(item.getAsTree(), out.append, self.ns)
+                count += 1
+                if count == self.chunkSize:
+                    if not self._put(u''.join(out).encode('utf-8'), count):
+                        return True
+                    out = []
+                    count = 0
+        except Exception, e:
+            logging.warning("[%s] Failed to read the roster: %s",
+                            self.__class__, e)
+            self.cond.acquire()
+            try:
+                self.failed = True
+                # pump() doesn't start once failed is set
+                return self.started
+            finally:
+                self.cond.release()
+
+        out.append(self.tail)
+        self._put(u''.join(out).encode('utf-8'), count, True)
+        return True
+
+    def _put(self, data, count, last=False):
+        """Queues a chunk of count items, waiting for room in the queue.
+        Returns False if the stream was abandoned.
+        """
+        self.cond.acquire()
+        try:
+            while len(self.pending) >= self.maxQueued and not self.cancelled:
+                self.cond.wait()
+            if self.cancelled:
+                return False
+            self.pending.append(data)
+            self.items += count
+            self.ready = last
+            return True
+        finally:
+            self.cond.release()
+
+    def pump(self):
+        """Writes the queued chunks while the connection's output buffer is
+        below the limit. Called from the main loop. Returns True when the
+        whole result was written or the stream was abandoned.
+        """
+        self.cond.acquire()
+        try:
+            return self._pump()
+        finally:
+            # there may be room in the queue now
+            self.cond.notify()
+            self.cond.release()
+
+    def _pump(self):
+        if self.finished:
+            return True
+
+        conn = self.conn
+        if conn.data['stream']['closing'] or not conn.connected:
+            self._cancel()
+            return True
+
+        if self.failed:
+            self.finished = True
+            if self.started:
+                # the client has a part of the roster. there's no way to end
+                # the <iq> as an error, so the stream is closed.
+                self.pending.clear()
+                conn.sendThrough(STREAM_ERROR)
+                conn.held = None
+                conn.handle_close()
+            return True
+
+        now = time.time()
+        if not self.started:
+            if not self.pending:
+                return False
+            conn.hold()
+            self.started = True
+            self.lastProgress = now
+        elif len(conn.out_buffer) < self.lastBuffered:
+            self.lastProgress = now
+
+        while self.pending and len(conn.out_buffer) < self.maxBuffered:
+            data = self.pending.popleft()
+            conn.sendThrough(data)
+            self.chunks += 1
+            self.written += len(data)
+            self.lastProgress = now
+
+        if not self.pending:
+            if self.ready:
+                self.finished = True
+                conn.release()
+                return True
+            # waiting for the thread, not for the client
+            self.lastProgress = now
+        elif now - self.lastProgress > self.timeout:
+            logging.info("[%s] %s stopped reading its roster",
+                         self.__class__, conn.addr)
+            self.stalled = True
+            self._cancel()
+            conn.handle_close()
+            return True
+
+        self.lastBuffered = len(conn.out_buffer)
+        return False
+
+    def cancel(self):
+        """Abandons the stream. Data held back on the connection is dropped,
+        since the connection is going away. Wakes up produce().
+        """
+        self.cond.acquire()
+        try:
+            self._cancel()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _cancel(self):
+        self.cancelled = True
+        self.finished = True
+        self.pending.clear()
+        self.conn.held = None
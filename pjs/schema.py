@@ -0,0 +1,137 @@
+"""Versioned schema of the SQLite DB.
+
+The schema is built by a list of numbered migrations. The number of the last
+one applied is kept in the DB's user_version, so migrate() only runs the
+ones the DB doesn't have yet, each in its own transaction. New changes to
+the schema are added as a new migration at the end of MIGRATIONS; the ones
+already there must not be changed, since they have been run on existing DBs.
+
+migrate() also puts the DB into the journal mode in pjs.conf.conf. The other
+tuning pragmas are per connection and are set by pjs.db.ConnectionPool.
+"""
+
+import logging
+
+import pjs.conf.conf
+
+from pjs.db import DB, beginImmediate, commitImmediate, rollbackImmediate
+
+# (version, description, statements)
+MIGRATIONS = [
+    (1, 'roster tables', [
+        "CREATE TABLE IF NOT EXISTS jids\
+            (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+             jid TEXT NOT NULL,\
+             password TEXT NOT NULL,\
+             UNIQUE(jid))",
+        "CREATE TABLE IF NOT EXISTS roster\
+            (userid INTEGER REFERENCES jids NOT NULL,\
+             contactid INTEGER REFERENCES jids NOT NULL,\
+             name TEXT,\
+             subscription INTEGER DEFAULT 0,\
+             PRIMARY KEY (userid, contactid))",
+        "CREATE TABLE IF NOT EXISTS rostergroups\
+            (groupid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+             userid INTEGER REFERENCES jids NOT NULL,\
+             name TEXT NOT NULL,\
+             UNIQUE(userid, name))",
+        "CREATE TABLE IF NOT EXISTS rostergroupitems\
+            (groupid INTEGER REFERENCES rostergroup NOT NULL,\
+             contactid INTEGER REFERENCES jids NOT NULL,\
+             PRIMARY KEY (groupid, contactid))",
+        "CREATE TABLE IF NOT EXISTS rosterversions\
+            (userid INTEGER PRIMARY KEY REFERENCES jids NOT NULL,\
+             version INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS rosterchanges\
+            (userid INTEGER REFERENCES jids NOT NULL,\
+             version INTEGER NOT NULL,\
+             contactid INTEGER REFERENCES jids NOT NULL,\
+             PRIMARY KEY (userid, version))",
+        ]),
+    # Lookups by (userid, contactid) and groups by groupid are covered by
+    # the primary keys already.
+    (2, 'indexes for the roster and presence queries', [
+        # the subscription states of a user's contacts (presence broadcasts
+        # and probes) and the roster count, without reading the table
+        "CREATE INDEX IF NOT EXISTS roster_userid_subscription\
+            ON roster (userid, subscription, contactid)",
+        # the users who have a contact in their rosters
+        "CREATE INDEX IF NOT EXISTS roster_contactid\
+            ON roster (contactid, userid, subscription)",
+        # a contact's groups
+        "CREATE INDEX IF NOT EXISTS rostergroupitems_contactid\
+            ON rostergroupitems (contactid, groupid)",
+        "ANALYZE",
+        ]),
+    (3, 'SCRAM keys', [
+        # the salted keys of pjs.scram. the binary values are in base64.
+        "CREATE TABLE IF NOT EXISTS scramkeys\
+            (userid INTEGER REFERENCES jids NOT NULL,\
+             mechanism TEXT NOT NULL,\
+             salt TEXT NOT NULL,\
+             iterations INTEGER NOT NULL,\
+             storedkey TEXT NOT NULL,\
+             serverkey TEXT NOT NULL,\
+             PRIMARY KEY (userid, mechanism))",
+        ]),
+    ]
+
+def getVersion(con):
+    """Returns the schema version of the DB of the connection con"""
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+def getLatestVersion():
+    """Returns the version migrate() brings the DB to"""
+    return MIGRATIONS[-1][0]
+
+def migrate(name=None, target=None):
+    """Applies the migrations the DB doesn't have yet. Returns the schema
+    version of the DB.
+    name -- DB name. The current DB if not given.
+    target -- version to stop at. The latest if not given.
+    """
+    if target is None:
+        target = getLatestVersion()
+
+    con = DB(name, None)
+    try:
+        setJournalMode(con)
+        version = getVersion(con)
+        for number, description, statements in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            c = beginImmediate(con)
+            try:
+                # another process may have migrated the DB in the meantime
+                if getVersion(con) >= number:
+                    rollbackImmediate(con, c)
+                    continue
+                for statement in statements:
+                    c.execute(statement)
+                c.execute("PRAGMA user_version = %d" % number)
+            except Exception, e:
+                rollbackImmediate(con, c)
+                logging.warning("[schema] Migration %d (%s) failed: %s",
+                                number, description, e)
+                raise
+            commitImmediate(con, c)
+            logging.info("[schema] Migrated the DB to version %d: %s",
+                         number, description)
+            version = number
+        return version
+    finally:
+        con.close()
+
+def setJournalMode(con):
+    """Sets the journal mode in pjs.conf.conf on the DB of the autocommit
+    connection con. The mode is kept in the DB file, so this only needs to
+    be done once. Returns the mode the DB is in.
+    """
+    mode = pjs.conf.conf.dbJournalMode
+    if not mode:
+        return None
+    res = con.execute("PRAGMA journal_mode = %s" % mode).fetchone()[0]
+    if res.lower() != mode.lower():
+        logging.warning("[schema] Could not set the journal mode to %s: " + \
+                        "the DB is in %s mode", mode, res)
+    return res
@@ -0,0 +1,219 @@
+"""Salted credentials for the SCRAM mechanisms (RFC 5802, RFC 7677).
+
+For each mechanism in scramMechanisms, a user gets a random salt and the
+StoredKey and ServerKey made from the password with scramIterations
+iterations of PBKDF2. A login then only costs a few HMACs (see
+pjs.auth_mechanisms.SASLScram). The keys are kept by the storage backend and
+are dropped when the password changes.
+
+PBKDF2 is meant to be slow, so it's run on the process pool (see
+pjs.procpool) rather than in the server's threads, where it would hold the
+GIL. Users created with addUser() or given a password with setPassword() get
+their keys right away. Users who don't have them get them at their first
+SCRAM login, or all at once with migrate(). Run from the top-level directory:
+    $ PYTHONPATH=. python pjs/scram.py [--all]
+--all also redoes the keys that were made with a different iteration count
+than scramIterations.
+
+Unknown users are given made-up keys with getMockKeys(), so that a login
+only fails once the proof is checked and doesn't tell whether the account
+exists (RFC 5802 #9).
+
+DIGEST-MD5 and the jabber:iq:auth digest need the password, so it's still
+stored. The passwords aren't prepared with SASLprep.
+"""
+
+import os
+import sys
+import hmac
+import struct
+import logging
+
+import pjs.conf.conf
+import pjs.procpool
+
+from pjs.storage.base import getStorage
+
+try:
+    # python >= 2.5
+    import hashlib
+    HASHES = {
+              'SCRAM-SHA-1' : hashlib.sha1,
+              'SCRAM-SHA-256' : hashlib.sha256,
+              }
+    # python >= 2.7.8
+    pbkdf2_hmac = getattr(hashlib, 'pbkdf2_hmac', None)
+except ImportError:
+    import sha
+    HASHES = {
+              'SCRAM-SHA-1' : sha.new,
+              }
+    pbkdf2_hmac = None
+
+# bytes of random salt
+SALT_SIZE = 16
+
+_mockSecret = None
+
+def _xor(a, b):
+    return ''.join([chr(ord(x) ^ ord(y)) for x, y in zip(a, b)])
+
+def _hmac(mechanism, key, msg):
+    return hmac.new(key, msg, HASHES[mechanism]).digest()
+
+def _pbkdf2(mechanism, password, salt, iterations):
+    """PBKDF2 with one block, for pythons without hashlib.pbkdf2_hmac"""
+    u = _hmac(mechanism, password, salt + struct.pack('>I', 1))
+    result = u
+    for i in xrange(iterations - 1):
+        u = _hmac(mechanism, password, u)
+        result = _xor(result, u)
+    return result
+
+def saltPassword(mechanism, password, salt, iterations):
+    """Returns SaltedPassword of RFC 5802 for the SCRAM mechanism"""
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    if pbkdf2_hmac is not None:
+        return pbkdf2_hmac(HASHES[mechanism]().name, password, salt,
+                           iterations)
+    return _pbkdf2(mechanism, password, salt, iterations)
+
+def getMockKeys(jid, mechanism):
+    """Returns made-up (salt, iterations, StoredKey, ServerKey) for jid, who
+    isn't a user. They're the same every time for the same jid, like a real
+    user's would be, and no proof matches them.
+    """
+    global _mockSecret
+    if _mockSecret is None:
+        _mockSecret = pjs.conf.conf.scramMockSecret or os.urandom(32)
+    if isinstance(jid, unicode):
+        jid = jid.encode('utf-8')
+    msg = '%s %s' % (mechanism, jid)
+    salt = _hmac(mechanism, _mockSecret, 'salt ' + msg)[:SALT_SIZE]
+    storedKey = _hmac(mechanism, _mockSecret, 'stored ' + msg)
+    serverKey = _hmac(mechanism, _mockSecret, 'server ' + msg)
+    return (salt, pjs.conf.conf.scramIterations, storedKey, serverKey)
+
+def makeKeys(password, mechanisms, iterations):
+    """Returns the dict of mechanism => (salt, iterations, StoredKey,
+    ServerKey) of password. This is the slow part, which runs in the process
+    pool, so it only uses its arguments.
+    """
+    keys = {}
+    for mechanism in mechanisms:
+        salt = os.urandom(SALT_SIZE)
+        salted = saltPassword(mechanism, password, salt, iterations)
+        clientKey = _hmac(mechanism, salted, 'Client Key')
+        storedKey = HASHES[mechanism](clientKey).digest()
+        serverKey = _hmac(mechanism, salted, 'Server Key')
+        keys[mechanism] = (salt, iterations, storedKey, serverKey)
+    return keys
+
+def getMechanisms():
+    """Returns the list of SCRAM mechanisms in scramMechanisms that are
+    supported
+    """
+    return [mech for mech in pjs.conf.conf.scramMechanisms if mech in HASHES]
+
+def computeKeys(password, mechanisms=None, iterations=None):
+    """Makes the keys of password on the process pool, if it's started, and
+    waits for them. See makeKeys().
+    """
+    if mechanisms is None:
+        mechanisms = getMechanisms()
+    if iterations is None:
+        iterations = pjs.conf.conf.scramIterations
+    pool = pjs.procpool.getPool()
+    if pool is None:
+        return makeKeys(password, mechanisms, iterations)
+    return pool.apply(makeKeys, password, mechanisms, iterations)
+
+def addUser(jid, password):
+    """Adds the local user jid with the SCRAM keys of password. Returns its
+    id.
+    """
+    keys = computeKeys(password)
+    storage = getStorage()
+    uid = storage.addUser(jid, password)
+    storage.setScramKeys(jid, keys)
+    return uid
+
+def setPassword(jid, password):
+    """Changes the password of the local user jid and its SCRAM keys.
+    Returns False if there's no such user.
+    """
+    keys = computeKeys(password)
+    storage = getStorage()
+    if not storage.setPassword(jid, password):
+        return False
+    storage.setScramKeys(jid, keys)
+    return True
+
+def getKeys(jid, mechanism):
+    """Returns the (salt, iterations, StoredKey, ServerKey) of the local user
+    jid for the mechanism or None if there's no such user. Users without
+    keys get them now.
+    """
+    storage = getStorage()
+    keys = storage.getScramKeys(jid, mechanism)
+    if keys is not None:
+        return keys
+
+    password = storage.getPassword(jid)
+    if password is None:
+        return None
+    mechanisms = getMechanisms()
+    if mechanism not in mechanisms:
+        mechanisms.append(mechanism)
+    allKeys = computeKeys(password, mechanisms)
+    # the password may have changed while the keys were made
+    if storage.getPassword(jid) == password:
+        storage.setScramKeys(jid, allKeys)
+    return allKeys[mechanism]
+
+def migrate(redo=False, chunkSize=100):
+    """Makes the SCRAM keys of all users who don't have them for all of
+    scramMechanisms. If redo is True, the keys made with a different
+    iteration count are made again. The keys are made on the process pool,
+    chunkSize users at a time. Returns the number of users converted.
+    """
+    storage = getStorage()
+    mechanisms = getMechanisms()
+    iterations = pjs.conf.conf.scramIterations
+
+    todo = []
+    for jid in storage.getUsers():
+        for mechanism in mechanisms:
+            keys = storage.getScramKeys(jid, mechanism)
+            if keys is None or (redo and keys[1] != iterations):
+                todo.append(jid)
+                break
+
+    converted = 0
+    for i in range(0, len(todo), chunkSize):
+        jids = todo[i:i + chunkSize]
+        passwords = [storage.getPassword(jid) for jid in jids]
+        args = [(password, mechanisms, iterations) for password in passwords]
+        pool = pjs.procpool.getPool()
+        if pool is None:
+            results = [makeKeys(*arg) for arg in args]
+        else:
+            results = pool.map(makeKeys, args)
+        for jid, password, keys in zip(jids, passwords, results):
+            if password and storage.getPassword(jid) == password:
+                storage.setScramKeys(jid, keys)
+                converted += 1
+        logging.info("[scram] Converted %d of %d users", converted, len(todo))
+    return converted
+
+if __name__ == '__main__':
+    redo = '--all' in sys.argv[1:]
+    pjs.procpool.startPool()
+    storage = getStorage()
+    storage.setup()
+    try:
+        print 'Converted %d users' % migrate(redo)
+    finally:
+        storage.close()
+        pjs.procpool.stopPool()
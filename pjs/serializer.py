@@ -0,0 +1,322 @@
+"""Serializes ElementTree's Elements into XML text for sending over the wire.
+
+This replaces the recursive string concatenation that pjs.utils.tostring()
+used to do. The output follows the same conventions: elements in the
+jabber:client and jabber:server namespaces are written without a namespace
+(the stream's default namespace applies), and elements in other namespaces
+get an xmlns attribute attached to their unprefixed tag. Unlike the old
+tostring(), text and attribute values are escaped.
+
+The (namespace, tag) split of every qualified name is memoized, since the
+same few dozen tags make up almost all of the traffic. Output is collected
+in a list and joined once at the end.
+"""
+
+# namespaces that we never declare, because they're the stream's default
+STANDARD_NS = ('jabber:client', 'jabber:server')
+
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+# The caches are bounded, because tag names come from the remote side and
+# we don't want a malicious client to be able to grow them indefinitely.
+MAX_CACHED_NAMES = 2048
+
+# qname => (tag, ns). ns is None for standard and unqualified tags.
+_tagCache = {}
+
+# attribute name => (name as written, ns uri or None)
+_attrCache = {}
+
+def clearCache():
+    """Clears the memoized names. Mostly useful for testing."""
+    _tagCache.clear()
+    _attrCache.clear()
+
+def splitTag(qname):
+    """Returns the (tag, namespace) tuple for ElementTree's "{ns}tag" qname.
+    The namespace is None for the standard stream namespaces and for tags
+    without a namespace.
+    """
+    try:
+        return _tagCache[qname]
+    except KeyError:
+        pass
+
+    if qname[:1] == '{':
+        ns, tag = qname[1:].split('}', 1)
+        if ns in STANDARD_NS:
+            ns = None
+    else:
+        ns, tag = None, qname
+
+    if len(_tagCache) >= MAX_CACHED_NAMES:
+        _tagCache.clear()
+    _tagCache[qname] = (tag, ns)
+
+    return tag, ns
+
+def _splitAttr(name):
+    """Returns the (name, namespace) tuple for an attribute name. expat
+    reports namespaced attributes as "ns}name", while ElementTree uses
+    "{ns}name", so we handle both. Attributes in the XML namespace
+    (ie. xml:lang) get the reserved xml prefix and no namespace.
+    """
+    try:
+        return _attrCache[name]
+    except KeyError:
+        pass
+
+    if '}' in name:
+        ns, local = name.lstrip('{').split('}', 1)
+        if ns == XML_NS:
+            res = ('xml:' + local, None)
+        else:
+            res = (local, ns)
+    else:
+        res = (name, None)
+
+    if len(_attrCache) >= MAX_CACHED_NAMES:
+        _attrCache.clear()
+    _attrCache[name] = res
+
+    return res
+
+def escapeText(text):
+    """Escapes character data for inclusion between tags"""
+    # checking first is much faster than replacing in the common case
+    # where there's nothing to escape
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+def escapeAttr(text):
+    """Escapes an attribute value. Values are always written in single
+    quotes, but we escape both kinds of quotes to be safe.
+    """
+    if not isinstance(text, basestring):
+        text = unicode(text)
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if "'" in text:
+        text = text.replace("'", '&apos;')
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    if '\t' in text:
+        text = text.replace('\t', '&#9;')
+    return text
+
+def writeAttrs(append, items):
+    """Writes the attributes in the items list of (name, value) pairs using
+    the append function. Returns the value of the xmlns attribute if one was
+    among the items; None otherwise.
+    """
+    declaredNs = None
+    prefixes = None
+    for k, v in items:
+        name, ns = _splitAttr(k)
+        if ns is not None:
+            # namespaced attribute. declare a prefix for it on this element.
+            if prefixes is None:
+                prefixes = {}
+            prefix = prefixes.get(ns)
+            if prefix is None:
+                prefix = prefixes[ns] = 'ns%d' % len(prefixes)
+                append(u" xmlns:%s='%s'" % (prefix, escapeAttr(ns)))
+            name = prefix + ':' + name
+        elif name == 'xmlns':
+            declaredNs = v
+        append(u" %s='%s'" % (name, escapeAttr(v)))
+    return declaredNs
+
+def _writeStart(append, elem, defaultNs):
+    """Writes the start tag of elem without the closing '>' using the
+    append function. Returns (tag, namespace in effect inside elem).
+    """
+    tag, ns = splitTag(elem.tag)
+    append(u'<' + tag)
+
+    declaredNs = None
+    items = elem.items()
+    if items:
+        declaredNs = writeAttrs(append, items)
+
+    if declaredNs is not None:
+        defaultNs = declaredNs
+    elif ns is not None and ns != defaultNs:
+        append(u" xmlns='%s'" % escapeAttr(ns))
+        defaultNs = ns
+
+    return tag, defaultNs
+
+def _serialize(append, elem, defaultNs):
+    """Writes out elem and its children using the append function.
+    defaultNs is the namespace in effect for the parent element.
+    """
+    tag, defaultNs = _writeStart(append, elem, defaultNs)
+
+    text = elem.text
+    if len(elem) or text:
+        append(u'>')
+        if text:
+            append(escapeText(text))
+        for child in elem:
+            _serialize(append, child, defaultNs)
+            if child.tail:
+                append(escapeText(child.tail))
+        append(u'</' + tag + u'>')
+    else:
+        append(u'/>')
+
+def serialize(tree, write, defaultNs=None):
+    """Serializes tree by calling write with successive chunks of text.
+    This is useful for streaming large trees into a connection without
+    building the whole string first. defaultNs is the namespace in effect
+    for tree's parent, if it's written separately (see startTag()).
+    """
+    _serialize(write, tree, defaultNs)
+
+def startTag(elem, defaultNs=None):
+    """Returns (start tag of elem, namespace in effect inside elem). elem's
+    children are left out, so that they can be written separately, and the
+    namespace should be passed as defaultNs for the first child. This is for
+    writing big elements piece by piece; see endTag().
+    """
+    out = []
+    tag, defaultNs = _writeStart(out.append, elem, defaultNs)
+    out.append(u'>')
+    return u''.join(out), defaultNs
+
+def endTag(elem):
+    """Returns the end tag of elem"""
+    return u'</%s>' % splitTag(elem.tag)[0]
+
+def tostring(tree):
+    """Converts tree into a unicode string"""
+    out = []
+    _serialize(out.append, tree, None)
+    return u''.join(out)
+
+def tobytes(tree, encoding='utf-8'):
+    """Converts tree into a byte string in the given encoding (UTF-8 by
+    default), ready to be written into a socket.
+    """
+    out = []
+    _serialize(out.append, tree, None)
+    return u''.join(out).encode(encoding)
+
+class StanzaTemplate:
+    """A stanza that's serialized once with its addressing attributes left
+    out, so that it can be rendered for many recipients by splicing in only
+    the values that differ. This is used for fan-out, such as presence
+    broadcasts and roster pushes, where the same stanza goes to hundreds of
+    contacts and only the 'to' (and possibly 'id') attribute changes.
+    """
+    def __init__(self, tree, slots=('to', 'id')):
+        """Serializes tree.
+
+        tree -- Element to serialize. It's not modified and shouldn't be
+                modified afterwards, since element() uses it.
+        slots -- names of the attributes of the top-level element that are
+                 filled in per recipient. When a slot isn't given a value
+                 during rendering, the value in tree (if any) is used.
+        """
+        self.tree = tree
+        self.slots = tuple(slots)
+        self.defaults = {}
+        for name in self.slots:
+            self.defaults[name] = tree.get(name)
+
+        tag, ns = splitTag(tree.tag)
+
+        head = [u'<' + tag]
+        items = [(k, v) for k, v in tree.items() if k not in self.slots]
+        declaredNs = None
+        if items:
+            declaredNs = writeAttrs(head.append, items)
+        defaultNs = declaredNs
+        if declaredNs is None and ns is not None:
+            head.append(u" xmlns='%s'" % escapeAttr(ns))
+            defaultNs = ns
+
+        tail = []
+        if len(tree) or tree.text:
+            tail.append(u'>')
+            if tree.text:
+                tail.append(escapeText(tree.text))
+            for child in tree:
+                _serialize(tail.append, child, defaultNs)
+                if child.tail:
+                    tail.append(escapeText(child.tail))
+            tail.append(u'</' + tag + u'>')
+        else:
+            tail.append(u'/>')
+
+        self.head = u''.join(head)
+        self.tail = u''.join(tail)
+
+    def render(self, **values):
+        """Returns the stanza as a unicode string with the slot attributes
+        set to values.
+        """
+        out = [self.head]
+        for name in self.slots:
+            v = values.get(name, self.defaults[name])
+            if v is not None:
+                out.append(u" %s='%s'" % (name, escapeAttr(v)))
+        out.append(self.tail)
+        return u''.join(out)
+
+    def bind(self, **values):
+        """Returns a BoundStanza for these slot values. Rendering is deferred
+        until the stanza is actually sent.
+        """
+        return BoundStanza(self, values)
+
+class BoundStanza:
+    """A StanzaTemplate together with the slot values for one recipient.
+    pjs.handlers.write.prepareDataForSending() knows how to send these.
+    """
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+
+    def get(self, key, default=None):
+        """Works like Element.get(), so that routers can find the 'to'"""
+        if key in self.values:
+            return self.values[key]
+        return self.template.tree.get(key, default)
+
+    def render(self):
+        """Returns the stanza as a unicode string"""
+        return self.template.render(**self.values)
+
+    def element(self):
+        """Returns a new Element for this stanza. The children are shared
+        with the template's tree, so they shouldn't be modified.
+        """
+        tree = self.template.tree
+        el = tree.makeelement(tree.tag, dict(tree.items()))
+        el.text = tree.text
+        el[:] = list(tree)
+        for k, v in self.values.items():
+            if v is None:
+                if k in el.attrib:
+                    del el.attrib[k]
+            else:
+                el.set(k, v)
+        return el
+
+    def __unicode__(self):
+        return self.render()
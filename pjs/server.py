@@ -3,13 +3,24 @@ and servers and create the appropriate Connection instances.
 """
 
 import pjs.threadpool as threadpool
+import pjs.async.core as asyncore
+import pjs.conf.conf
 import socket
+import logging
 
 from pjs.connection import Connection, ClientConnection, \
                            ServerInConnection, ServerOutConnection, \
-                           LocalServerInConnection, LocalServerOutConnection
+                           LocalServerInConnection, LocalServerOutConnection, \
+                           LocalDeliveryConnection
 from pjs.async.core import dispatcher
 from pjs.utils import SynchronizedDict
+from pjs.sessions import SessionIndex
+from pjs.lastpresence import LastPresenceStore, PresenceSnapshots
+from pjs.outqueue import OutboundQueue, makeBounce
+from pjs.coalesce import PresenceCoalescer
+from pjs.subscriptions import getSubscriptionGraph
+from pjs.roster import Subscription
+from pjs.dialback import VerifiedDomainCache, verifyElement, resultElement
 
 class Server(dispatcher):
     """General server that accepts connections, creates threadpools and stores
@@ -92,13 +103,37 @@ class C2SServer(Server):
         """Creates a C2S server. See Server.__doc__"""
         Server.__init__(self, ip, port, launcher)
 
-        self.data['resources'] = {}
+        # JID => Connection index of the clients. See pjs.sessions.
+        self.sessions = SessionIndex()
+
+        # this is the same dict as the index's bare JID map, so it's kept
+        # up to date by the index
+        self.data['resources'] = self.sessions.bare
+
+        # last presence of each available resource. used to answer probes.
+        self.lastPresences = LastPresenceStore()
+
+        # presence of the contacts of online users. sent to new resources.
+        self.contactPresences = PresenceSnapshots()
+
+        # holds back presence changes of flapping clients
+        self.presenceCoalescer = PresenceCoalescer(self.getPresenceFanout)
 #        example:
 #        self.data['resources']['tro@localhost'] = {
 #                                                   'resource' : <Connection obj>
 #                                                   }
         self.data['info']['type'] = 'c2s'
 
+    def getPresenceFanout(self, conn):
+        """Returns the number of stanzas that a presence broadcast from the
+        client on conn is delivered as
+        """
+        jid = conn.data['user']['jid']
+        subscribers = getSubscriptionGraph().getContacts(jid,
+                                                Subscription.PRESENCE_FROM)
+        resources = self.sessions.getResources(jid)
+        return len(subscribers or []) + max(len(resources) - 1, 0)
+
     def handle_accept(self):
         """Accepts a C2S connection"""
         sock, addr = self.accept()
@@ -119,6 +154,166 @@ class S2SServer(Server):
         #self.s2sConns = SynchronizedDict()
         self.s2sConns = {}
 
+        # domains served by this process. stanzas for these are delivered
+        # in-process through localDelivery instead of over S2S sockets.
+        self.localDomains = set([self.hostname, launcher.hostname])
+
+        # domain => OutboundQueue of stanzas for that remote domain. queues
+        # of domains that we have no connection to are removed by
+        # pruneQueues() once they're empty.
+        self.outQueues = {}
+        self._pruneTimer = None
+
+        # dialback keys that the authoritative servers confirmed recently
+        self.dialbackCache = VerifiedDomainCache()
+
+        # (remote domain, stream id) => list of (inbound Connection, key,
+        # local domain) waiting for the authoritative server's answer
+        self.pendingVerifies = {}
+
+        self.localDelivery = LocalDeliveryConnection(self)
+        self.conns[self.localDelivery.id] = ('localhost-in', self.localDelivery)
+
+    def isLocalDomain(self, domain):
+        """Returns True if domain is served by this process"""
+        return domain in self.localDomains
+
+    def connectTo(self, domain, queue=None, addrs=None):
+        """Returns the outgoing connection to the remote domain. If there
+        isn't one, a new one is created and starts connecting in the
+        background.
+
+        queue -- optional list of data to send over the connection once it's
+                 ready.
+        addrs -- optional list of (IP, port) pairs to connect to instead of
+                 looking up the domain in DNS.
+        """
+        outQueue = self.getOutQueue(domain)
+        if queue:
+            outQueue.extend(queue)
+
+        serverConns = self.s2sConns.setdefault(domain, [None, None])
+        conn = serverConns[1]
+        if conn is None:
+            conn = ServerOutConnection(None, None, self)
+            conn.outQueue = outQueue
+            self.conns[conn.id] = ('localhost-out', conn)
+            serverConns[1] = conn
+            conn.connectTo(domain, addrs)
+        return conn
+
+    def getOutQueue(self, domain):
+        """Returns the OutboundQueue for the remote domain"""
+        try:
+            return self.outQueues[domain]
+        except KeyError:
+            queue = OutboundQueue(domain, bounce=self.bounceStanzas)
+            self.outQueues[domain] = queue
+            if self._pruneTimer is None:
+                self._pruneTimer = asyncore.callLater(
+                                        pjs.conf.conf.s2sQueuePruneInterval,
+                                        self.pruneQueues)
+            return queue
+
+    def pruneQueues(self):
+        """Bounces the stale stanzas in the queues of domains that we have
+        no connection to and removes the queues that are left empty. Runs
+        every s2sQueuePruneInterval seconds while there are queues.
+        """
+        self._pruneTimer = None
+        for domain, queue in self.outQueues.items():
+            serverConns = self.s2sConns.get(domain)
+            if serverConns is not None and serverConns[1] is not None:
+                # in use or being connected
+                continue
+            queue.expire()
+            if not queue:
+                del self.outQueues[domain]
+
+        if self.outQueues:
+            self._pruneTimer = asyncore.callLater(
+                                        pjs.conf.conf.s2sQueuePruneInterval,
+                                        self.pruneQueues)
+
+    def bounceStanzas(self, stanzas, condition):
+        """Returns errors with the stanza error condition to the local
+        senders of the serialized stanzas, which couldn't be delivered to a
+        remote domain
+        """
+        errors = []
+        for data in stanzas:
+            error = makeBounce(data, condition)
+            if error is not None:
+                errors.append(error)
+        self.localDelivery.deliver(errors)
+
+    def sendTo(self, domain, data):
+        """Queues the unicode data for the remote domain. The data is sent
+        in a batch with anything else queued for the domain once the
+        connection is ready. A connection is created if we don't have one.
+        """
+        self.getOutQueue(domain).put(data)
+        serverConns = self.s2sConns.get(domain)
+        if serverConns is None or serverConns[1] is None:
+            self.connectTo(domain)
+
+    def requestVerify(self, domain, localDomain, conn, key):
+        """Asks the authoritative server of domain whether key is valid for
+        the incoming stream conn. All requests to a domain go over our one
+        outgoing connection to it, and the answer is handled by
+        verifyAnswered().
+        """
+        streamId = conn.data['stream']['id']
+        waiting = self.pendingVerifies.setdefault((domain, streamId), [])
+        waiting.append((conn, key, localDomain))
+        if len(waiting) > 1:
+            # already asked
+            return
+
+        out = self.connectTo(domain)
+        out.sendControl(verifyElement(localDomain, domain, streamId, key))
+
+    def verifyAnswered(self, domain, streamId, valid):
+        """Handles the authoritative server's answer to requestVerify()"""
+        waiting = self.pendingVerifies.pop((domain, streamId), [])
+        if not waiting:
+            logging.debug("[%s] Unexpected dialback verification for %s (%s)",
+                          self.__class__, domain, streamId)
+        for conn, key, localDomain in waiting:
+            if valid:
+                self.dialbackCache.add(domain, streamId, key)
+                self.inboundVerified(conn, domain)
+                conn.send(resultElement(localDomain, domain, type='valid'))
+            else:
+                logging.info("[%s] Dialback key from %s is invalid",
+                             self.__class__, domain)
+                conn.send(resultElement(localDomain, domain, type='invalid'))
+
+    def inboundVerified(self, conn, domain):
+        """Records that the incoming stream conn is authorized for domain"""
+        conn.data['server']['hostname'] = domain
+        conn.data['server'].setdefault('verified', []).append(domain)
+        self.s2sConns.setdefault(domain, [None, None])[0] = conn
+
+    def dialbackLinkClosed(self, domain):
+        """Forgets the verification requests sent to domain, since the
+        connection they were sent on is gone.
+        """
+        for key in self.pendingVerifies.keys():
+            if key[0] == domain:
+                logging.debug("[%s] Dropping dialback verification for %s",
+                              self.__class__, domain)
+                del self.pendingVerifies[key]
+
+    def getQueueStats(self):
+        """Returns a dict of domain => stats of its outbound queue. See
+        pjs.outqueue.OutboundQueue.getStats()
+        """
+        stats = {}
+        for domain, queue in self.outQueues.items():
+            stats[domain] = queue.getStats()
+        return stats
+
     def createRemoteOutConnection(self, sock):
         """Creates an outgoing connection to a remote server"""
         conn = ServerOutConnection(sock, sock.getpeername(), self)
@@ -0,0 +1,107 @@
+"""Index of the client sessions on a C2S server. Used for local delivery."""
+
+from threading import RLock
+
+class SessionIndex:
+    """Maps the JIDs of connected clients to their Connections, so that the
+    routers don't have to scan every connection on the server to find the
+    recipients of a stanza.
+
+    It's updated when a client authenticates, binds a resource and when its
+    connection is cleaned up. Updates can come from the threadpool (ie. iq-auth
+    binds the resource from a thread), so they're synchronized. Lookups are
+    plain dict reads.
+    """
+    def __init__(self):
+        self.lock = RLock()
+
+        # bare JID => {resource => Connection}
+        # This is also exposed as C2SServer.data['resources'], so it must
+        # not be replaced.
+        self.bare = {}
+
+        # full JID => Connection
+        self.full = {}
+
+        # connection id => (bare JID, resource) for all authenticated
+        # connections. resource is None until it's bound.
+        self.conns = {}
+
+    def authenticate(self, conn, jid):
+        """Records that conn has authenticated as the bare JID jid"""
+        self.lock.acquire()
+        try:
+            self.conns[conn.id] = (jid, None)
+        finally:
+            self.lock.release()
+
+    def bind(self, conn, jid, resource):
+        """Records that conn has bound the resource for the bare JID jid"""
+        self.lock.acquire()
+        try:
+            old = self.conns.get(conn.id)
+            if old is not None and old[1] is not None:
+                # rebinding. drop the old resource first.
+                self._unbind(old[0], old[1])
+
+            self.conns[conn.id] = (jid, resource)
+            self.bare.setdefault(jid, {})[resource] = conn
+            self.full['%s/%s' % (jid, resource)] = conn
+        finally:
+            self.lock.release()
+
+    def remove(self, conn):
+        """Removes all records of conn. Returns the (bare JID, resource) it
+        had or None if it didn't authenticate.
+        """
+        self.lock.acquire()
+        try:
+            rec = self.conns.pop(conn.id, None)
+            if rec is not None and rec[1] is not None:
+                self._unbind(rec[0], rec[1])
+            return rec
+        finally:
+            self.lock.release()
+
+    def _unbind(self, jid, resource):
+        resources = self.bare.get(jid)
+        if resources is not None:
+            resources.pop(resource, None)
+            if not resources:
+                del self.bare[jid]
+        self.full.pop('%s/%s' % (jid, resource), None)
+
+    def getResources(self, jid):
+        """Returns the {resource => Connection} dict of the bare JID jid. The
+        dict is empty if the user has no bound resources. It must not be
+        modified.
+        """
+        return self.bare.get(jid) or {}
+
+    def getConnection(self, jid):
+        """Returns the Connection for the full JID jid as a string or None"""
+        return self.full.get(jid)
+
+    def lookup(self, jid):
+        """Returns a list of Connections that a stanza addressed to the
+        pjs.jid.JID jid should be delivered to. For full JIDs, this is the
+        connection of that resource. For bare JIDs, these are the
+        connections of all bound resources.
+        """
+        if jid.resource:
+            conn = self.full.get('%s@%s/%s' % (jid.node, jid.domain, jid.resource))
+            if conn is None:
+                return []
+            return [conn]
+        else:
+            resources = self.bare.get('%s@%s' % (jid.node, jid.domain))
+            if not resources:
+                return []
+            return resources.values()
+
+    def isOnline(self, jid):
+        """Returns True if the bare JID jid has at least one bound resource"""
+        return bool(self.bare.get(jid))
+
+    def __len__(self):
+        return len(self.full)
@@ -0,0 +1,244 @@
+"""The interface of the storage backends and the selection of the backend
+used by the server (see storageBackend in pjs.conf.conf)
+"""
+
+import threading
+
+import pjs.conf.conf
+
+# names of the bundled backends => class paths
+BACKENDS = {
+    'sqlite' : 'pjs.storage.sqlitestore.SQLiteStorage',
+    'memory' : 'pjs.storage.memorystore.MemoryStorage',
+    'sharded' : 'pjs.storage.shardedstore.ShardedStorage',
+    }
+
+def uniqueGroups(groups):
+    """Returns the list of group names without the empty and repeated ones"""
+    seen = set()
+    res = []
+    for group in groups:
+        if group and group not in seen:
+            seen.add(group)
+            res.append(group)
+    return res
+
+class Storage:
+    """Stores the users, their credentials and their rosters.
+
+    Users and contacts are identified by ids that the backend assigns to
+    JIDs. A JID gets an id when it becomes a user or when it's first added
+    to someone's roster. Local users are the JIDs with a password.
+
+    The roster methods take and return contacts as (contact id, contact JID,
+    name, subscription, list of group names) tuples. Subscriptions are the
+    state ids of pjs.roster.Subscription.
+
+    Every change to a roster increments its version and logs the contact
+    that changed (see pjs.roster.Roster.getVersion()). The methods that
+    change a roster return the new version.
+
+    All methods can be called from any thread.
+    """
+    def setup(self):
+        """Prepares the storage for use. Called once when the server starts."""
+        pass
+
+    def close(self):
+        """Releases the resources of the storage. Called at shutdown."""
+        pass
+
+    # users and credentials
+
+    def getUserId(self, jid):
+        """Returns the id of the bare JID jid or None if it has none"""
+        raise NotImplementedError
+
+    def userExists(self, jid):
+        """Returns True if the bare JID jid is a local user"""
+        raise NotImplementedError
+
+    def getUsers(self):
+        """Returns the list of the bare JIDs of all local users"""
+        raise NotImplementedError
+
+    def getPassword(self, jid):
+        """Returns the password of the local user jid or None if there's no
+        such user
+        """
+        raise NotImplementedError
+
+    def addUser(self, jid, password):
+        """Makes jid a local user with the password. Returns its id."""
+        raise NotImplementedError
+
+    def setPassword(self, jid, password):
+        """Changes the password of the local user jid. Returns False if
+        there's no such user.
+        """
+        raise NotImplementedError
+
+    def getScramKeys(self, jid, mechanism):
+        """Returns the (salt, iterations, StoredKey, ServerKey) of the local
+        user jid for the SCRAM mechanism (see pjs.scram) or None if they
+        aren't stored
+        """
+        raise NotImplementedError
+
+    def setScramKeys(self, jid, keys):
+        """Replaces the SCRAM keys of the local user jid with the dict keys
+        of mechanism => (salt, iterations, StoredKey, ServerKey). Returns
+        False if there's no such user. addUser() and setPassword() drop the
+        keys, since they're made from the password.
+        """
+        raise NotImplementedError
+
+    # rosters
+
+    def getRoster(self, uid):
+        """Returns the list of all contacts in the roster of the user uid,
+        including the ones that aren't shown to the user
+        """
+        raise NotImplementedError
+
+    def iterRoster(self, uid, exclude=None):
+        """Yields the contacts in the roster of the user uid ordered by
+        contact id, leaving out the ones with the subscription exclude. Meant
+        for big rosters, so the backend shouldn't read the whole roster first.
+        """
+        raise NotImplementedError
+
+    def countRoster(self, uid, exclude=None):
+        """Returns the number of contacts in the roster of the user uid,
+        leaving out the ones with the subscription exclude
+        """
+        raise NotImplementedError
+
+    def getContact(self, uid, cjid, includeGroups=True):
+        """Returns the contact cjid in the roster of the user uid or None.
+        The groups are left empty if includeGroups is False.
+        """
+        raise NotImplementedError
+
+    def getGroups(self, uid, cid):
+        """Returns the list of groups of the contact cid in uid's roster"""
+        raise NotImplementedError
+
+    def getSubscription(self, uid, cid):
+        """Returns the subscription of the user uid to the contact cid or
+        None if cid isn't in the roster
+        """
+        raise NotImplementedError
+
+    def getSubscriptions(self, uid):
+        """Returns the list of (contact id, contact JID, subscription) of all
+        contacts of the user uid
+        """
+        raise NotImplementedError
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        """Adds the contact cjid to the roster of the user uid or updates it.
+        The name and groups are replaced. The subscription is set if it's
+        given; new contacts get Subscription.NONE otherwise. Returns
+        (contact, roster version).
+        """
+        raise NotImplementedError
+
+    def removeContact(self, uid, cjid):
+        """Removes the contact cjid from the roster of the user uid. Returns
+        (contact id, roster version) or (None, None) if cjid isn't in the
+        roster.
+        """
+        raise NotImplementedError
+
+    def setSubscription(self, uid, cid, subscription):
+        """Sets the subscription of the user uid to the contact cid. Returns
+        the roster version.
+        """
+        raise NotImplementedError
+
+    def applyTransition(self, uid, cjid, transition, create=False,
+                        groups=None):
+        """Changes the subscription to the contact cjid according to the
+        {old state => new state} dict transition, atomically. States that
+        aren't in transition don't change. If create is True, a contact
+        that's not in the roster is added first. groups are the contact's
+        groups if the caller knows them, so they don't have to be read.
+
+        Returns (contact with the new state, old state, roster version). The
+        version is None if nothing changed. Returns (None, None, None) if
+        there's no such contact.
+        """
+        raise NotImplementedError
+
+    # roster versions
+
+    def getRosterVersion(self, uid):
+        """Returns the roster version of the user uid, 0 if the roster was
+        never changed
+        """
+        raise NotImplementedError
+
+    def getRosterChanges(self, uid, version):
+        """Returns the list of (version, contact id, contact JID) of the
+        contacts changed after version, ordered by the version of their last
+        change. Returns None if the log doesn't go back that far.
+        """
+        raise NotImplementedError
+
+    # bulk access, used by pjs.storage.writebehind
+
+    def dump(self):
+        """Returns all data in the snapshot format of
+        pjs.storage.memorystore.MemoryStorage.dump()
+        """
+        raise NotImplementedError
+
+    def applyBatch(self, records):
+        """Writes the list of records in one transaction. The records hold
+        the state after a change rather than the change, so writing them
+        again has no effect:
+            ('user', JID, password), which drops the SCRAM keys
+            ('scram', JID, SCRAM keys)
+            ('contact', user JID, contact JID, name, subscription, groups,
+             roster version)
+            ('subscription', user JID, contact JID, subscription,
+             roster version)
+            ('remove', user JID, contact JID, roster version)
+        """
+        raise NotImplementedError
+
+_storage = None
+_storageLock = threading.Lock()
+
+def getStorage():
+    """Returns the process-wide storage backend"""
+    global _storage
+    if _storage is None:
+        _storageLock.acquire()
+        try:
+            if _storage is None:
+                storage = createStorage(pjs.conf.conf.storageBackend)
+                if pjs.conf.conf.storageWriteBehind:
+                    from pjs.storage.writebehind import WriteBehindStorage
+                    storage = WriteBehindStorage(storage)
+                elif pjs.conf.conf.userCache:
+                    from pjs.storage.usercache import UserCacheStorage
+                    storage = UserCacheStorage(storage)
+                _storage = storage
+        finally:
+            _storageLock.release()
+    return _storage
+
+def setStorage(storage):
+    """Replaces the process-wide storage backend. Mostly for tests."""
+    global _storage
+    _storage = storage
+
+def createStorage(name):
+    """Creates the backend name, which is either one of BACKENDS or the
+    dotted path of a Storage subclass
+    """
+    path = BACKENDS.get(name, name)
+    module, cls = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [cls]), cls)()
@@ -0,0 +1,415 @@
+"""Storage kept in dicts in memory.
+
+Nothing is read from or written to disk on the request paths, so this is
+meant for load tests and for deployments where latency matters more than
+durability. The data can be kept between runs in a snapshot file, which is
+written every storageSnapshotInterval seconds if anything changed and at
+shutdown. Changes made since the last snapshot are lost if the server
+crashes.
+"""
+
+import os
+import time
+import logging
+import threading
+import cPickle
+
+import pjs.conf.conf
+
+from pjs.storage.base import Storage, uniqueGroups
+from pjs.roster import Subscription
+
+# version of the snapshot format
+SNAPSHOT_FORMAT = 1
+
+class MemoryStorage(Storage):
+    """Keeps everything in dicts indexed by JID and id"""
+    def __init__(self, snapshotFile=None, snapshotInterval=None):
+        """snapshotFile -- file to load the data from and save it to. An
+                           empty string keeps the data only in memory.
+        snapshotInterval -- seconds between snapshots. 0 only takes one when
+                            the storage is closed.
+        """
+        if snapshotFile is None:
+            snapshotFile = pjs.conf.conf.storageSnapshotFile
+        if snapshotInterval is None:
+            snapshotInterval = pjs.conf.conf.storageSnapshotInterval
+        self.snapshotFile = snapshotFile
+        self.snapshotInterval = snapshotInterval
+
+        self.lock = threading.RLock()
+
+        # bare JID => id, and back
+        self.ids = {}
+        self.jids = {}
+        # id => password. contacts that aren't users have ''.
+        self.passwords = {}
+        self.nextId = 1
+        # user id => {SCRAM mechanism => keys}
+        self.scramKeys = {}
+
+        # user id => {contact id => [name, subscription, groups]}
+        self.rosters = {}
+        # user id => roster version
+        self.versions = {}
+        # user id => list of (version, contact id), oldest first
+        self.changes = {}
+
+        # set when there are changes that aren't in the snapshot
+        self.dirty = False
+        self.snapshots = 0
+        self.lastSnapshot = None
+
+        self.running = False
+        self.thread = None
+        # wakes up the snapshot thread when the storage is closed
+        self.stopEvent = threading.Event()
+
+        if self.snapshotFile and os.path.exists(self.snapshotFile):
+            self.load(self.snapshotFile)
+
+    def setup(self):
+        if self.snapshotFile and self.snapshotInterval > 0 and not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def close(self):
+        if self.running:
+            self.running = False
+            self.stopEvent.set()
+            self.thread.join()
+        if self.snapshotFile and self.dirty:
+            self.snapshot()
+
+    def _run(self):
+        """Snapshots the data periodically. Runs in its own thread."""
+        while self.running:
+            self.stopEvent.wait(self.snapshotInterval)
+            if self.running and self.dirty:
+                try:
+                    self.snapshot()
+                except Exception, e:
+                    logging.warning("[%s] Snapshot to %s failed: %s",
+                                    self.__class__, self.snapshotFile, e)
+
+    def snapshot(self, path=None):
+        """Writes all data to the file path or the snapshot file. The file is
+        replaced atomically, so a crash leaves the previous snapshot.
+        """
+        path = path or self.snapshotFile
+        self.lock.acquire()
+        try:
+            data = cPickle.dumps(self.dump(), cPickle.HIGHEST_PROTOCOL)
+            self.dirty = False
+        finally:
+            self.lock.release()
+
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+        self.snapshots += 1
+        self.lastSnapshot = time.time()
+
+    def load(self, path):
+        """Replaces all data with the snapshot in the file path"""
+        f = open(path, 'rb')
+        try:
+            state = cPickle.load(f)
+        finally:
+            f.close()
+        if state.get('format') != SNAPSHOT_FORMAT:
+            raise Exception, "Unknown snapshot format in %s" % path
+        self.setState(state)
+
+    def dump(self):
+        """Returns all data in the snapshot format. The data isn't copied, so
+        this must be called with the lock held.
+        """
+        return {
+                'format' : SNAPSHOT_FORMAT,
+                'ids' : self.ids,
+                'passwords' : self.passwords,
+                'scramKeys' : self.scramKeys,
+                'nextId' : self.nextId,
+                'rosters' : self.rosters,
+                'versions' : self.versions,
+                'changes' : self.changes,
+                }
+
+    def setState(self, state):
+        """Replaces all data with state, which is in the snapshot format (see
+        dump()). The state is used without copying.
+        """
+        self.lock.acquire()
+        try:
+            self.ids = state['ids']
+            self.jids = dict([(id, jid) for jid, id in self.ids.items()])
+            self.passwords = state['passwords']
+            # not in the snapshots written before SCRAM
+            self.scramKeys = state.get('scramKeys', {})
+            self.nextId = state['nextId']
+            self.rosters = state['rosters']
+            self.versions = state['versions']
+            self.changes = state['changes']
+            self.dirty = False
+        finally:
+            self.lock.release()
+
+    def _getId(self, jid, create=False):
+        """Returns the id of jid. If it has none and create is True, it's
+        created as a contact without a password.
+        """
+        id = self.ids.get(jid)
+        if id is None and create:
+            id = self.nextId
+            self.nextId += 1
+            self.ids[jid] = id
+            self.jids[id] = jid
+            self.passwords[id] = ''
+        return id
+
+    def getUserId(self, jid):
+        return self.ids.get(jid)
+
+    def userExists(self, jid):
+        id = self.ids.get(jid)
+        return id is not None and bool(self.passwords.get(id))
+
+    def getUsers(self):
+        self.lock.acquire()
+        try:
+            return [jid for jid, id in self.ids.items()
+                    if self.passwords.get(id)]
+        finally:
+            self.lock.release()
+
+    def getPassword(self, jid):
+        id = self.ids.get(jid)
+        if id is None:
+            return None
+        return self.passwords.get(id) or None
+
+    def addUser(self, jid, password):
+        self.lock.acquire()
+        try:
+            id = self._getId(jid, True)
+            self.passwords[id] = password
+            self.scramKeys.pop(id, None)
+            self.dirty = True
+            return id
+        finally:
+            self.lock.release()
+
+    def setPassword(self, jid, password):
+        self.lock.acquire()
+        try:
+            id = self.ids.get(jid)
+            if id is None or not self.passwords.get(id):
+                return False
+            self.passwords[id] = password
+            self.scramKeys.pop(id, None)
+            self.dirty = True
+            return True
+        finally:
+            self.lock.release()
+
+    def getScramKeys(self, jid, mechanism):
+        id = self.ids.get(jid)
+        return self.scramKeys.get(id, {}).get(mechanism)
+
+    def setScramKeys(self, jid, keys):
+        self.lock.acquire()
+        try:
+            id = self.ids.get(jid)
+            if id is None or not self.passwords.get(id):
+                return False
+            self.scramKeys[id] = dict(keys)
+            self.dirty = True
+            return True
+        finally:
+            self.lock.release()
+
+    def _contact(self, cid, entry, includeGroups=True):
+        """Returns the contact tuple of the roster entry of cid"""
+        if includeGroups:
+            groups = list(entry[2])
+        else:
+            groups = []
+        return (cid, self.jids[cid], entry[0], entry[1], groups)
+
+    def getRoster(self, uid):
+        self.lock.acquire()
+        try:
+            return [self._contact(cid, entry)
+                    for cid, entry in self.rosters.get(uid, {}).items()]
+        finally:
+            self.lock.release()
+
+    def iterRoster(self, uid, exclude=None):
+        self.lock.acquire()
+        try:
+            roster = self.rosters.get(uid, {})
+            contacts = [self._contact(cid, roster[cid])
+                        for cid in sorted(roster)
+                        if roster[cid][1] != exclude]
+        finally:
+            self.lock.release()
+        return iter(contacts)
+
+    def countRoster(self, uid, exclude=None):
+        self.lock.acquire()
+        try:
+            return len([1 for entry in self.rosters.get(uid, {}).itervalues()
+                        if entry[1] != exclude])
+        finally:
+            self.lock.release()
+
+    def getContact(self, uid, cjid, includeGroups=True):
+        self.lock.acquire()
+        try:
+            cid = self.ids.get(cjid)
+            entry = self.rosters.get(uid, {}).get(cid)
+            if entry is None:
+                return None
+            return self._contact(cid, entry, includeGroups)
+        finally:
+            self.lock.release()
+
+    def getGroups(self, uid, cid):
+        self.lock.acquire()
+        try:
+            entry = self.rosters.get(uid, {}).get(cid)
+            if entry is None:
+                return []
+            return list(entry[2])
+        finally:
+            self.lock.release()
+
+    def getSubscription(self, uid, cid):
+        self.lock.acquire()
+        try:
+            entry = self.rosters.get(uid, {}).get(cid)
+            if entry is None:
+                return None
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def getSubscriptions(self, uid):
+        self.lock.acquire()
+        try:
+            return [(cid, self.jids[cid], entry[1])
+                    for cid, entry in self.rosters.get(uid, {}).items()]
+        finally:
+            self.lock.release()
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        groups = uniqueGroups(groups)
+        self.lock.acquire()
+        try:
+            cid = self._getId(cjid, True)
+            roster = self.rosters.setdefault(uid, {})
+            entry = roster.get(cid)
+            if subscription is None:
+                if entry is None:
+                    subscription = Subscription.NONE
+                else:
+                    subscription = entry[1]
+            roster[cid] = [name, subscription, groups]
+            version = self._bumpVersion(uid, cid)
+            return (cid, cjid, name, subscription, list(groups)), version
+        finally:
+            self.lock.release()
+
+    def removeContact(self, uid, cjid):
+        self.lock.acquire()
+        try:
+            cid = self.ids.get(cjid)
+            roster = self.rosters.get(uid, {})
+            if cid not in roster:
+                return None, None
+            del roster[cid]
+            return cid, self._bumpVersion(uid, cid)
+        finally:
+            self.lock.release()
+
+    def setSubscription(self, uid, cid, subscription):
+        self.lock.acquire()
+        try:
+            entry = self.rosters.get(uid, {}).get(cid)
+            if entry is not None:
+                entry[1] = subscription
+            return self._bumpVersion(uid, cid)
+        finally:
+            self.lock.release()
+
+    def applyTransition(self, uid, cjid, transition, create=False,
+                        groups=None):
+        self.lock.acquire()
+        try:
+            cid = self.ids.get(cjid)
+            roster = self.rosters.get(uid, {})
+            entry = roster.get(cid)
+            if entry is None:
+                if not create:
+                    return None, None, None
+                cid = self._getId(cjid, True)
+                entry = ['', Subscription.NONE, []]
+                self.rosters.setdefault(uid, {})[cid] = entry
+                changed = True
+            else:
+                changed = False
+
+            old = entry[1]
+            new = transition.get(old, old)
+            version = None
+            if changed or new != old:
+                entry[1] = new
+                version = self._bumpVersion(uid, cid)
+            return self._contact(cid, entry), old, version
+        finally:
+            self.lock.release()
+
+    def getRosterVersion(self, uid):
+        return self.versions.get(uid, 0)
+
+    def getRosterChanges(self, uid, version):
+        self.lock.acquire()
+        try:
+            log = self.changes.get(uid)
+            # the log only keeps the latest changes
+            if not log or log[0][0] > version + 1:
+                return None
+            latest = {}
+            for ver, cid in log:
+                if ver > version:
+                    latest[cid] = ver
+            changes = [(ver, cid, self.jids[cid])
+                       for cid, ver in latest.items()]
+            changes.sort()
+            return changes
+        finally:
+            self.lock.release()
+
+    def _bumpVersion(self, uid, cid):
+        """Increments the roster version of the user uid and logs the change
+        to the contact with id cid. Call with the lock held.
+        """
+        version = self.versions.get(uid, 0) + 1
+        self.versions[uid] = version
+        log = self.changes.setdefault(uid, [])
+        log.append((version, cid))
+        excess = len(log) - pjs.conf.conf.rosterVersionLogSize
+        if excess > 0:
+            del log[:excess]
+        self.dirty = True
+        return version
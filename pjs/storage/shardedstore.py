@@ -0,0 +1,457 @@
+"""Storage spread over several SQLite files.
+
+Each user is kept in one shard, which is picked by a hash of the bare JID
+(see shardOf()). Its password, roster, groups and roster versions are all in
+that shard, so the roster queries and changes of a user only touch the
+user's shard, and writers of different shards don't wait for each other.
+The shards have the schema of pjs.schema and are used through
+SQLiteStorage.
+
+A roster refers to its contacts by the same ids that the contacts have as
+users, and the contacts can be in any shard. So the ids are handed out by a
+small directory DB with the id and the shard of every JID. It's only written
+when a JID is seen for the first time, and the user lookups by JID don't
+read it at all.
+
+The number of shards is storageShards in pjs.conf.conf. To change it, stop
+the server and move the users to their new shards with rebalance(). Run from
+the top-level directory:
+    $ PYTHONPATH=. python pjs/storage/shardedstore.py <number of shards>
+"""
+
+import sys
+import zlib
+import base64
+import logging
+
+import pjs.db
+import pjs.conf.conf
+
+from pjs.db import DBautocommit, closePool, \
+                   beginImmediate, commitImmediate, rollbackImmediate
+from pjs.storage.base import Storage
+from pjs.storage.sqlitestore import SQLiteStorage
+from pjs.storage.memorystore import SNAPSHOT_FORMAT
+
+def shardOf(jid, shards):
+    """Returns the number of the shard of the bare JID jid when there are
+    shards shards. The hash has to be the same in every process, so Python's
+    hash() can't be used.
+    """
+    if isinstance(jid, unicode):
+        jid = jid.encode('utf-8')
+    return (zlib.crc32(jid) & 0xffffffff) % shards
+
+class Directory:
+    """The ids and shards of all JIDs of a ShardedStorage"""
+    def __init__(self, name=None):
+        """name -- DB name. storageDirectoryName if not given."""
+        if name is None:
+            name = pjs.conf.conf.storageDirectoryName
+        self.name = name
+        self.shards = None
+        # id => shard. JIDs only change shards when the server isn't running.
+        self.shardIds = {}
+
+    def setup(self, shards=None):
+        """Creates the tables if needed. If the directory is new, it's set up
+        for shards shards. Returns the number of shards the users are in.
+        """
+        con = DBautocommit(self.name)
+        try:
+            c = beginImmediate(con)
+            try:
+                c.execute("CREATE TABLE IF NOT EXISTS directory\
+                               (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                jid TEXT NOT NULL,\
+                                shard INTEGER NOT NULL,\
+                                UNIQUE(jid))")
+                c.execute("CREATE TABLE IF NOT EXISTS shards\
+                               (count INTEGER NOT NULL)")
+                c.execute("SELECT count FROM shards")
+                res = c.fetchone()
+                if res is None and shards is not None:
+                    c.execute("INSERT INTO shards (count) VALUES (?)",
+                              (shards,))
+                    self.shards = shards
+                elif res is not None:
+                    self.shards = res[0]
+            except:
+                rollbackImmediate(con, c)
+                raise
+            commitImmediate(con, c)
+        finally:
+            con.close()
+        return self.shards
+
+    def close(self):
+        closePool(self.name)
+
+    def setShardCount(self, shards):
+        """Records that the users are in shards shards"""
+        con = DBautocommit(self.name)
+        try:
+            c = beginImmediate(con)
+            c.execute("DELETE FROM shards")
+            c.execute("INSERT INTO shards (count) VALUES (?)", (shards,))
+            commitImmediate(con, c)
+        finally:
+            con.close()
+        self.shards = shards
+
+    def getId(self, jid, create=False):
+        """Returns the id of jid. If it has none and create is True, one is
+        created. Returns None otherwise.
+        """
+        con = DBautocommit(self.name)
+        try:
+            res = con.execute("SELECT id FROM directory WHERE jid = ?",
+                              (jid,)).fetchone()
+            if res is None and create:
+                # another shard may be adding the same JID
+                shard = shardOf(jid, self.shards)
+                con.execute("INSERT OR IGNORE INTO directory (jid, shard)\
+                             VALUES (?, ?)", (jid, shard))
+                res = con.execute("SELECT id FROM directory WHERE jid = ?",
+                                  (jid,)).fetchone()
+        finally:
+            con.close()
+        if res is None:
+            return None
+        return res[0]
+
+    def getShard(self, id):
+        """Returns the shard of the JID with id id or None if there's no such
+        id
+        """
+        shard = self.shardIds.get(id)
+        if shard is None:
+            con = DBautocommit(self.name)
+            try:
+                res = con.execute("SELECT shard FROM directory WHERE id = ?",
+                                  (id,)).fetchone()
+            finally:
+                con.close()
+            if res is None:
+                return None
+            shard = self.shardIds[id] = res[0]
+        return shard
+
+    def setShard(self, id, shard):
+        """Records that the JID with id id is in the shard shard"""
+        con = DBautocommit(self.name)
+        try:
+            con.execute("UPDATE directory SET shard = ? WHERE id = ?",
+                        (shard, id))
+        finally:
+            con.close()
+        self.shardIds[id] = shard
+
+    def getEntries(self):
+        """Returns the list of (id, JID, shard) of all JIDs"""
+        con = DBautocommit(self.name)
+        try:
+            return [tuple(row) for row in
+                    con.execute("SELECT id, jid, shard FROM directory")]
+        finally:
+            con.close()
+
+class ShardStorage(SQLiteStorage):
+    """One shard of a ShardedStorage. New JIDs get their ids from the
+    directory.
+    """
+    def __init__(self, name, directory):
+        SQLiteStorage.__init__(self, name)
+        self.directory = directory
+
+    def _newId(self, jid):
+        return self.directory.getId(jid, True)
+
+    def exportUser(self, uid):
+        """Returns all data of the user uid in the shard as (password,
+        contacts, roster version, changes, SCRAM keys). changes are the
+        logged (version, contact id, contact JID).
+        """
+        res = self._fetchOne("SELECT password FROM jids WHERE id = ?", (uid,))
+        password = res and res[0] or ''
+        contacts = self.getRoster(uid)
+        version = self.getRosterVersion(uid)
+        con = self._connect()
+        c = con.cursor()
+        c.execute("SELECT rc.version, rc.contactid, jids.jid\
+                   FROM rosterchanges AS rc\
+                       JOIN jids ON jids.id = rc.contactid\
+                   WHERE rc.userid = ?\
+                   ORDER BY rc.version", (uid,))
+        changes = [tuple(row) for row in c]
+        c.execute("SELECT mechanism, salt, iterations, storedkey, serverkey\
+                   FROM scramkeys WHERE userid = ?", (uid,))
+        scramKeys = dict([(row[0], (base64.b64decode(row[1]), row[2],
+                                    base64.b64decode(row[3]),
+                                    base64.b64decode(row[4])))
+                          for row in c])
+        c.close()
+        con.close()
+        return password, contacts, version, changes, scramKeys
+
+    def importUser(self, uid, jid, data):
+        """Writes the data of the user uid from exportUser() of another
+        shard. Data that's already there is replaced.
+        """
+        password, contacts, version, changes, scramKeys = data
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            jids = [(uid, jid)] + [contact[:2] for contact in contacts] + \
+                   [change[1:] for change in changes]
+            c.executemany("INSERT OR IGNORE INTO jids (id, jid, password)\
+                           VALUES (?, ?, '')", jids)
+            if password:
+                c.execute("UPDATE jids SET password = ? WHERE id = ?",
+                          (password, uid))
+            for cid, cjid, name, subscription, groups in contacts:
+                c.execute("INSERT OR REPLACE INTO roster\
+                           (userid, contactid, name, subscription)\
+                           VALUES (?, ?, ?, ?)", (uid, cid, name, subscription))
+                self._setGroups(c, uid, cid, groups)
+            if version:
+                c.execute("INSERT OR REPLACE INTO rosterversions\
+                           (userid, version) VALUES (?, ?)", (uid, version))
+            c.executemany("INSERT OR REPLACE INTO rosterchanges\
+                           (userid, version, contactid) VALUES (?, ?, ?)",
+                          [(uid, ver, cid) for ver, cid, cjid in changes])
+            self._setScramKeys(c, uid, scramKeys)
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+
+    def dropUser(self, uid):
+        """Removes the user uid from the shard after it was moved to another
+        one. The JID stays as a contact of the other users in the shard.
+        """
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            c.execute("DELETE FROM rostergroupitems WHERE groupid IN\
+                       (SELECT groupid FROM rostergroups WHERE userid = ?)",
+                      (uid,))
+            c.execute("DELETE FROM rostergroups WHERE userid = ?", (uid,))
+            c.execute("DELETE FROM roster WHERE userid = ?", (uid,))
+            c.execute("DELETE FROM rosterversions WHERE userid = ?", (uid,))
+            c.execute("DELETE FROM rosterchanges WHERE userid = ?", (uid,))
+            c.execute("DELETE FROM scramkeys WHERE userid = ?", (uid,))
+            c.execute("UPDATE jids SET password = '' WHERE id = ?", (uid,))
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+
+class ShardedStorage(Storage):
+    """Spreads the users over storageShards SQLite files"""
+    def __init__(self, shards=None, shardName=None, directory=None):
+        """shards -- number of shards. storageShards if not given.
+        shardName -- file name of the shards with %d for the shard number.
+                     storageShardName if not given.
+        directory -- the Directory or its DB name. storageDirectoryName if
+                     not given.
+        """
+        if shards is None:
+            shards = pjs.conf.conf.storageShards
+        if shardName is None:
+            shardName = pjs.conf.conf.storageShardName
+        if not isinstance(directory, Directory):
+            directory = Directory(directory)
+        self.directory = directory
+        self.shardName = shardName
+        self.shards = [ShardStorage(shardName % i, self.directory)
+                       for i in range(shards)]
+
+    def setup(self):
+        count = self.directory.setup(len(self.shards))
+        if count != len(self.shards):
+            raise Exception, "The users are in %d shards, not %d. Move them " \
+                             "with pjs.storage.shardedstore.rebalance()." % \
+                             (count, len(self.shards))
+        self._setupShards()
+
+    def _setupShards(self):
+        """Creates or migrates the shard files"""
+        # pjs.schema.migrate() makes the DB it migrates the current one
+        dbname = pjs.db.dbname
+        try:
+            for shard in self.shards:
+                shard.setup()
+        finally:
+            pjs.db.dbname = dbname
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.directory.close()
+
+    def _shard(self, jid):
+        """Returns the shard of the user jid"""
+        return self.shards[shardOf(jid, len(self.shards))]
+
+    def _userShard(self, uid):
+        """Returns the shard of the user with id uid"""
+        shard = self.directory.getShard(uid)
+        if shard is None:
+            # there's nothing in any shard for an unknown id
+            shard = 0
+        return self.shards[shard]
+
+    def getUserId(self, jid):
+        return self.directory.getId(jid)
+
+    def userExists(self, jid):
+        return self._shard(jid).userExists(jid)
+
+    def getUsers(self):
+        users = []
+        for shard in self.shards:
+            users.extend(shard.getUsers())
+        return users
+
+    def getPassword(self, jid):
+        return self._shard(jid).getPassword(jid)
+
+    def addUser(self, jid, password):
+        return self._shard(jid).addUser(jid, password)
+
+    def setPassword(self, jid, password):
+        return self._shard(jid).setPassword(jid, password)
+
+    def getScramKeys(self, jid, mechanism):
+        return self._shard(jid).getScramKeys(jid, mechanism)
+
+    def setScramKeys(self, jid, keys):
+        return self._shard(jid).setScramKeys(jid, keys)
+
+    def getRoster(self, uid):
+        return self._userShard(uid).getRoster(uid)
+
+    def iterRoster(self, uid, exclude=None):
+        return self._userShard(uid).iterRoster(uid, exclude)
+
+    def countRoster(self, uid, exclude=None):
+        return self._userShard(uid).countRoster(uid, exclude)
+
+    def getContact(self, uid, cjid, includeGroups=True):
+        return self._userShard(uid).getContact(uid, cjid, includeGroups)
+
+    def getGroups(self, uid, cid):
+        return self._userShard(uid).getGroups(uid, cid)
+
+    def getSubscription(self, uid, cid):
+        return self._userShard(uid).getSubscription(uid, cid)
+
+    def getSubscriptions(self, uid):
+        return self._userShard(uid).getSubscriptions(uid)
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        return self._userShard(uid).updateContact(uid, cjid, name, groups,
+                                                  subscription)
+
+    def removeContact(self, uid, cjid):
+        return self._userShard(uid).removeContact(uid, cjid)
+
+    def setSubscription(self, uid, cid, subscription):
+        return self._userShard(uid).setSubscription(uid, cid, subscription)
+
+    def applyTransition(self, uid, cjid, transition, create=False,
+                        groups=None):
+        return self._userShard(uid).applyTransition(uid, cjid, transition,
+                                                    create, groups)
+
+    def getRosterVersion(self, uid):
+        return self._userShard(uid).getRosterVersion(uid)
+
+    def getRosterChanges(self, uid, version):
+        return self._userShard(uid).getRosterChanges(uid, version)
+
+    def dump(self):
+        ids = {}
+        passwords = {}
+        scramKeys = {}
+        rosters = {}
+        versions = {}
+        changes = {}
+        for shard in self.shards:
+            state = shard.dump()
+            ids.update(state['ids'])
+            # a user's password is only in its own shard
+            for id, password in state['passwords'].items():
+                if password or id not in passwords:
+                    passwords[id] = password
+            scramKeys.update(state['scramKeys'])
+            rosters.update(state['rosters'])
+            versions.update(state['versions'])
+            changes.update(state['changes'])
+        return {
+                'format' : SNAPSHOT_FORMAT,
+                'ids' : ids,
+                'passwords' : passwords,
+                'scramKeys' : scramKeys,
+                'nextId' : max([0] + ids.values()) + 1,
+                'rosters' : rosters,
+                'versions' : versions,
+                'changes' : changes,
+                }
+
+    def applyBatch(self, records):
+        """Writes the records of each shard in a transaction of its own. If
+        one of them fails, the others may have been written already, which
+        is fine since the records can be written again.
+        """
+        batches = {}
+        for record in records:
+            # record[1] is the user the record is about
+            shard = shardOf(record[1], len(self.shards))
+            batches.setdefault(shard, []).append(record)
+        for shard, batch in batches.items():
+            self.shards[shard].applyBatch(batch)
+
+def rebalance(shards, shardName=None, directory=None):
+    """Moves the users to their shards when there are shards shards. The
+    server must not be running. Each user is copied to its new shard and
+    removed from the old one before the directory points to the new shard,
+    so if this is interrupted, it can be run again without leaving a copy
+    behind. Returns the number of users moved.
+    """
+    directory = Directory(directory)
+    count = directory.setup()
+    if count is None:
+        raise Exception, "The directory %s is empty" % directory.name
+    storage = ShardedStorage(max(shards, count), shardName, directory)
+    storage._setupShards()
+
+    moved = 0
+    try:
+        for id, jid, current in directory.getEntries():
+            new = shardOf(jid, shards)
+            if new == current:
+                continue
+            data = storage.shards[current].exportUser(id)
+            # JIDs that are only contacts have nothing to move. neither do
+            # users that an interrupted run already moved but whose shard
+            # it didn't record.
+            if data[0] or data[1] or data[2]:
+                storage.shards[new].importUser(id, jid, data)
+                storage.shards[current].dropUser(id)
+                moved += 1
+            directory.setShard(id, new)
+        if count > shards:
+            logging.info("[rebalance] Shards %d to %d are no longer used",
+                         shards, count - 1)
+        directory.setShardCount(shards)
+    finally:
+        storage.close()
+    return moved
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print 'Usage: %s <number of shards>' % sys.argv[0]
+        sys.exit(1)
+    print 'Moved %d users' % rebalance(int(sys.argv[1]))
@@ -0,0 +1,656 @@
+"""Storage in the SQLite DB of pjs.db. The schema is in pjs.schema."""
+
+import base64
+
+import pjs.conf.conf
+
+from pjs.db import DBautocommit, closePool, \
+                   beginImmediate, commitImmediate, rollbackImmediate
+from pjs.storage.base import Storage, uniqueGroups
+from pjs.storage.memorystore import SNAPSHOT_FORMAT
+from pjs.roster import Subscription
+
+# Statements used on the hot paths. They're kept as constants, so that
+# SQLite's per-connection statement cache recognizes them.
+
+# the contact's JID id, and the name and subscription if it's in the roster
+SQL_FIND_CONTACT = "SELECT jids.id, roster.name, roster.subscription\
+                    FROM jids\
+                        LEFT JOIN roster ON roster.contactid = jids.id\
+                                        AND roster.userid = ?\
+                    WHERE jids.jid = ?"
+SQL_ADD_CONTACT = "INSERT INTO roster\
+                   (userid, contactid, name, subscription)\
+                   VALUES\
+                   (?, ?, ?, ?)"
+SQL_SET_SUBSCRIPTION = "UPDATE roster SET subscription = ?\
+                        WHERE userid = ? AND contactid = ?"
+SQL_GET_GROUPS = "SELECT rgs.name\
+                  FROM rostergroups AS rgs\
+                      JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
+                  WHERE rgs.userid = ? AND rgi.contactid = ?"
+SQL_DELETE_GROUP_ITEMS = "DELETE FROM rostergroupitems\
+                          WHERE contactid = ? AND groupid IN\
+                          (SELECT groupid FROM rostergroups WHERE\
+                              userid = ?)"
+SQL_ADD_GROUP = "INSERT OR IGNORE INTO rostergroups\
+                 (userid, name)\
+                 VALUES\
+                 (?, ?)"
+SQL_DELETE_SCRAM_KEYS = "DELETE FROM scramkeys WHERE userid IN\
+                         (SELECT id FROM jids WHERE jid = ?)"
+SQL_ADD_GROUP_ITEM = "INSERT INTO rostergroupitems\
+                      (groupid, contactid)\
+                      SELECT groupid, ? FROM rostergroups\
+                      WHERE userid = ? AND name = ?"
+
+class SQLiteStorage(Storage):
+    """Keeps everything in the tables created by pjs.schema"""
+    def __init__(self, name=None):
+        """name -- DB name. The current DB of pjs.db if not given."""
+        self.name = name
+
+    def setup(self):
+        from pjs.schema import migrate
+        migrate(self.name)
+
+    def close(self):
+        closePool(self.name)
+
+    def _connect(self):
+        """Returns an autocommit connection to the DB"""
+        return DBautocommit(self.name)
+
+    def _fetchOne(self, query, params):
+        """Runs query in autocommit mode and returns the first row or None"""
+        con = self._connect()
+        c = con.cursor()
+        c.execute(query, params)
+        res = c.fetchone()
+        c.close()
+        con.close()
+        return res
+
+    def getUserId(self, jid):
+        res = self._fetchOne("SELECT id FROM jids WHERE jid = ?", (jid,))
+        if res is None:
+            return None
+        return res[0]
+
+    def userExists(self, jid):
+        return self._fetchOne("SELECT jid FROM jids\
+                               WHERE jid = ? AND password != ''",
+                              (jid,)) is not None
+
+    def getUsers(self):
+        con = self._connect()
+        c = con.cursor()
+        c.execute("SELECT jid FROM jids WHERE password != ''")
+        jids = [row[0] for row in c]
+        c.close()
+        con.close()
+        return jids
+
+    def getPassword(self, jid):
+        res = self._fetchOne("SELECT password FROM jids WHERE jid = ?", (jid,))
+        if res is None or not res[0]:
+            return None
+        return res[0]
+
+    def addUser(self, jid, password):
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            c.execute("UPDATE jids SET password = ? WHERE jid = ?",
+                      (password, jid))
+            if c.rowcount:
+                c.execute("SELECT id FROM jids WHERE jid = ?", (jid,))
+                uid = c.fetchone()[0]
+                c.execute(SQL_DELETE_SCRAM_KEYS, (jid,))
+            else:
+                uid = self._addJID(c, jid, password)
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+        return uid
+
+    def setPassword(self, jid, password):
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            c.execute("UPDATE jids SET password = ?\
+                       WHERE jid = ? AND password != ''", (password, jid))
+            changed = c.rowcount > 0
+            if changed:
+                c.execute(SQL_DELETE_SCRAM_KEYS, (jid,))
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+        return changed
+
+    def getScramKeys(self, jid, mechanism):
+        res = self._fetchOne("SELECT salt, iterations, storedkey, serverkey\
+                              FROM scramkeys\
+                                  JOIN jids ON jids.id = scramkeys.userid\
+                              WHERE jids.jid = ? AND mechanism = ?",
+                             (jid, mechanism))
+        if res is None:
+            return None
+        return (base64.b64decode(res[0]), res[1],
+                base64.b64decode(res[2]), base64.b64decode(res[3]))
+
+    def setScramKeys(self, jid, keys):
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            c.execute("SELECT id FROM jids WHERE jid = ? AND password != ''",
+                      (jid,))
+            res = c.fetchone()
+            if res is None:
+                rollbackImmediate(con, c)
+                return False
+            self._setScramKeys(c, res[0], keys)
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+        return True
+
+    def _setScramKeys(self, c, uid, keys):
+        """Replaces the SCRAM keys of the user uid. Uses the cursor c."""
+        c.execute("DELETE FROM scramkeys WHERE userid = ?", (uid,))
+        c.executemany("INSERT INTO scramkeys\
+                       (userid, mechanism, salt, iterations,\
+                        storedkey, serverkey)\
+                       VALUES (?, ?, ?, ?, ?, ?)",
+                      [(uid, mechanism, base64.b64encode(salt), iterations,
+                        base64.b64encode(storedKey),
+                        base64.b64encode(serverKey))
+                       for mechanism, (salt, iterations, storedKey, serverKey)
+                       in keys.items()])
+
+    def getRoster(self, uid):
+        con = self._connect()
+        c = con.cursor()
+        # both reads in one transaction, so that they see the same roster
+        c.execute("BEGIN")
+        try:
+            # get the contactid, name and subscriptions
+            c.execute("SELECT roster.contactid, roster.name,\
+                              roster.subscription,\
+                              contactjids.jid cjid\
+                       FROM roster\
+                           JOIN jids AS contactjids ON roster.contactid = contactjids.id\
+                       WHERE roster.userid = ?", (uid,))
+            contacts = {}
+            for row in c:
+                contacts[row['contactid']] = (row['contactid'], row['cjid'],
+                                              row['name'], row['subscription'],
+                                              [])
+
+            # get the groups now for each cid
+            c.execute("SELECT rgi.contactid, rgs.name\
+                       FROM rostergroups AS rgs\
+                           JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
+                       WHERE rgs.userid = ?", (uid,))
+            for row in c:
+                contact = contacts.get(row['contactid'])
+                if contact is not None:
+                    contact[4].append(row['name'])
+        finally:
+            c.execute("COMMIT")
+            c.close()
+            con.close()
+
+        return contacts.values()
+
+    def iterRoster(self, uid, exclude=None):
+        con = self._connect()
+        c = con.cursor()
+        # one row per group of each contact, so that a contact's rows are
+        # next to each other
+        c.execute("SELECT roster.contactid, roster.name, roster.subscription,\
+                          contactjids.jid cjid, groups.name groupname\
+                   FROM roster\
+                       JOIN jids AS contactjids ON roster.contactid = contactjids.id\
+                       LEFT JOIN (SELECT rgi.contactid, rgs.name\
+                                  FROM rostergroupitems AS rgi\
+                                      JOIN rostergroups AS rgs\
+                                          ON rgs.groupid = rgi.groupid\
+                                  WHERE rgs.userid = ?) AS groups\
+                           ON groups.contactid = roster.contactid\
+                   WHERE roster.userid = ? AND roster.subscription IS NOT ?\
+                   ORDER BY roster.contactid",
+                   (uid, uid, exclude))
+
+        try:
+            contact = None
+            for row in c:
+                if contact is None or contact[0] != row['contactid']:
+                    if contact is not None:
+                        yield contact
+                    contact = (row['contactid'], row['cjid'], row['name'],
+                               row['subscription'], [])
+                if row['groupname'] is not None:
+                    contact[4].append(row['groupname'])
+            if contact is not None:
+                yield contact
+        finally:
+            c.close()
+            con.close()
+
+    def countRoster(self, uid, exclude=None):
+        return self._fetchOne("SELECT COUNT(*) FROM roster\
+                               WHERE userid = ? AND subscription IS NOT ?",
+                              (uid, exclude))[0]
+
+    def getContact(self, uid, cjid, includeGroups=True):
+        con = self._connect()
+        c = con.cursor()
+        c.execute("SELECT roster.contactid, roster.name, roster.subscription\
+                   FROM roster\
+                       JOIN jids ON jids.id = roster.contactid\
+                   WHERE userid = ? AND jids.jid = ?", (uid, cjid))
+        res = c.fetchone()
+        if res is None:
+            c.close()
+            con.close()
+            return None
+
+        cid = res[0]
+        groups = []
+        if includeGroups:
+            c.execute(SQL_GET_GROUPS, (uid, cid))
+            groups = [row['name'] for row in c]
+        c.close()
+        con.close()
+
+        return (cid, cjid, res[1], res[2], groups)
+
+    def getGroups(self, uid, cid):
+        con = self._connect()
+        c = con.cursor()
+        c.execute(SQL_GET_GROUPS, (uid, cid))
+        groups = [row['name'] for row in c]
+        c.close()
+        con.close()
+        return groups
+
+    def getSubscription(self, uid, cid):
+        res = self._fetchOne("SELECT subscription FROM roster\
+                              WHERE userid = ? AND contactid = ?", (uid, cid))
+        if res is None:
+            return None
+        return res[0]
+
+    def getSubscriptions(self, uid):
+        con = self._connect()
+        c = con.cursor()
+        c.execute("SELECT roster.contactid, jids.jid, roster.subscription\
+                   FROM roster\
+                   JOIN jids ON jids.id = roster.contactid\
+                   WHERE roster.userid = ?", (uid,))
+        contacts = [(row[0], row[1], row[2]) for row in c]
+        c.close()
+        con.close()
+        return contacts
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        groups = uniqueGroups(groups)
+
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            # check if this is an update to an existing roster entry. this
+            # also gets the contact's id if the JID is known but not in the
+            # roster.
+            c.execute(SQL_FIND_CONTACT, (uid, cjid))
+            res = c.fetchone()
+            if res:
+                cid = res['id']
+                old = res['subscription']
+            else:
+                cid = self._addJID(c, cjid)
+                old = None
+
+            if old is not None:
+                # this is an update
+                # we update the subscription if it's given to us; o/w
+                # just update the name
+                if subscription is not None:
+                    c.execute("UPDATE roster SET name = ?, subscription = ?\
+                               WHERE userid = ? AND contactid = ?",
+                              (name, subscription, uid, cid))
+                else:
+                    subscription = old
+                    c.execute("UPDATE roster SET name = ?\
+                               WHERE userid = ? AND contactid = ?",
+                              (name, uid, cid))
+            else:
+                # this is a new roster entry
+                if subscription is None:
+                    subscription = Subscription.NONE
+                c.execute(SQL_ADD_CONTACT, (uid, cid, name, subscription))
+
+            self._setGroups(c, uid, cid, groups, old is None)
+
+            version = self._bumpVersion(c, uid, cid)
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+
+        return (cid, cjid, name, subscription, groups), version
+
+    def _addJID(self, c, jid, password=''):
+        """Creates a new JID entry and returns its id. Contacts that aren't
+        users have no password.
+        """
+        res = c.execute("INSERT INTO jids\
+                         (id, jid, password)\
+                         VALUES\
+                         (?, ?, ?)", (self._newId(jid), jid, password))
+        return res.lastrowid
+
+    def _newId(self, jid):
+        """Returns the id of the new JID jid, or None to let the DB pick one"""
+        return None
+
+    def _setGroups(self, c, uid, cid, groups, newContact=False):
+        """Replaces the groups of the contact with id cid with the list of
+        unique group names. The missing groups are created. Uses the cursor
+        c.
+        """
+        # remove all group mappings for this contact and recreate
+        # them, since it's easier than figuring out what changed
+        if not newContact:
+            c.execute(SQL_DELETE_GROUP_ITEMS, (cid, uid))
+
+        if not groups:
+            return
+        c.executemany(SQL_ADD_GROUP, [(uid, g) for g in groups])
+        c.executemany(SQL_ADD_GROUP_ITEM, [(cid, uid, g) for g in groups])
+
+    def removeContact(self, uid, cjid):
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            # get the contact's id
+            c.execute("SELECT jids.id\
+                       FROM roster\
+                       JOIN jids ON roster.contactid = jids.id\
+                       WHERE roster.userid = ? AND jids.jid = ?", (uid, cjid))
+            res = c.fetchone()
+            if res is None:
+                rollbackImmediate(con, c)
+                return None, None
+            cid = res[0]
+
+            # delete the contact from all groups it's in for this user
+            c.execute(SQL_DELETE_GROUP_ITEMS, (cid, uid))
+
+            # now delete the roster entry
+            c.execute("DELETE FROM roster\
+                       WHERE userid = ? AND contactid = ?", (uid, cid))
+
+            version = self._bumpVersion(c, uid, cid)
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+
+        return cid, version
+
+    def setSubscription(self, uid, cid, subscription):
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            c.execute(SQL_SET_SUBSCRIPTION, (subscription, uid, cid))
+            version = self._bumpVersion(c, uid, cid)
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+
+        return version
+
+    def applyTransition(self, uid, cjid, transition, create=False,
+                        groups=None):
+        con = self._connect()
+        # the state is read under the write lock, so that it can't change
+        # before the new state is written
+        c = beginImmediate(con)
+        try:
+            c.execute(SQL_FIND_CONTACT, (uid, cjid))
+            res = c.fetchone()
+            if res and res['subscription'] is not None:
+                cid = res['id']
+                name = res['name']
+                old = res['subscription']
+                newContact = False
+            elif create:
+                if res:
+                    cid = res['id']
+                else:
+                    cid = self._addJID(c, cjid)
+                name = ''
+                old = Subscription.NONE
+                newContact = True
+            else:
+                rollbackImmediate(con, c)
+                return None, None, None
+
+            new = transition.get(old, old)
+
+            if newContact:
+                c.execute(SQL_ADD_CONTACT, (uid, cid, name, new))
+            elif new != old:
+                c.execute(SQL_SET_SUBSCRIPTION, (new, uid, cid))
+
+            # the groups are only needed for the roster push
+            if newContact:
+                groups = []
+            elif groups is None:
+                c.execute(SQL_GET_GROUPS, (uid, cid))
+                groups = [row['name'] for row in c]
+
+            if newContact or new != old:
+                version = self._bumpVersion(c, uid, cid)
+            else:
+                version = None
+        except:
+            rollbackImmediate(con, c)
+            raise
+
+        commitImmediate(con, c)
+
+        return (cid, cjid, name, new, list(groups)), old, version
+
+    def getRosterVersion(self, uid):
+        res = self._fetchOne("SELECT version FROM rosterversions\
+                              WHERE userid = ?", (uid,))
+        if res is None:
+            return 0
+        return res[0]
+
+    def getRosterChanges(self, uid, version):
+        con = self._connect()
+        c = con.cursor()
+        # the log only keeps the latest changes
+        c.execute("SELECT MIN(version) FROM rosterchanges\
+                   WHERE userid = ?", (uid,))
+        res = c.fetchone()
+        if res[0] is None or res[0] > version + 1:
+            c.close()
+            con.close()
+            return None
+
+        c.execute("SELECT rc.contactid, MAX(rc.version) AS version,\
+                          jids.jid cjid\
+                   FROM rosterchanges AS rc\
+                       JOIN jids ON jids.id = rc.contactid\
+                   WHERE rc.userid = ? AND rc.version > ?\
+                   GROUP BY rc.contactid\
+                   ORDER BY version", (uid, version))
+        changes = [(row['version'], row['contactid'], row['cjid'])
+                   for row in c]
+        c.close()
+        con.close()
+
+        return changes
+
+    def _bumpVersion(self, c, uid, cid):
+        """Increments the roster version of the user uid and logs the change
+        to the contact with id cid. c is the cursor of the transaction that
+        changes the contact. Returns the new version.
+        """
+        c.execute("UPDATE rosterversions SET version = version + 1\
+                   WHERE userid = ?", (uid,))
+        if c.rowcount == 0:
+            c.execute("INSERT INTO rosterversions (userid, version)\
+                       VALUES (?, 1)", (uid,))
+            version = 1
+        else:
+            c.execute("SELECT version FROM rosterversions\
+                       WHERE userid = ?", (uid,))
+            version = c.fetchone()[0]
+
+        c.execute("INSERT INTO rosterchanges (userid, version, contactid)\
+                   VALUES (?, ?, ?)", (uid, version, cid))
+        c.execute("DELETE FROM rosterchanges\
+                   WHERE userid = ? AND version <= ?",
+                   (uid, version - pjs.conf.conf.rosterVersionLogSize))
+
+        return version
+
+    def dump(self):
+        con = self._connect()
+        c = con.cursor()
+        c.execute("BEGIN")
+        try:
+            ids = {}
+            passwords = {}
+            c.execute("SELECT id, jid, password FROM jids")
+            for row in c:
+                ids[row[1]] = row[0]
+                passwords[row[0]] = row[2]
+
+            rosters = {}
+            c.execute("SELECT userid, contactid, name, subscription\
+                       FROM roster")
+            for row in c:
+                rosters.setdefault(row[0], {})[row[1]] = [row[2], row[3], []]
+            c.execute("SELECT rgs.userid, rgi.contactid, rgs.name\
+                       FROM rostergroups AS rgs\
+                           JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid")
+            for row in c:
+                entry = rosters.get(row[0], {}).get(row[1])
+                if entry is not None:
+                    entry[2].append(row[2])
+
+            scramKeys = {}
+            c.execute("SELECT userid, mechanism, salt, iterations,\
+                              storedkey, serverkey\
+                       FROM scramkeys")
+            for row in c:
+                scramKeys.setdefault(row[0], {})[row[1]] = \
+                        (base64.b64decode(row[2]), row[3],
+                         base64.b64decode(row[4]), base64.b64decode(row[5]))
+
+            c.execute("SELECT userid, version FROM rosterversions")
+            versions = dict([(row[0], row[1]) for row in c])
+            changes = {}
+            c.execute("SELECT userid, version, contactid FROM rosterchanges\
+                       ORDER BY userid, version")
+            for row in c:
+                changes.setdefault(row[0], []).append((row[1], row[2]))
+        finally:
+            c.execute("COMMIT")
+            c.close()
+            con.close()
+
+        return {
+                'format' : SNAPSHOT_FORMAT,
+                'ids' : ids,
+                'passwords' : passwords,
+                'scramKeys' : scramKeys,
+                'nextId' : max([0] + ids.values()) + 1,
+                'rosters' : rosters,
+                'versions' : versions,
+                'changes' : changes,
+                }
+
+    def applyBatch(self, records):
+        writers = {
+                   'user' : self._writeUser,
+                   'scram' : self._writeScramKeys,
+                   'contact' : self._writeContact,
+                   'subscription' : self._writeSubscription,
+                   'remove' : self._writeRemoval,
+                   }
+        con = self._connect()
+        c = beginImmediate(con)
+        try:
+            for record in records:
+                writers[record[0]](c, *record[1:])
+        except:
+            rollbackImmediate(con, c)
+            raise
+        commitImmediate(con, c)
+
+    def _getJID(self, c, jid):
+        """Returns the id of jid, creating it if needed. Uses the cursor c."""
+        c.execute("SELECT id FROM jids WHERE jid = ?", (jid,))
+        res = c.fetchone()
+        if res is None:
+            return self._addJID(c, jid)
+        return res[0]
+
+    def _writeUser(self, c, jid, password):
+        c.execute("UPDATE jids SET password = ? WHERE jid = ?", (password, jid))
+        if c.rowcount == 0:
+            self._addJID(c, jid, password)
+        else:
+            c.execute(SQL_DELETE_SCRAM_KEYS, (jid,))
+
+    def _writeScramKeys(self, c, jid, keys):
+        self._setScramKeys(c, self._getJID(c, jid), keys)
+
+    def _writeContact(self, c, ujid, cjid, name, subscription, groups,
+                      version):
+        uid = self._getJID(c, ujid)
+        cid = self._getJID(c, cjid)
+        c.execute("INSERT OR REPLACE INTO roster\
+                   (userid, contactid, name, subscription)\
+                   VALUES (?, ?, ?, ?)", (uid, cid, name, subscription))
+        self._setGroups(c, uid, cid, groups)
+        self._writeVersion(c, uid, cid, version)
+
+    def _writeSubscription(self, c, ujid, cjid, subscription, version):
+        uid = self._getJID(c, ujid)
+        cid = self._getJID(c, cjid)
+        c.execute(SQL_SET_SUBSCRIPTION, (subscription, uid, cid))
+        self._writeVersion(c, uid, cid, version)
+
+    def _writeRemoval(self, c, ujid, cjid, version):
+        uid = self._getJID(c, ujid)
+        cid = self._getJID(c, cjid)
+        c.execute(SQL_DELETE_GROUP_ITEMS, (cid, uid))
+        c.execute("DELETE FROM roster\
+                   WHERE userid = ? AND contactid = ?", (uid, cid))
+        self._writeVersion(c, uid, cid, version)
+
+    def _writeVersion(self, c, uid, cid, version):
+        """Sets the roster version of the user uid to version and logs the
+        change to the contact cid
+        """
+        c.execute("INSERT OR REPLACE INTO rosterversions (userid, version)\
+                   VALUES (?, ?)", (uid, version))
+        c.execute("INSERT OR REPLACE INTO rosterchanges\
+                   (userid, version, contactid)\
+                   VALUES (?, ?, ?)", (uid, version, cid))
+        c.execute("DELETE FROM rosterchanges\
+                   WHERE userid = ? AND version <= ?",
+                   (uid, version - pjs.conf.conf.rosterVersionLogSize))
@@ -0,0 +1,273 @@
+"""Cache of the local users and their credentials.
+
+The auth mechanisms read the user's password on every login attempt, and
+every message from a remote server checks that its recipient exists. With
+userCache set in pjs.conf.conf, UserCacheStorage answers these from memory:
+
+    - the set of all local users is loaded when the server starts and kept
+      up to date by addUser(), so userExists() and getPassword() for users
+      that don't exist never go to the backend.
+    - the passwords and SCRAM keys of the users that logged in recently are
+      kept for userCacheCredentialTTL seconds. setPassword(), addUser() and
+      setScramKeys() drop the cached ones.
+
+Users that are added to the backend by another process aren't seen until
+the set is reloaded, which happens every userCacheRefreshInterval seconds if
+that's set.
+"""
+
+import time
+import threading
+
+import pjs.conf.conf
+
+from pjs.storage.base import Storage
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = None
+
+class UserCacheStorage(Storage):
+    """Puts a cache of the users and passwords in front of a backend"""
+    def __init__(self, backend, ttl=None, maxCredentials=None,
+                 refreshInterval=None):
+        """backend -- the Storage that's cached.
+        ttl -- seconds a password is cached.
+        maxCredentials -- the most passwords cached.
+        refreshInterval -- seconds between reloads of the set of users. 0
+                           never reloads it.
+        """
+        conf = pjs.conf.conf
+        if ttl is None:
+            ttl = conf.userCacheCredentialTTL
+        if maxCredentials is None:
+            maxCredentials = conf.userCacheMaxCredentials
+        if refreshInterval is None:
+            refreshInterval = conf.userCacheRefreshInterval
+        self.backend = backend
+        self.ttl = ttl
+        self.maxCredentials = maxCredentials
+        self.refreshInterval = refreshInterval
+
+        self.lock = threading.Lock()
+
+        # bare JIDs of the local users. None until setup().
+        self.users = None
+        self.loaded = 0
+
+        # bare JID => (expiry time, {'password' or SCRAM mechanism =>
+        # value}), oldest first
+        if OrderedDict is not None:
+            self.credentials = OrderedDict()
+        else:
+            self.credentials = {}
+
+        # incremented when passwords change, so that a password read from
+        # the backend before the change isn't cached
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        # lookups of users that don't exist, answered without the backend
+        self.rejected = 0
+
+    def setup(self):
+        self.backend.setup()
+        self.reload()
+
+    def close(self):
+        self.backend.close()
+
+    def reload(self):
+        """Reloads the set of users from the backend and drops the cached
+        passwords
+        """
+        users = set(self.backend.getUsers())
+        self.lock.acquire()
+        try:
+            self.users = users
+            self.loaded = time.time()
+            self.credentials.clear()
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def invalidate(self, jid=None):
+        """Drops the cached credentials of jid or all of them"""
+        self.lock.acquire()
+        try:
+            if jid is None:
+                self.credentials.clear()
+            else:
+                self.credentials.pop(jid, None)
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def getStats(self):
+        """Returns a dict with the number of users and cached passwords, and
+        the hit counts of the password cache
+        """
+        self.lock.acquire()
+        try:
+            return {
+                    'users' : len(self.users or ()),
+                    'credentials' : len(self.credentials),
+                    'hits' : self.hits,
+                    'misses' : self.misses,
+                    'rejected' : self.rejected,
+                    }
+        finally:
+            self.lock.release()
+
+    def _getUsers(self):
+        """Returns the set of users, reloading it if it's due"""
+        if self.users is None or (self.refreshInterval > 0 and
+                                  time.time() - self.loaded > self.refreshInterval):
+            self.reload()
+        return self.users
+
+    # users and credentials come from the cache
+
+    def userExists(self, jid):
+        if jid in self._getUsers():
+            return True
+        self.lock.acquire()
+        try:
+            self.rejected += 1
+        finally:
+            self.lock.release()
+        return False
+
+    def getUsers(self):
+        return list(self._getUsers())
+
+    def getPassword(self, jid):
+        return self._getCredential(jid, 'password', self.backend.getPassword)
+
+    def getScramKeys(self, jid, mechanism):
+        return self._getCredential(jid, mechanism,
+                                   lambda jid: self.backend.getScramKeys(jid,
+                                                                        mechanism))
+
+    def _getCredential(self, jid, field, load):
+        """Returns the credential field of the user jid from the cache, or
+        calls load(jid) to get it from the backend
+        """
+        if not self.userExists(jid):
+            return None
+
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.credentials.get(jid)
+            if entry is not None and entry[0] > now and field in entry[1]:
+                self.hits += 1
+                return entry[1][field]
+            self.misses += 1
+            generation = self.generation
+        finally:
+            self.lock.release()
+
+        value = load(jid)
+
+        self.lock.acquire()
+        try:
+            if generation == self.generation and value is not None:
+                entry = self.credentials.pop(jid, None)
+                if entry is None or entry[0] <= now:
+                    entry = (now + self.ttl, {})
+                entry[1][field] = value
+                self.credentials[jid] = entry
+                while len(self.credentials) > self.maxCredentials:
+                    self._evict()
+        finally:
+            self.lock.release()
+        return value
+
+    def _evict(self):
+        """Drops the oldest cached password. Called with the lock held."""
+        if OrderedDict is not None:
+            self.credentials.popitem(False)
+        else:
+            oldest = min(self.credentials.items(),
+                         key=lambda item: item[1][0])[0]
+            del self.credentials[oldest]
+
+    def addUser(self, jid, password):
+        uid = self.backend.addUser(jid, password)
+        self.invalidate(jid)
+        self.lock.acquire()
+        try:
+            if self.users is not None:
+                self.users.add(jid)
+        finally:
+            self.lock.release()
+        return uid
+
+    def setPassword(self, jid, password):
+        try:
+            return self.backend.setPassword(jid, password)
+        finally:
+            self.invalidate(jid)
+
+    def setScramKeys(self, jid, keys):
+        try:
+            return self.backend.setScramKeys(jid, keys)
+        finally:
+            self.invalidate(jid)
+
+    # everything else goes to the backend
+
+    def getUserId(self, jid):
+        return self.backend.getUserId(jid)
+
+    def getRoster(self, uid):
+        return self.backend.getRoster(uid)
+
+    def iterRoster(self, uid, exclude=None):
+        return self.backend.iterRoster(uid, exclude)
+
+    def countRoster(self, uid, exclude=None):
+        return self.backend.countRoster(uid, exclude)
+
+    def getContact(self, uid, cjid, includeGroups=True):
+        return self.backend.getContact(uid, cjid, includeGroups)
+
+    def getGroups(self, uid, cid):
+        return self.backend.getGroups(uid, cid)
+
+    def getSubscription(self, uid, cid):
+        return self.backend.getSubscription(uid, cid)
+
+    def getSubscriptions(self, uid):
+        return self.backend.getSubscriptions(uid)
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        return self.backend.updateContact(uid, cjid, name, groups,
+                                          subscription)
+
+    def removeContact(self, uid, cjid):
+        return self.backend.removeContact(uid, cjid)
+
+    def setSubscription(self, uid, cid, subscription):
+        return self.backend.setSubscription(uid, cid, subscription)
+
+    def applyTransition(self, uid, cjid, transition, create=False,
+                        groups=None):
+        return self.backend.applyTransition(uid, cjid, transition, create,
+                                            groups)
+
+    def getRosterVersion(self, uid):
+        return self.backend.getRosterVersion(uid)
+
+    def getRosterChanges(self, uid, version):
+        return self.backend.getRosterChanges(uid, version)
+
+    def dump(self):
+        return self.backend.dump()
+
+    def applyBatch(self, records):
+        self.backend.applyBatch(records)
+        self.reload()
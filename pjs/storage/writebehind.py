@@ -0,0 +1,409 @@
+"""Write-behind of the changes to a storage backend.
+
+WriteBehindStorage keeps all data of the backend in a MemoryStorage, which
+answers all reads. Changes are made to the memory first and returned right
+away. They're queued as records of the new state (see
+pjs.storage.base.Storage.applyBatch()), which one writer thread writes to
+the backend in batches of up to storageWriteBehindBatchSize records. A
+change waits at most storageWriteBehindDelay seconds for others to join its
+batch. This way, one commit and one sync of the disk cover many changes.
+
+The changes that are still queued are lost if the server crashes, unless
+they're also appended to the storageWriteBehindJournal file. The journal is
+written to the backend when the server starts again. With
+storageWriteBehindFsync, the journal is synced to disk after every change,
+so the changes also survive a crash of the machine.
+"""
+
+import os
+import time
+import logging
+import threading
+import cPickle
+
+import pjs.conf.conf
+
+from pjs.storage.base import Storage
+from pjs.storage.memorystore import MemoryStorage
+
+# seconds to wait before retrying a batch that failed
+RETRY_DELAY = 1
+
+class WriteBehindStorage(Storage):
+    """Puts an in-memory view with write-behind in front of a backend"""
+    def __init__(self, backend, batchSize=None, delay=None, maxQueue=None,
+                 journal=None, fsync=None):
+        """backend -- the Storage the changes are written to. It has to
+                      support dump() and applyBatch().
+        batchSize -- the most records written in one transaction.
+        delay -- seconds a record can wait for its batch to fill up.
+        maxQueue -- changes block while this many records are queued.
+        journal -- file the queued records are appended to. An empty string
+                   doesn't keep a journal.
+        fsync -- True to sync the journal after every record.
+        """
+        conf = pjs.conf.conf
+        if batchSize is None:
+            batchSize = conf.storageWriteBehindBatchSize
+        if delay is None:
+            delay = conf.storageWriteBehindDelay
+        if maxQueue is None:
+            maxQueue = conf.storageWriteBehindMaxQueue
+        if journal is None:
+            journal = conf.storageWriteBehindJournal
+        if fsync is None:
+            fsync = conf.storageWriteBehindFsync
+        self.backend = backend
+        self.batchSize = batchSize
+        self.delay = delay
+        self.maxQueue = maxQueue
+        self.journalFile = journal
+        self.fsync = fsync
+
+        self.view = MemoryStorage('', 0)
+
+        # held while a change is made to the view and queued, so that the
+        # records are queued in the order of the changes
+        self.writeLock = threading.Lock()
+
+        # list of (time queued, record)
+        self.queue = []
+        self.cond = threading.Condition(threading.Lock())
+        self.journal = None
+        self.running = False
+        self.thread = None
+
+        self.batches = 0
+        self.written = 0
+        self.maxBatch = 0
+        self.totalLag = 0.0
+        self.maxLag = 0.0
+        self.lastLag = 0.0
+        self.failures = 0
+        # number of changes that waited because the queue was full
+        self.stalls = 0
+
+    def setup(self):
+        """Writes the journal left by a crash to the backend, loads the data
+        into memory and starts the writer thread
+        """
+        self.backend.setup()
+
+        if self.journalFile:
+            records = readJournal(self.journalFile)
+            if records:
+                logging.info("[%s] Writing %d records from the journal %s",
+                             self.__class__, len(records), self.journalFile)
+                for i in range(0, len(records), self.batchSize):
+                    self.backend.applyBatch(records[i:i + self.batchSize])
+            self.journal = open(self.journalFile, 'wb')
+
+        self.view.setState(self.backend.dump())
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def close(self):
+        """Writes the queued records and stops the writer thread"""
+        if self.running:
+            self.cond.acquire()
+            try:
+                self.running = False
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+            self.thread.join()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.backend.close()
+
+    def flush(self, timeout=None):
+        """Waits until all queued records are written. Returns False if they
+        weren't written within timeout seconds.
+        """
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        self.cond.acquire()
+        try:
+            self.cond.notifyAll()
+            while self.queue:
+                if end is None:
+                    self.cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+            return True
+        finally:
+            self.cond.release()
+
+    def getStats(self):
+        """Returns a dict with the queue length, batch sizes and lag. The lag
+        is the time from a change until it's committed to the backend.
+        """
+        self.cond.acquire()
+        try:
+            if self.batches:
+                avgBatch = float(self.written) / self.batches
+            else:
+                avgBatch = 0.0
+            if self.written:
+                avgLag = self.totalLag / self.written
+            else:
+                avgLag = 0.0
+            return {
+                    'queued' : len(self.queue),
+                    'batches' : self.batches,
+                    'written' : self.written,
+                    'avgBatch' : avgBatch,
+                    'maxBatch' : self.maxBatch,
+                    'avgLag' : avgLag,
+                    'maxLag' : self.maxLag,
+                    'lastLag' : self.lastLag,
+                    'failures' : self.failures,
+                    'stalls' : self.stalls,
+                    }
+        finally:
+            self.cond.release()
+
+    def _queue(self, record):
+        """Queues record for writing. Called with writeLock held."""
+        if self.journal is not None:
+            cPickle.dump(record, self.journal, cPickle.HIGHEST_PROTOCOL)
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+
+        self.cond.acquire()
+        try:
+            if len(self.queue) >= self.maxQueue:
+                self.stalls += 1
+                while len(self.queue) >= self.maxQueue and self.running:
+                    self.cond.wait()
+            self.queue.append((time.time(), record))
+            if len(self.queue) == 1 or len(self.queue) >= self.batchSize:
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        """Writes the queued records in batches. Runs in its own thread."""
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.queue and self.running:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                # give the batch time to fill up
+                while self.running and len(self.queue) < self.batchSize:
+                    remaining = self.queue[0][0] + self.delay - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self.queue[:self.batchSize]
+            finally:
+                self.cond.release()
+
+            try:
+                self.backend.applyBatch([record for queued, record in batch])
+            except Exception, e:
+                logging.warning("[%s] Writing a batch of %d records failed: %s",
+                                self.__class__, len(batch), e)
+                self.cond.acquire()
+                try:
+                    self.failures += 1
+                    running = self.running
+                finally:
+                    self.cond.release()
+                if not running:
+                    # shutting down. the records are still in the journal,
+                    # if there is one.
+                    return
+                time.sleep(RETRY_DELAY)
+                continue
+
+            now = time.time()
+            self.cond.acquire()
+            try:
+                del self.queue[:len(batch)]
+                self.batches += 1
+                self.written += len(batch)
+                self.maxBatch = max(self.maxBatch, len(batch))
+                for queued, record in batch:
+                    self.totalLag += now - queued
+                self.lastLag = now - batch[0][0]
+                self.maxLag = max(self.maxLag, self.lastLag)
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+            self._truncateJournal()
+
+    def _truncateJournal(self):
+        """Empties the journal if all records in it were written"""
+        if self.journal is None:
+            return
+        self.writeLock.acquire()
+        try:
+            if not self.queue:
+                self.journal.seek(0)
+                self.journal.truncate()
+        finally:
+            self.writeLock.release()
+
+    # reads come from memory
+
+    def getUserId(self, jid):
+        return self.view.getUserId(jid)
+
+    def userExists(self, jid):
+        return self.view.userExists(jid)
+
+    def getUsers(self):
+        return self.view.getUsers()
+
+    def getPassword(self, jid):
+        return self.view.getPassword(jid)
+
+    def getScramKeys(self, jid, mechanism):
+        return self.view.getScramKeys(jid, mechanism)
+
+    def getRoster(self, uid):
+        return self.view.getRoster(uid)
+
+    def iterRoster(self, uid, exclude=None):
+        return self.view.iterRoster(uid, exclude)
+
+    def countRoster(self, uid, exclude=None):
+        return self.view.countRoster(uid, exclude)
+
+    def getContact(self, uid, cjid, includeGroups=True):
+        return self.view.getContact(uid, cjid, includeGroups)
+
+    def getGroups(self, uid, cid):
+        return self.view.getGroups(uid, cid)
+
+    def getSubscription(self, uid, cid):
+        return self.view.getSubscription(uid, cid)
+
+    def getSubscriptions(self, uid):
+        return self.view.getSubscriptions(uid)
+
+    def getRosterVersion(self, uid):
+        return self.view.getRosterVersion(uid)
+
+    def getRosterChanges(self, uid, version):
+        return self.view.getRosterChanges(uid, version)
+
+    def dump(self):
+        return self.backend.dump()
+
+    # changes are made in memory and queued
+
+    def addUser(self, jid, password):
+        self.writeLock.acquire()
+        try:
+            uid = self.view.addUser(jid, password)
+            self._queue(('user', jid, password))
+            return uid
+        finally:
+            self.writeLock.release()
+
+    def setPassword(self, jid, password):
+        self.writeLock.acquire()
+        try:
+            if not self.view.setPassword(jid, password):
+                return False
+            self._queue(('user', jid, password))
+            return True
+        finally:
+            self.writeLock.release()
+
+    def setScramKeys(self, jid, keys):
+        self.writeLock.acquire()
+        try:
+            if not self.view.setScramKeys(jid, keys):
+                return False
+            self._queue(('scram', jid, dict(keys)))
+            return True
+        finally:
+            self.writeLock.release()
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        self.writeLock.acquire()
+        try:
+            contact, version = self.view.updateContact(uid, cjid, name,
+                                                       groups, subscription)
+            self._queueContact(uid, contact, version)
+            return contact, version
+        finally:
+            self.writeLock.release()
+
+    def removeContact(self, uid, cjid):
+        self.writeLock.acquire()
+        try:
+            cid, version = self.view.removeContact(uid, cjid)
+            if cid is not None:
+                self._queue(('remove', self.view.jids[uid], cjid, version))
+            return cid, version
+        finally:
+            self.writeLock.release()
+
+    def setSubscription(self, uid, cid, subscription):
+        self.writeLock.acquire()
+        try:
+            version = self.view.setSubscription(uid, cid, subscription)
+            self._queue(('subscription', self.view.jids[uid],
+                         self.view.jids[cid], subscription, version))
+            return version
+        finally:
+            self.writeLock.release()
+
+    def applyTransition(self, uid, cjid, transition, create=False,
+                        groups=None):
+        self.writeLock.acquire()
+        try:
+            contact, old, version = self.view.applyTransition(uid, cjid,
+                                                              transition,
+                                                              create, groups)
+            if version is not None:
+                self._queueContact(uid, contact, version)
+            return contact, old, version
+        finally:
+            self.writeLock.release()
+
+    def _queueContact(self, uid, contact, version):
+        cid, cjid, name, subscription, groups = contact
+        self._queue(('contact', self.view.jids[uid], cjid, name,
+                     subscription, list(groups), version))
+
+    def applyBatch(self, records):
+        raise NotImplementedError, "records can only be applied to the backend"
+
+def readJournal(path):
+    """Returns the list of records in the journal file path. A record cut
+    off by a crash is left out.
+    """
+    if not os.path.exists(path):
+        return []
+    records = []
+    f = open(path, 'rb')
+    try:
+        while True:
+            try:
+                records.append(cPickle.load(f))
+            except EOFError:
+                break
+            except Exception, e:
+                logging.warning("[writebehind] Ignoring the end of the " + \
+                                "journal %s: %s", path, e)
+                break
+    finally:
+        f.close()
+    return records
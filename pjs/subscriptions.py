@@ -0,0 +1,157 @@
+"""Process-wide cache of the presence subscription graph.
+
+For every user whose roster was loaded, this keeps the subscription state to
+each contact, so that presence broadcasts can find the subscribers and
+subscriptions of a user without going to the DB. Users are loaded lazily
+(see pjs.roster.Roster.loadSubscriptions()) and kept up to date by the Roster
+methods that change subscriptions.
+
+The cache is shared between the main loop and the threadpool threads, so
+all access goes through a lock.
+"""
+
+import threading
+
+class SubscriptionGraph:
+    """Maps bare JIDs of users to their contacts' subscription states"""
+    def __init__(self):
+        # user's bare JID => {contact id => (contact's bare JID, state)}
+        self.users = {}
+        self.lock = threading.Lock()
+
+        # user's bare JID => number of changes to the user since the load
+        # from the DB started. loads that raced with a change are thrown
+        # away, since they may have read the DB before the change.
+        self.loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def isLoaded(self, jid):
+        """Returns True if the subscriptions of jid are cached"""
+        return jid in self.users
+
+    def beginLoad(self, jid):
+        """Must be called before reading jid's subscriptions from the DB.
+        Returns the value to pass to load().
+        """
+        self.lock.acquire()
+        try:
+            return self.loading.setdefault(jid, 0)
+        finally:
+            self.lock.release()
+
+    def load(self, jid, contacts, stamp):
+        """Caches the subscriptions of the user jid. Returns False if they
+        changed while they were being read and weren't cached.
+
+        contacts -- list of (contact id, contact's bare JID, state) tuples
+                    for all contacts in the user's roster.
+        stamp -- return value of beginLoad()
+        """
+        entry = {}
+        for cid, cjid, sub in contacts:
+            entry[cid] = (cjid, sub)
+        self.lock.acquire()
+        try:
+            if self.loading.pop(jid, None) != stamp:
+                return False
+            self.users[jid] = entry
+            self.loads += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def _changed(self, jid):
+        """Marks the loads of jid in progress as stale. Call with the lock
+        held.
+        """
+        if jid in self.loading:
+            self.loading[jid] += 1
+
+    def getContacts(self, jid, states):
+        """Returns the list of JIDs of jid's contacts whose subscription
+        state is in states, or None if jid's subscriptions are not cached.
+        See Subscription.PRESENCE_FROM and Subscription.PRESENCE_TO in
+        pjs.roster.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.users.get(jid)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [cjid for cjid, sub in entry.itervalues() if sub in states]
+        finally:
+            self.lock.release()
+
+    def setSubscription(self, jid, cid, sub, cjid=None):
+        """Records the new subscription state of jid to the contact with id
+        cid. Nothing is done if jid is not cached. If cjid is not given and
+        the contact isn't known, jid is dropped from the cache so that it's
+        reloaded the next time.
+        """
+        self.lock.acquire()
+        try:
+            self._changed(jid)
+            entry = self.users.get(jid)
+            if entry is None:
+                return
+            if cjid is None:
+                try:
+                    cjid = entry[cid][0]
+                except KeyError:
+                    del self.users[jid]
+                    return
+            entry[cid] = (cjid, sub)
+        finally:
+            self.lock.release()
+
+    def removeContact(self, jid, cid):
+        """Forgets the contact with id cid in jid's roster"""
+        self.lock.acquire()
+        try:
+            self._changed(jid)
+            entry = self.users.get(jid)
+            if entry is not None:
+                entry.pop(cid, None)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, jid):
+        """Drops jid from the cache"""
+        self.lock.acquire()
+        try:
+            self._changed(jid)
+            self.users.pop(jid, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for jid in self.loading:
+                self.loading[jid] += 1
+            self.users.clear()
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.users)
+
+    def getStats(self):
+        """Returns a dict with the size and hit counters of the cache"""
+        return {
+                'users' : len(self.users),
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'loads' : self.loads,
+                }
+
+_graph = SubscriptionGraph()
+
+def getSubscriptionGraph():
+    """Returns the process-wide SubscriptionGraph"""
+    return _graph
@@ -3,16 +3,62 @@
 import unittest
 import pjs.test.test_parsers
 import pjs.test.test_utils
+import pjs.test.test_serializer
+import pjs.test.test_stream
+import pjs.test.test_sessions
+import pjs.test.test_route
 import pjs.test.test_async
+import pjs.test.test_resolver
+import pjs.test.test_outqueue
+import pjs.test.test_dialback
+import pjs.test.test_subscriptions
+import pjs.test.test_lastpresence
+import pjs.test.test_coalesce
+import pjs.test.test_rostercache
+import pjs.test.test_roster
+import pjs.test.test_rosterstream
+import pjs.test.test_presence
 import pjs.test.test_events
+import pjs.test.test_dbpool
+import pjs.test.test_schema
+import pjs.test.test_storage
+import pjs.test.test_writebehind
+import pjs.test.test_shardedstore
+import pjs.test.test_usercache
+import pjs.test.test_scram
+import pjs.test.test_procpool
+import pjs.test.test_localdelivery
 import pjs.test.test_xmpp
 
 fromModule = unittest.TestLoader().loadTestsFromModule
 
 suite = fromModule(pjs.test.test_parsers)
 suite.addTests(fromModule(pjs.test.test_utils))
+suite.addTests(fromModule(pjs.test.test_serializer))
+suite.addTests(fromModule(pjs.test.test_stream))
+suite.addTests(fromModule(pjs.test.test_sessions))
+suite.addTests(fromModule(pjs.test.test_route))
 suite.addTests(fromModule(pjs.test.test_async))
+suite.addTests(fromModule(pjs.test.test_resolver))
+suite.addTests(fromModule(pjs.test.test_outqueue))
+suite.addTests(fromModule(pjs.test.test_dialback))
+suite.addTests(fromModule(pjs.test.test_subscriptions))
+suite.addTests(fromModule(pjs.test.test_lastpresence))
+suite.addTests(fromModule(pjs.test.test_coalesce))
+suite.addTests(fromModule(pjs.test.test_rostercache))
+suite.addTests(fromModule(pjs.test.test_roster))
+suite.addTests(fromModule(pjs.test.test_rosterstream))
+suite.addTests(fromModule(pjs.test.test_presence))
 suite.addTests(fromModule(pjs.test.test_events))
+suite.addTests(fromModule(pjs.test.test_dbpool))
+suite.addTests(fromModule(pjs.test.test_schema))
+suite.addTests(fromModule(pjs.test.test_storage))
+suite.addTests(fromModule(pjs.test.test_writebehind))
+suite.addTests(fromModule(pjs.test.test_shardedstore))
+suite.addTests(fromModule(pjs.test.test_usercache))
+suite.addTests(fromModule(pjs.test.test_scram))
+suite.addTests(fromModule(pjs.test.test_procpool))
+suite.addTests(fromModule(pjs.test.test_localdelivery))
 
 # this doesn't work, because unittest does not import the helper classes
 # run test_xmpp directly instead
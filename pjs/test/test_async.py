@@ -120,6 +120,41 @@ class TestWatchFunction(unittest.TestCase):
         asyncore.poll()
         
         self.assert_(self.passed)
-        
+
+class TestTimers(unittest.TestCase):
+    """Testing of the timers in pjs.async.core"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = ServerHelper()
+        self.fired = []
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.server.handle_close()
+
+    def testFires(self):
+        """Due timers should run from poll() in order"""
+        asyncore.callLater(0, self.fired.append, 1)
+        asyncore.callLater(0, self.fired.append, 2)
+        asyncore.poll(1.0)
+        self.assertEqual(self.fired, [1, 2])
+
+    def testCancel(self):
+        """Cancelled timers shouldn't run"""
+        timer = asyncore.callLater(0, self.fired.append, 1)
+        timer.cancel()
+        asyncore.poll()
+        self.assertEqual(self.fired, [])
+
+    def testNotDue(self):
+        """Timers shouldn't run early, but should shorten the poll timeout"""
+        timer = asyncore.callLater(60, self.fired.append, 1)
+        asyncore.poll()
+        self.assertEqual(self.fired, [])
+        self.assert_(asyncore.timerTimeout(120) <= 60)
+        timer.cancel()
+        self.assertEqual(asyncore.timerTimeout(120), 120)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,105 @@
+import pjs.test.init # init the launcher
+import pjs.async.core as asyncore
+import pjs.conf.conf
+
+from pjs.coalesce import PresenceCoalescer
+from pjs.elementtree.ElementTree import Element, SubElement
+
+import unittest
+import time
+
+WINDOW = 0.05
+
+class FakeConn:
+    def __init__(self, id, jid):
+        self.id = id
+        self.data = {
+                     'user' : {'jid' : jid, 'active' : False},
+                     'stream' : {'closing' : False},
+                     }
+
+class RecordingCoalescer(PresenceCoalescer):
+    """Records the presences it would dispatch and passes them on like the
+    handler would
+    """
+    def __init__(self):
+        PresenceCoalescer.__init__(self, lambda conn: 10)
+        self.dispatched = []
+    def dispatch(self, conn, tree):
+        self.dispatched.append(tree)
+        self.failed = self.hold(conn, tree)
+
+def makePresence(type=None, show=None):
+    pres = Element('{jabber:client}presence')
+    if type:
+        pres.set('type', type)
+    if show:
+        SubElement(pres, '{jabber:client}show').text = show
+    return pres
+
+class TestPresenceCoalescer(unittest.TestCase):
+    """Tests the coalescing of presence changes"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        pjs.conf.conf.presenceCoalesceWindows['tro@localhost'] = WINDOW
+        self.coalescer = RecordingCoalescer()
+        self.conn = FakeConn('c1', 'tro@localhost')
+
+        # initial presence always goes through
+        self.failIf(self.coalescer.hold(self.conn, makePresence()))
+        self.conn.data['user']['active'] = True
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        del pjs.conf.conf.presenceCoalesceWindows['tro@localhost']
+        self.coalescer.remove(self.conn)
+
+    def wait(self):
+        time.sleep(WINDOW * 2)
+        asyncore.runTimers()
+
+    def testLatestWins(self):
+        """Only the latest presence in the window should be broadcast"""
+        self.assert_(self.coalescer.hold(self.conn, makePresence(show='away')))
+        self.assert_(self.coalescer.hold(self.conn, makePresence(show='xa')))
+        last = makePresence(show='dnd')
+        self.assert_(self.coalescer.hold(self.conn, last))
+        self.wait()
+        self.assertEqual(self.coalescer.dispatched, [last])
+        self.failIf(self.coalescer.failed)
+        stats = self.coalescer.getStats()
+        self.assertEqual((stats['held'], stats['coalesced'], stats['flushed']),
+                         (1, 2, 1))
+        self.assertEqual(stats['fanoutSaved'], 20)
+
+    def testTransientUnavailable(self):
+        """unavailable followed by the same available shouldn't be sent"""
+        self.assert_(self.coalescer.hold(self.conn, makePresence('unavailable')))
+        self.assert_(self.coalescer.hold(self.conn, makePresence()))
+        self.wait()
+        self.assertEqual(self.coalescer.dispatched, [])
+        self.assertEqual(self.coalescer.suppressed, 1)
+
+    def testClosing(self):
+        """The unavailable presence on stream close should go out at once"""
+        self.assert_(self.coalescer.hold(self.conn, makePresence(show='away')))
+        self.conn.data['stream']['closing'] = True
+        self.failIf(self.coalescer.hold(self.conn, makePresence('unavailable')))
+        self.wait()
+        self.assertEqual(self.coalescer.dispatched, [])
+
+    def testDisabled(self):
+        """Users without a window shouldn't be held"""
+        conn = FakeConn('c2', 'dv@localhost')
+        conn.data['user']['active'] = True
+        self.failIf(self.coalescer.hold(conn, makePresence(show='away')))
+
+    def testDirected(self):
+        """Directed presence shouldn't be held"""
+        pres = makePresence()
+        pres.set('to', 'dv@localhost')
+        self.failIf(self.coalescer.hold(self.conn, pres))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+from pjs.db import ConnectionPool, PoolTimeout
+import os
+import tempfile
+import threading
+import unittest
+
+class TestConnectionPool(unittest.TestCase):
+    """Tests the pooling of DB connections"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        self.pool = ConnectionPool(self.name, maxSize=2, timeout=0.2,
+                                   statementCacheSize=10, checkInterval=60)
+        con = self.pool.checkout()
+        con.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, v TEXT)")
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        self.pool.close()
+        os.remove(self.name)
+
+    def testReuse(self):
+        """A thread should get back the connection it returned"""
+        con = self.pool.checkout()
+        raw = con._con
+        con.close()
+        con = self.pool.checkout()
+        self.assert_(con._con is raw)
+        con.close()
+        stats = self.pool.getStats()
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['reused'], 2)
+        self.assertEqual(stats['stolen'], 0)
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['idle'], 1)
+
+    def testThreadAffinity(self):
+        """Threads should prefer their own idle connections"""
+        own = {}
+        def work(key):
+            con = self.pool.checkout()
+            own[key] = con._con
+            con.close()
+        # the one idle connection moves back and forth between the threads
+        t = threading.Thread(target=work, args=('other',))
+        t.start()
+        t.join()
+        work('main')
+        self.assert_(own['main'] is own['other'])
+        self.assertEqual(self.pool.getStats()['stolen'], 2)
+        self.assertEqual(self.pool.getStats()['opened'], 1)
+
+        # with one idle connection of our own, we get it back
+        con1 = self.pool.checkout()
+        con2 = self.pool.checkout()
+        raw2 = con2._con
+        con1.close()
+        t = threading.Thread(target=work, args=('other',))
+        t.start()
+        t.join()
+        con2.close()
+        con = self.pool.checkout()
+        self.assert_(con._con is raw2)
+
+    def testBounded(self):
+        """Checkouts beyond maxSize should wait and time out"""
+        con1 = self.pool.checkout()
+        con2 = self.pool.checkout()
+        self.assertRaises(PoolTimeout, self.pool.checkout)
+        stats = self.pool.getStats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['inUse'], 2)
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+
+        # a connection returned by another thread wakes the waiting one up
+        timer = threading.Timer(0.05, con1.close)
+        timer.start()
+        con3 = self.pool.checkout()
+        self.assert_(self.pool.getStats()['maxWait'] > 0)
+        con2.close()
+        con3.close()
+
+    def testGarbageCollected(self):
+        """Connections that aren't referenced any more go back to the pool,
+        but not while their cursors are in use
+        """
+        c = self.pool.checkout().cursor()
+        self.assertEqual(self.pool.getStats()['inUse'], 1)
+        c.execute("SELECT 1")
+        c.close()
+        del c
+        self.assertEqual(self.pool.getStats()['inUse'], 0)
+
+    def testRollbackOnCheckin(self):
+        """Uncommitted changes should be rolled back when returned"""
+        con = self.pool.checkout()
+        con.execute("INSERT INTO t (v) VALUES ('a')")
+        con.close()
+        con = self.pool.checkout(None)
+        self.assertEqual(con.execute("SELECT COUNT(*) FROM t").fetchone()[0], 0)
+        self.assertEqual(con.isolation_level, None)
+        con.close()
+        self.assertRaises(Exception, con.cursor)
+
+    def testHealthCheck(self):
+        """Broken idle connections should be replaced"""
+        self.pool.checkInterval = -1
+        con = self.pool.checkout()
+        raw = con._con
+        con.close()
+        raw.close()
+        con = self.pool.checkout()
+        self.assert_(con._con is not raw)
+        self.assertEqual(con.execute("SELECT COUNT(*) FROM t").fetchone()[0], 0)
+        con.close()
+        stats = self.pool.getStats()
+        self.assertEqual(stats['discarded'], 1)
+        self.assertEqual(stats['size'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,288 @@
+import pjs.test.init # pjs.events needs the launcher
+import pjs.conf.conf
+from pjs.dialback import makeKey, checkKey, resultElement, verifyElement, \
+                         VerifiedDomainCache
+from pjs.handlers.dialback import DialbackResultHandler, DialbackVerifyHandler
+from pjs.server import S2SServer
+from pjs.elementtree.ElementTree import Element, SubElement
+from pjs.events import _Dispatcher, S2SStanzaDispatcher
+import unittest
+import time
+
+class TestKeys(unittest.TestCase):
+    """Tests the dialback key generation"""
+
+    def testCheckKey(self):
+        """Keys should only be valid for the stream they were made for"""
+        key = makeKey('remote.com', 'localhost', 'abc123')
+        self.assert_(checkKey(key, 'remote.com', 'localhost', 'abc123'))
+        self.failIf(checkKey(key, 'remote.com', 'localhost', 'abc124'))
+        self.failIf(checkKey(key, 'other.com', 'localhost', 'abc123'))
+        self.failIf(checkKey(key[:-1], 'remote.com', 'localhost', 'abc123'))
+        self.failIf(checkKey(None, 'remote.com', 'localhost', 'abc123'))
+
+    def testElements(self):
+        """Dialback elements should be escaped and carry the key as text"""
+        self.assertEqual(resultElement('a.com', 'b.com', 'k1'),
+                         u"<db:result from='a.com' to='b.com'>k1</db:result>")
+        self.assertEqual(resultElement('a.com', 'b.com', type='valid'),
+                         u"<db:result from='a.com' to='b.com' type='valid'/>")
+        self.assertEqual(verifyElement('a.com', "b'", 'id1', 'k1'),
+                         u"<db:verify from='a.com' to='b&apos;' id='id1'>k1</db:verify>")
+
+class TestVerifiedDomainCache(unittest.TestCase):
+    """Tests the cache of verified keys"""
+
+    def testVerified(self):
+        """Keys should only be verified on the stream they were verified on"""
+        cache = VerifiedDomainCache(ttl=60)
+        cache.add('remote.com', 'id1', 'k1')
+        self.assert_(cache.isVerified('remote.com', 'id1', 'k1'))
+        self.failIf(cache.isVerified('remote.com', 'id1', 'k2'))
+        self.failIf(cache.isVerified('other.com', 'id1', 'k1'))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        cache.invalidate('remote.com')
+        self.failIf(cache.isVerified('remote.com', 'id1', 'k1'))
+
+    def testReplay(self):
+        """A verified key replayed on another stream shouldn't be trusted"""
+        cache = VerifiedDomainCache(ttl=60)
+        cache.add('remote.com', 'id1', 'k1')
+        self.failIf(cache.isVerified('remote.com', 'id2', 'k1'))
+
+    def testExpiry(self):
+        """Entries should expire after the TTL"""
+        cache = VerifiedDomainCache(ttl=60)
+        cache.add('remote.com', 'id1', 'k1')
+        cache.entries[('remote.com', 'id1')] = ('k1', time.time() - 1)
+        self.failIf(cache.isVerified('remote.com', 'id1', 'k1'))
+        self.assertEqual(len(cache), 0)
+
+    def testMaxSize(self):
+        """The cache should not grow beyond maxSize"""
+        cache = VerifiedDomainCache(ttl=60, maxSize=10)
+        for i in range(25):
+            cache.add('d%d.com' % i, 'id%d' % i, 'k')
+        self.assert_(len(cache) <= 10)
+        self.assert_(cache.isVerified('d24.com', 'id24', 'k'))
+
+class FakeConnection:
+    def __init__(self, verified=None):
+        self.id = 'fakeconn%s' % id(self)
+        self.data = {'server' : {}}
+        if verified is not None:
+            self.data['server']['verified'] = verified
+
+class TestUnverifiedStanzas(unittest.TestCase):
+    """Tests that stanzas are only accepted from verified domains"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.dispatched = []
+        self.original = _Dispatcher.__dict__['dispatch']
+        def record(dispatcher, tree, conn, knownPhase=None):
+            self.dispatched.append(tree[0].get('from'))
+        _Dispatcher.dispatch = record
+
+    def tearDown(self):
+        _Dispatcher.dispatch = self.original
+        unittest.TestCase.tearDown(self)
+
+    def dispatch(self, conn, frm):
+        wrapper = Element('wrapper')
+        SubElement(wrapper, '{jabber:server}message', {'from' : frm,
+                                                       'to' : 'bob@localhost'})
+        S2SStanzaDispatcher().dispatch(wrapper, conn)
+
+    def testRemote(self):
+        """Stanzas on a remote server's stream should need a verified domain"""
+        conn = FakeConnection([])
+        self.dispatch(conn, 'alice@remote.com')
+        self.assertEqual(self.dispatched, [])
+
+        conn.data['server']['verified'].append('remote.com')
+        self.dispatch(conn, 'alice@remote.com/res')
+        self.dispatch(conn, 'eve@other.com')
+        self.dispatch(conn, '')
+        self.assertEqual(self.dispatched, ['alice@remote.com/res'])
+
+    def testLocal(self):
+        """Local connections don't go through dialback"""
+        self.dispatch(FakeConnection(), 'alice@localhost')
+        self.assertEqual(self.dispatched, ['alice@localhost'])
+
+class FakeInConnection:
+    """Incoming stream from a remote server that records its output"""
+    def __init__(self, server, streamId):
+        self.id = 'fakein%s' % id(self)
+        self.server = server
+        self.data = {'stream' : {'id' : streamId},
+                     'server' : {'direction' : 'from', 'verified' : []}}
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+class FakeOutConnection:
+    """Our outgoing stream to a remote server"""
+    def __init__(self, server, queue):
+        self.id = 'fakeout%s' % id(self)
+        self.server = server
+        self.data = {'stream' : {'id' : 'outid'},
+                     'server' : {'direction' : 'to'}}
+        self.outQueue = queue
+        self.control = []
+        self.sent = []
+
+    def sendControl(self, data):
+        self.control.append(data)
+
+    def send(self, data):
+        self.sent.append(data)
+
+class FakeMessage:
+    def __init__(self, conn):
+        self.conn = conn
+        self.output = []
+
+    def addTextOutput(self, data):
+        self.output.append(data)
+
+def makeDb(name, frm, to, text=None, **attrs):
+    tree = Element('{jabber:server:dialback}' + name, {'from' : frm, 'to' : to})
+    for k, v in attrs.items():
+        tree.set(k, v)
+    tree.text = text
+    return tree
+
+class TestDialbackHandlers(unittest.TestCase):
+    """Runs the dialback handlers against the S2S server with fake
+    connections
+    """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = S2SServer('127.0.0.1', 0, pjs.conf.conf.launcher)
+        # the link to the authoritative server of remote.com
+        self.out = FakeOutConnection(self.server,
+                                     self.server.getOutQueue('remote.com'))
+        self.server.s2sConns['remote.com'] = [None, self.out]
+
+    def tearDown(self):
+        if self.server._pruneTimer is not None:
+            self.server._pruneTimer.cancel()
+        self.server.close()
+        unittest.TestCase.tearDown(self)
+
+    def result(self, conn, key, frm='remote.com', to='localhost'):
+        msg = FakeMessage(conn)
+        DialbackResultHandler().handle(makeDb('result', frm, to, key), msg)
+        return msg.output
+
+    def answer(self, streamId, type):
+        msg = FakeMessage(self.out)
+        DialbackVerifyHandler().handle(makeDb('verify', 'remote.com',
+                                              'localhost', id=streamId,
+                                              type=type), msg)
+        return msg.output
+
+    def testRequestVerify(self):
+        """Keys from several streams should be verified over the one
+        outgoing link, once per stream
+        """
+        first = FakeInConnection(self.server, 'id1')
+        second = FakeInConnection(self.server, 'id2')
+        self.assertEqual(self.result(first, 'k1'), [])
+        self.assertEqual(self.result(second, 'k2'), [])
+        # repeated before the answer came
+        self.assertEqual(self.result(first, 'k1'), [])
+
+        self.assertEqual(self.out.control,
+                         [verifyElement('localhost', 'remote.com', 'id1', 'k1'),
+                          verifyElement('localhost', 'remote.com', 'id2', 'k2')])
+        self.assertEqual(sorted(self.server.pendingVerifies.keys()),
+                         [('remote.com', 'id1'), ('remote.com', 'id2')])
+        self.assertEqual(len(self.server.pendingVerifies[('remote.com', 'id1')]),
+                         2)
+
+    def testVerifyAnswered(self):
+        """A valid answer should authorize the stream and be cached for it,
+        an invalid one shouldn't
+        """
+        good = FakeInConnection(self.server, 'id1')
+        bad = FakeInConnection(self.server, 'id2')
+        self.result(good, 'k1')
+        self.result(bad, 'k2')
+
+        self.answer('id1', 'valid')
+        self.answer('id2', 'invalid')
+        self.assertEqual(self.server.pendingVerifies, {})
+
+        valid = resultElement('localhost', 'remote.com', type='valid')
+        self.assertEqual(good.sent, [valid])
+        self.assertEqual(good.data['server']['verified'], ['remote.com'])
+        self.assertEqual(good.data['server']['hostname'], 'remote.com')
+        self.assert_(self.server.s2sConns['remote.com'][0] is good)
+        self.assertEqual(bad.sent, [resultElement('localhost', 'remote.com',
+                                                  type='invalid')])
+        self.assertEqual(bad.data['server']['verified'], [])
+
+        # the same key on the same stream is answered from the cache
+        self.assertEqual(self.result(good, 'k1'), [valid])
+        self.assertEqual(len(self.out.control), 2)
+        # but a new stream is verified again
+        other = FakeInConnection(self.server, 'id3')
+        self.assertEqual(self.result(other, 'k1'), [])
+        self.assertEqual(len(self.out.control), 3)
+
+    def testInboundVerified(self):
+        """Verified streams should record every domain verified on them"""
+        conn = FakeInConnection(self.server, 'id1')
+        self.server.inboundVerified(conn, 'remote.com')
+        self.server.inboundVerified(conn, 'other.com')
+        self.assertEqual(conn.data['server']['verified'],
+                         ['remote.com', 'other.com'])
+        self.assert_(self.server.s2sConns['other.com'][0] is conn)
+
+    def testNotLocal(self):
+        """Results for domains we don't serve should be rejected"""
+        conn = FakeInConnection(self.server, 'id1')
+        self.assertEqual(self.result(conn, 'k1', to='other.org'),
+                         [resultElement('other.org', 'remote.com',
+                                        type='invalid')])
+        self.assertEqual(self.out.control, [])
+
+    def testLinkClosed(self):
+        """Requests sent on a link that closed should be forgotten"""
+        conn = FakeInConnection(self.server, 'id1')
+        self.result(conn, 'k1')
+        self.server.dialbackLinkClosed('remote.com')
+        self.assertEqual(self.server.pendingVerifies, {})
+        self.answer('id1', 'valid')
+        self.assertEqual(conn.sent, [])
+
+    def testAuthoritative(self):
+        """Our own keys should be checked when a receiving server asks"""
+        key = makeKey('remote.com', 'localhost', 'sid')
+        for text, type in ((key, 'valid'), ('bad', 'invalid')):
+            msg = FakeMessage(self.out)
+            DialbackVerifyHandler().handle(makeDb('verify', 'remote.com',
+                                                  'localhost', text, id='sid'),
+                                           msg)
+            self.assertEqual(msg.output, [verifyElement('localhost',
+                                                        'remote.com', 'sid',
+                                                        type=type)])
+
+    def testOriginating(self):
+        """Our queued stanzas should go out once our key is accepted"""
+        queue = self.out.outQueue
+        queue.put(u"<message from='a@localhost' to='b@remote.com'/>")
+        msg = FakeMessage(self.out)
+        DialbackResultHandler().handle(makeDb('result', 'remote.com',
+                                              'localhost', type='valid'), msg)
+        self.assertEqual(self.out.sent,
+                         ["<message from='a@localhost' to='b@remote.com'/>"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+from pjs.lastpresence import LastPresenceStore, PresenceSnapshots
+from pjs.elementtree.ElementTree import Element, SubElement
+import unittest
+
+def makePresence(frm, type=None, show=None, to=None):
+    pres = Element('{jabber:client}presence', {'from' : frm})
+    if to:
+        pres.set('to', to)
+    if type:
+        pres.set('type', type)
+    if show:
+        SubElement(pres, '{jabber:client}show').text = show
+    return pres
+
+class TestLastPresenceStore(unittest.TestCase):
+    """Tests the store that answers presence probes"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.store = LastPresenceStore()
+        self.store.update('tro@localhost', 'home',
+                          makePresence('tro@localhost/home', show='away'))
+        self.store.update('tro@localhost', 'work',
+                          makePresence('tro@localhost/work'))
+
+    def testProbe(self):
+        """Probes should get the last presence of every resource"""
+        res = [p.render() for p in self.store.get('tro@localhost', 'dv@localhost/a')]
+        res.sort()
+        self.assertEqual(res, [
+            u"<presence from='tro@localhost/home' to='dv@localhost/a'><show>away</show></presence>",
+            u"<presence from='tro@localhost/work' to='dv@localhost/a'/>"])
+        self.assertEqual(self.store.get('bob@localhost', 'dv@localhost'), [])
+        self.assertEqual((self.store.probes, self.store.answered), (2, 1))
+
+    def testUpdate(self):
+        """Newer presences replace older ones and unavailable removes them"""
+        self.store.update('tro@localhost', 'home',
+                          makePresence('tro@localhost/home', show='dnd'))
+        self.store.update('tro@localhost', 'work',
+                          makePresence('tro@localhost/work', type='unavailable'))
+        res = self.store.get('tro@localhost', 'dv@localhost')
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0].render(),
+            u"<presence from='tro@localhost/home' to='dv@localhost'><show>dnd</show></presence>")
+
+    def testRemove(self):
+        """Removing the last resource should make the user unavailable"""
+        self.store.remove('tro@localhost', 'home')
+        self.assert_(self.store.isAvailable('tro@localhost'))
+        self.store.remove('tro@localhost', 'work')
+        self.failIf(self.store.isAvailable('tro@localhost'))
+        self.assertEqual(len(self.store), 0)
+        self.store.remove('tro@localhost', 'gone')
+
+class TestPresenceSnapshots(unittest.TestCase):
+    """Tests the snapshots of the contacts' presence"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.snapshots = PresenceSnapshots()
+        self.snapshots.create('dv@localhost', ['tro@localhost'])
+
+    def testUpdate(self):
+        """Broadcasts and probe answers should be recorded"""
+        self.snapshots.update('dv@localhost',
+                              makePresence('tro@localhost/home',
+                                           to='dv@localhost/a'))
+        self.snapshots.update('dv@localhost',
+                              makePresence('bob@localhost/x', show='dnd',
+                                           to='dv@localhost'))
+        res = [p.render() for p in self.snapshots.get('dv@localhost', 'dv@localhost/b')]
+        res.sort()
+        self.assertEqual(res, [
+            u"<presence from='bob@localhost/x' to='dv@localhost/b'><show>dnd</show></presence>",
+            u"<presence from='tro@localhost/home' to='dv@localhost/b'/>"])
+
+        self.snapshots.update('dv@localhost',
+                              makePresence('bob@localhost/x', type='unavailable',
+                                           to='dv@localhost'))
+        self.assertEqual(len(self.snapshots.get('dv@localhost', 'dv@localhost/b')), 1)
+
+    def testDirectedPresence(self):
+        """Directed presence from non-contacts shouldn't be recorded"""
+        self.snapshots.update('dv@localhost',
+                              makePresence('bob@localhost/x', to='dv@localhost/a'))
+        self.assertEqual(self.snapshots.get('dv@localhost', 'dv@localhost/b'), [])
+
+    def testSubscriptionChanges(self):
+        """Contacts should be followed or forgotten as the subscriptions
+        change
+        """
+        self.snapshots.setSubscription('dv@localhost', 'bob@localhost', True)
+        self.snapshots.update('dv@localhost',
+                              makePresence('bob@localhost/x', to='dv@localhost/a'))
+        self.snapshots.update('dv@localhost',
+                              makePresence('tro@localhost/home', to='dv@localhost/a'))
+        self.snapshots.update('dv@localhost',
+                              makePresence('tro@localhost/work', to='dv@localhost'))
+        self.assertEqual(len(self.snapshots.get('dv@localhost', 'dv@localhost/b')), 3)
+
+        self.snapshots.setSubscription('dv@localhost', 'tro@localhost', False)
+        res = [p.render() for p in self.snapshots.get('dv@localhost', 'dv@localhost/b')]
+        self.assertEqual(res, [u"<presence from='bob@localhost/x' to='dv@localhost/b'/>"])
+
+        # directed presence from an unsubscribed contact isn't recorded
+        self.snapshots.update('dv@localhost',
+                              makePresence('tro@localhost/home', to='dv@localhost/a'))
+        self.assertEqual(len(self.snapshots.get('dv@localhost', 'dv@localhost/b')), 1)
+
+        # users without snapshots are left alone
+        self.snapshots.setSubscription('tro@localhost', 'dv@localhost', True)
+        self.failIf(self.snapshots.has('tro@localhost'))
+
+    def testNoSnapshot(self):
+        """Users without snapshots are ignored"""
+        self.snapshots.update('tro@localhost',
+                              makePresence('dv@localhost/a', to='tro@localhost'))
+        self.failIf(self.snapshots.has('tro@localhost'))
+        self.snapshots.drop('dv@localhost')
+        self.failIf(self.snapshots.has('dv@localhost'))
+        self.assertEqual(len(self.snapshots), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import pjs.test.init # init the launcher
+import pjs.async.core as asyncore
+import pjs.conf.conf
+import pjs.handlers.message
+import pjs.queues
+from pjs.connection import toServerNS
+from pjs.elementtree.ElementTree import Element, SubElement
+from pjs.roster import Roster, Subscription
+
+import unittest
+import time
+
+class TestToServerNS(unittest.TestCase):
+    """Tests moving stanzas into the jabber:server namespace"""
+
+    def testNamespaces(self):
+        """Client and unqualified elements should move, others shouldn't"""
+        tree = Element('{jabber:client}message', {'to' : 'bob@localhost'})
+        body = SubElement(tree, '{jabber:client}body')
+        body.text = 'hi'
+        x = SubElement(tree, '{jabber:x:oob}x')
+        SubElement(x, 'url')
+
+        new = toServerNS(tree)
+        self.assert_(new is not tree)
+        self.assertEqual(new.tag, '{jabber:server}message')
+        self.assertEqual(new.get('to'), 'bob@localhost')
+        self.assertEqual(new[0].tag, '{jabber:server}body')
+        self.assertEqual(new[0].text, 'hi')
+        # the subtree in another namespace is shared
+        self.assert_(new[1] is x)
+        self.assertEqual(tree.tag, '{jabber:client}message')
+
+        new = toServerNS(Element('presence'))
+        self.assertEqual(new.tag, '{jabber:server}presence')
+
+class FakeClient:
+    """Client connection that records what it's sent"""
+    def __init__(self):
+        self.id = 'fakeclient%s' % id(self)
+        self.data = {}
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+class TestLocalDelivery(unittest.TestCase):
+    """Delivers stanzas to a local user through the real S2S phases"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.launcher = pjs.conf.conf.launcher
+        self.launcher.c2sport = 45222
+        self.launcher.s2sport = 45269
+        self.launcher.run()
+        self.s2s = self.launcher.getS2SServer()
+        self.local = self.s2s.localDelivery
+
+        self.client = FakeClient()
+        sessions = self.launcher.getC2SServer().sessions
+        sessions.authenticate(self.client, 'bob@localhost')
+        sessions.bind(self.client, 'bob@localhost', 'res')
+
+    def tearDown(self):
+        self.launcher.stop()
+        for server in self.launcher.servers:
+            server.threadpool.dismissWorkers(5)
+        del self.launcher.servers[:]
+        unittest.TestCase.tearDown(self)
+
+    def pump(self, done, timeout=5):
+        """Runs the main loop until done() is True"""
+        end = time.time() + timeout
+        while not done() and time.time() < end:
+            asyncore.poll(0.05)
+        # let the last Message release its connection
+        asyncore.poll(0.05)
+        return done()
+
+    def received(self, text):
+        return lambda: [out for out in self.client.sent if text in out]
+
+    def testMessage(self):
+        """A message from a local user should reach the online client"""
+        tree = Element('{jabber:client}message', {'from' : 'alice@localhost/x',
+                                                  'to' : 'bob@localhost'})
+        SubElement(tree, '{jabber:client}body').text = 'local hello'
+        self.local.deliver(tree)
+
+        self.assert_(self.pump(self.received('local hello')))
+        self.failIf(self.local.id in pjs.queues._runningMessages)
+        self.assertEqual(self.local.delivered, 1)
+
+    def testSubscription(self):
+        """A subscription request from a local user should be recorded and
+        reach the online client
+        """
+        roster = Roster('bob@localhost')
+        roster.removeContact('alice@localhost')
+        self.local.deliver(u"<presence from='alice@localhost' " +\
+                           u"to='bob@localhost' type='subscribe'/>")
+
+        self.assert_(self.pump(self.received("type='subscribe'")))
+        self.failIf(self.local.id in pjs.queues._runningMessages)
+        cinfo = Roster('bob@localhost').getContactInfo('alice@localhost')
+        self.assertEqual(cinfo.subscription, Subscription.NONE_PENDING_IN)
+        roster.removeContact('alice@localhost')
+
+    def testHandlerFailure(self):
+        """A failing handler shouldn't hold up the next stanzas"""
+        handler = pjs.handlers.message.S2SMessageHandler
+        original = handler.__dict__['handle']
+        def fail(self, tree, msg, lastRetVal=None):
+            raise Exception, 'failing as planned'
+        handler.handle = fail
+        try:
+            tree = Element('{jabber:client}message', {'from' : 'alice@localhost',
+                                                      'to' : 'bob@localhost'})
+            self.local.deliver(tree)
+            self.pump(lambda: self.local.delivered and
+                      self.local.id not in pjs.queues._runningMessages)
+        finally:
+            handler.handle = original
+
+        self.failIf(self.local.id in pjs.queues._runningMessages)
+        tree = Element('{jabber:client}message', {'from' : 'alice@localhost',
+                                                  'to' : 'bob@localhost'})
+        SubElement(tree, '{jabber:client}body').text = 'after failure'
+        self.local.deliver(tree)
+        self.assert_(self.pump(self.received('after failure')))
+
+if __name__ == '__main__':
+    unittest.main()
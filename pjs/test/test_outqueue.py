@@ -0,0 +1,200 @@
+import pjs.test.init # init the launcher
+import pjs.async.core as asyncore
+import pjs.conf.conf
+from pjs.outqueue import OutboundQueue, makeBounce
+from pjs.server import S2SServer
+from pjs.connection import ServerOutConnection
+
+import unittest
+import time
+
+class FakeConn:
+    def __init__(self):
+        self.sent = []
+    def send(self, data):
+        self.sent.append(data)
+
+class TestOutboundQueue(unittest.TestCase):
+    """Tests the per-domain S2S outbound queue"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.bounced = []
+        self.queue = OutboundQueue('example.com', maxSize=3, maxAge=60,
+                                   maxBytes=1000, bounce=self.bounce)
+        self.conn = FakeConn()
+
+    def bounce(self, stanzas, condition):
+        self.bounced.append((stanzas, condition))
+
+    def testBuffersUntilReady(self):
+        """Nothing should be sent before the queue is attached"""
+        self.queue.put(u'<a/>')
+        self.queue.put(u'<b/>')
+        self.assertEqual(self.conn.sent, [])
+        self.queue.attach(self.conn)
+        self.assertEqual(self.conn.sent, [u'<a/><b/>'])
+        self.assertEqual(len(self.queue), 0)
+
+    def testBatchesWhenReady(self):
+        """Stanzas queued in one pass should go out in one write"""
+        self.queue.attach(self.conn)
+        self.queue.put(u'<a/>')
+        self.queue.put(u'<b/>')
+        self.assertEqual(self.conn.sent, [])
+        asyncore.runTimers()
+        self.assertEqual(self.conn.sent, [u'<a/><b/>'])
+        self.assertEqual(self.queue.getStats()['writes'], 1)
+
+    def testMaxSize(self):
+        """The oldest stanzas should be dropped when the queue's full"""
+        for i in range(5):
+            self.queue.put(u'<%d/>' % i)
+        self.assertEqual(len(self.queue), 3)
+        self.queue.attach(self.conn)
+        self.assertEqual(self.conn.sent, [u'<2/><3/><4/>'])
+        self.assertEqual(self.queue.getStats()['dropped'], 2)
+
+    def testMaxAge(self):
+        """Stale stanzas should be dropped"""
+        self.queue.put(u'<old/>')
+        self.queue.items[0] = (time.time() - 120, u'<old/>')
+        self.queue.put(u'<new/>')
+        self.queue.attach(self.conn)
+        self.assertEqual(self.conn.sent, [u'<new/>'])
+        self.assertEqual(self.queue.getStats()['expired'], 1)
+
+    def testDetach(self):
+        """Detached queues should keep the stanzas for the next connection"""
+        self.queue.attach(self.conn)
+        self.queue.detach(self.conn)
+        self.queue.put(u'<a/>')
+        asyncore.runTimers()
+        self.assertEqual(self.conn.sent, [])
+        self.assertEqual(self.queue.getStats()['depth'], 1)
+
+    def testMaxBytes(self):
+        """The oldest stanzas should be dropped when they take up too many
+        bytes
+        """
+        queue = OutboundQueue('example.com', maxSize=100, maxAge=60,
+                              maxBytes=10, bounce=self.bounce)
+        queue.put(u'<aaaa/>')
+        queue.put(u'<\xe9\xe9/>')
+        # non-ASCII counts in bytes
+        self.assertEqual(queue.getStats()['size'], 7)
+        self.assertEqual(self.bounced, [(['<aaaa/>'], 'resource-constraint')])
+        queue.attach(self.conn)
+        self.assertEqual(self.conn.sent, [u'<\xe9\xe9/>'.encode('utf-8')])
+
+    def testBounce(self):
+        """Dropped stanzas should be bounced with the right condition"""
+        for i in range(4):
+            self.queue.put(u'<%d/>' % i)
+        self.queue.items[0] = (time.time() - 120, '<1/>')
+        self.queue.expire()
+        self.assertEqual(self.queue.clear('remote-server-timeout'), 2)
+        self.assertEqual(self.bounced,
+                         [(['<0/>'], 'resource-constraint'),
+                          (['<1/>'], 'remote-server-timeout'),
+                          (['<2/>', '<3/>'], 'remote-server-timeout')])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.getStats()['size'], 0)
+
+class TestMakeBounce(unittest.TestCase):
+    """Tests the errors returned for stanzas that couldn't be delivered"""
+
+    def testMessage(self):
+        """Messages should go back to the sender with the condition"""
+        error = makeBounce("<message from='tro@localhost/res' " +\
+                           "to='bob@remote.com' id='m1'><body>hi</body>" +\
+                           "</message>", 'remote-server-not-found')
+        self.assertEqual((error.tag, error.get('type'), error.get('to'),
+                          error.get('from'), error.get('id')),
+                         ('message', 'error', 'tro@localhost/res',
+                          'bob@remote.com', 'm1'))
+        self.assertEqual(error[0].text, 'hi')
+        self.assertEqual(error[1].get('type'), 'cancel')
+        self.assertEqual(error[1][0].tag,
+            '{urn:ietf:params:xml:ns:xmpp-stanzas}remote-server-not-found')
+
+        error = makeBounce("<iq xmlns='jabber:server' type='get' " +\
+                           "from='tro@localhost/res' to='remote.com'/>",
+                           'remote-server-timeout')
+        self.assertEqual(error.tag, '{jabber:server}iq')
+        self.assertEqual(error[0].get('type'), 'wait')
+
+    def testNotBounced(self):
+        """Errors, results, presence and broken data shouldn't be bounced"""
+        for data in ("<message from='a@localhost' type='error'/>",
+                     "<iq from='a@localhost' type='result'/>",
+                     "<presence from='a@localhost'/>",
+                     "<message to='b@remote.com'/>",
+                     "<message"):
+            self.assertEqual(makeBounce(data, 'remote-server-timeout'), None)
+
+class TestServerQueues(unittest.TestCase):
+    """Tests the queues of the S2S server"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = S2SServer('127.0.0.1', 0, pjs.conf.conf.launcher)
+        self.stanza = u"<message from='tro@localhost/res' to='bob@%s'/>"
+
+    def tearDown(self):
+        if self.server._pruneTimer is not None:
+            self.server._pruneTimer.cancel()
+        self.server.close()
+        unittest.TestCase.tearDown(self)
+
+    def bounced(self):
+        return [(error.get('from'), error[0][0].tag.split('}')[1])
+                for error in self.server.localDelivery.pending]
+
+    def testPrune(self):
+        """Stale stanzas in detached queues should be bounced and the empty
+        queues removed
+        """
+        server = self.server
+        queue = server.getOutQueue('remote.com')
+        queue.put(self.stanza % 'remote.com')
+        queue.items[0] = (time.time() - 300, queue.items[0][1])
+        server.getOutQueue('other.com').put(self.stanza % 'other.com')
+        # being connected
+        busy = server.getOutQueue('busy.com')
+        busy.items.append((time.time() - 300, self.stanza % 'busy.com'))
+        server.s2sConns['busy.com'] = [None, object()]
+
+        server.pruneQueues()
+        self.assertEqual(sorted(server.outQueues.keys()),
+                         ['busy.com', 'other.com'])
+        self.assertEqual(self.bounced(),
+                         [('bob@remote.com', 'remote-server-timeout')])
+        self.failIf(server._pruneTimer is None)
+
+    def testConnectFailed(self):
+        """Stanzas should be bounced when the domain can't be reached"""
+        server = self.server
+        for domain, resolved, condition in (
+                        ('nowhere.com', False, 'remote-server-not-found'),
+                        ('down.com', True, 'remote-server-timeout')):
+            queue = server.getOutQueue(domain)
+            queue.put(self.stanza % domain)
+            conn = ServerOutConnection(None, None, server)
+            conn.outQueue = queue
+            conn.data['server']['hostname'] = domain
+            server.s2sConns[domain] = [None, conn]
+            conn.resolved = resolved
+            conn._connectNext()
+
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(server.s2sConns[domain][1], None)
+            self.assertEqual(self.bounced()[-1], ('bob@' + domain, condition))
+
+        # the queues are removed once they're idle
+        server.pruneQueues()
+        self.assertEqual(server.outQueues, {})
+        self.assertEqual(server._pruneTimer, None)
+
+if __name__ == '__main__':
+    unittest.main()
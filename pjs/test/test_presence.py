@@ -0,0 +1,176 @@
+import pjs.test.init # handlers need the launcher
+import pjs.async.core as asyncore
+import pjs.queues
+import pjs.rostercache
+import pjs.threadpool
+from pjs.test.test_roster import RosterTestCase
+from pjs.roster import Roster, Subscription
+from pjs.rostercache import RosterCache
+from pjs.subscriptions import SubscriptionGraph
+from pjs.sessions import SessionIndex
+from pjs.lastpresence import LastPresenceStore, PresenceSnapshots
+from pjs.coalesce import PresenceCoalescer
+from pjs.handlers.presence import C2SPresenceHandler, C2SPresenceLoadHandler
+from pjs.events import C2SStanzaDispatcher
+from pjs.elementtree.ElementTree import Element, SubElement
+import pjs.subscriptions
+import time
+import unittest
+
+class FakeLocalDelivery:
+    """Records what's delivered in-process"""
+    def __init__(self, sent):
+        self.id = 'localdelivery'
+        self.sent = sent
+
+    def deliver(self, data):
+        for item in data:
+            self.sent.append(unicode(item))
+
+class FakeS2SServer:
+    """Records what's sent to other servers"""
+    def __init__(self):
+        self.sent = []
+        self.localDelivery = FakeLocalDelivery(self.sent)
+
+    def isLocalDomain(self, domain):
+        return domain == 'localhost'
+
+    def sendTo(self, domain, data):
+        self.sent.append(unicode(data))
+
+class FakeServer:
+    """Stands in for the launcher and the C2S server"""
+    def __init__(self, threadpool):
+        self.threadpool = threadpool
+        self.sessions = SessionIndex()
+        self.data = {'resources' : self.sessions.bare}
+        self.lastPresences = LastPresenceStore()
+        self.contactPresences = PresenceSnapshots()
+        self.presenceCoalescer = PresenceCoalescer()
+        self.launcher = self
+        self.s2s = FakeS2SServer()
+
+    def getC2SServer(self):
+        return self
+
+    def getS2SServer(self):
+        return self.s2s
+
+class FakeClient:
+    """Client connection that records what it's sent"""
+    watch_function = asyncore.wf
+
+    def __init__(self, server, jid, resource):
+        self.id = 'fakeclient%s' % id(self)
+        self.server = server
+        self.data = {'user' : {'jid' : jid, 'resource' : resource,
+                               'active' : False, 'requestedRoster' : True},
+                     'stream' : {'closing' : False}}
+        self.sent = []
+        server.sessions.authenticate(self, jid)
+        server.sessions.bind(self, jid, resource)
+
+    def send(self, data):
+        self.sent.append(data)
+
+class FakeMessage:
+    def __init__(self, conn):
+        self.conn = conn
+        self.nextHandlers = []
+
+    def setNextHandler(self, name):
+        self.nextHandlers.append(name)
+
+def makePresence(show=None):
+    tree = Element('{jabber:client}presence')
+    if show:
+        SubElement(tree, '{jabber:client}show').text = show
+    return tree
+
+class TestPresenceLoad(RosterTestCase):
+    """Tests the presences that are sent while the subscriptions are loaded
+    from the DB
+    """
+
+    def setUp(self):
+        RosterTestCase.setUp(self)
+        roster = Roster('tro@localhost')
+        roster.updateContact('dv@localhost', subscriptionId=Subscription.BOTH)
+        roster.updateContact('alice@remote', subscriptionId=Subscription.BOTH)
+        pjs.rostercache._cache = RosterCache()
+        pjs.subscriptions._graph = SubscriptionGraph()
+
+        self.tpool = pjs.threadpool.ThreadPool(1)
+        self.server = FakeServer(self.tpool)
+        self.home = FakeClient(self.server, 'tro@localhost', 'home')
+        self.work = FakeClient(self.server, 'tro@localhost', 'work')
+
+    def tearDown(self):
+        self.tpool.dismissWorkers(1)
+        RosterTestCase.tearDown(self)
+
+    def probes(self, batch):
+        return [to for client, to, data, func in batch.entries
+                if "type='probe'" in unicode(data)]
+
+    def testBroadcastInMainLoop(self):
+        """The loading thread shouldn't change any state, so that a
+        presence from another resource in the meantime is seen and the
+        contacts are probed once
+        """
+        msg = FakeMessage(self.home)
+        tree = makePresence()
+        C2SPresenceHandler().handle(tree, msg)
+        self.assertEqual(msg.nextHandlers, ['c2s-presence-load'])
+
+        handler = C2SPresenceLoadHandler()
+        checkFunc, initFunc = handler.handle(tree, msg)
+        initFunc.func(**initFunc.funcArgs)
+        end = time.time() + 5
+        while not checkFunc.func(**checkFunc.funcArgs):
+            self.assert_(time.time() < end)
+            time.sleep(0.01)
+        self.failIf(self.home.data['user']['active'])
+        self.failIf(self.server.contactPresences.has('tro@localhost'))
+
+        # the other resource comes online before the first one's resumed
+        # and finds the subscriptions cached
+        workMsg = FakeMessage(self.work)
+        out = C2SPresenceHandler().handle(makePresence(), workMsg)
+        self.assertEqual(workMsg.nextHandlers, ['route-batch'])
+        self.assertEqual(self.probes(out[-1]), ['alice@remote'])
+
+        out = handler.resume()
+        self.assertEqual(msg.nextHandlers[-1], 'route-batch')
+        self.assertEqual(self.probes(out[-1]), [])
+        self.assert_(self.home.data['user']['active'])
+
+    def testQueuedBehindLoad(self):
+        """A presence sent while the first one loads the subscriptions
+        should be broadcast after it
+        """
+        for tree in (makePresence(), makePresence('away')):
+            wrapper = Element('wrapper')
+            wrapper.append(tree)
+            C2SStanzaDispatcher().dispatch(wrapper, self.home)
+        # the second waits for the first one's subscriptions to load
+        self.assertEqual([connId for connId, msg in pjs.queues._processingQ],
+                         [self.home.id])
+
+        end = time.time() + 5
+        while self.home.id in pjs.queues._runningMessages:
+            self.assert_(time.time() < end)
+            asyncore.poll(0.01)
+
+        sent = self.server.s2s.sent
+        toDV = [data for data in sent if "to='dv@localhost'" in data and
+                "type='probe'" not in data]
+        self.assertEqual(len(toDV), 2)
+        self.failIf('<show>' in toDV[0])
+        self.assert_('<show>away</show>' in toDV[1])
+        self.assertEqual(len([data for data in sent
+                              if "type='probe'" in data]), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+from pjs.auth_mechanisms import digestResponse
+from pjs.handlers.auth import SASLAuthHandler, SASLResponseHandler
+from pjs.procpool import ProcessRequest, ProcessError, execute, runInline
+import pjs.conf.handlers
+import pjs.procpool
+import os
+import threading
+import unittest
+
+def fail(message):
+    raise ValueError, message
+
+def failUnpicklable():
+    raise ValueError, threading.Lock()
+
+class TestEnvelopes(unittest.TestCase):
+    def testExecute(self):
+        """Responses should carry the result or the exception"""
+        response = execute(ProcessRequest(divmod, (7, 2)))
+        self.assertEqual(response.get(), (3, 1))
+        response = execute(ProcessRequest(fail, ('bad',)))
+        self.assertRaises(ValueError, response.get)
+        response = execute(ProcessRequest(failUnpicklable))
+        self.assertRaises(ProcessError, response.get)
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        pjs.procpool.startPool(1)
+
+    def tearDown(self):
+        pjs.procpool.stopPool()
+
+    def testApply(self):
+        """Calls should run in another process and raise its exceptions"""
+        pool = pjs.procpool.getPool()
+        self.assertNotEqual(pool.apply(os.getpid), os.getpid())
+        self.assertRaises(ValueError, pool.apply, fail, 'bad')
+        args = ('user', 'localhost', 'test', 'abc', 'def', '00000001',
+                'xmpp/localhost')
+        self.assertEqual(pool.apply(digestResponse, *args),
+                         digestResponse(*args))
+
+    def testMap(self):
+        """Calls should run in parallel and return in order"""
+        pool = pjs.procpool.getPool()
+        self.assertEqual(pool.map(divmod, [(7, 2), (9, 4), (1, 1)]),
+                         [(3, 1), (2, 1), (1, 0)])
+        self.assertRaises(ValueError, pool.map, fail, [('ok',), ('bad',)])
+
+    def testRouting(self):
+        """Only the CPU-bound handlers in processPoolHandlers should use the
+        pool
+        """
+        pool = pjs.procpool.getPool()
+        handlers = pjs.conf.handlers.processPoolHandlers
+        self.assertEqual(handlers, [])
+        self.assertEqual(pjs.procpool.getExecutor(SASLResponseHandler()),
+                         runInline)
+
+        pjs.conf.handlers.processPoolHandlers = [SASLResponseHandler,
+                                                 SASLAuthHandler]
+        try:
+            self.assertEqual(pjs.procpool.getExecutor(SASLResponseHandler()),
+                             pool.apply)
+            # not CPU-bound
+            self.assertEqual(pjs.procpool.getExecutor(SASLAuthHandler()),
+                             runInline)
+
+            pjs.procpool.stopPool()
+            self.assertEqual(pjs.procpool.getExecutor(SASLResponseHandler()),
+                             runInline)
+        finally:
+            pjs.conf.handlers.processPoolHandlers = handlers
+
+if __name__ == '__main__':
+    unittest.main()
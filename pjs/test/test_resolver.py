@@ -0,0 +1,242 @@
+import pjs.test.init # init the launcher
+import pjs.async.core as asyncore
+import pjs.conf.conf
+import pjs.resolver as resolver
+from pjs.server import S2SServer
+import unittest
+import random
+import socket
+import struct
+import time
+
+def makeResponse(query, answers, rcode=0, authority=()):
+    """Builds a response to query with the answers, which are
+    (type, ttl, rdata) tuples for the queried name. authority is the same
+    for the authority section.
+    """
+    header = struct.pack('!HHHHHH', struct.unpack('!H', query[:2])[0],
+                         0x8180 | rcode, 1, len(answers), len(authority), 0)
+    out = header + query[12:]
+    for rtype, ttl, rdata in list(answers) + list(authority):
+        # compressed pointer to the name in the question
+        out += '\xc0\x0c' + struct.pack('!HHIH', rtype, 1, ttl, len(rdata)) + rdata
+    return out
+
+def makeSOA(minimum):
+    return resolver.encodeName('ns.example.com') + \
+           resolver.encodeName('admin.example.com') + \
+           struct.pack('!IIIII', 1, 7200, 900, 1209600, minimum)
+
+class TestWireFormat(unittest.TestCase):
+    """Tests the DNS message encoding and decoding"""
+
+    def testSRV(self):
+        """SRV and A records should be decoded"""
+        query = resolver.makeQuery(7, '_xmpp-server._tcp.example.com',
+                                   resolver.TYPE_SRV)
+        srv = struct.pack('!HHH', 10, 5, 5270) + resolver.encodeName('xmpp.example.com')
+        data = makeResponse(query, [(resolver.TYPE_SRV, 600, srv),
+                                    (resolver.TYPE_A, 60, '\x01\x02\x03\x04')])
+        qid, rcode, records = resolver.parseResponse(data)
+        self.assertEqual(qid, 7)
+        self.assertEqual(rcode, 0)
+        self.assertEqual(records[0], ('_xmpp-server._tcp.example.com',
+                                      resolver.TYPE_SRV, 600,
+                                      (10, 5, 5270, 'xmpp.example.com')))
+        self.assertEqual(records[1][3], '1.2.3.4')
+
+    def testOrderSRV(self):
+        """SRV records should be ordered by priority first"""
+        ordered = resolver.orderSRV([(20, 0, 1, 'c'), (10, 5, 1, 'a'),
+                                     (10, 0, 1, 'b')])
+        self.assertEqual([r[3] for r in ordered[:2]].count('c'), 0)
+        self.assertEqual(ordered[-1][3], 'c')
+
+    def testOrderSRVZeroWeight(self):
+        """Records with weight 0 should only be picked first when the
+        random number is 0
+        """
+        randint = random.randint
+        random.randint = lambda a, b: 0
+        try:
+            ordered = resolver.orderSRV([(10, 5, 1, 'a'), (10, 0, 1, 'z')])
+        finally:
+            random.randint = randint
+        self.assertEqual([r[3] for r in ordered], ['z', 'a'])
+
+    def testSOA(self):
+        """The SOA minimum in the authority section should be read"""
+        query = resolver.makeQuery(7, 'nowhere.example.com', resolver.TYPE_A)
+        data = makeResponse(query, [], resolver.RCODE_NXDOMAIN,
+                            [(resolver.TYPE_SOA, 3600, makeSOA(600)),
+                             (resolver.TYPE_A, 60, '\x01\x02\x03\x04')])
+        qid, rcode, records = resolver.parseResponse(data)
+        self.assertEqual(rcode, resolver.RCODE_NXDOMAIN)
+        self.assertEqual(records, [('nowhere.example.com', resolver.TYPE_SOA,
+                                    3600, 600)])
+
+class TestResolverCache(unittest.TestCase):
+    """Tests the positive and negative caching of the resolver"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.resolver = resolver.Resolver(['127.0.0.1'], {})
+        self.results = []
+
+    def testPositive(self):
+        """Answers should be cached for at least MIN_TTL"""
+        key = ('example.com', resolver.TYPE_A)
+        records = [('example.com', resolver.TYPE_A, 1, '1.2.3.4')]
+        self.assertEqual(self.resolver._store(key, 0, records), ['1.2.3.4'])
+        self.resolver.lookup('example.com', resolver.TYPE_A, self.results.append)
+        self.assertEqual(self.results, [['1.2.3.4']])
+        self.assert_(self.resolver.cache[key][0] >= time.time() + resolver.MIN_TTL - 1)
+
+    def testCNAME(self):
+        """CNAMEs in the answer should be followed"""
+        key = ('www.example.com', resolver.TYPE_A)
+        records = [('www.example.com', resolver.TYPE_CNAME, 300, 'example.com'),
+                   ('example.com', resolver.TYPE_A, 300, '1.2.3.4')]
+        self.assertEqual(self.resolver._store(key, 0, records), ['1.2.3.4'])
+
+    def testNegative(self):
+        """NXDOMAIN should be cached, timeouts shouldn't"""
+        key = ('nowhere.example.com', resolver.TYPE_A)
+        self.assertEqual(self.resolver._store(key, resolver.RCODE_NXDOMAIN, []), [])
+        self.resolver.lookup('nowhere.example.com', resolver.TYPE_A, self.results.append)
+        self.assertEqual(self.results, [[]])
+        self.assertEqual(self.resolver.stats['negativeHits'], 1)
+
+        key = ('slow.example.com', resolver.TYPE_A)
+        self.resolver._store(key, None, [])
+        self.failIf(key in self.resolver.cache)
+
+    def testNegativeTTL(self):
+        """Negative answers should be cached for the SOA minimum, but no
+        longer than the SOA's TTL and within the bounds
+        """
+        for ttl, minimum, expected in ((3600, 600, 600),
+                                       (120, 600, 120),
+                                       (3600, 1, resolver.MIN_NEGATIVE_TTL),
+                                       (86400, 86400, resolver.MAX_NEGATIVE_TTL)):
+            key = ('nowhere%d.example.com' % minimum, resolver.TYPE_A)
+            soa = (key[0], resolver.TYPE_SOA, ttl, minimum)
+            self.resolver._store(key, resolver.RCODE_NXDOMAIN, [soa])
+            expires = self.resolver.cache[key][0] - time.time()
+            self.assert_(expected - 1 <= expires <= expected, (ttl, minimum))
+
+        # without an SOA
+        key = ('nosoa.example.com', resolver.TYPE_A)
+        self.resolver._store(key, resolver.RCODE_OK, [])
+        expires = self.resolver.cache[key][0] - time.time()
+        self.assert_(resolver.NEGATIVE_TTL - 1 <= expires <= resolver.NEGATIVE_TTL)
+
+    def testHosts(self):
+        """IPs and names in the hosts file shouldn't be looked up"""
+        self.resolver.hosts['myhost'] = '10.0.0.1'
+        self.resolver.resolveServer('myhost', self.results.append)
+        self.resolver.resolveHost('10.0.0.2', self.results.append)
+        self.assertEqual(self.results, [[('10.0.0.1', 5269)], ['10.0.0.2']])
+        self.assertEqual(self.resolver.stats['queries'], 0)
+
+class TestConnect(unittest.TestCase):
+    """Tests how outgoing S2S connections go through the addresses of the
+    remote server
+    """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = S2SServer('127.0.0.1', 0, pjs.conf.conf.launcher)
+        self.sockets = []
+        self.timeouts = pjs.conf.conf.s2sConnectTimeouts.copy()
+        # errors for the local senders
+        self.bounced = []
+        self.server.localDelivery.deliver = self.bounced.extend
+
+    def tearDown(self):
+        pjs.conf.conf.s2sConnectTimeouts = self.timeouts
+        for conns in self.server.s2sConns.values():
+            if conns[1] is not None:
+                conns[1].handle_close()
+        if self.server._pruneTimer is not None:
+            self.server._pruneTimer.cancel()
+        self.server.close()
+        for sock in self.sockets:
+            sock.close()
+        unittest.TestCase.tearDown(self)
+
+    def listen(self):
+        """Returns the address of a socket that accepts connections"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        self.sockets.append(sock)
+        return sock.getsockname()
+
+    def closedPort(self):
+        """Returns an address that refuses connections"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        addr = sock.getsockname()
+        sock.close()
+        return addr
+
+    def waitFor(self, cond):
+        end = time.time() + 5
+        while not cond():
+            self.assert_(time.time() < end)
+            asyncore.poll(0.01)
+
+    def testRefused(self):
+        """A refused connection should be followed by the next address"""
+        listening = self.listen()
+        conn = self.server.connectTo('remote.com',
+                                     addrs=[self.closedPort(), listening])
+        self.waitFor(lambda: conn.connected)
+        self.assertEqual(conn.addr, listening)
+        self.assertEqual(conn.connectTimer, None)
+
+        sock = self.sockets[0].accept()[0]
+        self.sockets.append(sock)
+        sock.settimeout(5)
+        self.assert_('<stream:stream' in sock.recv(4096))
+
+    def testTimeout(self):
+        """The next address should be tried when a connection doesn't get
+        established in time
+        """
+        pjs.conf.conf.s2sConnectTimeouts['slow.com'] = 0
+        first, second = self.listen(), self.listen()
+        conn = self.server.connectTo('slow.com', addrs=[first, second])
+        self.assertEqual(conn.addr, first)
+        firstTimer = conn.connectTimer
+
+        # the timer runs before the socket's seen as connected
+        asyncore.runTimers()
+        self.assert_(firstTimer.cancelled or conn.connectTimer is not firstTimer)
+        self.assertEqual(conn.addr, second)
+        self.failIf(conn.connected)
+        self.assertEqual(conn.targets, [])
+
+        # nothing left to try after the second times out as well
+        asyncore.runTimers()
+        self.assertEqual(self.server.s2sConns['slow.com'][1], None)
+        self.assertEqual(conn.socket, None)
+
+    def testAllRefused(self):
+        """The queued stanzas should be bounced when no address accepts
+        the connection
+        """
+        stanza = u"<message from='tro@localhost/res' to='bob@down.com'/>"
+        conn = self.server.connectTo('down.com', [stanza],
+                                     [self.closedPort(), self.closedPort()])
+        self.waitFor(lambda: self.server.s2sConns['down.com'][1] is None)
+        self.failIf(conn.connected)
+        self.assertEqual(conn.socket, None)
+        self.assertEqual(len(self.server.getOutQueue('down.com')), 0)
+        self.assertEqual([error[0][0].tag.split('}')[1] for error in self.bounced],
+                         ['remote-server-timeout'])
+        self.failIf(conn.id in self.server.conns)
+
+if __name__ == '__main__':
+    unittest.main()
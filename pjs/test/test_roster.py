@@ -0,0 +1,385 @@
+import pjs.test.init # handlers need the launcher
+import pjs.db
+import pjs.rostercache
+import pjs.storage.base
+import pjs.subscriptions
+import pjs.threadpool
+import pjs.conf.conf
+from pjs.db import closePool
+from pjs.schema import migrate
+from pjs.roster import Roster, Subscription
+from pjs.rostercache import RosterCache
+from pjs.subscriptions import SubscriptionGraph
+from pjs.storage.base import setStorage
+from pjs.storage.sqlitestore import SQLiteStorage
+from pjs.handlers.iq import IQRosterGetHandler, IQRosterUpdateHandler, \
+                            RosterPushHandler
+from pjs.handlers.presence import C2SSubscriptionHandler, \
+                                 S2SSubscriptionHandler
+from pjs.lastpresence import PresenceSnapshots
+from pjs.elementtree.ElementTree import Element, SubElement, XML
+import os
+import tempfile
+import time
+import unittest
+
+class RosterTestCase(unittest.TestCase):
+    """Runs each test on a new SQLite DB with empty caches"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        os.remove(self.name)
+        self.oldName = pjs.db.dbname
+        migrate(self.name)
+        self.oldStorage = pjs.storage.base._storage
+        self.oldCache = pjs.rostercache._cache
+        self.oldGraph = pjs.subscriptions._graph
+        self.storage = SQLiteStorage()
+        setStorage(self.storage)
+        pjs.rostercache._cache = RosterCache()
+        pjs.subscriptions._graph = SubscriptionGraph()
+
+        self.storage.addUser('tro@localhost', 'test')
+        self.storage.addUser('dv@localhost', 'test')
+
+    def tearDown(self):
+        setStorage(self.oldStorage)
+        pjs.rostercache._cache = self.oldCache
+        pjs.subscriptions._graph = self.oldGraph
+        closePool(self.name)
+        pjs.db.dbname = self.oldName
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.name + suffix):
+                os.remove(self.name + suffix)
+        unittest.TestCase.tearDown(self)
+
+class TestVersions(RosterTestCase):
+    """Tests the roster versions and the log of changes"""
+
+    def testGetChanges(self):
+        """Only the latest change of every contact should be returned"""
+        roster = Roster('tro@localhost')
+        self.assertEqual(roster.getChanges('0'), [])
+
+        roster.updateContact('a@remote')
+        roster.updateContact('b@remote')
+        roster.updateContact('a@remote', name='A')
+        roster.removeContact('b@remote')
+        roster.updateContact('c@remote')
+
+        changes = Roster('tro@localhost').getChanges('1')
+        self.assertEqual([(v, cjid) for v, cjid, item in changes],
+                         [(3, 'a@remote'), (4, 'b@remote'), (5, 'c@remote')])
+        self.assertEqual(changes[0][2].name, 'A')
+        # removed contacts come without a RosterItem
+        self.assertEqual(changes[1][2], None)
+
+        self.assertEqual(roster.getChanges('5'), [])
+        self.assertEqual(roster.getChanges('6'), None)
+        self.assertEqual(roster.getChanges('-1'), None)
+        self.assertEqual(roster.getChanges('abc'), None)
+        # the full roster is sent when there are limit changes or more
+        self.assertEqual(roster.getChanges('1', 3), None)
+        self.assertEqual(len(roster.getChanges('1', 4)), 3)
+
+    def testChangesNotLoaded(self):
+        """Reading the changes of an uncached roster shouldn't load it"""
+        roster = Roster('tro@localhost')
+        for i in range(5):
+            roster.updateContact('c%d@remote' % i)
+        roster.updateContact('p@remote',
+                             subscriptionId=Subscription.NONE_PENDING_IN)
+        pjs.rostercache._cache = RosterCache()
+
+        changes = Roster('tro@localhost').getChanges('4')
+        self.assertEqual([(cjid, item and item.jid)
+                          for v, cjid, item in changes],
+                         [('c4@remote', 'c4@remote'), ('p@remote', None)])
+        self.assertEqual(pjs.rostercache._cache.getItems('tro@localhost'),
+                         None)
+
+    def testLogTrimming(self):
+        """The log should keep only the last rosterVersionLogSize changes"""
+        logSize = pjs.conf.conf.rosterVersionLogSize
+        pjs.conf.conf.rosterVersionLogSize = 3
+        try:
+            roster = Roster('tro@localhost')
+            for i in range(6):
+                roster.updateContact('c%d@remote' % i)
+        finally:
+            pjs.conf.conf.rosterVersionLogSize = logSize
+
+        uid = self.storage.getUserId('tro@localhost')
+        con = self.storage._connect()
+        c = con.cursor()
+        c.execute("SELECT version FROM rosterchanges\
+                   WHERE userid = ? ORDER BY version", (uid,))
+        self.assertEqual([row[0] for row in c], [4, 5, 6])
+        c.close()
+        con.close()
+        self.assertEqual(roster.getVersion(), 6)
+        # the change from 3 to 4 is still known, but not the one before
+        self.assertEqual(len(roster.getChanges('3')), 3)
+        self.assertEqual(roster.getChanges('2'), None)
+
+class TestTransitions(RosterTestCase):
+    """Tests the subscription state changes of RFC 3921 section 9"""
+
+    def setState(self, state):
+        """Puts dv in tro's roster in the subscription state"""
+        uid = self.storage.getUserId('tro@localhost')
+        self.storage.updateContact(uid, 'dv@localhost', 'DV', ['g'], state)
+        pjs.rostercache._cache = RosterCache()
+
+    def testTable(self):
+        """Every state should change as the table says and the other states
+        shouldn't change
+        """
+        states = Subscription.state2primaryName.keys()
+        for (direction, type), transition in Subscription.transitions.items():
+            for old in states:
+                self.setState(old)
+                roster = Roster('tro@localhost')
+                version = roster.getVersion()
+                item, oldSub = roster.applyTransition('dv@localhost',
+                                                      direction, type)
+                new = transition.get(old, old)
+                where = (direction, type, old)
+                self.assertEqual(oldSub, old, where)
+                self.assertEqual(item.subscription, new, where)
+                self.assertEqual(item.name, 'DV', where)
+                self.assertEqual(item.groups, ['g'], where)
+                stored = Roster('tro@localhost').getContactInfo('dv@localhost')
+                self.assertEqual(stored.subscription, new, where)
+                if new == old:
+                    self.assertEqual(roster.version, None, where)
+                    self.assertEqual(roster.getVersion(), version, where)
+                else:
+                    self.assertEqual(roster.version, version + 1, where)
+
+    def testUnsubscribePendingOut(self):
+        """Unsubscribing from From + Pending Out should leave From
+        (RFC 3921 section 9.2)
+        """
+        self.setState(Subscription.FROM_PENDING_OUT)
+        item, old = Roster('tro@localhost').applyTransition('dv@localhost',
+                                                            'out',
+                                                            'unsubscribe')
+        self.assertEqual(item.subscription, Subscription.FROM)
+
+    def testCreate(self):
+        """Contacts should only be added when asked to"""
+        roster = Roster('tro@localhost')
+        self.assertEqual(roster.applyTransition('new@remote', 'in',
+                                                'subscribe'), (None, None))
+        item, old = roster.applyTransition('new@remote', 'in', 'subscribe',
+                                           True)
+        self.assertEqual((item.subscription, old),
+                         (Subscription.NONE_PENDING_IN, Subscription.NONE))
+
+    def testUpdateContact(self):
+        """Updating a contact should change only this user's roster and keep
+        the subscription when it's not given
+        """
+        tro = Roster('tro@localhost')
+        dv = Roster('dv@localhost')
+        tro.updateContact('c@remote', ['a'], 'C', Subscription.TO)
+        dv.updateContact('c@remote', ['b'], 'Other', Subscription.FROM)
+
+        tro.updateContact('c@remote', ['x'], 'New')
+        pjs.rostercache._cache = RosterCache()
+
+        item = Roster('tro@localhost').getContactInfo('c@remote')
+        self.assertEqual((item.name, item.subscription, item.groups),
+                         ('New', Subscription.TO, ['x']))
+        item = Roster('dv@localhost').getContactInfo('c@remote')
+        self.assertEqual((item.name, item.subscription, item.groups),
+                         ('Other', Subscription.FROM, ['b']))
+
+class FakeServer:
+    """Stands in for both the launcher and the C2S server"""
+    def __init__(self, threadpool):
+        self.threadpool = threadpool
+        self.data = {'resources' : {}}
+        self.launcher = self
+        self.contactPresences = PresenceSnapshots()
+
+    def getC2SServer(self):
+        return self
+
+class FakeConnection:
+    def __init__(self, server, jid, resource):
+        self.server = server
+        self.data = {'user' : {'jid' : jid, 'resource' : resource,
+                               'requestedRoster' : True}}
+        self.sent = []
+        server.data['resources'].setdefault(jid, {})[resource] = self
+
+    def send(self, data):
+        self.sent.append(data)
+
+class FakeMessage:
+    def __init__(self, conn):
+        self.conn = conn
+        self.nextHandlers = []
+
+    def setNextHandler(self, name):
+        self.nextHandlers.append(name)
+
+class TestRosterHandlers(RosterTestCase):
+    """Tests the roster versions in the replies to roster gets and in the
+    roster pushes
+    """
+
+    def setUp(self):
+        RosterTestCase.setUp(self)
+        self.tpool = pjs.threadpool.ThreadPool(1)
+        server = FakeServer(self.tpool)
+        self.conn = FakeConnection(server, 'tro@localhost', 'res')
+        self.msg = FakeMessage(self.conn)
+
+        roster = Roster('tro@localhost')
+        for i in range(4):
+            roster.updateContact('c%d@remote' % i)
+
+    def tearDown(self):
+        self.tpool.dismissWorkers(1)
+        RosterTestCase.tearDown(self)
+
+    def runHandler(self, handler, tree, lastRetVal=None):
+        """Runs the ThreadedHandler and returns its output"""
+        checkFunc, initFunc = handler.handle(tree, self.msg, lastRetVal)
+        initFunc.func(**initFunc.funcArgs)
+        end = time.time() + 5
+        while not checkFunc.func(**checkFunc.funcArgs):
+            self.assert_(time.time() < end)
+            time.sleep(0.01)
+        return handler.resume()
+
+    def getRoster(self, ver):
+        iq = Element('{jabber:client}iq', {'type' : 'get', 'id' : 'r1'})
+        SubElement(iq, '{jabber:iq:roster}query', {'ver' : ver})
+        return self.runHandler(IQRosterGetHandler(), iq)
+
+    def testUpToDate(self):
+        """Clients with the current version should get an empty result"""
+        out = self.getRoster('4')
+        self.assertEqual(len(out), 1)
+        self.assertEqual(out[0].get('type'), 'result')
+        self.assertEqual(len(out[0]), 0)
+
+    def testDeltas(self):
+        """Clients with a recent version should get the changes as pushes"""
+        out = self.getRoster('2')
+        self.assertEqual(out[0].get('type'), 'result')
+        self.assertEqual(len(out[0]), 0)
+        self.assertEqual([(p[0].get('ver'), p[0][0].get('jid'))
+                          for p in out[1:]],
+                         [('3', 'c2@remote'), ('4', 'c3@remote')])
+
+    def testStreamedDeltas(self):
+        """Clients of big rosters with a recent version should get the
+        changes without the roster being loaded
+        """
+        threshold = pjs.conf.conf.rosterStreamThreshold
+        pjs.conf.conf.rosterStreamThreshold = 2
+        try:
+            pjs.rostercache._cache = RosterCache()
+            out = self.getRoster('3')
+        finally:
+            pjs.conf.conf.rosterStreamThreshold = threshold
+        self.assertEqual([p[0][0].get('jid') for p in out[1:]],
+                         ['c3@remote'])
+        self.assertEqual(pjs.rostercache._cache.getItems('tro@localhost'),
+                         None)
+
+    def testFull(self):
+        """Clients with an unknown version should get the whole roster"""
+        for ver in ('', '0', '99'):
+            out = self.getRoster(ver)
+            self.assertEqual(len(out), 1)
+            query = out[0][0]
+            self.assertEqual(query.get('ver'), '4')
+            self.assertEqual(len(query), 4)
+
+    def testPushVersion(self):
+        """Pushes should carry the version of their change, not the version
+        at the time they're sent
+        """
+        iq = Element('{jabber:client}iq', {'type' : 'set', 'id' : 'u1'})
+        query = SubElement(iq, '{jabber:iq:roster}query')
+        SubElement(query, '{jabber:iq:roster}item', {'jid' : 'new@remote'})
+        out = self.runHandler(IQRosterUpdateHandler(), iq)
+        self.assertEqual(self.msg.nextHandlers, ['roster-push'])
+        self.assertEqual(out[-1].get('ver'), '5')
+
+        # another change before the push is sent
+        Roster('tro@localhost').updateContact('other@remote')
+
+        self.runHandler(RosterPushHandler(), iq, out)
+        push = XML(self.conn.sent[0])
+        self.assertEqual(push[0].get('ver'), '5')
+        self.assertEqual(push[0][0].get('jid'), 'new@remote')
+
+    def testRemoveVersion(self):
+        """Pushes for removed contacts should carry the version too"""
+        iq = Element('{jabber:client}iq', {'type' : 'set', 'id' : 'u1'})
+        query = SubElement(iq, '{jabber:iq:roster}query', {'ver' : '1'})
+        SubElement(query, '{jabber:iq:roster}item', {'jid' : 'c0@remote',
+                                                     'subscription' : 'remove'})
+        # the presences for the contact come after the <query>
+        out = self.runHandler(IQRosterUpdateHandler(), iq)
+        self.assertEqual(out[-2].get('ver'), '5')
+
+        # the contact is already gone
+        out = self.runHandler(IQRosterUpdateHandler(), iq)
+        self.assertEqual(out[-2].get('ver'), None)
+
+    def testUnsubscribedPendingOut(self):
+        """Refusing a contact's request while ours is pending should push
+        the pending ask
+        """
+        self.setState(Subscription.NONE_PENDING_IN_OUT)
+        tree = Element('{jabber:client}presence', {'to' : 'dv@localhost',
+                                                   'type' : 'unsubscribed'})
+        out = self.runHandler(C2SSubscriptionHandler(), tree)
+        self.assertEqual(self.msg.nextHandlers, ['route-server', 'roster-push'])
+        item = out[-1][0]
+        self.assertEqual(item.get('subscription'), 'none')
+        self.assertEqual(item.get('ask'), 'subscribe')
+
+    def testSnapshot(self):
+        """Subscription changes should update the snapshot of the contacts'
+        presence
+        """
+        snapshots = self.conn.server.contactPresences
+        snapshots.create('tro@localhost', [])
+        presence = Element('presence', {'from' : 'dv@localhost/x',
+                                        'to' : 'tro@localhost/res'})
+
+        # dv approves our request
+        self.setState(Subscription.NONE_PENDING_OUT)
+        tree = Element('{jabber:server}presence', {'from' : 'dv@localhost',
+                                                   'to' : 'tro@localhost',
+                                                   'type' : 'subscribed'})
+        self.runHandler(S2SSubscriptionHandler(), tree)
+        snapshots.update('tro@localhost', presence)
+        self.assertEqual(len(snapshots.get('tro@localhost', 'tro@localhost/b')),
+                         1)
+
+        # and we unsubscribe
+        tree = Element('{jabber:client}presence', {'to' : 'dv@localhost',
+                                                   'type' : 'unsubscribe'})
+        self.runHandler(C2SSubscriptionHandler(), tree)
+        self.assertEqual(snapshots.get('tro@localhost', 'tro@localhost/b'), [])
+
+    def setState(self, state):
+        """Puts dv in tro's roster in the subscription state"""
+        uid = self.storage.getUserId('tro@localhost')
+        self.storage.updateContact(uid, 'dv@localhost', '', [], state)
+        pjs.rostercache._cache = RosterCache()
+
+if __name__ == '__main__':
+    unittest.main()
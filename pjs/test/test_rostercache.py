@@ -0,0 +1,140 @@
+from pjs.rostercache import RosterCache
+import unittest
+
+class FakeItem:
+    """Stands in for pjs.roster.RosterItem, which needs the DB to import"""
+    def __init__(self, jid, subscription=0):
+        self.jid = jid
+        self.subscription = subscription
+
+def items(*jids):
+    return dict([(i + 1, FakeItem(jid)) for i, jid in enumerate(jids)])
+
+class TestRosterCache(unittest.TestCase):
+    """Tests the LRU cache of rosters"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.cache = RosterCache(maxUsers=3, maxContacts=5)
+
+    def load(self, jid, uid, items):
+        stamp = self.cache.beginLoad(jid)
+        return self.cache.setItems(jid, uid, items, stamp)
+
+    def testLookups(self):
+        """Cached rosters should be found by contact JID and id"""
+        self.assertEqual(self.cache.getItems('tro@localhost'), None)
+        self.assert_(self.load('tro@localhost', 1,
+                               items('dv@localhost', 'bob@localhost')))
+        self.assertEqual(self.cache.getUid('tro@localhost'), 1)
+        self.assertEqual(self.cache.getItem('tro@localhost', 'bob@localhost').jid,
+                         'bob@localhost')
+        self.assertEqual(self.cache.getItem('tro@localhost', 'nobody@localhost'),
+                         False)
+        self.assertEqual(self.cache.getItemById('tro@localhost', 1).jid,
+                         'dv@localhost')
+        self.assertEqual(self.cache.getItemById('tro@localhost', 99), False)
+        self.assertEqual(self.cache.getItem('dv@localhost', 'tro@localhost'), None)
+
+        # only the uid is known
+        self.cache.setUid('dv@localhost', 2)
+        self.assertEqual(self.cache.getUid('dv@localhost'), 2)
+        self.assertEqual(self.cache.getItems('dv@localhost'), None)
+
+    def testWriteThrough(self):
+        """Updates and removals should change the cached roster"""
+        self.load('tro@localhost', 1, items('dv@localhost', 'bob@localhost'))
+        self.cache.updateItem('tro@localhost', 3, FakeItem('new@localhost'))
+        self.cache.updateItem('tro@localhost', 1, FakeItem('dv@localhost', 8))
+        self.cache.removeItem('tro@localhost', 2)
+
+        cached = self.cache.getItems('tro@localhost')
+        self.assertEqual(sorted(cached.keys()), [1, 3])
+        self.assertEqual(cached[1].subscription, 8)
+        self.assertEqual(self.cache.getItem('tro@localhost', 'bob@localhost'),
+                         False)
+        self.assertEqual(self.cache.contacts, 2)
+
+        # the returned dict is a copy
+        del cached[1]
+        self.assertEqual(len(self.cache.getItems('tro@localhost')), 2)
+
+    def testLRU(self):
+        """The least recently used rosters should be dropped first"""
+        self.load('a@localhost', 1, items('x@localhost'))
+        self.load('b@localhost', 2, items('x@localhost'))
+        self.load('c@localhost', 3, items('x@localhost'))
+        self.cache.getItems('a@localhost')
+        self.load('d@localhost', 4, items('x@localhost'))
+        self.assertEqual(sorted(self.cache.users.keys()),
+                         ['a@localhost', 'c@localhost', 'd@localhost'])
+
+        # too many contacts
+        self.load('e@localhost', 5, items('x@localhost', 'y@localhost',
+                                          'z@localhost', 'w@localhost'))
+        self.assertEqual(sorted(self.cache.users.keys()),
+                         ['d@localhost', 'e@localhost'])
+        self.assertEqual(self.cache.contacts, 5)
+        self.assertEqual(self.cache.evictions, 3)
+
+        # the newest roster is kept even if it's too big by itself
+        self.load('f@localhost', 6, items('1', '2', '3', '4', '5', '6'))
+        self.assertEqual(self.cache.users.keys(), ['f@localhost'])
+
+    def testPushesTrim(self):
+        """New contacts pushed into cached rosters should count towards the
+        limit
+        """
+        self.load('a@localhost', 1, items('x@localhost', 'y@localhost'))
+        self.load('b@localhost', 2, items('x@localhost', 'y@localhost'))
+        self.cache.updateItem('b@localhost', 3, FakeItem('z@localhost'))
+        self.assertEqual(sorted(self.cache.users.keys()),
+                         ['a@localhost', 'b@localhost'])
+
+        self.cache.updateItem('b@localhost', 4, FakeItem('w@localhost'))
+        self.assertEqual(self.cache.users.keys(), ['b@localhost'])
+        self.assertEqual(self.cache.contacts, 4)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def testVersion(self):
+        """Cached roster versions should only go up"""
+        self.cache.setVersion('tro@localhost', 3)
+        self.assertEqual(self.cache.getVersion('tro@localhost'), None)
+
+        self.cache.setUid('tro@localhost', 1)
+        self.cache.setVersion('tro@localhost', 3)
+        self.cache.setVersion('tro@localhost', 2)
+        self.assertEqual(self.cache.getVersion('tro@localhost'), 3)
+
+        self.cache.invalidate('tro@localhost')
+        self.assertEqual(self.cache.getVersion('tro@localhost'), None)
+
+    def testRacingLoad(self):
+        """Loads that raced with a change shouldn't be cached"""
+        stamp = self.cache.beginLoad('tro@localhost')
+        self.cache.updateItem('tro@localhost', 1, FakeItem('dv@localhost'))
+        self.failIf(self.cache.setItems('tro@localhost', 1, {}, stamp))
+        self.assertEqual(self.cache.getItems('tro@localhost'), None)
+
+        self.assert_(self.load('tro@localhost', 1, items('dv@localhost')))
+
+    def testEvict(self):
+        """Evicted and invalidated rosters should be dropped"""
+        self.load('tro@localhost', 1, items('dv@localhost'))
+        self.load('dv@localhost', 2, items('tro@localhost'))
+        self.cache.evict('tro@localhost')
+        self.cache.evict('nobody@localhost')
+        self.cache.invalidate('dv@localhost')
+        self.assertEqual(len(self.cache), 0)
+
+        stats = self.cache.getStats()
+        self.assertEqual(stats['contacts'], 0)
+        self.assertEqual(stats['evictions'], 1)
+
+        self.cache.getItems('tro@localhost')
+        self.load('tro@localhost', 1, items('dv@localhost'))
+        self.cache.getItems('tro@localhost')
+        self.assertEqual(self.cache.getStats()['hitRate'], 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import threading
+import time
+import unittest
+
+import pjs.conf.conf
+
+from pjs.rosterstream import RosterStream, STREAM_ERROR
+from pjs.elementtree.ElementTree import Element, SubElement, XML
+
+class FakeItem:
+    """Stands in for pjs.roster.RosterItem, which needs the DB to import"""
+    def __init__(self, jid):
+        self.jid = jid
+
+    def getAsTree(self):
+        return Element('item', {'jid' : self.jid, 'subscription' : 'both'})
+
+class FakeConnection:
+    """Collects the output like pjs.connection.Connection, without a socket"""
+    def __init__(self):
+        self.addr = ('test', 0)
+        self.data = {'stream' : {'closing' : False}}
+        self.connected = True
+        self.out_buffer = ''
+        self.held = None
+        self.sent = []
+        self.closed = False
+
+    def send(self, data):
+        if self.held is not None:
+            self.held.append(data)
+        else:
+            self.sendThrough(data)
+
+    def sendThrough(self, data):
+        self.out_buffer += data
+
+    def hold(self):
+        self.held = []
+
+    def release(self):
+        held = self.held
+        self.held = None
+        self.out_buffer += ''.join(held)
+
+    def drain(self):
+        self.sent.append(self.out_buffer)
+        self.out_buffer = ''
+
+    def handle_close(self):
+        self.closed = True
+
+def makeResult():
+    iq = Element('iq', {'type' : 'result', 'id' : 'r1'})
+    SubElement(iq, '{jabber:iq:roster}query', {'ver' : '3'})
+    return iq
+
+def makeItems(count, failAt=None):
+    """Yields count FakeItems, raising an exception after failAt of them"""
+    for i in range(count):
+        if i == failAt:
+            raise Exception, 'failing as planned'
+        yield FakeItem('c%d@localhost' % i)
+
+class Producer(threading.Thread):
+    """Runs produce() in its own thread, like the threadpool does"""
+    def __init__(self, stream, items):
+        threading.Thread.__init__(self)
+        self.stream = stream
+        self.items = items
+        self.result = None
+        self.setDaemon(True)
+        self.start()
+
+    def run(self):
+        self.result = self.stream.produce(self.items)
+
+class TestRosterStream(unittest.TestCase):
+    """Tests the chunked writing of roster results"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.old = (pjs.conf.conf.rosterStreamChunkSize,
+                    pjs.conf.conf.rosterStreamBufferSize,
+                    pjs.conf.conf.rosterStreamQueueSize,
+                    pjs.conf.conf.rosterStreamTimeout)
+        pjs.conf.conf.rosterStreamChunkSize = 10
+        pjs.conf.conf.rosterStreamBufferSize = 500
+        pjs.conf.conf.rosterStreamQueueSize = 2
+        self.conn = FakeConnection()
+
+    def tearDown(self):
+        (pjs.conf.conf.rosterStreamChunkSize,
+         pjs.conf.conf.rosterStreamBufferSize,
+         pjs.conf.conf.rosterStreamQueueSize,
+         pjs.conf.conf.rosterStreamTimeout) = self.old
+        unittest.TestCase.tearDown(self)
+
+    def waitFor(self, done):
+        end = time.time() + 5
+        while not done():
+            self.assert_(time.time() < end)
+            time.sleep(0.01)
+
+    def testStream(self):
+        """The whole roster should be written with backpressure and the
+        other output held back until it's done
+        """
+        stream = RosterStream(self.conn, makeResult())
+        producer = Producer(stream, makeItems(95))
+
+        maxBuffered = 0
+        maxQueued = 0
+        end = time.time() + 5
+        while not stream.pump():
+            self.assert_(time.time() < end)
+            maxQueued = max(maxQueued, len(stream.pending))
+            # other stanzas sent meanwhile
+            self.conn.send('<presence/>')
+            maxBuffered = max(maxBuffered, len(self.conn.out_buffer))
+            self.conn.drain()
+            time.sleep(0.001)
+        self.conn.drain()
+        producer.join(5)
+        self.assertEqual(producer.result, True)
+
+        # one chunk over the limit at most
+        self.assert_(maxBuffered < 500 + 1000)
+        self.assert_(maxQueued <= 2)
+        self.assertEqual((stream.items, stream.chunks), (95, 10))
+
+        # what was sent before the first chunk went out before it
+        out = ''.join(self.conn.sent)
+        before, out = out.split('<iq', 1)
+        self.assertEqual(before.replace('<presence/>', ''), '')
+        result, presences = out.split('</iq>', 1)
+        result = '<iq' + result
+        self.failIf('<presence/>' in result)
+        self.assert_(presences.startswith('<presence/>'))
+
+        iq = XML(result + '</iq>')
+        query = iq[0]
+        self.assertEqual(query.tag, '{jabber:iq:roster}query')
+        self.assertEqual(query.get('ver'), '3')
+        self.assertEqual(len(query), 95)
+        self.assertEqual(query[94].get('jid'), 'c94@localhost')
+
+    def testBounded(self):
+        """The thread shouldn't get more than the queue size ahead of the
+        client
+        """
+        stream = RosterStream(self.conn, makeResult())
+        producer = Producer(stream, makeItems(1000))
+        self.waitFor(lambda: len(stream.pending) == 2)
+        time.sleep(0.05)
+        self.assertEqual((len(stream.pending), stream.items), (2, 20))
+        self.assert_(producer.isAlive())
+
+        # the client reads some, so the thread reads the next items
+        self.failIf(stream.pump())
+        self.waitFor(lambda: stream.items > 20)
+        self.assertEqual(self.conn.held, [])
+
+        stream.cancel()
+        producer.join(5)
+        self.failIf(producer.isAlive())
+        self.assertEqual(producer.result, True)
+
+    def testEmpty(self):
+        """An empty roster should still be a complete result"""
+        stream = RosterStream(self.conn, makeResult())
+        self.assert_(stream.produce([]))
+        self.assert_(stream.pump())
+        iq = XML(self.conn.out_buffer)
+        self.assertEqual(len(iq[0]), 0)
+
+    def testNotReady(self):
+        """Nothing should be written before the first chunk is read"""
+        stream = RosterStream(self.conn, makeResult())
+        self.failIf(stream.pump())
+        self.assertEqual(self.conn.out_buffer, '')
+        self.assertEqual(self.conn.held, None)
+
+    def testReadError(self):
+        """A roster that fails to be read before anything was written
+        shouldn't be written at all
+        """
+        stream = RosterStream(self.conn, makeResult())
+        self.failIf(stream.produce(makeItems(50, 15)))
+        self.assert_(stream.pump())
+        self.assertEqual(self.conn.out_buffer, '')
+        self.assertEqual(self.conn.held, None)
+        self.failIf(self.conn.closed)
+
+    def testReadErrorLater(self):
+        """A roster that fails to be read after a part of it was written
+        should end the stream with an error
+        """
+        stream = RosterStream(self.conn, makeResult())
+        producer = Producer(stream, makeItems(100, 50))
+        self.waitFor(lambda: stream.pump() or self.conn.drain())
+        producer.join(5)
+        # pump() answers, so the handler doesn't
+        self.assertEqual(producer.result, True)
+
+        out = ''.join(self.conn.sent) + self.conn.out_buffer
+        self.assert_(out.endswith(STREAM_ERROR))
+        self.failIf('</iq>' in out)
+        self.assert_(self.conn.closed)
+        self.assertEqual(self.conn.held, None)
+
+    def testClosed(self):
+        """Closing the connection should abandon the stream and stop the
+        thread
+        """
+        stream = RosterStream(self.conn, makeResult())
+        producer = Producer(stream, makeItems(1000))
+        self.waitFor(lambda: stream.pending)
+        self.failIf(stream.pump())
+        self.conn.data['stream']['closing'] = True
+        self.assert_(stream.pump())
+        self.assert_(stream.cancelled)
+        producer.join(5)
+        self.failIf(producer.isAlive())
+        self.assertEqual(len(stream.pending), 0)
+
+    def testStalled(self):
+        """Clients that don't read should be disconnected"""
+        pjs.conf.conf.rosterStreamTimeout = 0.05
+        stream = RosterStream(self.conn, makeResult())
+        producer = Producer(stream, makeItems(1000))
+        self.waitFor(lambda: len(stream.pending) == 2)
+        self.failIf(stream.pump())
+        self.waitFor(lambda: len(stream.pending) == 2)
+        # the client reads a bit
+        self.conn.out_buffer = self.conn.out_buffer[100:]
+        time.sleep(0.03)
+        self.failIf(stream.pump())
+        time.sleep(0.03)
+        self.failIf(stream.pump())
+        self.failIf(stream.stalled)
+        # and then stops reading
+        time.sleep(0.1)
+        self.assert_(stream.pump())
+        self.assert_(stream.stalled)
+        self.assert_(self.conn.closed)
+        producer.join(5)
+        self.failIf(producer.isAlive())
+
+if __name__ == '__main__':
+    unittest.main()
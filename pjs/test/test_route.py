@@ -0,0 +1,138 @@
+from pjs.handlers.route import RouteBatch, BatchRouteHandler, deliverBatch
+from pjs.sessions import SessionIndex
+from pjs.elementtree.ElementTree import Element
+import unittest
+
+class FakeConn:
+    """Client connection that records its writes"""
+    def __init__(self, id):
+        self.id = id
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+class FakeLocalDelivery:
+    """Records what's delivered in-process"""
+    def __init__(self):
+        self.id = 'localdelivery'
+        self.delivered = []
+
+    def deliver(self, data):
+        self.delivered.append(data)
+
+class FakeS2SServer:
+    def __init__(self):
+        self.localDelivery = FakeLocalDelivery()
+        self.sent = []
+
+    def isLocalDomain(self, domain):
+        return domain == 'localhost'
+
+    def sendTo(self, domain, data):
+        self.sent.append((domain, data))
+
+class FakeC2SServer:
+    def __init__(self):
+        self.sessions = SessionIndex()
+
+class FakeLauncher:
+    def __init__(self):
+        self.c2s = FakeC2SServer()
+        self.s2s = FakeS2SServer()
+
+    def getC2SServer(self):
+        return self.c2s
+
+    def getS2SServer(self):
+        return self.s2s
+
+class FakeServer:
+    def __init__(self, launcher):
+        self.launcher = launcher
+
+class FakeMessage:
+    def __init__(self, launcher):
+        self.conn = FakeConn('sender')
+        self.conn.server = FakeServer(launcher)
+
+class TestBatchRoute(unittest.TestCase):
+    """Tests that the batched stanzas are grouped by the connection or
+    domain they go out to
+    """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.launcher = FakeLauncher()
+        sessions = self.launcher.c2s.sessions
+        self.home = FakeConn(1)
+        self.work = FakeConn(2)
+        self.alice = FakeConn(3)
+        for conn, jid, resource in ((self.home, 'tro@localhost', 'home'),
+                                    (self.work, 'tro@localhost', 'work'),
+                                    (self.alice, 'alice@localhost', 'res')):
+            sessions.authenticate(conn, jid)
+            sessions.bind(conn, jid, resource)
+
+    def testClients(self):
+        """Each client connection should get one write with its stanzas in
+        order
+        """
+        batch = RouteBatch()
+        batch.addClient('tro@localhost', u'<a/>')
+        batch.addClient('alice@localhost/res', u'<b/>')
+        batch.addClient('tro@localhost/work', u'<c/>')
+        batch.addClient('tro@localhost',
+                        Element('presence', {'to' : 'tro@localhost'}),
+                        lambda data, conn: u'<d%s/>' % conn.id)
+        batch.addClient('nobody@localhost', u'<e/>')
+        deliverBatch(batch, self.launcher)
+
+        self.assertEqual(self.home.sent, [u'<a/><d1/>'])
+        self.assertEqual(self.work.sent, [u'<a/><c/><d2/>'])
+        self.assertEqual(self.alice.sent, [u'<b/>'])
+
+    def testServers(self):
+        """Each remote domain should get one batch and the local domains one
+        in-process delivery
+        """
+        batch = RouteBatch()
+        batch.addServer('bob@remote.com', u'<a/>')
+        batch.addServer('dv@other.org/x', u'<b/>')
+        batch.addServer('carol@remote.com', u'<c/>')
+        local = Element('message', {'to' : 'tro@localhost'})
+        batch.addServer(None, local)
+        batch.addServer('alice@localhost', [u'<d/>', u'<e/>'])
+        deliverBatch(batch, self.launcher)
+
+        self.assertEqual(self.launcher.s2s.sent,
+                         [('remote.com', u'<a/><c/>'), ('other.org', u'<b/>')])
+        self.assertEqual(self.launcher.s2s.localDelivery.delivered,
+                         [[local, u'<d/>', u'<e/>']])
+
+    def testSkipped(self):
+        """Entries without data or an address should be skipped"""
+        batch = RouteBatch()
+        batch.addClient('tro@localhost/home', None)
+        batch.addClient(None, u'<a/>')
+        batch.addServer(None, Element('message'))
+        batch.addClient('tro@localhost/home', u'<b/>')
+        self.assertEqual(len(batch), 4)
+        deliverBatch(batch, self.launcher)
+
+        self.assertEqual(self.home.sent, [u'<b/>'])
+        self.assertEqual(self.launcher.s2s.sent, [])
+
+    def testHandler(self):
+        """The handler should take the batch off lastRetVal"""
+        batch = RouteBatch()
+        batch.addClient('alice@localhost', u'<a/>')
+        msg = FakeMessage(self.launcher)
+        self.assertEqual(BatchRouteHandler().handle(None, msg, ['x', batch]),
+                         ['x'])
+        self.assertEqual(self.alice.sent, [u'<a/>'])
+
+        self.assertEqual(BatchRouteHandler().handle(None, msg, ['x']), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+from pjs.db import DB, closePool
+from pjs.schema import migrate, getVersion, getLatestVersion
+import os
+import tempfile
+import unittest
+
+class TestMigrate(unittest.TestCase):
+    """Tests the versioned schema migrations"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        os.remove(self.name)
+
+    def tearDown(self):
+        closePool(self.name)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.name + suffix):
+                os.remove(self.name + suffix)
+
+    def getIndexes(self):
+        con = DB(self.name)
+        c = con.execute("SELECT name FROM sqlite_master WHERE type = 'index'\
+                         AND name NOT LIKE 'sqlite_%'")
+        indexes = set([row[0] for row in c])
+        con.close()
+        return indexes
+
+    def testNewDB(self):
+        """A new DB should get all migrations and WAL mode"""
+        self.assertEqual(migrate(self.name), getLatestVersion())
+        self.assert_('roster_userid_subscription' in self.getIndexes())
+        self.assert_('rostergroupitems_contactid' in self.getIndexes())
+        con = DB(self.name)
+        self.assertEqual(getVersion(con), getLatestVersion())
+        self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        con.close()
+
+        # nothing left to do
+        self.assertEqual(migrate(self.name), getLatestVersion())
+
+    def testStepwise(self):
+        """Migrations should stop at the target and resume from there"""
+        self.assertEqual(migrate(self.name, 1), 1)
+        self.assertEqual(self.getIndexes(), set())
+        self.assertEqual(migrate(self.name), getLatestVersion())
+        self.assert_('roster_contactid' in self.getIndexes())
+
+    def testUnversionedDB(self):
+        """DBs created before the schema was versioned should be upgraded"""
+        con = DB(self.name)
+        con.execute("CREATE TABLE jids (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                        jid TEXT NOT NULL,\
+                                        password TEXT NOT NULL,\
+                                        UNIQUE(jid))")
+        con.execute("INSERT INTO jids (jid, password) VALUES ('tro@localhost', 'test')")
+        con.commit()
+        con.close()
+
+        self.assertEqual(migrate(self.name), getLatestVersion())
+        con = DB(self.name)
+        self.assertEqual(con.execute("SELECT jid FROM jids").fetchone()[0],
+                         'tro@localhost')
+        con.close()
+
+    def testCoveringIndex(self):
+        """The subscriptions of a user's contacts should come from the index"""
+        migrate(self.name)
+        con = DB(self.name)
+        plan = ' '.join([str(row[-1]) for row in
+                         con.execute("EXPLAIN QUERY PLAN\
+                                      SELECT contactid, subscription FROM roster\
+                                      WHERE userid = ? AND subscription != ?",
+                                     (1, 0))])
+        con.close()
+        self.assert_('COVERING INDEX roster_userid_subscription' in plan, plan)
+
+if __name__ == '__main__':
+    unittest.main()
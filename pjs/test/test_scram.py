@@ -0,0 +1,211 @@
+from pjs.auth_mechanisms import SASLScram, SASLAuthError
+from pjs.storage.base import getStorage, setStorage
+import pjs.storage.base
+from pjs.storage.memorystore import MemoryStorage
+import pjs.conf.conf
+import pjs.scram
+import pjs.procpool
+import base64
+import binascii
+import hashlib
+import hmac
+import unittest
+
+class FakeServer:
+    def __init__(self):
+        self.hostname = 'localhost'
+        self.conns = {}
+        self.sessions = self
+        self.authenticated = []
+
+    def authenticate(self, conn, jid):
+        self.authenticated.append(jid)
+
+class FakeConn:
+    def __init__(self):
+        self.id = 1
+        self.server = FakeServer()
+        self.parser = self
+        self.data = {'sasl' : {}, 'user' : {}}
+
+    def resetParser(self):
+        pass
+
+class FakeMessage:
+    def __init__(self):
+        self.conn = FakeConn()
+
+class TestScram(unittest.TestCase):
+    """Tests the SCRAM keys and mechanisms with the examples of RFC 5802
+    and RFC 7677
+    """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.oldStorage = pjs.storage.base._storage
+        setStorage(MemoryStorage('', 0))
+        getStorage().addUser('user@localhost', 'pencil')
+
+    def tearDown(self):
+        setStorage(self.oldStorage)
+
+    def setKeys(self, mechanism, salt):
+        """Stores the keys of the examples"""
+        salt = base64.b64decode(salt)
+        hash = pjs.scram.HASHES[mechanism]
+        salted = pjs.scram.saltPassword(mechanism, 'pencil', salt, 4096)
+        storedKey = hash(hmac.new(salted, 'Client Key', hash).digest()).digest()
+        serverKey = hmac.new(salted, 'Server Key', hash).digest()
+        getStorage().setScramKeys('user@localhost', {
+                            mechanism : (salt, 4096, storedKey, serverKey)})
+
+    def exchange(self, mechanism, serverNonce, clientFirst, clientFinal):
+        """Runs the exchange and returns (server-first, server-final)"""
+        msg = FakeMessage()
+        scram = SASLScram(msg, mechanism)
+        scram._makeNonce = lambda: serverNonce
+        serverFirst = scram.handle(base64.b64encode(clientFirst))
+        self.assertEqual(serverFirst.tag, 'challenge')
+        success = scram.handle(base64.b64encode(clientFinal))
+        self.assertEqual(success.tag, 'success')
+        self.assertEqual(msg.conn.server.authenticated, ['user@localhost'])
+        return (base64.b64decode(serverFirst.text),
+                base64.b64decode(success.text))
+
+    def testSaltedPassword(self):
+        """PBKDF2 should match RFC 5802"""
+        salted = pjs.scram.saltPassword('SCRAM-SHA-1', 'pencil',
+                                        base64.b64decode('QSXCR+Q6sek8bf92'),
+                                        4096)
+        self.assertEqual(binascii.b2a_hex(salted),
+                         '1d96ee3a529b5a5f9e47c01f229a2cb8a6e15f7d')
+        self.assertEqual(pjs.scram._pbkdf2('SCRAM-SHA-1', 'pencil',
+                                           base64.b64decode('QSXCR+Q6sek8bf92'),
+                                           4096), salted)
+
+    def testSHA1(self):
+        """The SCRAM-SHA-1 example of RFC 5802 should succeed"""
+        self.setKeys('SCRAM-SHA-1', 'QSXCR+Q6sek8bf92')
+        serverFirst, serverFinal = self.exchange('SCRAM-SHA-1',
+                '3rfcNHYJY1ZVvWVs7j',
+                'n,,n=user,r=fyko+d2lbbFgONRv9qkxdawL',
+                'c=biws,r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,' \
+                'p=v0X8v3Bz2T0CJGbJQyF0X+HI4Ts=')
+        self.assertEqual(serverFirst, 'r=fyko+d2lbbFgONRv9qkxdawL3rfc' \
+                                      'NHYJY1ZVvWVs7j,s=QSXCR+Q6sek8bf92,i=4096')
+        self.assertEqual(serverFinal, 'v=rmF9pqV8S7suAoZWja4dJRkFsKQ=')
+
+    def testSHA256(self):
+        """The SCRAM-SHA-256 example of RFC 7677 should succeed"""
+        self.setKeys('SCRAM-SHA-256', 'W22ZaJ0SNY7soEsUEjb6gQ==')
+        serverFirst, serverFinal = self.exchange('SCRAM-SHA-256',
+                '%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0',
+                'n,,n=user,r=rOprNGfwEbeRWgbNEkqO',
+                'c=biws,r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,' \
+                'p=dHzbZapWIk4jUhN+Ute9ytag9zjfMHgsqmmiz7AndVQ=')
+        self.assertEqual(serverFinal,
+                         'v=6rriTRBi23WpRR/wtup+mMhUZUn/dB5nLTJRsjl95G4=')
+
+    def testWrongProof(self):
+        """A wrong proof should fail"""
+        self.setKeys('SCRAM-SHA-1', 'QSXCR+Q6sek8bf92')
+        scram = SASLScram(FakeMessage(), 'SCRAM-SHA-1')
+        scram._makeNonce = lambda: '3rfcNHYJY1ZVvWVs7j'
+        scram.handle(base64.b64encode('n,,n=user,r=fyko+d2lbbFgONRv9qkxdawL'))
+        self.assertRaises(SASLAuthError, scram.handle, base64.b64encode(
+                'c=biws,r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,' \
+                'p=AAX8v3Bz2T0CJGbJQyF0X+HI4Ts='))
+        self.assertEqual(scram.state, SASLScram.INIT)
+
+        # and so should channel binding
+        self.assertRaises(SASLAuthError, scram.handle,
+                          base64.b64encode('p=tls-unique,,n=user,r=abc'))
+
+    def testUnknownUser(self):
+        """Unknown users should get a stable challenge like real users and
+        fail with the proof
+        """
+        def serverFirst(mechanism, username):
+            scram = SASLScram(FakeMessage(), mechanism)
+            scram._makeNonce = lambda: 'servernonce'
+            res = scram.handle(base64.b64encode('n,,n=%s,r=abc' % username))
+            self.assertEqual(res.tag, 'challenge')
+            return scram, dict([attr.split('=', 1) for attr in
+                                base64.b64decode(res.text).split(',')])
+
+        scram, attrs = serverFirst('SCRAM-SHA-1', 'bob')
+        self.assertEqual(attrs['r'], 'abcservernonce')
+        self.assertEqual(len(base64.b64decode(attrs['s'])),
+                         pjs.scram.SALT_SIZE)
+        self.assertEqual(int(attrs['i']), pjs.conf.conf.scramIterations)
+        self.assertEqual(serverFirst('SCRAM-SHA-1', 'bob')[1], attrs)
+        self.assertNotEqual(serverFirst('SCRAM-SHA-1', 'alice')[1]['s'],
+                            attrs['s'])
+
+        self.assertRaises(SASLAuthError, scram.handle, base64.b64encode(
+                'c=biws,r=abcservernonce,p=AAX8v3Bz2T0CJGbJQyF0X+HI4Ts='))
+        self.assertEqual(scram.state, SASLScram.INIT)
+        self.assertEqual(scram.msg.conn.server.authenticated, [])
+
+    def testKeys(self):
+        """Keys should be made for users without them and redone when the
+        password changes
+        """
+        storage = getStorage()
+        keys = pjs.scram.getKeys('user@localhost', 'SCRAM-SHA-1')
+        self.assertEqual(keys[1], pjs.conf.conf.scramIterations)
+        self.assertEqual(storage.getScramKeys('user@localhost', 'SCRAM-SHA-1'),
+                         keys)
+        self.assert_(storage.getScramKeys('user@localhost', 'SCRAM-SHA-256'))
+        self.assertEqual(pjs.scram.getKeys('bob@localhost', 'SCRAM-SHA-1'),
+                         None)
+
+        self.assert_(pjs.scram.setPassword('user@localhost', 'new'))
+        new = storage.getScramKeys('user@localhost', 'SCRAM-SHA-1')
+        self.assertNotEqual(new, keys)
+        salted = pjs.scram.saltPassword('SCRAM-SHA-1', 'new', new[0], new[1])
+        self.assertEqual(new[3], hmac.new(salted, 'Server Key',
+                                          hashlib.sha1).digest())
+
+    def testMigrate(self):
+        """migrate() should make the keys of the users without them"""
+        storage = getStorage()
+        for i in range(5):
+            storage.addUser('user%d@localhost' % i, 'pw')
+        pjs.scram.addUser('made@localhost', 'pw')
+        iterations = pjs.conf.conf.scramIterations
+        pjs.conf.conf.scramIterations = 100
+        try:
+            self.assertEqual(pjs.scram.migrate(chunkSize=2), 6)
+            self.assertEqual(pjs.scram.migrate(), 0)
+        finally:
+            pjs.conf.conf.scramIterations = iterations
+        self.assertEqual(storage.getScramKeys('user3@localhost',
+                                              'SCRAM-SHA-256')[1], 100)
+        self.assertEqual(pjs.scram.migrate(True), 6)
+        self.assertEqual(storage.getScramKeys('user3@localhost',
+                                              'SCRAM-SHA-256')[1], iterations)
+
+    def testPool(self):
+        """Keys made in the process pool should work"""
+        storage = getStorage()
+        for i in range(3):
+            storage.addUser('user%d@localhost' % i, 'pw')
+        iterations = pjs.conf.conf.scramIterations
+        pjs.conf.conf.scramIterations = 10
+        pjs.procpool.startPool(1)
+        try:
+            keys = pjs.scram.computeKeys('pencil', ['SCRAM-SHA-1'], 10)
+            self.assertEqual(pjs.scram.migrate(chunkSize=2), 4)
+        finally:
+            pjs.procpool.stopPool()
+            pjs.conf.conf.scramIterations = iterations
+        salt, iterations, storedKey, serverKey = keys['SCRAM-SHA-1']
+        salted = pjs.scram.saltPassword('SCRAM-SHA-1', 'pencil', salt, 10)
+        self.assertEqual(serverKey, hmac.new(salted, 'Server Key',
+                                             hashlib.sha1).digest())
+        self.assert_(storage.getScramKeys('user2@localhost',
+                                          'SCRAM-SHA-1') is not None)
+
+if __name__ == '__main__':
+    unittest.main()
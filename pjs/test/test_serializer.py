@@ -0,0 +1,132 @@
+import unittest
+import pjs.serializer
+
+from pjs.serializer import tostring, tobytes, escapeText, escapeAttr, StanzaTemplate
+from pjs.serializer import startTag, endTag, serialize
+from pjs.elementtree.ElementTree import Element, SubElement, XML
+
+def sameXML(a, b):
+    """Compares two serialized elements regardless of attribute order"""
+    a, b = XML(a), XML(b)
+    return a.tag == b.tag and a.attrib == b.attrib and len(a) == len(b) \
+            and a.text == b.text
+
+class TestSerializer(unittest.TestCase):
+    """Tests the XML serializer in pjs.serializer"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        pjs.serializer.clearCache()
+
+    def testStandardNamespaceStripped(self):
+        """jabber:client and jabber:server namespaces should not be written"""
+        el = Element('{jabber:client}presence', {'to' : 'a@b'})
+        self.assertEqual(tostring(el), u"<presence to='a@b'/>")
+        el = Element('{jabber:server}presence')
+        self.assertEqual(tostring(el), u"<presence/>")
+
+    def testCustomNamespace(self):
+        """Other namespaces should be declared as the default on the tag"""
+        el = Element('{jabber:iq:roster}query')
+        SubElement(el, '{jabber:iq:roster}item', {'jid' : 'a@b'})
+        SubElement(el, '{urn:other}x')
+        self.assertEqual(tostring(el),
+                         u"<query xmlns='jabber:iq:roster'><item jid='a@b'/>" +\
+                         u"<x xmlns='urn:other'/></query>")
+
+    def testXmlnsAttribute(self):
+        """Literal xmlns attributes should be respected by children"""
+        el = Element('query', {'xmlns' : 'jabber:iq:roster'})
+        SubElement(el, '{jabber:iq:roster}item')
+        self.assertEqual(tostring(el),
+                         u"<query xmlns='jabber:iq:roster'><item/></query>")
+
+    def testEscaping(self):
+        """Text and attributes should be escaped"""
+        el = Element('message', {'to' : "a'b<c>&d\""})
+        body = SubElement(el, 'body')
+        body.text = u'<script>&amp;'
+        body.tail = u'a>b'
+        self.assertEqual(tostring(el),
+                         u"<message to='a&apos;b&lt;c&gt;&amp;d&quot;'>" +\
+                         u"<body>&lt;script&gt;&amp;amp;</body>a&gt;b</message>")
+        self.assertEqual(escapeText('plain'), 'plain')
+        self.assertEqual(escapeAttr(5), u'5')
+
+    def testXmlLang(self):
+        """xml:lang should be written with the reserved prefix"""
+        el = Element('message',
+                     {'{http://www.w3.org/XML/1998/namespace}lang' : 'en'})
+        self.assertEqual(tostring(el), u"<message xml:lang='en'/>")
+
+    def testBytes(self):
+        """tobytes() should produce UTF-8"""
+        el = Element('body')
+        el.text = u'\u0436'
+        self.assertEqual(tobytes(el), '<body>\xd0\xb6</body>')
+
+    def testPiecewise(self):
+        """Elements written piece by piece should match tostring()"""
+        iq = Element('{jabber:client}iq', {'type' : 'result'})
+        query = SubElement(iq, '{jabber:iq:roster}query')
+        head, ns = startTag(iq)
+        qhead, ns = startTag(query, ns)
+        self.assertEqual(ns, 'jabber:iq:roster')
+
+        out = [head, qhead]
+        item = Element('{jabber:iq:roster}item', {'jid' : 'a@b'})
+        serialize(item, out.append, ns)
+        out.append(endTag(query) + endTag(iq))
+
+        query.append(item)
+        self.assertEqual(u''.join(out), tostring(iq))
+
+    def testCacheBounded(self):
+        """The tag cache shouldn't grow past its limit"""
+        for i in range(pjs.serializer.MAX_CACHED_NAMES + 10):
+            tostring(Element('{urn:ns%d}a' % i))
+        self.assert_(len(pjs.serializer._tagCache) <= pjs.serializer.MAX_CACHED_NAMES)
+
+class TestStanzaTemplate(unittest.TestCase):
+    """Tests the serialize-once stanza templates"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tree = Element('{jabber:client}presence', {'from' : 'a@b/c'})
+        SubElement(self.tree, '{jabber:client}show').text = 'away'
+
+    def testRenderMatchesTostring(self):
+        """Rendering should produce the same output as setting the attribute"""
+        template = StanzaTemplate(self.tree, ('to',))
+        self.tree.set('to', "d@e'f")
+        self.assert_(sameXML(template.render(to="d@e'f"), tostring(self.tree)))
+
+    def testMissingSlot(self):
+        """Slots without values should be left out"""
+        template = StanzaTemplate(self.tree)
+        self.assertEqual(template.render(),
+                         u"<presence from='a@b/c'><show>away</show></presence>")
+
+    def testDefaultSlotValue(self):
+        """Slots without values should fall back to the tree's value"""
+        self.tree.set('id', 'x1')
+        template = StanzaTemplate(self.tree)
+        self.assertEqual(template.render(to='d@e'),
+                         u"<presence from='a@b/c' to='d@e' id='x1'>" +\
+                         u"<show>away</show></presence>")
+
+    def testBound(self):
+        """BoundStanza should render lazily and build Elements"""
+        template = StanzaTemplate(self.tree, ('to',))
+        bound = template.bind(to='d@e')
+        self.assertEqual(bound.get('to'), 'd@e')
+        self.assertEqual(bound.get('from'), 'a@b/c')
+        self.assertEqual(bound.render(), template.render(to='d@e'))
+
+        el = bound.element()
+        self.assertEqual(el.get('to'), 'd@e')
+        self.assertEqual(self.tree.get('to'), None)
+        self.assert_(sameXML(tostring(el), bound.render()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+from pjs.sessions import SessionIndex
+import unittest
+
+class FakeConn:
+    def __init__(self, id):
+        self.id = id
+
+class FakeJID:
+    """Has the same fields as pjs.jid.JID, which needs the DB to import"""
+    def __init__(self, node, domain, resource=None):
+        self.node = node
+        self.domain = domain
+        self.resource = resource
+
+class TestSessionIndex(unittest.TestCase):
+    """Tests the JID => Connection index"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.index = SessionIndex()
+        self.c1 = FakeConn(1)
+        self.c2 = FakeConn(2)
+        self.index.authenticate(self.c1, 'tro@localhost')
+        self.index.authenticate(self.c2, 'tro@localhost')
+        self.index.bind(self.c1, 'tro@localhost', 'home')
+        self.index.bind(self.c2, 'tro@localhost', 'work')
+
+    def testLookupFull(self):
+        """Full JIDs should map to exactly one connection"""
+        self.assertEqual(self.index.lookup(FakeJID('tro', 'localhost', 'work')),
+                         [self.c2])
+        self.assertEqual(self.index.lookup(FakeJID('tro', 'localhost', 'gone')), [])
+        self.assertEqual(self.index.getConnection('tro@localhost/home'), self.c1)
+
+    def testLookupBare(self):
+        """Bare JIDs should map to all bound resources"""
+        conns = self.index.lookup(FakeJID('tro', 'localhost'))
+        self.assertEqual(len(conns), 2)
+        self.assert_(self.c1 in conns and self.c2 in conns)
+        self.assertEqual(self.index.lookup(FakeJID('bob', 'localhost')), [])
+
+    def testRemove(self):
+        """Removing connections should clean up all maps"""
+        self.assertEqual(self.index.remove(self.c1), ('tro@localhost', 'home'))
+        self.assertEqual(self.index.getResources('tro@localhost').keys(), ['work'])
+        self.index.remove(self.c2)
+        self.failIf(self.index.isOnline('tro@localhost'))
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.bare, {})
+        self.assertEqual(self.index.remove(FakeConn(3)), None)
+
+    def testRebind(self):
+        """Binding a new resource on the same connection drops the old one"""
+        self.index.bind(self.c1, 'tro@localhost', 'laptop')
+        self.assertEqual(self.index.getConnection('tro@localhost/home'), None)
+        self.assertEqual(self.index.getConnection('tro@localhost/laptop'), self.c1)
+        self.assertEqual(len(self.index), 2)
+
+    def testUnboundRemove(self):
+        """Authenticated but unbound connections can be removed"""
+        c3 = FakeConn(3)
+        self.index.authenticate(c3, 'bob@localhost')
+        self.assertEqual(self.index.remove(c3), ('bob@localhost', None))
+        self.failIf(self.index.isOnline('bob@localhost'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+from pjs.roster import Subscription
+from pjs.storage.shardedstore import ShardedStorage, ShardStorage, \
+                                     Directory, shardOf, rebalance
+from pjs.test.test_storage import StorageTests
+import pjs.db
+import os
+import shutil
+import tempfile
+import unittest
+
+class ShardedTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.shardName = os.path.join(self.dir, 'shard%d')
+        self.directory = os.path.join(self.dir, 'directory')
+        self.oldName = pjs.db.dbname
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        pjs.db.dbname = self.oldName
+        shutil.rmtree(self.dir)
+
+    def create(self, shards):
+        storage = ShardedStorage(shards, self.shardName, self.directory)
+        storage.setup()
+        self.storages.append(storage)
+        return storage
+
+class TestShardedStorage(StorageTests, ShardedTestCase):
+    """Runs the storage tests on the sharded storage"""
+
+    def setUp(self):
+        ShardedTestCase.setUp(self)
+        self.storage = self.create(3)
+        StorageTests.setUp(self)
+
+    def testShards(self):
+        """Users should be kept in their own shards with global ids"""
+        jids = ['user%d@localhost' % i for i in range(20)]
+        ids = [self.storage.addUser(jid, 'pw') for jid in jids]
+        self.assertEqual(len(set(ids + [self.tro, self.dv])), 22)
+        for jid in jids:
+            shard = self.storage.shards[shardOf(jid, 3)]
+            self.assertEqual(shard.getPassword(jid), 'pw')
+            for other in self.storage.shards:
+                if other is not shard:
+                    self.assertEqual(other.getPassword(jid), None)
+        self.assertEqual(len(self.storage.getUsers()), 22)
+
+        # contacts have the ids they have as users
+        contact, version = self.storage.updateContact(ids[0], jids[1], '',
+                                                      ['g'])
+        self.assertEqual(contact[0], ids[1])
+        self.assertEqual(self.storage.getSubscriptions(ids[0]),
+                         [(ids[1], jids[1], Subscription.NONE)])
+
+        state = self.storage.dump()
+        self.assertEqual(state['passwords'][ids[1]], 'pw')
+        self.assertEqual(state['rosters'][ids[0]],
+                         {ids[1] : ['', Subscription.NONE, ['g']]})
+
+    def testShardCount(self):
+        """The storage shouldn't start with a different number of shards"""
+        storage = ShardedStorage(2, self.shardName, self.directory)
+        self.assertRaises(Exception, storage.setup)
+
+class TestRebalance(ShardedTestCase):
+    def testRebalance(self):
+        """Users should keep their data when they're moved"""
+        storage = self.create(2)
+        jids = ['user%d@localhost' % i for i in range(30)]
+        ids = [storage.addUser(jid, 'pw%d' % i) for i, jid in enumerate(jids)]
+        for uid, jid in zip(ids, jids):
+            storage.updateContact(uid, 'friend@remote', 'F', ['a', 'b'],
+                                  Subscription.TO)
+            storage.updateContact(uid, jids[0], '', [])
+            storage.setScramKeys(jid, {'SCRAM-SHA-1' : (jid, 1, 'a', 'b')})
+        before = [(storage.getRoster(uid), storage.getRosterVersion(uid),
+                   storage.getRosterChanges(uid, 0)) for uid in ids]
+        storage.close()
+        self.storages.remove(storage)
+
+        moved = rebalance(5, self.shardName, self.directory)
+        self.assert_(moved > 0)
+        self.assertEqual(Directory(self.directory).setup(), 5)
+        self.assertEqual(rebalance(5, self.shardName, self.directory), 0)
+
+        storage = self.create(5)
+        for i, (uid, jid) in enumerate(zip(ids, jids)):
+            self.assertEqual(storage.getUserId(jid), uid)
+            self.assertEqual(storage.getPassword(jid), 'pw%d' % i)
+            roster, version, changes = before[i]
+            self.assertEqual(sorted(storage.getRoster(uid)), sorted(roster))
+            self.assertEqual(storage.getRosterVersion(uid), version)
+            self.assertEqual(storage.getRosterChanges(uid, 0), changes)
+            self.assertEqual(storage.getScramKeys(jid, 'SCRAM-SHA-1'),
+                             (jid, 1, 'a', 'b'))
+        self.assertEqual(sorted(storage.getUsers()), sorted(jids))
+
+        # and back
+        storage.close()
+        self.storages.remove(storage)
+        rebalance(2, self.shardName, self.directory)
+        storage = self.create(2)
+        self.assertEqual(sorted(storage.getUsers()), sorted(jids))
+        self.assertEqual(sorted(storage.getRoster(ids[3])), sorted(before[3][0]))
+
+    def testInterrupted(self):
+        """A run interrupted at any step should be finished by the next one
+        without leaving copies in the old shards
+        """
+        storage = self.create(2)
+        jids = ['user%d@localhost' % i for i in range(10)]
+        ids = [storage.addUser(jid, 'pw%d' % i) for i, jid in enumerate(jids)]
+        for uid in ids:
+            storage.updateContact(uid, 'friend@remote', 'F', ['a'])
+        storage.close()
+        self.storages.remove(storage)
+
+        shards = 2
+        for cls, name in ((ShardStorage, 'importUser'),
+                          (ShardStorage, 'dropUser'),
+                          (Directory, 'setShard')):
+            shards += 1
+            original = cls.__dict__[name]
+            calls = []
+            def fail(*args):
+                calls.append(args)
+                if len(calls) == 2:
+                    raise Exception, 'failing as planned'
+                return original(*args)
+            setattr(cls, name, fail)
+            try:
+                self.assertRaises(Exception, rebalance, shards,
+                                  self.shardName, self.directory)
+            finally:
+                setattr(cls, name, original)
+            rebalance(shards, self.shardName, self.directory)
+
+            storage = self.create(shards)
+            for i, (uid, jid) in enumerate(zip(ids, jids)):
+                home = storage.shards[shardOf(jid, shards)]
+                self.assertEqual(home.getPassword(jid), 'pw%d' % i)
+                self.assertEqual(len(home.getRoster(uid)), 1)
+                for shard in storage.shards:
+                    if shard is not home:
+                        self.failIf(shard.getPassword(jid), (name, jid))
+                        self.assertEqual(shard.getRoster(uid), [])
+            storage.close()
+            self.storages.remove(storage)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+import pjs.db
+from pjs.db import closePool
+from pjs.schema import migrate
+from pjs.roster import Subscription
+from pjs.storage.sqlitestore import SQLiteStorage
+from pjs.storage.memorystore import MemoryStorage
+import pjs.conf.conf
+import os
+import tempfile
+import unittest
+
+class StorageTests:
+    """Tests that every storage backend has to pass. Mixed into a TestCase
+    that creates self.storage.
+    """
+
+    def setUp(self):
+        self.tro = self.storage.addUser('tro@localhost', 'test')
+        self.dv = self.storage.addUser('dv@localhost', 'secret')
+
+    def testUsers(self):
+        """Users should have ids and passwords, and contacts should not"""
+        self.assertEqual(self.storage.getUserId('tro@localhost'), self.tro)
+        self.assertEqual(self.storage.getPassword('dv@localhost'), 'secret')
+        self.assert_(self.storage.userExists('tro@localhost'))
+        self.assert_(not self.storage.userExists('bob@localhost'))
+        self.assertEqual(self.storage.getPassword('bob@localhost'), None)
+
+        self.storage.updateContact(self.tro, 'bob@remote', '', [])
+        self.assert_(self.storage.getUserId('bob@remote') is not None)
+        self.assert_(not self.storage.userExists('bob@remote'))
+        self.assertEqual(self.storage.getPassword('bob@remote'), None)
+        self.assert_(not self.storage.setPassword('bob@remote', 'x'))
+
+        self.assert_(self.storage.setPassword('dv@localhost', 'new'))
+        self.assertEqual(self.storage.getPassword('dv@localhost'), 'new')
+        users = self.storage.getUsers()
+        users.sort()
+        self.assertEqual(users, ['dv@localhost', 'tro@localhost'])
+
+        # contacts can become users
+        bob = self.storage.getUserId('bob@remote')
+        self.assertEqual(self.storage.addUser('bob@remote', 'pw'), bob)
+        self.assert_(self.storage.userExists('bob@remote'))
+
+    def testScramKeys(self):
+        """SCRAM keys should be kept until the password changes"""
+        keys = {'SCRAM-SHA-1' : ('salt', 4096, 'stored', 'server'),
+                'SCRAM-SHA-256' : ('salt2', 10000, 'stored2', 'server2')}
+        self.assertEqual(self.storage.getScramKeys('tro@localhost',
+                                                   'SCRAM-SHA-1'), None)
+        self.assert_(self.storage.setScramKeys('tro@localhost', keys))
+        self.assert_(not self.storage.setScramKeys('bob@localhost', keys))
+        self.assertEqual(self.storage.getScramKeys('tro@localhost',
+                                                   'SCRAM-SHA-256'),
+                         ('salt2', 10000, 'stored2', 'server2'))
+
+        self.storage.setPassword('tro@localhost', 'new')
+        self.assertEqual(self.storage.getScramKeys('tro@localhost',
+                                                   'SCRAM-SHA-1'), None)
+        self.storage.setScramKeys('tro@localhost', keys)
+        self.storage.addUser('tro@localhost', 'again')
+        self.assertEqual(self.storage.getScramKeys('tro@localhost',
+                                                   'SCRAM-SHA-1'), None)
+
+    def testContacts(self):
+        """Contacts should be added, updated and removed"""
+        contact, version = self.storage.updateContact(self.tro, 'dv@localhost',
+                                                      'DV', ['b', 'a', 'b', ''])
+        self.assertEqual(contact, (self.dv, 'dv@localhost', 'DV',
+                                   Subscription.NONE, ['b', 'a']))
+        self.assertEqual(version, 1)
+
+        contact, version = self.storage.updateContact(self.tro, 'dv@localhost',
+                                                      'D', ['c'],
+                                                      Subscription.TO)
+        self.assertEqual(contact[3], Subscription.TO)
+        # the subscription is kept when it's not given
+        contact, version = self.storage.updateContact(self.tro, 'dv@localhost',
+                                                      'D', ['c'])
+        self.assertEqual(contact[3], Subscription.TO)
+        self.assertEqual(version, 3)
+        # NONE is a subscription too
+        contact, version = self.storage.updateContact(self.tro, 'dv@localhost',
+                                                      'D', ['c'],
+                                                      Subscription.NONE)
+        self.assertEqual(contact[3], Subscription.NONE)
+        contact, version = self.storage.updateContact(self.tro, 'dv@localhost',
+                                                      'D', ['c'],
+                                                      Subscription.TO)
+        self.assertEqual(version, 5)
+
+        self.assertEqual(self.storage.getContact(self.tro, 'dv@localhost'),
+                         (self.dv, 'dv@localhost', 'D', Subscription.TO, ['c']))
+        self.assertEqual(self.storage.getContact(self.tro, 'dv@localhost',
+                                                 False)[4], [])
+        self.assertEqual(self.storage.getContact(self.dv, 'tro@localhost'), None)
+        self.assertEqual(self.storage.getGroups(self.tro, self.dv), ['c'])
+        self.assertEqual(self.storage.getSubscription(self.tro, self.dv),
+                         Subscription.TO)
+        self.assertEqual(self.storage.getSubscriptions(self.tro),
+                         [(self.dv, 'dv@localhost', Subscription.TO)])
+
+        self.storage.setSubscription(self.tro, self.dv, Subscription.BOTH)
+        self.assertEqual(self.storage.getSubscription(self.tro, self.dv),
+                         Subscription.BOTH)
+
+        self.assertEqual(self.storage.removeContact(self.tro, 'dv@localhost'),
+                         (self.dv, 7))
+        self.assertEqual(self.storage.removeContact(self.tro, 'dv@localhost'),
+                         (None, None))
+        self.assertEqual(self.storage.getRoster(self.tro), [])
+        self.assertEqual(self.storage.getSubscription(self.tro, self.dv), None)
+
+    def testRoster(self):
+        """Rosters should be read whole, counted and iterated"""
+        self.storage.updateContact(self.tro, 'c@remote', '', ['x'],
+                                   Subscription.NONE_PENDING_IN)
+        self.storage.updateContact(self.tro, 'a@remote', 'A', ['x', 'y'])
+        self.storage.updateContact(self.tro, 'b@remote', '', [])
+
+        contacts = self.storage.getRoster(self.tro)
+        contacts.sort(key=lambda contact: contact[1])
+        self.assertEqual([(c[1], c[4]) for c in contacts],
+                         [('a@remote', ['x', 'y']), ('b@remote', []),
+                          ('c@remote', ['x'])])
+
+        self.assertEqual(self.storage.countRoster(self.tro), 3)
+        self.assertEqual(self.storage.countRoster(self.tro,
+                                                  Subscription.NONE_PENDING_IN), 2)
+        contacts = list(self.storage.iterRoster(self.tro,
+                                                Subscription.NONE_PENDING_IN))
+        self.assertEqual([c[1] for c in contacts], ['a@remote', 'b@remote'])
+        self.assertEqual(contacts[0][4], ['x', 'y'])
+
+    def testTransitions(self):
+        """Transitions should change the state atomically"""
+        transitions = Subscription.transitions
+        self.assertEqual(self.storage.applyTransition(self.tro, 'dv@localhost',
+                                                      transitions[('in', 'subscribe')]),
+                         (None, None, None))
+
+        contact, old, version = self.storage.applyTransition(
+                self.tro, 'dv@localhost', transitions[('out', 'subscribe')], True)
+        self.assertEqual(contact, (self.dv, 'dv@localhost', '',
+                                   Subscription.NONE_PENDING_OUT, []))
+        self.assertEqual(old, Subscription.NONE)
+        self.assertEqual(version, 1)
+
+        # no change
+        contact, old, version = self.storage.applyTransition(
+                self.tro, 'dv@localhost', transitions[('out', 'subscribe')])
+        self.assertEqual(version, None)
+
+        self.storage.updateContact(self.tro, 'dv@localhost', 'DV', ['g'])
+        contact, old, version = self.storage.applyTransition(
+                self.tro, 'dv@localhost', transitions[('in', 'subscribed')])
+        self.assertEqual(contact, (self.dv, 'dv@localhost', 'DV',
+                                   Subscription.TO, ['g']))
+        self.assertEqual(old, Subscription.NONE_PENDING_OUT)
+        self.assertEqual(version, 3)
+
+    def testVersions(self):
+        """Changes should be logged for roster versioning"""
+        self.assertEqual(self.storage.getRosterVersion(self.tro), 0)
+        self.assertEqual(self.storage.getRosterChanges(self.tro, 0), None)
+
+        self.storage.updateContact(self.tro, 'a@remote', '', [])
+        self.storage.updateContact(self.tro, 'b@remote', '', [])
+        self.storage.updateContact(self.tro, 'a@remote', 'A', [])
+        self.assertEqual(self.storage.getRosterVersion(self.tro), 3)
+        self.assertEqual([(v, cjid) for v, cid, cjid in
+                          self.storage.getRosterChanges(self.tro, 0)],
+                         [(2, 'b@remote'), (3, 'a@remote')])
+        self.assertEqual(self.storage.getRosterChanges(self.tro, 3), [])
+
+        logSize = pjs.conf.conf.rosterVersionLogSize
+        pjs.conf.conf.rosterVersionLogSize = 2
+        try:
+            self.storage.updateContact(self.tro, 'b@remote', 'B', [])
+        finally:
+            pjs.conf.conf.rosterVersionLogSize = logSize
+        self.assertEqual(self.storage.getRosterChanges(self.tro, 1), None)
+        self.assertEqual(len(self.storage.getRosterChanges(self.tro, 2)), 2)
+
+class TestSQLiteStorage(StorageTests, unittest.TestCase):
+    """Tests the SQLite backend"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        os.remove(self.name)
+        self.oldName = pjs.db.dbname
+        migrate(self.name)
+        self.storage = SQLiteStorage()
+        StorageTests.setUp(self)
+
+    def tearDown(self):
+        closePool(self.name)
+        pjs.db.dbname = self.oldName
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.name + suffix):
+                os.remove(self.name + suffix)
+
+class TestMemoryStorage(StorageTests, unittest.TestCase):
+    """Tests the in-memory backend"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.storage = MemoryStorage('', 0)
+        StorageTests.setUp(self)
+
+    def testSnapshot(self):
+        """The data should survive a snapshot and a restart"""
+        fd, name = tempfile.mkstemp('.snapshot')
+        os.close(fd)
+        os.remove(name)
+        try:
+            storage = MemoryStorage(name, 0)
+            uid = storage.addUser('tro@localhost', 'test')
+            storage.updateContact(uid, 'dv@localhost', 'DV', ['g'])
+            storage.close()
+            self.assert_(os.path.exists(name))
+
+            storage = MemoryStorage(name, 0)
+            self.assertEqual(storage.getPassword('tro@localhost'), 'test')
+            self.assertEqual(storage.getContact(uid, 'dv@localhost')[2:],
+                             ('DV', Subscription.NONE, ['g']))
+            self.assertEqual(storage.getRosterVersion(uid), 1)
+            # new ids don't clash with the loaded ones
+            self.assert_(storage.addUser('bob@localhost', 'x') not in
+                         (uid, storage.getUserId('dv@localhost')))
+        finally:
+            if os.path.exists(name):
+                os.remove(name)
+
+if __name__ == '__main__':
+    unittest.main()
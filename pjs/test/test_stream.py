@@ -0,0 +1,106 @@
+import pjs.conf.features as features
+from pjs.handlers.stream import streamHeader, outStreamHeader, getFeaturesData
+from pjs.handlers.write import WriteHandler
+from pjs.elementtree.ElementTree import Element, XML
+import unittest
+
+class TestFeatures(unittest.TestCase):
+    """Tests the run-time changes to the stream features and the cached
+    <stream:features>
+    """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.saved = dict([(stage, list(feats))
+                           for stage, feats in features._features.items()])
+
+    def tearDown(self):
+        for stage, feats in self.saved.items():
+            features.setFeatures(stage, feats)
+        unittest.TestCase.tearDown(self)
+
+    def tags(self, data):
+        return [el.tag for el in XML(data.replace('stream:features',
+                                                  'features'))]
+
+    def testGeneration(self):
+        """Every change to the feature set should bump the generation"""
+        gen = features.generation
+        features.addFeature('postauth', Element('{urn:test}test'))
+        self.assertEqual(features.generation, gen + 1)
+        features.removeFeature('postauth', 'test')
+        self.assertEqual(features.generation, gen + 2)
+        features.setFeatures('postauth', [])
+        self.assertEqual(features.generation, gen + 3)
+
+    def testCache(self):
+        """The encoded features should be reused until they change"""
+        data = getFeaturesData('postauth')
+        self.assert_(getFeaturesData('postauth') is data)
+        self.assert_('{urn:ietf:params:xml:ns:xmpp-bind}bind' in self.tags(data))
+
+        features.addFeature('postauth', Element('test', {'xmlns' : 'urn:test'}))
+        data = getFeaturesData('postauth')
+        self.assertEqual(self.tags(data)[-1], '{urn:test}test')
+
+        features.removeFeature('postauth', 'bind')
+        data = getFeaturesData('postauth')
+        self.failIf('{urn:ietf:params:xml:ns:xmpp-bind}bind' in self.tags(data))
+        self.assert_('{urn:test}test' in self.tags(data))
+
+        # the stages are cached separately
+        self.assert_('{urn:ietf:params:xml:ns:xmpp-sasl}mechanisms' in
+                     self.tags(getFeaturesData('init')))
+
+    def testWrite(self):
+        """The encoded features should be sent without being decoded again"""
+        class FakeConn:
+            def __init__(self):
+                self.sent = []
+            def send(self, data):
+                self.sent.append(data)
+        class FakeMessage:
+            def __init__(self):
+                self.conn = FakeConn()
+                self.outputBuffer = u''
+
+        msg = FakeMessage()
+        data = getFeaturesData('postauth')
+        WriteHandler().handle(None, msg, [u'<r\xe9ponse/>', data])
+        sent = msg.conn.sent[0]
+        self.assert_(isinstance(sent, str))
+        self.assertEqual(sent, '<r\xc3\xa9ponse/>' + data)
+
+class TestStreamHeaders(unittest.TestCase):
+    """Tests the pre-encoded stream headers"""
+
+    def parse(self, header):
+        """Parses the header as the opening tag of a full document"""
+        return XML(header + '</stream:stream>')
+
+    def testStreamHeader(self):
+        """The host and id should be substituted and escaped"""
+        stream = self.parse(streamHeader('localhost', 'abc', 'jabber:client'))
+        self.assertEqual(stream.tag, '{http://etherx.jabber.org/streams}stream')
+        self.assertEqual((stream.get('from'), stream.get('id')),
+                         ('localhost', 'abc'))
+
+        header = streamHeader("a'b<c>&", "x'y", 'jabber:server')
+        self.failIf("a'b" in header)
+        stream = self.parse(header)
+        self.assertEqual((stream.get('from'), stream.get('id')),
+                         ("a'b<c>&", "x'y"))
+        self.assert_("xmlns:db='jabber:server:dialback'" in header)
+
+    def testOutStreamHeader(self):
+        """The remote host should be substituted and escaped"""
+        stream = self.parse(outStreamHeader('remote.com'))
+        self.assertEqual(stream.get('to'), 'remote.com')
+
+        header = outStreamHeader("evil.com' from='localhost")
+        stream = self.parse(header)
+        self.assertEqual(stream.get('to'), "evil.com' from='localhost")
+        self.assertEqual(stream.get('from'), None)
+
+if __name__ == '__main__':
+    unittest.main()
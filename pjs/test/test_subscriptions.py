@@ -0,0 +1,68 @@
+from pjs.subscriptions import SubscriptionGraph
+import unittest
+
+# same values as in pjs.roster.Subscription, which needs the DB to import
+NONE = 0
+TO = 4
+FROM = 6
+BOTH = 8
+PRESENCE_FROM = frozenset([FROM, 7, BOTH])
+PRESENCE_TO = frozenset([TO, 5, BOTH])
+
+class TestSubscriptionGraph(unittest.TestCase):
+    """Tests the cache of presence subscriptions"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.graph = SubscriptionGraph()
+        stamp = self.graph.beginLoad('tro@localhost')
+        self.graph.load('tro@localhost', [(2, 'dv@localhost', BOTH),
+                                          (3, 'bob@localhost', FROM),
+                                          (4, 'alice@remote', TO)], stamp)
+
+    def testContacts(self):
+        """Subscribers and subscriptions should be split by state"""
+        subscribers = self.graph.getContacts('tro@localhost', PRESENCE_FROM)
+        subscriptions = self.graph.getContacts('tro@localhost', PRESENCE_TO)
+        self.assertEqual(sorted(subscribers), ['bob@localhost', 'dv@localhost'])
+        self.assertEqual(sorted(subscriptions), ['alice@remote', 'dv@localhost'])
+        self.assertEqual(self.graph.getContacts('dv@localhost', PRESENCE_TO), None)
+        self.assertEqual((self.graph.hits, self.graph.misses), (2, 1))
+
+    def testUpdates(self):
+        """Changes should be reflected in the cached users"""
+        self.graph.setSubscription('tro@localhost', 3, NONE)
+        self.graph.setSubscription('tro@localhost', 5, FROM, 'new@localhost')
+        self.graph.removeContact('tro@localhost', 2)
+        self.assertEqual(self.graph.getContacts('tro@localhost', PRESENCE_FROM),
+                         ['new@localhost'])
+
+        # unknown contact without a JID drops the user
+        self.graph.setSubscription('tro@localhost', 99, BOTH)
+        self.failIf(self.graph.isLoaded('tro@localhost'))
+
+        # users that aren't cached are left alone
+        self.graph.setSubscription('dv@localhost', 1, BOTH, 'tro@localhost')
+        self.failIf(self.graph.isLoaded('dv@localhost'))
+
+    def testRacingLoad(self):
+        """Loads that raced with a change shouldn't be cached"""
+        stamp = self.graph.beginLoad('dv@localhost')
+        self.graph.setSubscription('dv@localhost', 1, NONE, 'tro@localhost')
+        self.failIf(self.graph.load('dv@localhost',
+                                    [(1, 'tro@localhost', BOTH)], stamp))
+        self.failIf(self.graph.isLoaded('dv@localhost'))
+
+        stamp = self.graph.beginLoad('dv@localhost')
+        self.assert_(self.graph.load('dv@localhost',
+                                     [(1, 'tro@localhost', NONE)], stamp))
+        self.assertEqual(self.graph.getContacts('dv@localhost', PRESENCE_TO), [])
+
+    def testInvalidate(self):
+        """Invalidated users should be dropped"""
+        self.graph.invalidate('tro@localhost')
+        self.failIf(self.graph.isLoaded('tro@localhost'))
+        self.assertEqual(len(self.graph), 0)
+
+if __name__ == '__main__':
+    unittest.main()
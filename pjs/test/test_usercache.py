@@ -0,0 +1,84 @@
+from pjs.storage.memorystore import MemoryStorage
+from pjs.storage.usercache import UserCacheStorage
+from pjs.test.test_storage import StorageTests
+import unittest
+
+class CountingStorage(MemoryStorage):
+    """Memory backend that counts the user lookups"""
+    def __init__(self):
+        MemoryStorage.__init__(self, '', 0)
+        self.lookups = 0
+
+    def userExists(self, jid):
+        self.lookups += 1
+        return MemoryStorage.userExists(self, jid)
+
+    def getPassword(self, jid):
+        self.lookups += 1
+        return MemoryStorage.getPassword(self, jid)
+
+class TestUserCacheStorage(StorageTests, unittest.TestCase):
+    """Runs the storage tests on the cached storage"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.backend = CountingStorage()
+        self.storage = UserCacheStorage(self.backend, 300, 3, 0)
+        self.storage.setup()
+        StorageTests.setUp(self)
+
+    def testUnknownUsers(self):
+        """Unknown users should be rejected without the backend"""
+        for i in range(10):
+            self.assert_(not self.storage.userExists('bob@localhost'))
+            self.assertEqual(self.storage.getPassword('bob@localhost'), None)
+        self.assert_(self.storage.userExists('tro@localhost'))
+        self.assertEqual(self.backend.lookups, 0)
+        self.assertEqual(self.storage.getStats()['rejected'], 20)
+
+    def testCredentials(self):
+        """Passwords should be cached until they change or expire"""
+        for i in range(5):
+            self.assertEqual(self.storage.getPassword('dv@localhost'), 'secret')
+        self.assertEqual(self.backend.lookups, 1)
+        stats = self.storage.getStats()
+        self.assertEqual((stats['hits'], stats['misses']), (4, 1))
+
+        self.storage.setPassword('dv@localhost', 'new')
+        self.assertEqual(self.storage.getPassword('dv@localhost'), 'new')
+        self.assertEqual(self.backend.lookups, 2)
+
+        self.storage.ttl = -1
+        self.storage.invalidate()
+        self.storage.getPassword('dv@localhost')
+        self.storage.getPassword('dv@localhost')
+        self.assertEqual(self.backend.lookups, 4)
+
+    def testEviction(self):
+        """The oldest passwords should be dropped when the cache is full"""
+        for i in range(5):
+            self.storage.addUser('user%d@localhost' % i, 'pw%d' % i)
+            self.storage.getPassword('user%d@localhost' % i)
+        self.assertEqual(self.storage.getStats()['credentials'], 3)
+        lookups = self.backend.lookups
+        self.storage.getPassword('user4@localhost')
+        self.assertEqual(self.backend.lookups, lookups)
+        self.storage.getPassword('user0@localhost')
+        self.assertEqual(self.backend.lookups, lookups + 1)
+
+    def testChangeDuringRead(self):
+        """A password read before it changed shouldn't be cached"""
+        storage = self.storage
+        class RacingStorage(CountingStorage):
+            def getPassword(self, jid):
+                password = CountingStorage.getPassword(self, jid)
+                # the password changes after it was read
+                storage.invalidate(jid)
+                return password
+        self.storage.backend = RacingStorage()
+        self.storage.backend.addUser('dv@localhost', 'old')
+        self.assertEqual(self.storage.getPassword('dv@localhost'), 'old')
+        self.assertEqual(self.storage.getStats()['credentials'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
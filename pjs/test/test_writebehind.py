@@ -0,0 +1,109 @@
+from pjs.db import closePool
+from pjs.roster import Subscription
+from pjs.schema import migrate
+from pjs.storage.sqlitestore import SQLiteStorage
+from pjs.storage.writebehind import WriteBehindStorage, readJournal
+from pjs.test.test_storage import StorageTests
+import pjs.db
+import os
+import tempfile
+import unittest
+
+class FailingStorage(SQLiteStorage):
+    """SQLite backend whose writes fail, as if the server crashed before
+    they were committed
+    """
+    def applyBatch(self, records):
+        raise Exception, 'crashed'
+
+class WriteBehindTestCase(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        os.remove(self.name)
+        self.journal = self.name + '.journal'
+        self.oldName = pjs.db.dbname
+        migrate(self.name)
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        closePool(self.name)
+        pjs.db.dbname = self.oldName
+        for suffix in ('', '-wal', '-shm', '.journal'):
+            if os.path.exists(self.name + suffix):
+                os.remove(self.name + suffix)
+
+    def create(self, backend=None, **kwargs):
+        storage = WriteBehindStorage(backend or SQLiteStorage(), **kwargs)
+        storage.setup()
+        self.storages.append(storage)
+        return storage
+
+class TestWriteBehindStorage(StorageTests, WriteBehindTestCase):
+    """Runs the storage tests on the write-behind storage"""
+
+    def setUp(self):
+        WriteBehindTestCase.setUp(self)
+        self.storage = self.create(batchSize=10, delay=0.01, journal='')
+        StorageTests.setUp(self)
+
+    def testWritten(self):
+        """The changes should reach the backend in batches"""
+        for i in range(25):
+            self.storage.updateContact(self.tro, 'c%d@remote' % i, '', ['g'])
+        self.storage.applyTransition(self.tro, 'c1@remote',
+                                     Subscription.transitions[('out', 'subscribe')])
+        self.storage.removeContact(self.tro, 'c2@remote')
+        self.storage.setPassword('dv@localhost', 'new')
+        self.assert_(self.storage.flush(5))
+
+        backend = SQLiteStorage()
+        uid = backend.getUserId('tro@localhost')
+        self.assertEqual(backend.getPassword('dv@localhost'), 'new')
+        self.assertEqual(backend.countRoster(uid), 24)
+        self.assertEqual(backend.getContact(uid, 'c1@remote')[3:],
+                         (Subscription.NONE_PENDING_OUT, ['g']))
+        self.assertEqual(backend.getRosterVersion(uid), 27)
+
+        stats = self.storage.getStats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['written'], 30)
+        self.assert_(stats['maxBatch'] <= 10)
+        self.assert_(stats['batches'] >= 3)
+
+class TestJournal(WriteBehindTestCase):
+    """Tests the crash safety of the journal"""
+
+    def testReplay(self):
+        """Changes in the journal should be written after a crash"""
+        storage = self.create(FailingStorage(), delay=0.01,
+                              journal=self.journal)
+        uid = storage.addUser('tro@localhost', 'test')
+        storage.updateContact(uid, 'dv@localhost', 'DV', ['g'])
+        storage.updateContact(uid, 'dv@localhost', 'D', ['h'])
+        self.assertEqual(len(readJournal(self.journal)), 3)
+
+        # a record cut off by the crash
+        f = open(self.journal, 'ab')
+        f.write('\x80\x02(U')
+        f.close()
+
+        storage = self.create(journal=self.journal)
+        self.assertEqual(readJournal(self.journal), [])
+        uid = storage.getUserId('tro@localhost')
+        self.assertEqual(storage.getContact(uid, 'dv@localhost')[2:],
+                         ('D', Subscription.NONE, ['h']))
+        self.assertEqual(storage.getRosterVersion(uid), 2)
+
+    def testTruncated(self):
+        """The journal should be emptied once the changes are written"""
+        storage = self.create(delay=0.01, journal=self.journal, fsync=True)
+        storage.addUser('tro@localhost', 'test')
+        self.assert_(storage.flush(5))
+        self.assertEqual(readJournal(self.journal), [])
+
+if __name__ == '__main__':
+    unittest.main()
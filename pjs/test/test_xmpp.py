@@ -8,7 +8,8 @@ import threading
 import time
 import pjs.conf.handlers as handlers
 
-from pjs.db import DB, sqlite
+from pjs.db import DB, closePool, sqlite
+from pjs.storage.base import setStorage
 
 from copy import deepcopy
 
@@ -479,6 +480,9 @@ class TestSubscriptions(unittest.TestCase):
 
 def deletePresenceDB():
     import os
+    closePool(TEST_PRESDB_NAME)
+    # drop the cached users of this DB
+    setStorage(None)
     os.remove(TEST_PRESDB_NAME)
 def initPresenceDB():
     con = DB(TEST_PRESDB_NAME)
@@ -503,6 +507,14 @@ def initPresenceDB():
                     (groupid INTEGER REFERENCES rostergroup NOT NULL,\
                      contactid INTEGER REFERENCES jids NOT NULL,\
                      PRIMARY KEY (groupid, contactid))")
+        c.execute("CREATE TABLE rosterversions\
+                    (userid INTEGER PRIMARY KEY REFERENCES jids NOT NULL,\
+                     version INTEGER NOT NULL)")
+        c.execute("CREATE TABLE rosterchanges\
+                    (userid INTEGER REFERENCES jids NOT NULL,\
+                     version INTEGER NOT NULL,\
+                     contactid INTEGER REFERENCES jids NOT NULL,\
+                     PRIMARY KEY (userid, version))")
         c.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
         c.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
         c.execute("INSERT INTO roster (userid, contactid, subscription) VALUES (1, 2, 8)")
@@ -515,6 +527,9 @@ def initPresenceDB():
     
 def deleteNoRosterItemsDB():
     import os
+    closePool(TEST_NOROSTER_NAME)
+    # drop the cached users of this DB
+    setStorage(None)
     os.remove(TEST_NOROSTER_NAME)
 def initNoRosterItemsDB():
     con = DB(TEST_NOROSTER_NAME)
@@ -539,6 +554,14 @@ def initNoRosterItemsDB():
                     (groupid INTEGER REFERENCES rostergroup NOT NULL,\
                      contactid INTEGER REFERENCES jids NOT NULL,\
                      PRIMARY KEY (groupid, contactid))")
+        c.execute("CREATE TABLE rosterversions\
+                    (userid INTEGER PRIMARY KEY REFERENCES jids NOT NULL,\
+                     version INTEGER NOT NULL)")
+        c.execute("CREATE TABLE rosterchanges\
+                    (userid INTEGER REFERENCES jids NOT NULL,\
+                     version INTEGER NOT NULL,\
+                     contactid INTEGER REFERENCES jids NOT NULL,\
+                     PRIMARY KEY (userid, version))")
         c.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
         c.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
         con.commit()
@@ -10,6 +10,7 @@ except ImportError:
     from sha import new as sha1
 
 import time, os, re, sys
+import pjs.serializer
 
 standardNSre = re.compile(r'^{jabber:(client|server)}', re.UNICODE)
 customNSre = re.compile(r'^{(.*?)}(.*)')
@@ -54,29 +55,10 @@ def tostring(tree):
     This is a workaround for ET's broken tostring(), which returns crazy stuff
     like:
     <ns0:a xmlns:ns0="asdf"><ns0:b>asdfasdf</ns0:b></ns0:a>
-    """
-    def processTree(tree):
-        res, tag = decurl(tree.tag)
-        res = u'<' + res
-        for k,v in tree.items():
-            res += " %s='%s'" % (k,v)
-        if len(tree) > 0 or tree.text:
-            res += '>'
-            if tree.text:
-                res += tree.text
-            for i in tree:
-                res += processTree(i)
-                if i.tail:
-                    res += i.tail
-            res += '</%s>' % tag
-        else:
-            res += '/>'
 
-        return res
-
-    res = u''
-    res += processTree(tree)
-    return res
+    See pjs.serializer for the implementation.
+    """
+    return pjs.serializer.tostring(tree)
 
 def decurl(tagName):
     """Returns the "tag xmls='ns'" and 'tag' tuple. This is for parsing out
@@ -0,0 +1,150 @@
+"""Measures how late the main loop wakes up while DIGEST-MD5 logins are
+checked in the threadpool, with the hashing in the handlers' threads and in
+the process pool (see pjs.procpool).
+
+The loop wakes up every millisecond, starts the logins that are due at the
+given rate and polls the running ones, like the server's main loop does with
+the handlers' checking functions. Each login is a client's response to the
+first DIGEST-MD5 challenge, run by SASLResponseHandler, which is the step
+that hashes. The users are in a memory storage, so the server doesn't need to
+be running. Run from the top-level directory:
+    $ PYTHONPATH=. python prototypes/load-tests/cpu-offload.py [logins per second] [seconds] [processes]
+"""
+
+import sys
+import time
+import base64
+
+import pjs.conf.handlers
+import pjs.procpool
+import pjs.threadpool
+
+from pjs.auth_mechanisms import SASLDigestMD5, digestResponse
+from pjs.elementtree.ElementTree import Element
+from pjs.handlers.auth import SASLResponseHandler
+from pjs.storage.base import setStorage
+from pjs.storage.memorystore import MemoryStorage
+
+USERS = 100
+
+class FakeServer:
+    def __init__(self, threadpool):
+        self.hostname = 'localhost'
+        self.threadpool = threadpool
+
+class FakeConn:
+    def __init__(self, server):
+        self.server = server
+        self.data = {'sasl' : {}, 'user' : {}}
+
+class FakeMessage:
+    def __init__(self, conn):
+        self.conn = conn
+
+def makeResponse(username, nonce):
+    """Returns the <response> of the client to the first challenge"""
+    cnonce = 'c' + nonce
+    digestUri = 'xmpp/localhost'
+    response = digestResponse(username, 'localhost', 'test', nonce, cnonce,
+                              '00000001', digestUri)[0]
+    text = 'username="%s",realm="localhost",nonce="%s",cnonce="%s",' \
+           'nc=00000001,qop=auth,digest-uri="%s",response=%s,charset=utf-8' \
+           % (username, nonce, cnonce, digestUri, response)
+    el = Element('response', {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-sasl'})
+    el.text = base64.b64encode(text)
+    return el
+
+def startLogin(server, i):
+    """Starts the login i and returns its checking function"""
+    conn = FakeConn(server)
+    msg = FakeMessage(conn)
+    mech = SASLDigestMD5(msg)
+    mech.nonce = 'nonce%d' % i
+    mech.state = SASLDigestMD5.SENT_CHALLENGE1
+    conn.data['sasl']['mechObj'] = mech
+    tree = makeResponse('user%d' % (i % USERS), mech.nonce)
+
+    handler = SASLResponseHandler()
+    checkFunc, initFunc = handler.handle(tree, msg)
+    initFunc.func(**initFunc.funcArgs)
+    return checkFunc, handler
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def run(rate, seconds, processes):
+    pjs.conf.handlers.processPoolHandlers = [SASLResponseHandler]
+    pjs.procpool.startPool(processes)
+    tpool = pjs.threadpool.ThreadPool(5)
+    server = FakeServer(tpool)
+
+    running = []
+    lags = []
+    latencies = []
+    failed = 0
+    started = 0
+    total = rate * seconds
+
+    start = time.time()
+    tick = start
+    while started < total or running:
+        tick += 0.001
+        delay = tick - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        now = time.time()
+        lags.append(now - tick)
+        if now - tick > 0.001:
+            # don't try to catch up on the missed ticks
+            tick = now
+
+        due = min(int((now - start) * rate), total)
+        while started < due:
+            checkFunc, handler = startLogin(server, started)
+            running.append((checkFunc, handler, time.time()))
+            started += 1
+
+        stillRunning = []
+        for checkFunc, handler, began in running:
+            if checkFunc.func(**checkFunc.funcArgs):
+                latencies.append(time.time() - began)
+                if not isinstance(handler.resume(), list):
+                    failed += 1
+            else:
+                stillRunning.append((checkFunc, handler, began))
+        running = stillRunning
+
+    elapsed = time.time() - start
+    tpool.dismissWorkers(5)
+    pjs.procpool.stopPool()
+
+    print '%-9s %6d logins/s %4d failed   loop lag ms: median %.2f, ' \
+          '99%% %.2f, max %.2f   login ms: median %.2f, 99%% %.2f' % \
+          (processes and '%d procs' % processes or 'threads',
+           total / elapsed, failed,
+           percentile(lags, 0.5) * 1000, percentile(lags, 0.99) * 1000,
+           max(lags) * 1000,
+           percentile(latencies, 0.5) * 1000,
+           percentile(latencies, 0.99) * 1000)
+
+if __name__ == '__main__':
+    rate = 1000
+    seconds = 10
+    processes = 2
+    if len(sys.argv) > 1:
+        rate = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        seconds = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        processes = int(sys.argv[3])
+
+    storage = MemoryStorage('', 0)
+    setStorage(storage)
+    for i in range(USERS):
+        storage.addUser('user%d@localhost' % i, 'test')
+
+    run(rate, seconds, 0)
+    run(rate, seconds, processes)
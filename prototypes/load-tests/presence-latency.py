@@ -0,0 +1,88 @@
+"""Measures the end-to-end presence latency: the time from one client sending
+a presence update until its contact receives it. Both users are local, so
+this covers C2SPresenceHandler, the S2S loopback and local delivery.
+
+The server must be running with the sample DB (pjs/pjsserver.py). This
+makes tro@localhost and dv@localhost subscribed to each other.
+
+Run from the top-level directory:
+    $ PYTHONPATH=. python prototypes/load-tests/presence-latency.py [count]
+"""
+
+import sys
+import time
+import xmpp
+
+from pjs.db import DB
+from pjs.roster import Subscription
+
+def subscribe(jid1, jid2):
+    """Makes jid1 and jid2 subscribed to each other"""
+    con = DB()
+    c = con.cursor()
+    c.execute("SELECT id FROM jids WHERE jid = ?", (jid1,))
+    id1 = c.fetchone()[0]
+    c.execute("SELECT id FROM jids WHERE jid = ?", (jid2,))
+    id2 = c.fetchone()[0]
+    for userid, contactid in ((id1, id2), (id2, id1)):
+        c.execute("INSERT OR REPLACE INTO roster (userid, contactid, subscription)\
+                   VALUES (?, ?, ?)", (userid, contactid, Subscription.BOTH))
+    con.commit()
+    c.close()
+
+def login(jid, password='test'):
+    jid = xmpp.JID(jid)
+    cl = xmpp.Client(jid.getDomain(), debug=[])
+    if not cl.connect(use_srv=False):
+        raise Exception, 'Could not connect'
+    if not cl.auth(jid.getNode(), password, jid.getResource(), sasl=1):
+        raise Exception, 'Could not authenticate'
+    return cl
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 500
+
+    subscribe('tro@localhost', 'dv@localhost')
+
+    receiver = login('dv@localhost/bench')
+    sender = login('tro@localhost/bench')
+
+    received = {}
+    def gotPresence(con, pres):
+        status = pres.getStatus()
+        if pres.getFrom().getStripped() == 'tro@localhost' and status:
+            received[status] = time.time()
+    receiver.RegisterHandler('presence', gotPresence)
+
+    receiver.sendInitPresence(requestRoster=0)
+    sender.sendInitPresence(requestRoster=0)
+    while receiver.Process(0.1) or sender.Process(0.1):
+        pass
+
+    latencies = []
+    for i in range(count):
+        status = 'bench %d' % i
+        start = time.time()
+        sender.send(xmpp.Presence(status=status))
+        while status not in received and time.time() - start < 5:
+            receiver.Process(0.01)
+        if status in received:
+            latencies.append(received[status] - start)
+
+    sender.disconnect()
+    receiver.disconnect()
+
+    if not latencies:
+        print 'No presence received'
+        sys.exit(1)
+
+    latencies.sort()
+    print '%d/%d received' % (len(latencies), count)
+    print 'min %.3f ms  avg %.3f ms  p95 %.3f ms  max %.3f ms' % \
+            (latencies[0] * 1000,
+             sum(latencies) / len(latencies) * 1000,
+             latencies[int(len(latencies) * 0.95) - 1] * 1000,
+             latencies[-1] * 1000)
@@ -0,0 +1,134 @@
+"""Measures the roster and presence queries against a big roster table, once
+on the schema without the indexes of pjs.schema migration 2 in the default
+rollback-journal mode, and once after migrating to the latest schema with
+WAL. The connection pragmas from pjs.conf.conf are used in both runs.
+
+The queries are made through pjs.roster.Roster with the roster cache and the
+subscription graph cleared before each call, so that every call goes to the
+DB:
+    loadRoster        the full roster of a user with its groups
+    loadSubscriptions the subscription states used for presence broadcasts
+    countItems        the size check for roster streaming
+    getContactInfo    one contact with its groups
+
+The default is 10000 users with 100 contacts each, which is 1M rows in
+roster and in rostergroupitems. Building the DB takes a while.
+
+Runs on a new DB file, so the server doesn't need to be running. Run from the
+top-level directory:
+    $ PYTHONPATH=. python prototypes/load-tests/roster-queries.py [users] [contacts] [calls]
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+import pjs.db
+import pjs.schema
+import pjs.conf.conf
+
+from pjs.roster import Roster
+from pjs.rostercache import getRosterCache
+from pjs.subscriptions import getSubscriptionGraph
+
+GROUPS = ('friends', 'family', 'work')
+
+def createRosters(users, contacts):
+    """Fills the DB with users who each have contacts random contacts, each
+    of them in one group
+    """
+    con = pjs.db.DB()
+    c = con.cursor()
+    c.executemany("INSERT INTO jids (id, jid, password) VALUES (?, ?, 'test')",
+                  [(i + 1, 'user%d@localhost' % i) for i in range(users)])
+    c.executemany("INSERT INTO rostergroups (groupid, userid, name)\
+                   VALUES (?, ?, ?)",
+                  [(uid * len(GROUPS) + i, uid, name)
+                   for uid in range(1, users + 1)
+                   for i, name in enumerate(GROUPS)])
+    for uid in range(1, users + 1):
+        cids = random.sample(xrange(1, users + 1), contacts + 1)
+        if uid in cids:
+            cids.remove(uid)
+        cids = cids[:contacts]
+        c.executemany("INSERT INTO roster (userid, contactid, subscription)\
+                       VALUES (?, ?, ?)",
+                      [(uid, cid, random.choice((0, 1, 2, 4, 8, 10, 12)))
+                       for cid in cids])
+        c.executemany("INSERT INTO rostergroupitems (groupid, contactid)\
+                       VALUES (?, ?)",
+                      [(uid * len(GROUPS) + random.randrange(len(GROUPS)), cid)
+                       for cid in cids])
+        if uid % 1000 == 0:
+            con.commit()
+    con.commit()
+    c.close()
+    con.close()
+
+def clearCaches():
+    getRosterCache().clear()
+    getSubscriptionGraph().clear()
+
+def contactOf(roster):
+    con = pjs.db.DB()
+    c = con.cursor()
+    c.execute("SELECT jids.jid FROM roster JOIN jids ON jids.id = roster.contactid\
+               WHERE roster.userid = ? LIMIT 1", (roster.uid,))
+    cjid = c.fetchone()[0]
+    c.close()
+    con.close()
+    return cjid
+
+def run(users, calls):
+    jids = ['user%d@localhost' % random.randrange(users) for i in range(calls)]
+    rosters = [Roster(jid) for jid in jids]
+    cjids = [contactOf(roster) for roster in rosters]
+
+    tests = (
+        ('loadRoster', lambda r, cjid: r.loadRoster()),
+        ('loadSubscriptions', lambda r, cjid: r.loadSubscriptions()),
+        ('countItems', lambda r, cjid: r.countItems()),
+        ('getContactInfo', lambda r, cjid: r.getContactInfo(cjid)),
+        )
+    for name, func in tests:
+        total = 0.0
+        for roster, cjid in zip(rosters, cjids):
+            clearCaches()
+            start = time.time()
+            func(roster, cjid)
+            total += time.time() - start
+        print '    %-18s %8.3f ms/call' % (name, total / calls * 1000)
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    users, contacts, calls = (args + [10000, 100, 200][len(args):])[:3]
+
+    fd, name = tempfile.mkstemp('.db')
+    os.close(fd)
+    os.remove(name)
+    journalMode = pjs.conf.conf.dbJournalMode
+    try:
+        pjs.conf.conf.dbJournalMode = None
+        pjs.schema.migrate(name, 1)
+        start = time.time()
+        createRosters(users, contacts)
+        print 'Created %d roster rows in %.1f s' % (users * contacts,
+                                                   time.time() - start)
+
+        print 'Schema version 1, rollback journal:'
+        run(users, calls)
+
+        pjs.conf.conf.dbJournalMode = journalMode
+        start = time.time()
+        version = pjs.schema.migrate(name)
+        print 'Migrated to version %d in %.1f s' % (version, time.time() - start)
+
+        print 'Schema version %d, %s journal:' % (version, journalMode)
+        run(users, calls)
+    finally:
+        pjs.db.closePool(name)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
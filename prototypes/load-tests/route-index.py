@@ -0,0 +1,69 @@
+"""Compares ClientRouteHandler's old scan over all C2S connections with the
+lookup in pjs.sessions.SessionIndex, for 1k, 10k and 100k connected
+resources.
+
+Run from the top-level directory:
+    $ PYTHONPATH=. python prototypes/load-tests/route-index.py
+"""
+
+import timeit
+import random
+
+from pjs.jid import JID
+from pjs.sessions import SessionIndex
+
+class FakeConn:
+    def __init__(self, id):
+        self.id = id
+
+def populate(numConns):
+    """Returns the old C2SServer.conns dict and an index with the same
+    sessions. Every user has two resources.
+    """
+    conns = {}
+    index = SessionIndex()
+    for i in range(numConns):
+        conn = FakeConn(i)
+        bare = 'user%d@localhost' % (i / 2)
+        resource = 'res%d' % (i % 2)
+        jid = JID(bare)
+        jid.resource = resource
+        conns[i] = (jid, conn)
+        index.authenticate(conn, bare)
+        index.bind(conn, bare, resource)
+    return conns, index
+
+def oldLookup(conns, jid):
+    """ClientRouteHandler's lookup before the index"""
+    if jid.resource:
+        def f(i):
+            if not conns[i][0]: return False
+            return conns[i][0] == jid
+    else:
+        def f(i):
+            jidConn = conns[i]
+            if not jidConn[0]: return False
+            return jidConn[0].node == jid.node and jidConn[0].domain == jid.domain
+    return [conns[i][1] for i in filter(f, conns)]
+
+if __name__ == '__main__':
+    for size in (1000, 10000, 100000):
+        conns, index = populate(size)
+        targets = [JID('user%d@localhost/res0' % random.randrange(size / 2))
+                   for i in range(50)]
+        targets += [JID('user%d@localhost' % random.randrange(size / 2))
+                    for i in range(50)]
+
+        def runOld():
+            for jid in targets:
+                oldLookup(conns, jid)
+        def runNew():
+            for jid in targets:
+                index.lookup(jid)
+
+        number = max(1, 100000 / size)
+        old = min(timeit.Timer(runOld).repeat(3, number)) / number / len(targets)
+        new = min(timeit.Timer(runNew).repeat(3, 1000)) / 1000 / len(targets)
+
+        print '%6d conns: scan %10.3f us  index %8.3f us  speedup %.0fx' % \
+                (size, old * 1e6, new * 1e6, old / new)
@@ -0,0 +1,76 @@
+"""Compares the old regex-based tostring() with pjs.serializer on
+roster-sized trees.
+
+Run from the top-level directory:
+    $ PYTHONPATH=. python prototypes/load-tests/serializer.py
+"""
+
+import re
+import timeit
+
+from pjs.elementtree.ElementTree import Element, SubElement
+import pjs.serializer
+
+standardNSre = re.compile(r'^{jabber:(client|server)}', re.UNICODE)
+customNSre = re.compile(r'^{(.*?)}(.*)')
+
+def decurl(tagName):
+    res = standardNSre.sub('', tagName)
+    res = customNSre.sub(r"\2 xmlns='\1'", res)
+    end = res.find(' ')
+    if end == -1:
+        tag = res
+    else:
+        tag = res[:end]
+    return res, tag
+
+def oldTostring(tree):
+    """pjs.utils.tostring() before pjs.serializer"""
+    def processTree(tree):
+        res, tag = decurl(tree.tag)
+        res = u'<' + res
+        for k,v in tree.items():
+            res += " %s='%s'" % (k,v)
+        if len(tree) > 0 or tree.text:
+            res += '>'
+            if tree.text:
+                res += tree.text
+            for i in tree:
+                res += processTree(i)
+                if i.tail:
+                    res += i.tail
+            res += '</%s>' % tag
+        else:
+            res += '/>'
+
+        return res
+
+    return processTree(tree)
+
+def makeRoster(numItems):
+    """Builds a roster result the way IQRosterGetHandler does"""
+    iq = Element('{jabber:client}iq', {'type' : 'result', 'id' : 'roster_1',
+                                       'to' : 'tro@localhost/test'})
+    query = SubElement(iq, '{jabber:iq:roster}query')
+    for i in range(numItems):
+        item = SubElement(query, '{jabber:iq:roster}item', {
+                                'jid' : 'contact%d@example.com' % i,
+                                'subscription' : 'both',
+                                'name' : 'Contact %d' % i,
+                                })
+        SubElement(item, '{jabber:iq:roster}group').text = 'friends'
+        SubElement(item, '{jabber:iq:roster}group').text = 'work'
+    return iq
+
+if __name__ == '__main__':
+    for size in (50, 500, 2000, 10000):
+        tree = makeRoster(size)
+        number = max(1, 20000 / size)
+
+        old = min(timeit.Timer(lambda: oldTostring(tree)).repeat(3, number))
+        new = min(timeit.Timer(lambda: pjs.serializer.tostring(tree)).repeat(3, number))
+        newBytes = min(timeit.Timer(lambda: pjs.serializer.tobytes(tree)).repeat(3, number))
+
+        print '%6d items: old %8.3f ms  new %8.3f ms  new (utf-8) %8.3f ms  speedup %.1fx' % \
+                (size, old / number * 1000, new / number * 1000,
+                 newBytes / number * 1000, old / new)
@@ -0,0 +1,98 @@
+"""Measures concurrent subscription writes against the number of shards of
+pjs.storage.shardedstore. Each thread makes subscription handshakes (see
+subscription-handshakes.py) between its own pairs of users, so the writers
+only wait for each other when their users are in the same shard.
+
+The users and their rosters are created first, so that the measured writes
+don't hand out new ids in the directory. Each shard count runs on new files
+in a temporary directory, so the server doesn't need to be running. The
+connection pragmas in pjs.conf.conf are used; set dbSynchronous to 'FULL' to
+see the cost of a synced commit. Run from the top-level directory:
+    $ PYTHONPATH=. python prototypes/load-tests/sharded-writes.py [threads] [handshakes per thread] [shard counts...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+import pjs.db
+
+from pjs.roster import Subscription
+from pjs.storage.shardedstore import ShardedStorage
+
+def handshake(storage, a, b, ajid, bjid):
+    """Subscribes a to b, one transaction per state change"""
+    transitions = Subscription.transitions
+    storage.applyTransition(a, bjid, transitions[('out', 'subscribe')], True)
+    storage.applyTransition(b, ajid, transitions[('in', 'subscribe')], True)
+    storage.applyTransition(b, ajid, transitions[('out', 'subscribed')])
+    storage.applyTransition(a, bjid, transitions[('in', 'subscribed')])
+
+def unsubscribe(storage, a, b, ajid, bjid):
+    """Undoes handshake(), so that the next one changes the states again"""
+    transitions = Subscription.transitions
+    storage.applyTransition(a, bjid, transitions[('out', 'unsubscribe')])
+    storage.applyTransition(b, ajid, transitions[('in', 'unsubscribe')])
+
+def worker(storage, pairs, count, errors):
+    try:
+        for i in range(count):
+            a, b, ajid, bjid = pairs[i % len(pairs)]
+            if i >= len(pairs):
+                unsubscribe(storage, a, b, ajid, bjid)
+            handshake(storage, a, b, ajid, bjid)
+    except Exception, e:
+        errors.append(e)
+
+def run(shards, threads, count):
+    dir = tempfile.mkdtemp()
+    dbname = pjs.db.dbname
+    storage = ShardedStorage(shards, os.path.join(dir, 'shard%d'),
+                             os.path.join(dir, 'directory'))
+    try:
+        storage.setup()
+        # 10 pairs of users per thread, each with the other in its roster
+        pairs = []
+        for t in range(threads):
+            tpairs = []
+            for i in range(10):
+                ajid = 'a%d-%d@localhost' % (t, i)
+                bjid = 'b%d-%d@localhost' % (t, i)
+                a = storage.addUser(ajid, 'test')
+                b = storage.addUser(bjid, 'test')
+                storage.updateContact(a, bjid, '', [])
+                storage.updateContact(b, ajid, '', [])
+                tpairs.append((a, b, ajid, bjid))
+            pairs.append(tpairs)
+
+        errors = []
+        workers = [threading.Thread(target=worker,
+                                    args=(storage, pairs[t], count, errors))
+                   for t in range(threads)]
+        start = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - start
+
+        # 4 changes per handshake, and 2 more per unsubscribe
+        writes = threads * (4 * count + 2 * max(0, count - 10))
+        print '%2d shards: %6d writes in %.2f s: %7.1f writes/s%s' % \
+              (shards, writes, elapsed, writes / elapsed,
+               errors and ' (%d errors: %s)' % (len(errors), errors[0]) or '')
+    finally:
+        storage.close()
+        pjs.db.dbname = dbname
+        shutil.rmtree(dir)
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    threads, count = (args + [16, 100][len(args):])[:2]
+    shardCounts = args[2:] or [1, 2, 4, 8]
+    print '%d threads, %d handshakes each' % (threads, count)
+    for shards in shardCounts:
+        run(shards, threads, count)
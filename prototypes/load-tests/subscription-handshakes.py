@@ -0,0 +1,106 @@
+"""Measures subscription handshakes per second at the roster layer. A
+handshake is the four state changes of RFC 3921 8.2: A sends subscribe, B
+receives it, B sends subscribed and A receives it.
+
+The handshakes are run once with Roster.applyTransition(), which makes each
+change in one transaction, and once with the getContactInfo() and
+setSubscription() calls that the subscription handlers used to make.
+
+Runs on a new DB file, or in memory with the memory storage backend, so the
+server doesn't need to be running. writebehind runs on the SQLite backend
+with pjs.storage.writebehind and prints the batch sizes and the lag. Run
+from the top-level directory:
+    $ PYTHONPATH=. python prototypes/load-tests/subscription-handshakes.py [pairs] [sqlite|memory|writebehind]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import pjs.db
+import pjs.conf.conf
+
+from pjs.pjsserver import populateDB
+from pjs.roster import Roster, Subscription
+from pjs.rostercache import getRosterCache
+from pjs.storage.base import getStorage
+
+def createUsers(count):
+    storage = getStorage()
+    for i in range(count):
+        storage.addUser('user%d@localhost' % i, 'test')
+
+def handshake(a, b):
+    """Subscribes a to b using applyTransition()"""
+    ra, rb = Roster(a), Roster(b)
+    ra.applyTransition(b, 'out', 'subscribe', True)
+    rb.applyTransition(a, 'in', 'subscribe', True)
+    rb.applyTransition(a, 'out', 'subscribed')
+    ra.applyTransition(b, 'in', 'subscribed')
+
+def change(roster, cjid, direction, type):
+    """One state change the old way: a lookup and an update, each on its own
+    connection
+    """
+    cinfo = roster.getContactInfo(cjid)
+    if not cinfo:
+        roster.updateContact(cjid)
+        cinfo = roster.getContactInfo(cjid)
+    new = Subscription.transitions[(direction, type)].get(cinfo.subscription)
+    if new is not None:
+        roster.setSubscription(cinfo.id, new)
+
+def oldHandshake(a, b):
+    """Subscribes a to b with separate lookups and updates"""
+    ra, rb = Roster(a), Roster(b)
+    change(ra, b, 'out', 'subscribe')
+    change(rb, a, 'in', 'subscribe')
+    change(rb, a, 'out', 'subscribed')
+    change(ra, b, 'in', 'subscribed')
+
+def run(func, pairs, offset):
+    getRosterCache().clear()
+    start = time.time()
+    for i in range(pairs):
+        func('user%d@localhost' % (offset + 2 * i),
+             'user%d@localhost' % (offset + 2 * i + 1))
+    elapsed = time.time() - start
+    print '%-16s %6d handshakes in %.2f s: %.1f handshakes/s' % \
+            (func.__name__, pairs, elapsed, pairs / elapsed)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        pairs = int(sys.argv[1])
+    else:
+        pairs = 500
+    if len(sys.argv) > 2 and sys.argv[2] == 'writebehind':
+        pjs.conf.conf.storageWriteBehind = True
+    elif len(sys.argv) > 2:
+        pjs.conf.conf.storageBackend = sys.argv[2]
+    pjs.conf.conf.storageSnapshotFile = ''
+
+    fd, name = tempfile.mkstemp('.db')
+    os.close(fd)
+    os.remove(name)
+    try:
+        pjs.db.DB(name).close()
+        populateDB()
+        createUsers(4 * pairs)
+
+        run(oldHandshake, pairs, 0)
+        run(handshake, pairs, 2 * pairs)
+
+        storage = getStorage()
+        if hasattr(storage, 'flush'):
+            start = time.time()
+            storage.flush()
+            print 'flushed in %.2f s' % (time.time() - start)
+            stats = storage.getStats()
+            print '%(written)d records in %(batches)d batches, ' \
+                  'avg batch %(avgBatch).1f, avg lag %(avgLag).3f s, ' \
+                  'max lag %(maxLag).3f s' % stats
+        storage.close()
+    finally:
+        pjs.db.closePool(name)
+        os.remove(name)